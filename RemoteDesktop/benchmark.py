@@ -0,0 +1,361 @@
+"""
+远程桌面 - 端到端基准测试
+在固定的负载集合上运行完整链路（捕获源 → 服务器XOR编码 → Protocol打包 → 本机回环TCP → 客户端/Web解码），
+不启动GUI。每个负载在独立子进程中运行（CPU与峰值内存互不干扰），结果输出为JSON，可与保存的基线比较。
+
+用法:
+    python benchmark.py                                  # 运行全部负载
+    python benchmark.py typing video --duration 5        # 只运行指定负载
+    python benchmark.py --recording desktop.rdrec        # 追加录制文件负载（原速回放）
+    python benchmark.py --output result.json             # 结果写入文件
+    python benchmark.py --baseline baseline.json         # 与基线比较，有退化时退出码为1
+"""
+
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from metrics import REGISTRY, Histogram
+from protocol import PF_BGRA, PF_RGB565, PF_YUV420
+
+# 默认每个负载的测量时长与预热时长（秒，预热期间的首帧等不计入结果）
+DEFAULT_DURATION = 10.0
+WARMUP = 2.0
+# 默认捕获帧率（服务器捕获线程约60fps封顶）
+DEFAULT_FPS = 60.0
+# 与基线比较时允许的相对退化
+DEFAULT_TOLERANCE = 0.10
+
+
+class Workload(NamedTuple):
+    source: str              # SYNTHETIC_SOURCES中的场景名或 'replay'
+    width: int = 1920
+    height: int = 1080
+    clients: int = 1         # TCP客户端数
+    web: bool = False        # 是否同时运行一个Web观看端（含JPEG编码）
+    options: Dict = {}       # 传给捕获源的额外参数（replay时为 {'path': 录制文件}）
+    block_diff: bool = False  # 忽略捕获源的脏矩形，逐帧分块比较（BlockDiffSource）
+    output_width: int = 0    # 客户端请求的输出宽度（服务器端缩放），0表示原始分辨率
+    pixel_format: int = PF_BGRA  # 客户端请求的传输像素格式
+    lossy_quality: int = 0   # 服务器高运动区域的有损编码质量（JPEG），0表示不启用
+
+
+# 负载集合（未注明分辨率的均为1080p）
+WORKLOADS = {
+    'idle': Workload('idle'),
+    'typing': Workload('typing'),
+    'scrolling': Workload('scrolling'),
+    'drag': Workload('drag'),
+    'drag-diff': Workload('drag', block_diff=True),
+    'video': Workload('video', options={'full_screen': True}),
+    'video-lossy': Workload('video', options={'full_screen': True}, lossy_quality=70),
+    '4k': Workload('scrolling', 3840, 2160),
+    '4k-scaled': Workload('scrolling', 3840, 2160, output_width=1280),
+    'scrolling-rgb565': Workload('scrolling', pixel_format=PF_RGB565),
+    'scrolling-yuv420': Workload('scrolling', pixel_format=PF_YUV420),
+    'multi': Workload('typing', clients=4, web=True),
+}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """本进程峰值常驻内存（MB），无法获取时返回None"""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024 / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _snapshot() -> Dict:
+    """注册表中所有指标的当前值：(指标名, 标签) -> 数值 或 (桶计数, 总和)"""
+    values = {}
+    for family in list(REGISTRY.families.values()):
+        with family.lock:
+            children = list(family.children.items())
+        for key, child in children:
+            labels = dict(zip(family.labelnames, key))
+            if family.type == 'histogram':
+                with child.lock:
+                    values[(family.name, key)] = (labels, (list(child.counts), child.sum))
+            else:
+                values[(family.name, key)] = (labels, child.value)
+    return values
+
+
+def _delta(after: Dict, before: Dict, name: str, **match) -> List:
+    """两次快照之间指定指标（标签匹配match）的增量"""
+    result = []
+    for (family, key), (labels, value) in after.items():
+        if family != name or any(labels.get(k) != v for k, v in match.items()):
+            continue
+        old = before.get((family, key), (labels, None))[1]
+        if isinstance(value, tuple):
+            histogram = Histogram()
+            counts, total = value
+            if old is not None:
+                counts = [a - b for a, b in zip(counts, old[0])]
+                total -= old[1]
+            histogram.counts = counts
+            histogram.sum = total
+            histogram.count = sum(counts)
+            result.append((labels, histogram))
+        else:
+            result.append((labels, value - (old or 0)))
+    return result
+
+
+def _merge(histograms: List[Histogram]) -> Histogram:
+    merged = Histogram()
+    for h in histograms:
+        merged.counts = [a + b for a, b in zip(merged.counts, h.counts)]
+        merged.sum += h.sum
+        merged.count += h.count
+    return merged
+
+
+def _stage_summary(histogram: Histogram) -> Dict:
+    if histogram.count == 0:
+        return {'count': 0}
+    return {
+        'count': histogram.count,
+        'p50_ms': round(histogram.percentile(0.5) * 1000, 3),
+        'p99_ms': round(histogram.percentile(0.99) * 1000, 3),
+        'mean_ms': round(histogram.sum / histogram.count * 1000, 3),
+    }
+
+
+def _stages(after: Dict, before: Dict) -> Dict:
+    """各阶段耗时：服务器（capture/xor/compress/send）、观看端（receive/decompress/apply/display）、延迟"""
+    groups: Dict[str, List[Histogram]] = {}
+    for _, h in _delta(after, before, 'rd_capture_seconds'):
+        groups.setdefault('capture', []).append(h)
+    for labels, h in _delta(after, before, 'rd_server_stage_seconds'):
+        groups.setdefault(labels['stage'], []).append(h)
+    for labels, h in _delta(after, before, 'rd_viewer_stage_seconds'):
+        groups.setdefault(labels['stage'], []).append(h)
+    for labels, h in _delta(after, before, 'rd_latency_seconds'):
+        groups.setdefault('latency_' + labels['stage'], []).append(h)
+    stages = {name: _stage_summary(_merge(hs)) for name, hs in groups.items()}
+    return {name: summary for name, summary in stages.items() if summary['count']}
+
+
+def run_workload(name: str, workload: Workload, duration: float = DEFAULT_DURATION,
+                 fps: Optional[float] = DEFAULT_FPS, warmup: float = WARMUP) -> Dict:
+    """在本进程中运行一个负载并返回结果（由子进程调用，运行后进程中会残留服务器线程）"""
+    from capture import SYNTHETIC_SOURCES, BlockDiffSource
+    from client import RemoteDesktopClient
+    from lossy import LossyEncoder
+    from protocol import View
+    from server import RemoteDesktopServer
+
+    if workload.source == 'replay':
+        from recording import RecordingReader
+        source = RecordingReader(workload.options['path']).source(speed=1.0)
+    else:
+        source = SYNTHETIC_SOURCES[workload.source](workload.width, workload.height, fps=fps,
+                                                    **workload.options)
+    if workload.block_diff:
+        source = BlockDiffSource(source)
+
+    port = _free_port()
+    lossy = LossyEncoder(quality=workload.lossy_quality) if workload.lossy_quality else None
+    server = RemoteDesktopServer(host='127.0.0.1', port=port, metrics_port=0, capture_source=source, lossy=lossy)
+    threading.Thread(target=server.start, name="server", daemon=True).start()
+    while not server.running:
+        time.sleep(0.05)
+
+    viewers = []
+    for i in range(workload.clients):
+        client = RemoteDesktopClient('127.0.0.1', port, viewer=f'client{i}', headless=True,
+                                     view=View(width=workload.output_width, pixel_format=workload.pixel_format)
+                                     if workload.output_width or workload.pixel_format != PF_BGRA else None)
+        for _ in range(50):
+            if client.connect():
+                break
+            time.sleep(0.1)
+        else:
+            raise RuntimeError(f"客户端{i}无法连接")
+        threading.Thread(target=client.connection_loop, name=f"receive {i}", daemon=True).start()
+        viewers.append(client)
+
+    if workload.web:
+        import web_server
+        if not web_server.connect_to_server('127.0.0.1', port):
+            raise RuntimeError("Web观看端无法连接")
+        web_server.running = True
+        threading.Thread(target=web_server.receive_loop, name="receive web", daemon=True).start()
+
+    time.sleep(warmup)
+    before = _snapshot()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    time.sleep(duration)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    after = _snapshot()
+
+    frames = {labels['viewer']: value for labels, value in _delta(after, before, 'rd_viewer_frames_total')}
+    received = {labels['viewer']: value for labels, value in _delta(after, before, 'rd_viewer_received_bytes_total')}
+    captures = sum(value for labels, value in _delta(after, before, 'rd_captures_total')
+                   if labels['result'] in ('dirty', 'idle'))
+    dirty = sum(value for _, value in _delta(after, before, 'rd_captures_total', result='dirty'))
+    viewer_fps = [frames.get(viewer, 0) / elapsed for viewer in received]
+    total_frames = sum(frames.values())
+    total_bytes = sum(received.values())
+
+    return {
+        'workload': name,
+        'source': workload.source,
+        'size': f"{source.width}x{source.height}",
+        'viewers': len(received),
+        'duration': round(elapsed, 2),
+        'capture_fps': round(captures / elapsed, 2),
+        'dirty_fps': round(dirty / elapsed, 2),
+        'fps': round(sum(viewer_fps) / len(viewer_fps), 2) if viewer_fps else 0.0,
+        'fps_min': round(min(viewer_fps), 2) if viewer_fps else 0.0,
+        'bytes_per_frame': round(total_bytes / total_frames) if total_frames else 0,
+        'bandwidth_mbps': round(total_bytes / elapsed / 1024 / 1024, 3),
+        'cpu_percent': round(cpu / elapsed * 100, 1),
+        'peak_rss_mb': _round(_peak_rss_mb()),
+        'stages': _stages(after, before),
+    }
+
+
+def _round(value, digits=1):
+    return round(value, digits) if value is not None else None
+
+
+def run_isolated(name: str, workload: Workload, duration: float, fps: Optional[float]) -> Dict:
+    """在子进程中运行一个负载（子进程的输出丢弃，结果通过标准输出的最后一行JSON返回）"""
+    spec = json.dumps({'name': name, 'workload': workload._asdict(), 'duration': duration, 'fps': fps})
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', spec],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                          encoding='utf-8', errors='replace')
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        return {'workload': name, 'error': (proc.stderr.strip().splitlines() or ['子进程无输出'])[-1]}
+    return json.loads(lines[-1])
+
+
+# 与基线比较的指标：名称 -> 越大越好为True
+COMPARED = {
+    'fps': True,
+    'bytes_per_frame': False,
+    'cpu_percent': False,
+    'peak_rss_mb': False,
+}
+COMPARED_STAGES = ('capture', 'xor', 'compress', 'send', 'decompress', 'apply', 'display',
+                   'latency_capture_to_receive')
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """与基线比较，打印变化并返回退化项"""
+    regressions = []
+
+    def check(workload, metric, new, old, higher_is_better):
+        if new is None or not old:
+            return
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        mark = '✗' if worse > tolerance else ('✓' if worse < -tolerance else ' ')
+        print(f"[基准] {mark} {workload:<12} {metric:<32} {old:>10.3f} → {new:>10.3f} ({change:+.1%})")
+        if worse > tolerance:
+            regressions.append(f"{workload} {metric}")
+
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old or 'error' in result or 'error' in old:
+            continue
+        for metric, higher_is_better in COMPARED.items():
+            check(name, metric, result.get(metric), old.get(metric), higher_is_better)
+        for stage in COMPARED_STAGES:
+            new_stage, old_stage = result['stages'].get(stage), old['stages'].get(stage)
+            if new_stage and old_stage:
+                check(name, f"{stage} p99_ms", new_stage['p99_ms'], old_stage['p99_ms'], False)
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="远程桌面端到端基准测试")
+    parser.add_argument('workloads', nargs='*', help=f"要运行的负载（默认全部）: {', '.join(WORKLOADS)}")
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help="每个负载的测量时长（秒）")
+    parser.add_argument('--fps', type=float, default=DEFAULT_FPS, help="合成场景的帧率")
+    parser.add_argument('--recording', action='append', default=[], metavar='FILE',
+                        help="追加录制文件负载（可多次指定）")
+    parser.add_argument('--output', metavar='FILE', help="结果写入JSON文件")
+    parser.add_argument('--baseline', metavar='FILE', help="与基线JSON比较")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="允许的相对退化（默认0.1）")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        spec = json.loads(args.child)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w', encoding='utf-8')  # 屏蔽服务器与客户端的打印
+        result = run_workload(spec['name'], Workload(**spec['workload']), spec['duration'], spec['fps'])
+        stdout.write(json.dumps(result, ensure_ascii=False) + "\n")
+        stdout.flush()
+        os._exit(0)  # 不等待服务器线程
+
+    workloads = {name: WORKLOADS[name] for name in (args.workloads or WORKLOADS)}
+    for path in args.recording:
+        workloads['replay:' + os.path.basename(path)] = Workload('replay', options={'path': os.path.abspath(path)})
+
+    results = {}
+    for name, workload in workloads.items():
+        print(f"[基准] 运行 {name} ...", file=sys.stderr, flush=True)
+        result = run_isolated(name, workload, args.duration, args.fps)
+        results[name] = result
+        if 'error' in result:
+            print(f"[基准] {name} 失败: {result['error']}", file=sys.stderr)
+        else:
+            print(f"[基准] {name}: {result['fps']}fps | {result['bytes_per_frame']}B/帧 | "
+                  f"CPU {result['cpu_percent']}% | 峰值内存 {result['peak_rss_mb']}MB", file=sys.stderr)
+
+    report = {
+        'version': 1,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'duration': args.duration,
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"[基准] {len(regressions)} 项退化超过 {args.tolerance:.0%}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+远程桌面 - 分块比较生成脏矩形
+老版DXGI整帧接口（dxgi_get_frame）和非DXGI的捕获源只能给出完整画面，没有脏矩形信息。
+BlockDiff把新帧与上一帧按 tile_size×tile_size 的块比较，得到脏块掩码并合并为矩形，
+使这些捕获源也能走脏矩形增量协议。
+
+比较方式：每两个像素视为一个uint64逐个比较（结果写入复用的bool数组），
+8个比较结果（16个像素）再视为一个uint64，沿块内的行做按位或归约，最后在每块的t/16个单元上取any；
+1080p每帧不到1ms，主要耗时是读取两帧的内存带宽。
+
+用法:
+    python blockdiff.py                 # 测量1080p/4K在不同变化量下的耗时
+"""
+
+from typing import Dict, List
+
+import numpy as np
+
+# 块边长（像素，须为16的倍数）
+TILE_SIZE = 16
+# 合并后矩形数超过此值时把掩码按2×2合并（块边长加倍）后重新合并
+MAX_RECTS = 64
+
+
+def _pixel_view(frame: np.ndarray) -> np.ndarray:
+    """BGRA帧（H×W×4，C连续）视为 H×W 的uint32数组（不复制）"""
+    if frame.ndim != 3 or frame.shape[2] * frame.itemsize != 4 or not frame.flags.c_contiguous:
+        raise ValueError(f"不支持的帧布局: shape={frame.shape} dtype={frame.dtype}")
+    return frame.view(np.uint32).reshape(frame.shape[0], frame.shape[1])
+
+
+def mask_rects(mask: np.ndarray, tile_size: int, width: int, height: int) -> List[Dict]:
+    """脏块掩码 → 矩形：每行连续的脏块合并为一段，上下相邻且左右边界相同的段再合并为一个矩形"""
+    rows, cols = mask.shape
+    padded = np.zeros((rows, cols + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    run_rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)  # 与starts按行优先一一对应
+
+    merged = []
+    active = {}  # (起始列, 结束列) -> 最近一个该列范围的矩形 [c0, r0, c1, r1]
+    for row, c0, c1 in zip(run_rows.tolist(), starts.tolist(), ends.tolist()):
+        rect = active.get((c0, c1))
+        if rect is not None and rect[3] == row:
+            rect[3] = row + 1
+        else:
+            rect = [c0, row, c1, row + 1]
+            merged.append(rect)
+            active[(c0, c1)] = rect
+
+    t = tile_size
+    return [{'left': c0 * t, 'top': r0 * t, 'right': min(c1 * t, width), 'bottom': min(r1 * t, height)}
+            for c0, r0, c1, r1 in merged]
+
+
+class BlockDiff:
+    """相邻两帧的分块比较
+
+    compare()返回合并后的脏矩形（最多max_rects个，超出时以更大的块重新合并），
+    dirty_tiles()返回脏块掩码（rows×cols，含右侧/底部不足一块的边缘块）。
+    """
+
+    def __init__(self, width: int, height: int, tile_size: int = TILE_SIZE, max_rects: int = MAX_RECTS):
+        if tile_size <= 0 or tile_size % 16:
+            raise ValueError(f"块边长须为16的倍数: {tile_size}")
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.max_rects = max_rects
+        # 完整块的行列数，以及含边缘块的掩码
+        self.full_rows, self.full_cols = height // tile_size, width // tile_size
+        self.rows = (height + tile_size - 1) // tile_size
+        self.cols = (width + tile_size - 1) // tile_size
+        self.mask = np.zeros((self.rows, self.cols), dtype=bool)
+        # 完整块区域每两个像素的比较结果（复用）
+        self._diff = np.empty((self.full_rows * tile_size, self.full_cols * tile_size // 2), dtype=bool)
+
+    def dirty_tiles(self, current: np.ndarray, previous: np.ndarray) -> np.ndarray:
+        """脏块掩码（返回内部数组，下次调用前有效）"""
+        cur, prev = _pixel_view(current), _pixel_view(previous)
+        if cur.shape != (self.height, self.width) or prev.shape != cur.shape:
+            raise ValueError(f"帧尺寸不符: {cur.shape} / {prev.shape}，应为 {(self.height, self.width)}")
+        t = self.tile_size
+        rows, cols = self.full_rows, self.full_cols
+        h, w = rows * t, cols * t
+        mask = self.mask
+
+        if h and w:
+            np.not_equal(cur[:h, :w].view(np.uint64), prev[:h, :w].view(np.uint64), out=self._diff)
+            # 8个比较结果（16个像素）视为一个uint64，块内每行为t/16个；先沿块内的行按位或，再在每块的单元上取any
+            units = self._diff.view(np.uint64).reshape(rows, t, cols * t // 16)
+            mask[:rows, :cols] = np.bitwise_or.reduce(units, axis=1).reshape(rows, cols, t // 16).any(axis=2)
+        if w < self.width and h:
+            # 右侧不足一块宽的列
+            mask[:rows, cols] = (cur[:h, w:] != prev[:h, w:]).reshape(rows, t, -1).any(axis=(1, 2))
+        if h < self.height:
+            # 底部不足一块高的行
+            tail = cur[h:] != prev[h:]
+            if w:
+                mask[rows, :cols] = tail[:, :w].reshape(-1, cols, t).any(axis=(0, 2))
+            if w < self.width:
+                mask[rows, cols] = tail[:, w:].any()
+        return mask
+
+    def compare(self, current: np.ndarray, previous: np.ndarray) -> List[Dict]:
+        """比较两帧，返回合并后的脏矩形（无变化时为空列表）"""
+        mask = self.dirty_tiles(current, previous)
+        if not mask.any():
+            return []
+        tile_size = self.tile_size
+        while True:
+            rects = mask_rects(mask, tile_size, self.width, self.height)
+            if len(rects) <= self.max_rects or mask.size == 1:
+                return rects
+            # 矩形过多（零散的小变化）：2×2块合并为一块后重新合并，以少量多余像素换取更少的矩形
+            rows, cols = (mask.shape[0] + 1) // 2, (mask.shape[1] + 1) // 2
+            padded = np.zeros((rows * 2, cols * 2), dtype=bool)
+            padded[:mask.shape[0], :mask.shape[1]] = mask
+            mask = padded.reshape(rows, 2, cols, 2).any(axis=(1, 3))
+            tile_size *= 2
+
+
+def _bench():
+    import time
+
+    rng = np.random.default_rng(0)
+    print(f"{'分辨率':>10} {'变化':>8} {'矩形':>5} {'耗时ms':>8}")
+    for width, height in ((1920, 1080), (3840, 2160)):
+        previous = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+        diff = BlockDiff(width, height)
+        cases = {
+            'none': [],
+            'caret': [(100, 100, 2, 16)],
+            'typing': [(300 + i * 8, 400, 8, 16) for i in range(4)],
+            'scattered': [(int(x), int(y), 8, 8) for x, y in zip(rng.integers(0, width - 8, 200),
+                                                                  rng.integers(0, height - 8, 200))],
+            'full': [(0, 0, width, height)],
+        }
+        for name, changes in cases.items():
+            current = previous.copy()
+            for left, top, w, h in changes:
+                current[top:top + h, left:left + w] ^= 0xFF
+            rects = diff.compare(current, previous)
+            count = 20
+            start = time.perf_counter()
+            for _ in range(count):
+                diff.compare(current, previous)
+            elapsed = (time.perf_counter() - start) / count
+            print(f"{f'{width}x{height}':>10} {name:>8} {len(rects):>5} {elapsed * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    _bench()
@@ -0,0 +1,135 @@
+"""
+远程桌面 - 可复用缓冲区
+热路径（捕获 → XOR编码 → 压缩 → 发送，接收 → 解压 → 应用 → 显示）每帧都需要与脏区域或整帧相当的临时数组，
+每次新建会带来大块内存分配、缺页和GC压力。
+
+ScratchBuffer: 单个线程独占的暂存区，按需增长，get(n)返回前n字节的视图（下次get之前有效）。
+FramePool:     固定形状的预分配帧，在线程间传递（如显示队列），用完后归还复用。
+PacketRing:    固定容量的环形包存储（如会话的历史包），新包覆盖最旧的包，不为每个包分配内存。
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+import numpy as np
+
+# 暂存区增长时的倍数（避免逐帧小幅增长导致反复分配）
+GROWTH = 1.5
+
+
+class ScratchBuffer:
+    """按需增长的字节暂存区（非线程安全）"""
+
+    def __init__(self, nbytes: int = 0):
+        self._buffer = np.empty(nbytes, dtype=np.uint8)
+        self.allocations = 0  # 分配（含增长）次数
+
+    @property
+    def capacity(self) -> int:
+        return self._buffer.size
+
+    def get(self, nbytes: int) -> np.ndarray:
+        """返回至少nbytes字节的暂存区中前nbytes字节的一维uint8视图"""
+        if nbytes > self._buffer.size:
+            self._buffer = np.empty(max(nbytes, int(self._buffer.size * GROWTH)), dtype=np.uint8)
+            self.allocations += 1
+        return self._buffer[:nbytes]
+
+
+class FramePool:
+    """同形状帧的池，acquire取出、release归还（线程安全）
+
+    帧在首次需要时分配，最多count个；全部被占用时acquire返回None，由调用方决定丢弃旧帧或跳过。
+    """
+
+    def __init__(self, shape: Tuple[int, ...], count: int, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self._frames: List[np.ndarray] = []
+        self._free: List[np.ndarray] = []
+        self._lock = threading.Lock()
+
+    @property
+    def free(self) -> int:
+        """可取出的帧数（含尚未分配的）"""
+        with self._lock:
+            return len(self._free) + self.count - len(self._frames)
+
+    def acquire(self) -> Optional[np.ndarray]:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            if len(self._frames) < self.count:
+                frame = np.empty(self.shape, dtype=self.dtype)
+                self._frames.append(frame)
+                return frame
+            return None
+
+    def release(self, frame: Optional[np.ndarray]) -> None:
+        """归还帧（None或不属于本池的数组被忽略）"""
+        if frame is None:
+            return
+        with self._lock:
+            if any(frame is f for f in self._frames) and not any(frame is f for f in self._free):
+                self._free.append(frame)
+
+
+class PacketRing:
+    """按插入顺序保存数据包的环形存储（非线程安全）
+
+    容量在首次写入时一次分配；空间不足时淘汰最旧的包。put返回包在环中的memoryview，
+    在该包被淘汰前有效。大于容量的包不保存，并清空全部（与淘汰到只剩它自己的效果相同）。
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._buffer: Optional[np.ndarray] = None
+        self._entries: 'OrderedDict[Hashable, Tuple[int, int]]' = OrderedDict()  # key -> (偏移, 长度)
+        self._head = 0  # 下一个包的写入位置
+        self.nbytes = 0  # 保存的包的总字节数
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def __getitem__(self, key) -> memoryview:
+        offset, size = self._entries[key]
+        return memoryview(self._buffer)[offset:offset + size]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict(self) -> None:
+        _, (_, size) = self._entries.popitem(last=False)
+        self.nbytes -= size
+
+    def put(self, key, packet) -> Optional[memoryview]:
+        """保存一个包（复制到环中），返回其视图；包大于容量时返回None"""
+        size = memoryview(packet).nbytes
+        if size > self.capacity:
+            self.clear()
+            return None
+        if self._buffer is None:
+            self._buffer = np.empty(self.capacity, dtype=np.uint8)
+        position = self._head
+        if position + size > self.capacity:
+            # 绕回开头：写入位置之后的包是最旧的，连同尾部的空隙一起淘汰
+            while self._entries and next(iter(self._entries.values()))[0] >= position:
+                self._evict()
+            position = 0
+        # 淘汰与新包重叠的最旧的包
+        while self._entries and position <= next(iter(self._entries.values()))[0] < position + size:
+            self._evict()
+        view = memoryview(self._buffer)[position:position + size]
+        view[:] = memoryview(packet).cast('B')
+        self._entries[key] = (position, size)
+        self._head = position + size
+        self.nbytes += size
+        return view
+
+    def clear(self) -> None:
+        """清空（保留已分配的空间）"""
+        self._entries.clear()
+        self._head = 0
+        self.nbytes = 0
@@ -0,0 +1,631 @@
+"""
+远程桌面 - 屏幕捕获源
+CaptureSource统一了DXGI的 获取帧 → 脏矩形 → 复制脏区域 → 释放 流程；
+除DxgiCapture外提供合成场景（空闲、打字、滚动、视频）和回放源，
+使编码与传输链路可以在没有DXGI的机器（如Linux）上无界面运行和压测。
+只能给出完整画面的捕获源由BlockDiffSource逐帧分块比较生成脏矩形。
+"""
+
+import ctypes
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import regions
+from blockdiff import BlockDiff, TILE_SIZE
+from buffers import ScratchBuffer
+
+# 定义FrameStatus枚举
+FS_OK = 0
+FS_TIMEOUT = 1
+FS_ERROR = 2
+
+
+# 定义DirtyRect结构体
+class DirtyRect(ctypes.Structure):
+    _fields_ = [
+        ("left", ctypes.c_int),
+        ("top", ctypes.c_int),
+        ("right", ctypes.c_int),
+        ("bottom", ctypes.c_int)
+    ]
+
+
+class CaptureSource:
+    """屏幕捕获源接口（BGRA）
+
+    与DXGI相同的调用顺序:
+        status = source.acquire(timeout_ms)      # FS_OK / FS_TIMEOUT / FS_ERROR
+        if status == FS_OK:
+            try:
+                rects = source.dirty_rects()     # 本帧脏矩形，空列表表示无变化
+                data = source.copy_dirty_regions()
+            finally:
+                source.release()
+    """
+
+    width = 0
+    height = 0
+
+    @property
+    def size(self) -> int:
+        """完整帧字节数"""
+        return self.width * self.height * 4
+
+    def acquire(self, timeout_ms: int = 100) -> int:
+        """等待下一帧"""
+        raise NotImplementedError
+
+    def dirty_rects(self) -> List[Dict]:
+        """已获取帧的脏矩形"""
+        raise NotImplementedError
+
+    def copy_dirty_regions(self) -> Optional[np.ndarray]:
+        """已获取帧的脏区域像素（按dirty_rects顺序拼接），失败时返回None
+
+        返回的数组可能是捕获源内部缓冲区的视图，只保证在release()之前有效。
+        """
+        raise NotImplementedError
+
+    def copy_frame(self) -> Optional[np.ndarray]:
+        """已获取帧的完整画面（H×W×4），失败时返回None"""
+        raise NotImplementedError
+
+    def release(self) -> None:
+        """释放已获取的帧"""
+
+    def capture(self, timeout_ms: int = 100) -> Tuple[int, Optional[np.ndarray]]:
+        """捕获完整帧（BGRA格式）"""
+        status = self.acquire(timeout_ms)
+        if status != FS_OK:
+            return status, None
+        try:
+            frame = self.copy_frame()
+        finally:
+            self.release()
+        return (FS_OK, frame) if frame is not None else (FS_ERROR, None)
+
+    def close(self) -> None:
+        """释放资源"""
+
+
+class DxgiCapture(CaptureSource):
+    def __init__(self, dll_path="../DxgiGrab3.dll"):
+        """初始化DXGI捕获"""
+        # 加载DLL
+        dll_file = Path(dll_path)
+
+        if not dll_file.exists():
+            for possible_path in [
+                "DxgiGrab3.dll",
+                "../DxgiGrab3.dll",
+                "../../DxgiGrab3.dll",
+                r"C:\Users\Administrator\Desktop\DXGI-ScreenCapture-DLL\DxgiGrab3.dll"
+            ]:
+                dll_file = Path(possible_path)
+                if dll_file.exists():
+                    break
+            else:
+                raise FileNotFoundError(f"找不到DLL文件")
+
+        self.dll = ctypes.CDLL(str(dll_file.absolute()))
+
+        # 定义函数原型
+        self.dll.dxgi_create.restype = ctypes.c_void_p
+        self.dll.dxgi_create.argtypes = []
+
+        self.dll.dxgi_destroy.restype = None
+        self.dll.dxgi_destroy.argtypes = [ctypes.c_void_p]
+
+        self.dll.dxgi_get_width.restype = ctypes.c_int
+        self.dll.dxgi_get_width.argtypes = [ctypes.c_void_p]
+
+        self.dll.dxgi_get_height.restype = ctypes.c_int
+        self.dll.dxgi_get_height.argtypes = [ctypes.c_void_p]
+
+        self.dll.dxgi_get_size.restype = ctypes.c_int
+        self.dll.dxgi_get_size.argtypes = [ctypes.c_void_p]
+
+        self.dll.dxgi_get_frame.restype = ctypes.c_int
+        self.dll.dxgi_get_frame.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_int]
+
+        self.dll.dxgi_acquire_frame.restype = ctypes.c_int
+        self.dll.dxgi_acquire_frame.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+        self.dll.dxgi_release_frame.restype = None
+        self.dll.dxgi_release_frame.argtypes = [ctypes.c_void_p]
+
+        self.dll.dxgi_get_dirty_rects_count.restype = ctypes.c_int
+        self.dll.dxgi_get_dirty_rects_count.argtypes = [ctypes.c_void_p]
+
+        self.dll.dxgi_get_dirty_rects.restype = ctypes.c_int
+        self.dll.dxgi_get_dirty_rects.argtypes = [ctypes.c_void_p, ctypes.POINTER(DirtyRect), ctypes.c_int]
+
+        self.dll.dxgi_copy_acquired_frame.restype = ctypes.c_int
+        self.dll.dxgi_copy_acquired_frame.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char)]
+
+        self.dll.dxgi_get_dirty_region_size.restype = ctypes.c_int
+        self.dll.dxgi_get_dirty_region_size.argtypes = [ctypes.c_void_p]
+
+        self.dll.dxgi_copy_dirty_regions.restype = ctypes.c_int
+        self.dll.dxgi_copy_dirty_regions.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_int]
+
+        # 创建DXGI实例
+        self.dxgi = self.dll.dxgi_create()
+        if not self.dxgi:
+            raise RuntimeError("创建DXGI实例失败")
+
+        # 获取屏幕信息
+        self.width = self.dll.dxgi_get_width(self.dxgi)
+        self.height = self.dll.dxgi_get_height(self.dxgi)
+        self.frame_size = self.dll.dxgi_get_size(self.dxgi)
+
+        # 创建缓冲区
+        self.buffer = (ctypes.c_char * self.frame_size)()
+        self.dirty_buffer = (ctypes.c_char * self.frame_size)()  # 脏区域缓冲
+
+        print(f"[服务器] 屏幕尺寸: {self.width}x{self.height}, 帧大小: {self.frame_size/1024/1024:.2f} MB")
+
+    @property
+    def size(self):
+        return self.frame_size
+
+    def acquire(self, timeout_ms=100):
+        return self.dll.dxgi_acquire_frame(self.dxgi, timeout_ms)
+
+    def dirty_rects(self):
+        dirty_count = self.dll.dxgi_get_dirty_rects_count(self.dxgi)
+        if dirty_count == 0:
+            return []
+
+        rects_array = (DirtyRect * dirty_count)()
+        self.dll.dxgi_get_dirty_rects(self.dxgi, rects_array, dirty_count)
+        return [{'left': r.left, 'top': r.top, 'right': r.right, 'bottom': r.bottom} for r in rects_array]
+
+    def copy_dirty_regions(self):
+        dirty_size = self.dll.dxgi_get_dirty_region_size(self.dxgi)
+        if dirty_size <= 0:
+            return None
+
+        if self.dll.dxgi_copy_dirty_regions(self.dxgi, self.dirty_buffer, dirty_size) != FS_OK:
+            return None
+        return np.frombuffer(self.dirty_buffer, dtype=np.uint8, count=dirty_size)
+
+    def copy_frame(self):
+        if self.dll.dxgi_copy_acquired_frame(self.dxgi, self.buffer) != FS_OK:
+            return None
+        return np.frombuffer(self.buffer, dtype=np.uint8).copy().reshape(self.height, self.width, 4)
+
+    def release(self):
+        self.dll.dxgi_release_frame(self.dxgi)
+
+    def capture(self, timeout_ms=100):
+        """捕获完整帧（BGRA格式）"""
+        status = self.dll.dxgi_get_frame(self.dxgi, self.buffer, timeout_ms)
+
+        if status == FS_OK:
+            frame = np.frombuffer(self.buffer, dtype=np.uint8).copy()
+            frame = frame.reshape(self.height, self.width, 4)  # 保持BGRA格式
+            return status, frame
+
+        return status, None
+
+    def capture_dirty_rects(self, timeout_ms=100):
+        """使用脏矩形捕获（只在有变化时获取完整帧，BGR格式）
+
+        Returns:
+            (status, frame, dirty_info)，dirty_info包含 count、rects、size、saved_percent；
+            无变化时frame为None
+        """
+        status = self.acquire(timeout_ms)
+
+        if status != FS_OK:
+            return status, None, None
+
+        try:
+            rects = self.dirty_rects()
+            dirty_info = {
+                'count': len(rects),
+                'rects': [dict(r, width=r['right'] - r['left'], height=r['bottom'] - r['top']) for r in rects],
+                'size': 0,
+                'saved_percent': 100.0  # 默认100%节省（无变化）
+            }
+
+            # 无变化
+            if not rects:
+                return FS_OK, None, dirty_info
+
+            dirty_size = self.dll.dxgi_get_dirty_region_size(self.dxgi)
+            dirty_info['size'] = dirty_size
+            dirty_info['saved_percent'] = (1.0 - dirty_size / self.size) * 100.0 if self.size > 0 else 0.0
+
+            # 获取完整帧
+            frame = self.copy_frame()
+            if frame is not None:
+                return FS_OK, frame[:, :, :3], dirty_info
+
+        finally:
+            self.release()
+
+        return FS_ERROR, None, None
+
+    def close(self):
+        if getattr(self, 'dxgi', None):
+            self.dll.dxgi_destroy(self.dxgi)
+            self.dxgi = None
+
+    def __del__(self):
+        """释放资源"""
+        self.close()
+
+
+class SyntheticSource(CaptureSource):
+    """合成画面源基类
+
+    按fps节奏产生帧（fps为None时每次acquire立即产生下一帧，用于压测），
+    子类在step()中修改self.frame并返回脏矩形；返回None表示画面无变化（acquire超时），
+    与DXGI在桌面静止时的行为一致。随机数由seed决定，同一参数的运行结果可重复。
+    """
+
+    def __init__(self, width: int = 1920, height: int = 1080, fps: Optional[float] = 30.0, seed: int = 0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.rng = np.random.default_rng(seed)
+        self.frame = self._desktop()
+        self.frame_count = 0
+        self.next_time = time.perf_counter()
+        self._rects: List[Dict] = []
+        self._scratch = ScratchBuffer()  # 脏区域像素（每帧复用）
+
+    def _desktop(self) -> np.ndarray:
+        """桌面背景 + 一个窗口（白色客户区、深色标题栏）"""
+        frame = np.empty((self.height, self.width, 4), dtype=np.uint8)
+        frame[:] = (96, 64, 32, 255)
+        self.window = {
+            'left': self.width // 8, 'top': self.height // 8,
+            'right': self.width * 7 // 8, 'bottom': self.height * 7 // 8
+        }
+        w = self.window
+        frame[w['top']:w['bottom'], w['left']:w['right']] = (255, 255, 255, 255)
+        frame[w['top']:w['top'] + 24, w['left']:w['right']] = (80, 48, 32, 255)
+        # 客户区（标题栏以下，留出边距）
+        self.area = {'left': w['left'] + 8, 'top': w['top'] + 32, 'right': w['right'] - 8, 'bottom': w['bottom'] - 8}
+        return frame
+
+    def _text(self, height: int, width: int, density: float = 0.25) -> np.ndarray:
+        """类似文字的块状图案（8×16字符格、行间距4像素）"""
+        block = np.full((height, width, 4), 255, dtype=np.uint8)
+        ink = self.rng.random((height, width)) < density
+        ink[(np.arange(height) % 20) >= 16] = False
+        block[ink, :3] = 32
+        return block
+
+    def step(self) -> Optional[List[Dict]]:
+        raise NotImplementedError
+
+    def acquire(self, timeout_ms=100):
+        if self.fps:
+            wait = self.next_time - time.perf_counter()
+            if wait > timeout_ms / 1000:
+                time.sleep(timeout_ms / 1000)
+                return FS_TIMEOUT
+            if wait > 0:
+                time.sleep(wait)
+            # 落后时不补帧
+            self.next_time = max(self.next_time + 1 / self.fps, time.perf_counter())
+
+        self.frame_count += 1
+        rects = self.step()
+        if rects is None:
+            self._rects = []
+            return FS_TIMEOUT
+        self._rects = rects
+        return FS_OK
+
+    def dirty_rects(self):
+        return list(self._rects)
+
+    def copy_dirty_regions(self):
+        region_plan = regions.plan(self._rects, self.width, self.height)
+        return region_plan.gather(self.frame, self._scratch.get(region_plan.nbytes()))
+
+    def copy_frame(self):
+        return self.frame.copy()
+
+    def release(self):
+        self._rects = []
+
+    def capture(self, timeout_ms=100):
+        return FS_OK, self.frame.copy()
+
+
+class IdleSource(SyntheticSource):
+    """空闲桌面：只有光标每500ms闪烁一次"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        a = self.area
+        self.caret = {'left': a['left'] + 4, 'top': a['top'] + 4, 'right': a['left'] + 6, 'bottom': a['top'] + 20}
+        self.caret_on = False
+        self.last_blink = 0.0
+
+    def step(self):
+        now = time.perf_counter() if self.fps else self.frame_count / 60
+        if now - self.last_blink < 0.5:
+            return None
+        self.last_blink = now
+        self.caret_on = not self.caret_on
+        c = self.caret
+        self.frame[c['top']:c['bottom'], c['left']:c['right'], :3] = 0 if self.caret_on else 255
+        return [dict(c)]
+
+
+class TypingSource(SyntheticSource):
+    """打字：每帧输入0~2个字符（8×16），光标随之移动，写满后清空客户区"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.x = self.area['left']
+        self.y = self.area['top']
+
+    def step(self):
+        a = self.area
+        count = int(self.rng.choice([0, 1, 1, 2]))
+        if count == 0:
+            return None
+
+        if self.y + 20 > a['bottom']:
+            # 翻页：清空客户区
+            self.frame[a['top']:a['bottom'], a['left']:a['right']] = 255
+            self.x, self.y = a['left'], a['top']
+            return [dict(a)]
+
+        left = self.x
+        width = min(count * 8, a['right'] - 2 - left)
+        self.frame[self.y:self.y + 16, left:left + width] = self._text(16, width, density=0.35)
+        self.x += width
+        # 光标
+        self.frame[self.y:self.y + 16, self.x:self.x + 2, :3] = 0
+        rect = {'left': left, 'top': self.y, 'right': self.x + 2, 'bottom': self.y + 16}
+
+        if self.x + 10 > a['right'] or self.rng.random() < 0.02:
+            # 换行（擦掉旧光标）
+            self.frame[self.y:self.y + 16, self.x:self.x + 2, :3] = 255
+            self.x = a['left']
+            self.y += 20
+        return [rect]
+
+
+class ScrollingSource(SyntheticSource):
+    """滚动：客户区内容每帧上移speed像素（整个客户区为脏矩形）"""
+
+    def __init__(self, *args, speed: int = 8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.speed = speed
+        a = self.area
+        height = a['bottom'] - a['top']
+        self.document = self._text(height * 4, a['right'] - a['left'])
+        self.offset = 0
+
+    def step(self):
+        a = self.area
+        height = a['bottom'] - a['top']
+        self.offset = (self.offset + self.speed) % (self.document.shape[0] - height)
+        self.frame[a['top']:a['bottom'], a['left']:a['right']] = self.document[self.offset:self.offset + height]
+        return [dict(a)]
+
+
+class DragSource(SyntheticSource):
+    """拖动窗口：窗口每帧移动(speed, speed/2)像素，碰到屏幕边缘反弹，脏矩形为新旧位置的外接矩形"""
+
+    BACKGROUND = (96, 64, 32, 255)
+
+    def __init__(self, *args, speed: int = 12, **kwargs):
+        super().__init__(*args, **kwargs)
+        w, a = self.window, self.area
+        self.frame[a['top']:a['bottom'], a['left']:a['right']] = self._text(a['bottom'] - a['top'], a['right'] - a['left'])
+        self.image = self.frame[w['top']:w['bottom'], w['left']:w['right']].copy()
+        self.x, self.y = w['left'], w['top']
+        self.dx, self.dy = speed, max(1, speed // 2)
+
+    def step(self):
+        height, width = self.image.shape[:2]
+        old_x, old_y = self.x, self.y
+        if not 0 <= self.x + self.dx <= self.width - width:
+            self.dx = -self.dx
+        if not 0 <= self.y + self.dy <= self.height - height:
+            self.dy = -self.dy
+        self.x += self.dx
+        self.y += self.dy
+
+        self.frame[old_y:old_y + height, old_x:old_x + width] = self.BACKGROUND
+        self.frame[self.y:self.y + height, self.x:self.x + width] = self.image
+        return [{'left': min(old_x, self.x), 'top': min(old_y, self.y),
+                 'right': max(old_x, self.x) + width, 'bottom': max(old_y, self.y) + height}]
+
+
+class VideoSource(SyntheticSource):
+    """视频播放：播放区域每帧整体变化（块状低频内容 + 细噪声，接近真实视频的可压缩性）
+
+    full_screen为True时播放区域为整个屏幕，否则为窗口客户区居中的16:9区域。
+    """
+
+    POOL_SIZE = 4
+
+    def __init__(self, *args, full_screen: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        if full_screen:
+            self.region = {'left': 0, 'top': 0, 'right': self.width, 'bottom': self.height}
+        else:
+            a = self.area
+            width = a['right'] - a['left']
+            height = min(a['bottom'] - a['top'], width * 9 // 16)
+            top = a['top'] + (a['bottom'] - a['top'] - height) // 2
+            self.region = {'left': a['left'], 'top': top, 'right': a['right'], 'bottom': top + height}
+
+        r = self.region
+        height, width = r['bottom'] - r['top'], r['right'] - r['left']
+        self.pool = []
+        for _ in range(self.POOL_SIZE):
+            coarse = self.rng.integers(0, 224, ((height + 15) // 16, (width + 15) // 16, 3), dtype=np.uint8)
+            picture = np.repeat(np.repeat(coarse, 16, axis=0), 16, axis=1)[:height, :width]
+            picture += self.rng.integers(0, 32, picture.shape, dtype=np.uint8)
+            self.pool.append(np.dstack([picture, np.full((height, width), 255, dtype=np.uint8)]))
+
+    def step(self):
+        r = self.region
+        self.frame[r['top']:r['bottom'], r['left']:r['right']] = self.pool[self.frame_count % self.POOL_SIZE]
+        return [dict(r)]
+
+
+class ReplaySource(CaptureSource):
+    """回放源：按原始时间间隔（除以speed）重放记录的帧，脏矩形与记录完全一致
+
+    frames为 (timestamp_us, rects, data) 的可迭代对象，data为按rects顺序拼接的BGRA像素；
+    initial为首帧完整画面。speed为None时不等待，尽快回放。回放结束后acquire始终返回FS_TIMEOUT。
+    """
+
+    def __init__(self, frames: Iterable[Tuple[int, List[Dict], object]], width: int, height: int,
+                 initial: Optional[np.ndarray] = None, speed: Optional[float] = 1.0):
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self.frames = iter(frames)
+        self.frame = initial.copy() if initial is not None else np.zeros((height, width, 4), dtype=np.uint8)
+        self.finished = False
+        self.timestamp = 0  # 当前帧的原始时间戳（微秒）
+        self._pending = None
+        self._rects: List[Dict] = []
+        self._data = None
+        self._origin = None  # (首帧原始时间戳, 开始回放的时刻)
+
+    def acquire(self, timeout_ms=100):
+        if self._pending is None:
+            self._pending = next(self.frames, None)
+            if self._pending is None:
+                self.finished = True
+                time.sleep(timeout_ms / 1000)
+                return FS_TIMEOUT
+
+        timestamp, rects, data = self._pending
+        if self.speed:
+            if self._origin is None:
+                self._origin = (timestamp, time.perf_counter())
+            due = self._origin[1] + (timestamp - self._origin[0]) / 1e6 / self.speed
+            wait = due - time.perf_counter()
+            if wait > timeout_ms / 1000:
+                time.sleep(timeout_ms / 1000)
+                return FS_TIMEOUT
+            if wait > 0:
+                time.sleep(wait)
+
+        self._pending = None
+        self.timestamp = timestamp
+        self._rects = rects
+        self._data = data
+        if rects:
+            regions.scatter(self.frame, rects, data)
+        return FS_OK
+
+    def dirty_rects(self):
+        return [dict(r) for r in self._rects]
+
+    def copy_dirty_regions(self):
+        if self._data is None:
+            return None
+        return np.frombuffer(self._data, dtype=np.uint8) if not isinstance(self._data, np.ndarray) else self._data
+
+    def copy_frame(self):
+        return self.frame.copy()
+
+    def release(self):
+        self._rects = []
+        self._data = None
+
+    def capture(self, timeout_ms=100):
+        return FS_OK, self.frame.copy()
+
+
+class BlockDiffSource(CaptureSource):
+    """为只能给出完整画面的捕获源生成脏矩形：每帧与上一帧分块比较（见blockdiff.py）
+
+    DxgiCapture使用整帧接口dxgi_get_frame（老版DLL同样提供）；其他捕获源按 acquire → copy_frame → release
+    取完整画面，忽略其自带的脏矩形。无变化的帧返回FS_OK和空的脏矩形列表，与DXGI桌面静止时一致。
+    """
+
+    def __init__(self, source: CaptureSource, tile_size: int = TILE_SIZE):
+        self.source = source
+        self.width = source.width
+        self.height = source.height
+        self.diff = BlockDiff(source.width, source.height, tile_size)
+        self.frame = np.zeros((self.height, self.width, 4), dtype=np.uint8)  # 最近一帧
+        self._rects: List[Dict] = []
+        self._scratch = ScratchBuffer()
+
+    @property
+    def size(self):
+        return self.source.size
+
+    def _grab(self, timeout_ms: int) -> Tuple[int, Optional[np.ndarray]]:
+        if isinstance(self.source, DxgiCapture):
+            return self.source.capture(timeout_ms)
+        return CaptureSource.capture(self.source, timeout_ms)
+
+    def acquire(self, timeout_ms=100):
+        status, frame = self._grab(timeout_ms)
+        if status != FS_OK:
+            return status
+        self._rects = self.diff.compare(frame, self.frame)
+        self.frame = frame  # 每次取到的都是新数组，直接作为下一次比较的参考
+        return FS_OK
+
+    def dirty_rects(self):
+        return [dict(r) for r in self._rects]
+
+    def copy_dirty_regions(self):
+        region_plan = regions.plan(self._rects, self.width, self.height)
+        return region_plan.gather(self.frame, self._scratch.get(region_plan.nbytes()))
+
+    def copy_frame(self):
+        return self.frame.copy()
+
+    def release(self):
+        self._rects = []
+
+    def capture(self, timeout_ms=100):
+        status, frame = self._grab(timeout_ms)
+        if status != FS_OK:
+            return status, None
+        self.frame = frame
+        return FS_OK, frame.copy()
+
+    def close(self):
+        self.source.close()
+
+
+# 合成场景
+SYNTHETIC_SOURCES = {
+    'idle': IdleSource,
+    'typing': TypingSource,
+    'scrolling': ScrollingSource,
+    'drag': DragSource,
+    'video': VideoSource,
+}
+
+
+def create_source(name: str = 'dxgi', width: int = 1920, height: int = 1080,
+                  fps: Optional[float] = 30.0, seed: int = 0, block_diff: bool = False) -> CaptureSource:
+    """按名称创建捕获源：dxgi 或 SYNTHETIC_SOURCES 中的合成场景
+
+    block_diff为True时不使用捕获源自带的脏矩形，改为逐帧分块比较（BlockDiffSource）
+    """
+    if name == 'dxgi':
+        source = DxgiCapture()
+    elif name in SYNTHETIC_SOURCES:
+        source = SYNTHETIC_SOURCES[name](width, height, fps=fps, seed=seed)
+    else:
+        raise ValueError(f"未知的捕获源: {name}")
+    return BlockDiffSource(source) if block_diff else source
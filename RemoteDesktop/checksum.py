@@ -0,0 +1,87 @@
+"""
+远程桌面 - 分块校验和
+把帧缓冲划分为固定大小的块，维护每块的CRC32，应用脏矩形后只重算被触及的块。
+服务器定期下发紧凑形式（每块低16位），客户端比对后只请求重传不一致的块。
+"""
+
+import zlib
+from typing import Dict, List
+
+import numpy as np
+
+# 块边长（像素）
+TILE_SIZE = 64
+
+
+class TileChecksums:
+    """帧缓冲的分块校验和"""
+
+    def __init__(self, width: int, height: int, tile_size: int = TILE_SIZE):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.cols = (width + tile_size - 1) // tile_size
+        self.rows = (height + tile_size - 1) // tile_size
+        self.sums = np.zeros((self.rows, self.cols), dtype=np.uint32)
+        self._tile = np.empty(0, dtype=np.uint8)  # 块像素的连续副本（复用，CRC32需要连续内存）
+
+    def _update_tiles(self, frame: np.ndarray, row0: int, row1: int, col0: int, col1: int) -> None:
+        t = self.tile_size
+        if self._tile.size < t * t * frame.strides[1]:
+            self._tile = np.empty(t * t * frame.strides[1], dtype=np.uint8)
+        for row in range(row0, row1):
+            band = frame[row * t:(row + 1) * t]
+            for col in range(col0, col1):
+                block = band[:, col * t:(col + 1) * t]
+                tile = self._tile[:block.nbytes].view(frame.dtype).reshape(block.shape)
+                np.copyto(tile, block)
+                self.sums[row, col] = zlib.crc32(tile)
+
+    def reset(self, frame: np.ndarray) -> None:
+        """完整重算（收到或发送完整帧后调用）"""
+        self._update_tiles(frame, 0, self.rows, 0, self.cols)
+
+    def update(self, frame: np.ndarray, rects: List[Dict]) -> None:
+        """重算被脏矩形触及的块"""
+        t = self.tile_size
+        touched = set()
+        for rect in rects:
+            if rect['right'] <= rect['left'] or rect['bottom'] <= rect['top']:
+                continue
+            for row in range(rect['top'] // t, (rect['bottom'] - 1) // t + 1):
+                for col in range(rect['left'] // t, (rect['right'] - 1) // t + 1):
+                    touched.add((row, col))
+        for row, col in touched:
+            self._update_tiles(frame, row, row + 1, col, col + 1)
+
+    def compact(self) -> bytes:
+        """紧凑形式：每块取CRC32低16位（网络字节序）"""
+        return (self.sums & 0xFFFF).astype('>u2').tobytes()
+
+    def diff(self, compact: bytes) -> List[int]:
+        """与对端的紧凑校验和比较
+
+        Returns:
+            不一致的块索引（row * cols + col）
+        """
+        remote = np.frombuffer(compact, dtype='>u2')
+        local = (self.sums & 0xFFFF).astype(np.uint16).ravel()
+        if remote.size != local.size:
+            return list(range(local.size))
+        return np.nonzero(remote != local)[0].tolist()
+
+    def tile_rects(self, indices: List[int]) -> List[Dict]:
+        """块索引转换为矩形（裁剪到帧边界）"""
+        t = self.tile_size
+        rects = []
+        for index in indices:
+            row, col = divmod(index, self.cols)
+            if row >= self.rows:
+                continue
+            rects.append({
+                'left': col * t,
+                'top': row * t,
+                'right': min((col + 1) * t, self.width),
+                'bottom': min((row + 1) * t, self.height)
+            })
+        return rects
@@ -3,86 +3,161 @@
 接收屏幕数据并显示
 """
 
+import functools
 import socket
 import threading
 import time
 import numpy as np
 import cv2
-import tkinter as tk
-from PIL import Image, ImageTk
 from queue import Queue, Empty
-from protocol import Protocol, PKT_INIT, PKT_FRAME, PKT_DIRTY, PKT_SKIP
+from protocol import (Protocol, PKT_INIT, PKT_FRAME, PKT_DIRTY, PKT_SKIP, PKT_CHECKSUM, PKT_REFRESH,
+                      PKT_HEARTBEAT, PKT_VIEW, PKT_LOSSY, PACKET_NAMES, EMPTY_TOKEN, PF_AUTO, PF_BGRA,
+                      PIXEL_FORMAT_NAMES, LOSSY_CODEC_NAMES, LEGACY_CAPABILITIES, Capabilities, View, bitmask, now_us)
+from checksum import TileChecksums
+import regions
+from buffers import ScratchBuffer
+from display import DisplayBuffer
+from pixelformat import PIXEL_FORMATS, get_format
+from lossy import decode_into
+from latency import LatencyTracker, HEARTBEAT_INTERVAL
+from multiplex import MuxConnection
+from datagram import FEC_GROUP, NetworkSimulator, connect_datagram
+from metrics import REGISTRY, ViewerMetrics, start_http_server
+from ratecontrol import TokenBucket
+from tracing import TRACER
+
+# 断线重连退避（秒）
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 10.0
+
+# 读取线程 → 解码线程的包队列长度（解码跟不上时读取线程阻塞，由TCP窗口向服务器施加背压）
+PACKET_QUEUE_SIZE = 8
+# 解码线程一次最多连续应用的积压包数（应用完后只刷新一次显示）
+MAX_COALESCE = 8
+
+# 客户端的能力（握手时发给服务器）：能处理的数据包类型、全部像素格式与有损编码，解码队列长度为可缓冲的包数
+CLIENT_CAPABILITIES = Capabilities(
+    packet_types=bitmask((PKT_INIT, PKT_FRAME, PKT_DIRTY, PKT_SKIP, PKT_HEARTBEAT, PKT_CHECKSUM, PKT_REFRESH,
+                          PKT_VIEW, PKT_LOSSY)),
+    pixel_formats=bitmask(PIXEL_FORMATS), lossy_codecs=bitmask(LOSSY_CODEC_NAMES), window=PACKET_QUEUE_SIZE)
+
+# 窗口显示宽度（GUI模式下同时作为请求的输出宽度，服务器按此缩放后再传输）
+DISPLAY_WIDTH = 1280
+# 缩放视口的步进倍数、最小视口宽度，平移步长（视口宽/高的比例）
+ZOOM_STEP = 2.0
+MIN_VIEWPORT_WIDTH = 160
+PAN_STEP = 0.25
 
 
 class RemoteDesktopClient:
-    """远程桌面客户端"""
+    """远程桌面客户端
     
-    def __init__(self, server_host='127.0.0.1', server_port=9999):
+    每个连接由两个线程处理：读取线程只接收并分帧，包放入有界队列；解码线程应用到帧缓冲并确认，
+    队列中积压多个更新时全部应用后只刷新一次显示。
+    headless为True时只接收并解码到帧缓冲，不更新显示缓冲，也不需要tkinter（用于压测）。
+    view为向服务器请求的视图（输出分辨率/视口/像素格式），None表示整个屏幕的原始分辨率BGRA；
+    运行中可用 set_view / zoom / pan / cycle_format 更换。帧缓冲为服务器输出的传输帧（见pixelformat.py），
+    image为转换回BGRA的画面（BGRA格式时就是帧缓冲）。
+    connector为返回已连接socket的函数（如多路复用连接的一个流，见run_streams；数据报连接，见datagram.py），
+    None时直接以TCP连接服务器。
+    """
+    
+    def __init__(self, server_host='127.0.0.1', server_port=9999, latency_marker=False, viewer='client',
+                 headless=False, throttle=None, view=None, connector=None):
         self.server_host = server_host
         self.server_port = server_port
+        self.connector = connector
+        self.latency_marker = latency_marker  # 测试模式：从显示画面读出服务器写入的帧标记
+        self.headless = headless
+        # 模拟慢速客户端：限制读取速率（字节/秒），None表示不限
+        self.throttle = TokenBucket(throttle) if throttle else None
         self.socket = None
         self.running = False
         
-        # 屏幕信息
+        # 屏幕信息（width/height为服务器输出画面的尺寸）
         self.width = 0
         self.height = 0
-        self.current_frame = None
-        self.frame_buffer = None  # 完整帧缓冲
-        
-        # 帧队列（增大以应对突发）
-        self.frame_queue = Queue(maxsize=5)
-        
-        # 统计信息
-        self.stats = {
-            'recv_count': 0,
-            'skip_count': 0,
-            'bytes_recv': 0,
-            'start_time': 0,
-            'last_fps_time': 0,
-            'fps_counter': 0,
-            'current_fps': 0
-        }
+        self.view = view
+        self.screen_size = None  # 服务器屏幕尺寸（旧服务器不报告时为输出尺寸）
+        self.viewport = None  # 输出画面对应的屏幕区域
+        self.pixel_format = PF_BGRA  # 当前的传输像素格式
+        self.frame_buffer = None  # 完整帧缓冲（传输帧）
+        self.image = None  # BGRA画面
+        self.tiles = None  # 帧缓冲分块校验和（与服务器比对以发现漂移）
+        self.last_seq = 0  # 最近应用的更新序号
+        self.session_token = EMPTY_TOKEN  # 服务器分配的会话令牌，重连时用于恢复
+        self.capabilities = LEGACY_CAPABILITIES  # 与服务器协商的能力（旧服务器不回复能力）
+        
+        # 显示分辨率的RGB缓冲（由start_gui创建），解码线程只重新缩放其中的脏区域
+        self.display = None
+        
+        # 读取线程 → 解码线程：队列元素为 (包, 所在缓冲区, 读取耗时, 接收时刻us, 入队时刻)，None表示连接结束。
+        # 包体接收到池中的缓冲区，解码线程处理完后归还（读取线程不能复用仍在队列中的缓冲区）
+        self.packet_queue = Queue(maxsize=PACKET_QUEUE_SIZE)
+        self.packet_buffers = Queue()
+        for _ in range(PACKET_QUEUE_SIZE + 2):
+            self.packet_buffers.put(ScratchBuffer())
+        self.decode_buffer = ScratchBuffer()  # 解码线程解压的暂存区（应用到帧缓冲后即可复用）
+        self.send_lock = threading.Lock()  # 两个线程都会发送（心跳 / 确认、重传请求）
+        
+        # 延迟测量与统计指标（viewer标签区分同一进程中的多个客户端）
+        self.latency = LatencyTracker(REGISTRY, viewer)
+        self.metrics = ViewerMetrics(viewer)
+        self.metrics.queue_depth['decode'].set_function(self.packet_queue.qsize)
+        self.last_heartbeat = 0
     
     def connect(self):
         """连接到服务器"""
         try:
             print(f"[客户端] 连接到 {self.server_host}:{self.server_port}...")
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # 优化网络性能
-            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 禁用Nagle
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)  # 1MB接收缓冲
-            self.socket.connect((self.server_host, self.server_port))
+            if self.connector is not None:
+                self.socket = self.connector()
+            else:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                # 优化网络性能
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 禁用Nagle
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)  # 1MB接收缓冲
+                self.socket.connect((self.server_host, self.server_port))
             print(f"[客户端] 已连接")
             
+            # 发送会话恢复请求：首次连接令牌为空，重连时携带最近序号和帧缓冲校验和
+            checksum = Protocol.frame_checksum(self.frame_buffer) if self.frame_buffer is not None else 0
+            Protocol.send_packet(self.socket, Protocol.pack_resume(self.session_token, self.last_seq, checksum,
+                                                                   self.view, CLIENT_CAPABILITIES))
+            
             # 接收初始化信息
             init_packet = Protocol.recv_packet(self.socket)
             if not init_packet:
                 raise Exception("未收到初始化数据")
             
-            self.width, self.height = Protocol.unpack_init(init_packet)
-            print(f"[客户端] 屏幕尺寸: {self.width}x{self.height}")
-            
-            # 创建帧缓冲（BGRA格式，4通道）
-            self.frame_buffer = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+            width, height, session_token = Protocol.unpack_init(init_packet)
+            capabilities = Protocol.unpack_init_capabilities(init_packet)
+            if capabilities is None and session_token != self.session_token:
+                print("[客户端] 服务器未回复能力（旧版本协议），按兼容方式运行")
+            self.capabilities = capabilities or LEGACY_CAPABILITIES
+            screen = Protocol.unpack_init_view(init_packet)
+            if screen is None:
+                screen = (width, height, View(width, height, 0, 0, width, height))
+            self.screen_size, view = screen[:2], screen[2]
+            self.viewport = view.viewport
+            if self.screen_size != (width, height) or view.pixel_format != PF_BGRA:
+                print(f"[客户端] 屏幕尺寸: {self.screen_size[0]}x{self.screen_size[1]}，输出: {width}x{height} "
+                      f"{PIXEL_FORMAT_NAMES.get(view.pixel_format, view.pixel_format)}")
+            else:
+                print(f"[客户端] 屏幕尺寸: {width}x{height}")
             
-            # 接收首帧
-            first_packet = Protocol.recv_packet(self.socket)
-            if not first_packet:
-                raise Exception("未收到首帧")
+            if session_token != self.session_token:
+                # 新会话：服务器随后发送完整帧
+                self.session_token = session_token
+                self.last_seq = 0
+            else:
+                print(f"[客户端] 恢复会话 (序号 {self.last_seq})")
             
-            pkt_type = Protocol.get_packet_type(first_packet)
-            if pkt_type == PKT_FRAME:
-                frame_data = Protocol.unpack_frame(first_packet)
-                frame = np.frombuffer(frame_data, dtype=np.uint8)
-                frame = frame.reshape(self.height, self.width, 4)  # BGRA格式
-                self.frame_buffer[:] = frame  # 初始化帧缓冲
-                # 直接取BGR通道（前3个通道）
-                self.current_frame = frame[:, :, :3].copy()
-                print(f"[客户端] 已接收首帧")
+            if self.frame_buffer is None or (width, height, view.pixel_format) != (self.width, self.height,
+                                                                                    self.pixel_format):
+                self.resize(width, height, view.pixel_format)
             
             self.running = True
-            self.stats['start_time'] = time.time()
-            self.stats['last_fps_time'] = time.time()
             
             return True
             
@@ -90,167 +165,409 @@ class RemoteDesktopClient:
             print(f"[客户端] 连接失败: {e}")
             return False
     
+    def resize(self, width, height, pixel_format=PF_BGRA):
+        """按输出尺寸和像素格式创建帧缓冲与BGRA画面，内容由随后的完整帧填充"""
+        self.width, self.height = width, height
+        self.pixel_format = pixel_format
+        self.frame_buffer = get_format(pixel_format).allocate(width, height)
+        if pixel_format == PF_BGRA:
+            self.image = self.frame_buffer
+        else:
+            self.image = np.zeros((height, width, 4), dtype=np.uint8)
+        self.tiles = TileChecksums(self.frame_buffer.shape[1], self.frame_buffer.shape[0])
+        self.tiles.reset(self.frame_buffer)
+    
+    def convert(self, rects):
+        """帧缓冲的rects区域转换到BGRA画面（解码线程调用）
+        
+        Returns:
+            画面坐标的矩形，rects为None（整帧）时为None
+        """
+        if self.image is self.frame_buffer:
+            return rects
+        pixel_format = get_format(self.pixel_format)
+        if rects is not None:
+            rects = [pixel_format.output_rect(rect) for rect in rects]
+        pixel_format.decode(self.frame_buffer, self.image, rects)
+        return rects
+    
+    def set_view(self, view):
+        """请求新的视图（任意线程调用）；服务器回复PKT_VIEW和该分辨率的完整帧，断线重连时也按此视图请求"""
+        self.view = view
+        if self.running:
+            try:
+                self.send_packet(Protocol.pack_view(view))
+            except OSError:
+                pass  # 连接已断开，重连时携带
+    
+    def zoom(self, factor):
+        """以当前视口中心缩放视口：factor<1放大画面，视口保持屏幕比例，最大为整个屏幕"""
+        if not self.screen_size:
+            return
+        screen_width, screen_height = self.screen_size
+        viewport = self.viewport
+        width = min((viewport['right'] - viewport['left']) * factor, screen_width)
+        width = min(screen_width, max(MIN_VIEWPORT_WIDTH, round(width)))
+        height = max(1, round(width * screen_height / screen_width))
+        center_x = (viewport['left'] + viewport['right']) / 2
+        center_y = (viewport['top'] + viewport['bottom']) / 2
+        self._request_viewport(round(center_x - width / 2), round(center_y - height / 2), width, height)
+    
+    def pan(self, dx, dy):
+        """平移视口，dx/dy为视口宽/高的比例"""
+        if not self.screen_size:
+            return
+        viewport = self.viewport
+        width = viewport['right'] - viewport['left']
+        height = viewport['bottom'] - viewport['top']
+        self._request_viewport(viewport['left'] + round(dx * width), viewport['top'] + round(dy * height),
+                               width, height)
+    
+    def _request_viewport(self, left, top, width, height):
+        """请求视口（限制在屏幕内），保持请求的输出尺寸与像素格式"""
+        screen_width, screen_height = self.screen_size
+        left = min(max(left, 0), screen_width - width)
+        top = min(max(top, 0), screen_height - height)
+        self.set_view((self.view or View())._replace(left=left, top=top, right=left + width, bottom=top + height))
+    
+    def cycle_format(self):
+        """切换到下一种像素格式（bgra → rgb565 → yuv420 → gray8 → auto → bgra，跳过服务器不支持的）"""
+        formats = [code for code in PIXEL_FORMAT_NAMES
+                   if code == PF_AUTO or self.capabilities.has_pixel_format(code)]
+        view = self.view or View()
+        current = formats.index(view.pixel_format) if view.pixel_format in formats else 0
+        self.set_view(view._replace(pixel_format=formats[(current + 1) % len(formats)]))
+    
+    def send_packet(self, packet):
+        """发送控制包（读取线程与解码线程共用连接）"""
+        with self.send_lock:
+            Protocol.send_packet(self.socket, packet)
+    
+    def send_ack(self, seq, timestamp):
+        """确认已应用的更新，服务器据此推进发送窗口"""
+        self.last_seq = seq
+        self.send_packet(Protocol.pack_ack(seq, timestamp))
+    
+    def connection_loop(self):
+        """接收线程主循环：连接断开后按指数退避自动重连并恢复会话"""
+        delay = RECONNECT_MIN_DELAY
+        while self.running:
+            self.receive_loop()
+            if not self.running:
+                break
+            
+            print(f"[客户端] {delay:.1f}s 后重连...")
+            time.sleep(delay)
+            if self.running and self.connect():
+                self.metrics.reconnects.inc()
+                delay = RECONNECT_MIN_DELAY
+            else:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    
+    def publish_frame(self, rects, seq, capture_us=0, decode_us=0):
+        """帧缓冲的rects区域已更新（None表示整帧）：重新缩放显示缓冲的对应区域"""
+        display = self.display
+        if display is not None:
+            with self.metrics.stage('display', seq):
+                display.update(self.image, rects, seq, capture_us, decode_us)
+    
+    def check_tiles(self, packet):
+        """比对服务器下发的分块校验和，不一致的块请求重传"""
+        seq, tile_size, cols, rows, sums = Protocol.unpack_checksum(packet)
+        if seq != self.last_seq or (cols, rows) != (self.tiles.cols, self.tiles.rows):
+            return
+        
+        diverged = self.tiles.diff(sums)
+        if diverged:
+            self.metrics.resync_tiles.inc(len(diverged))
+            print(f"[客户端] {len(diverged)} 个块校验不一致，请求重传")
+            self.send_packet(Protocol.pack_resync(seq, diverged))
+    
     def receive_loop(self):
-        """接收数据循环"""
+        """读取线程：接收数据包放入解码队列（并启动本连接的解码线程），连接断开时返回"""
+        decoder = threading.Thread(target=self.decode_loop, name=f"decode {self.metrics.viewer}", daemon=True)
+        decoder.start()
+        buffer = None
         try:
             while self.running:
-                # 接收数据包
-                packet = Protocol.recv_packet(self.socket)
+                # 接收数据包（包体接收到池中的缓冲区，解码线程处理完后归还；心跳包的缓冲区直接复用）
+                if buffer is None:
+                    buffer = self.packet_buffers.get()
+                packet, receive_time = Protocol.recv_packet_timed(self.socket, buffer)
                 if not packet:
                     print("[客户端] 连接已断开")
                     break
+                receive_us = now_us()
+                if self.throttle:
+                    self.throttle.consume(len(packet) + 4)
                 
-                self.stats['bytes_recv'] += len(packet)
-                pkt_type = Protocol.get_packet_type(packet)
+                # 定期发送心跳，服务器回传后计算RTT和时钟偏差
+                if receive_us - self.last_heartbeat >= HEARTBEAT_INTERVAL * 1e6:
+                    self.last_heartbeat = receive_us
+                    self.send_packet(Protocol.pack_heartbeat(receive_us))
                 
-                if pkt_type == PKT_SKIP:
-                    # 跳帧包
-                    self.stats['skip_count'] += 1
-                    
-                elif pkt_type == PKT_DIRTY:
-                    # 脏矩形局部更新（XOR编码）
-                    rects, dirty_data = Protocol.unpack_dirty(packet)
-                    
-                    # 将脏区域XOR数据应用到帧缓冲
-                    dirty_array = np.frombuffer(dirty_data, dtype=np.uint8)
-                    offset = 0
-                    
-                    for rect in rects:
-                        left, top = rect['left'], rect['top']
-                        width, height = rect['width'], rect['height']
-                        region_size = width * height * 4  # BGRA格式，4字节/像素
-                        
-                        if offset + region_size <= len(dirty_array):
-                            # XOR编码的数据
-                            xor_data = dirty_array[offset:offset+region_size]
-                            xor_region = xor_data.reshape(height, width, 4)  # BGRA格式
-                            
-                            # XOR恢复：xor_region XOR frame_buffer = 新像素
-                            # （服务器：new XOR old = xor，客户端：xor XOR old = new）
-                            self.frame_buffer[top:top+height, left:left+width] = np.bitwise_xor(
-                                self.frame_buffer[top:top+height, left:left+width], 
-                                xor_region
-                            )
-                            offset += region_size
-                    
-                    # 直接取BGR通道（前3个通道）
-                    self.current_frame = self.frame_buffer[:, :, :3].copy()
-                    self.stats['recv_count'] += 1
-                    
-                    # 放入队列
-                    try:
-                        # 如果队列满，清空旧帧
-                        while self.frame_queue.full():
-                            try:
-                                self.frame_queue.get_nowait()
-                            except:
-                                break
-                        self.frame_queue.put_nowait(self.current_frame.copy())
-                    except:
-                        pass
-                    
-                    # 更新FPS
-                    self.stats['fps_counter'] += 1
-                    current_time = time.time()
-                    if current_time - self.stats['last_fps_time'] >= 1.0:
-                        self.stats['current_fps'] = self.stats['fps_counter']
-                        self.stats['fps_counter'] = 0
-                        self.stats['last_fps_time'] = current_time
+                if Protocol.get_packet_type(packet) == PKT_HEARTBEAT:
+                    # 心跳回传在读取线程处理，RTT不包含解码排队时间
+                    self.apply_packet(packet, receive_time, receive_us)
+                    continue
                 
-                elif pkt_type == PKT_FRAME:
-                    # 完整帧
-                    frame_data = Protocol.unpack_frame(packet)
-                    frame = np.frombuffer(frame_data, dtype=np.uint8)
-                    frame = frame.reshape(self.height, self.width, 4)  # BGRA格式
-                    
-                    # 直接取BGR通道（前3个通道）
-                    self.current_frame = frame[:, :, :3].copy()
-                    self.stats['recv_count'] += 1
-                    
-                    if self.frame_queue.full():
-                        try:
-                            self.frame_queue.get_nowait()
-                        except:
-                            pass
-                    try:
-                        self.frame_queue.put_nowait(self.current_frame.copy())
-                    except:
-                        pass
+                self.packet_queue.put((packet, buffer, receive_time, receive_us, time.perf_counter()))
+                buffer = None
         
-        except ConnectionResetError:
+        except (ConnectionResetError, BrokenPipeError):
             print("[客户端] 连接被重置")
         except Exception as e:
-            print(f"[客户端] 接收错误: {e}")
-            import traceback
-            traceback.print_exc()
+            if self.running:
+                print(f"[客户端] 接收错误: {e}")
+                import traceback
+                traceback.print_exc()
         finally:
-            self.running = False
+            if buffer is not None:
+                self.packet_buffers.put(buffer)
+            # 等解码线程处理完已入队的包（其中的确认仍需发送）再关闭连接
+            self.packet_queue.put(None)
+            decoder.join()
+            if self.socket:
+                self.socket.close()
+    
+    def decode_loop(self):
+        """解码线程：依次应用队列中的包，积压的多个更新全部应用后只刷新一次显示；收到None时返回"""
+        wait = self.metrics.queue_wait['decode']
+        failed = False
+        while True:
+            items = [self.packet_queue.get()]
+            while items[-1] is not None and len(items) < MAX_COALESCE:
+                try:
+                    items.append(self.packet_queue.get_nowait())
+                except Empty:
+                    break
+            
+            updates = []
+            for item in items:
+                if item is None:
+                    break
+                packet, buffer, receive_time, receive_us, queued = item
+                wait.observe(time.perf_counter() - queued)
+                try:
+                    if not failed:
+                        update = self.apply_packet(packet, receive_time, receive_us)
+                        if update is not None:
+                            updates.append(update)
+                except Exception as e:
+                    # 解码或发送失败：断开连接使读取线程退出，之后的包只归还缓冲区；
+                    # 帧缓冲可能已被部分更新（如应用后发送确认失败），整帧刷新显示
+                    failed = True
+                    updates.append((None, self.last_seq, 0, 0))
+                    if self.running:
+                        print(f"[客户端] 解码错误: {e}")
+                    try:
+                        self.socket.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                finally:
+                    self.packet_buffers.put(buffer)
+            
+            if updates:
+                self.publish_updates(updates)
+            if items[-1] is None:
+                return
+    
+    def publish_updates(self, updates):
+        """合并一批已应用的更新后刷新一次显示（任一为整帧时整帧刷新）"""
+        if len(updates) > 1:
+            self.metrics.coalesced.inc(len(updates) - 1)
+        rects = []
+        for update_rects, _, _, _ in updates:
+            if update_rects is None:
+                rects = None
+                break
+            rects.extend(update_rects)
+        _, seq, capture_us, decode_us = updates[-1]
+        self.publish_frame(rects, seq, capture_us, decode_us)
+    
+    def handle_packet(self, packet, receive_time=0.0, receive_us=None):
+        """在当前线程处理一个数据包：应用、确认并刷新显示"""
+        update = self.apply_packet(packet, receive_time, receive_us)
+        if update is not None:
+            self.publish_frame(*update)
+    
+    def apply_packet(self, packet, receive_time=0.0, receive_us=None):
+        """处理一个收到的数据包：解码并应用到帧缓冲，确认
+        
+        Returns:
+            更新了帧缓冲时为 (rects, seq, capture_us, decode_us)，rects为None表示整帧；否则为None
+        """
+        if receive_us is None:
+            receive_us = now_us()
+        pkt_type = Protocol.get_packet_type(packet)
+        self.metrics.on_packet(PACKET_NAMES.get(pkt_type, 'other'), len(packet) + 4)
+        if pkt_type == PKT_HEARTBEAT:
+            self.metrics.observe('receive', receive_time)
+            server_us, sent_us = Protocol.unpack_heartbeat(packet)
+            self.latency.on_echo(sent_us, server_us, receive_us)
+            return None
+        if pkt_type == PKT_VIEW:
+            # 服务器切换了视图，随后的完整帧为新的输出分辨率
+            view = Protocol.unpack_view(packet)
+            self.viewport = view.viewport
+            if (view.width, view.height, view.pixel_format) != (self.width, self.height, self.pixel_format):
+                self.resize(view.width, view.height, view.pixel_format)
+            print(f"[客户端] 视图: {view.width}x{view.height} {PIXEL_FORMAT_NAMES.get(view.pixel_format)} "
+                  f"视口 ({view.left}, {view.top})-({view.right}, {view.bottom})")
+            return None
+        
+        pkt_type, seq, timestamp = Protocol.unpack_update_header(packet)
+        self.metrics.observe('receive', receive_time, seq)
+        
+        if pkt_type == PKT_SKIP:
+            # 跳帧包
+            pass
+            
+        elif pkt_type == PKT_DIRTY:
+            # 脏矩形局部更新（XOR编码）
+            with self.metrics.stage('decompress', seq):
+                rects, dirty_data = Protocol.unpack_dirty(packet, self.decode_buffer)
+            
+            # 将脏区域XOR数据应用到帧缓冲
+            with self.metrics.stage('apply', seq):
+                # XOR恢复：xor XOR frame_buffer = 新像素
+                # （服务器：new XOR old = xor，客户端：xor XOR old = new）
+                regions.xor_apply(self.frame_buffer, rects, dirty_data)
+                self.tiles.update(self.frame_buffer, rects)
+                rects = self.convert(rects)
+            self.send_ack(seq, timestamp)
+            decode_us = now_us()
+            self.latency.on_decoded(timestamp, receive_us, decode_us)
+            self.metrics.on_frame()
+            return rects, seq, timestamp, decode_us
+        
+        elif pkt_type == PKT_REFRESH:
+            # 重传的原始像素块，直接覆盖
+            with self.metrics.stage('decompress', seq):
+                rects, pixel_data = Protocol.unpack_refresh(packet, self.decode_buffer)
+            
+            with self.metrics.stage('apply', seq):
+                regions.scatter(self.frame_buffer, rects, pixel_data)
+                self.tiles.update(self.frame_buffer, rects)
+                rects = self.convert(rects)
+            self.send_ack(seq, timestamp)
+            self.metrics.on_frame()
+            return rects, seq, timestamp, now_us()
+        
+        elif pkt_type == PKT_LOSSY:
+            # 高运动区域的有损图像，解码后直接覆盖（静止后服务器以PKT_DIRTY发送无损修正）
+            _, rects, images = Protocol.unpack_lossy(packet)
+            with self.metrics.stage('apply', seq):
+                for r, image in zip(rects, images):
+                    decode_into(image, self.frame_buffer[r['top']:r['bottom'], r['left']:r['right']])
+                self.tiles.update(self.frame_buffer, rects)
+                rects = self.convert(rects)
+            self.send_ack(seq, timestamp)
+            decode_us = now_us()
+            self.latency.on_decoded(timestamp, receive_us, decode_us)
+            self.metrics.on_frame()
+            return rects, seq, timestamp, decode_us
+        
+        elif pkt_type == PKT_CHECKSUM:
+            self.check_tiles(packet)
+        
+        elif pkt_type == PKT_FRAME:
+            # 完整帧
+            with self.metrics.stage('decompress', seq):
+                frame_data = Protocol.unpack_frame(packet, self.decode_buffer)
+            
+            with self.metrics.stage('apply', seq):
+                frame = np.frombuffer(frame_data, dtype=np.uint8)
+                frame = frame.reshape(self.frame_buffer.shape)  # 传输帧（BGRA格式时即画面）
+                self.frame_buffer[:] = frame
+                
+                self.tiles.reset(self.frame_buffer)
+                self.convert(None)
+            self.send_ack(seq, timestamp)
+            self.metrics.on_frame()
+            print(f"[客户端] 已接收完整帧 (序号 {seq})")
+            return None, seq, timestamp, now_us()
+        
+        return None
     
-    def start_gui(self):
-        """启动GUI显示"""
+    def stop(self):
+        """停止接收（关闭连接使接收线程退出）"""
+        self.running = False
+        if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+    
+    def start_gui(self, master=None, title=None):
+        """启动GUI显示
+        
+        画布上只有一个持久的图像，每次刷新只把显示缓冲中新更新的区域写入该图像（PPM数据，-to 指定位置），
+        缩放和颜色转换已由解码线程按脏矩形完成。
+        master不为None时在其中创建子窗口（多个流各一个窗口，见run_streams），由调用方运行主循环。
+        """
+        import tkinter as tk
+        
         # 创建窗口
-        root = tk.Tk()
-        root.title(f"远程桌面 - {self.server_host}:{self.server_port}")
+        root = tk.Tk() if master is None else tk.Toplevel(master)
+        root.title(title or f"远程桌面 - {self.server_host}:{self.server_port}")
         
         # 计算显示尺寸
-        display_width = 1280
+        display_width = DISPLAY_WIDTH
         display_height = int(display_width * self.height / self.width)
         
-        # 创建Canvas
+        # 创建Canvas和持久的画布图像
         canvas = tk.Canvas(root, width=display_width, height=display_height, bg='black')
         canvas.pack()
+        photo_image = tk.PhotoImage(width=display_width, height=display_height)
+        canvas.create_image(0, 0, anchor=tk.NW, image=photo_image)
         
         # 创建状态标签
         status_label = tk.Label(root, text="", font=("Arial", 10))
         status_label.pack()
         
-        photo_image = None
-        last_frame_id = None
+        # 先设置display再整帧缩放一次：之后解码线程应用的每个更新都会刷新对应区域
+        display = DisplayBuffer(self.width, self.height, display_width, display_height)
+        self.display = display
+        display.update(self.image, None)
+        self.metrics.queue_depth['display'].set_function(lambda: display.pending)
         
         def update_frame():
-            """更新帧显示"""
-            nonlocal photo_image, last_frame_id
-            
+            """把新更新的区域写入画布图像"""
             if not self.running:
-                root.quit()
+                if master is None:
+                    root.quit()
+                else:
+                    root.destroy()
                 return
             
             has_new_frame = False
             
             try:
-                frame = self.frame_queue.get_nowait()
-                
-                if frame is not None:
-                    frame_id = id(frame)
+                patches, seq, capture_us, decode_us, waited = display.take()
+                if patches:
+                    has_new_frame = True
+                    self.metrics.queue_wait['display'].observe(waited)
+                    for x, y, w, h, pixels in patches:
+                        root.tk.call(photo_image.name, 'put', b'P6 %d %d 255\n' % (w, h) + pixels,
+                                     '-format', 'ppm', '-to', x, y)
                     
-                    if frame_id != last_frame_id:
-                        last_frame_id = frame_id
-                        has_new_frame = True
-                        
-                        # BGR转RGB
-                        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                        
-                        # 调整大小（使用快速插值）
-                        frame_resized = cv2.resize(frame_rgb, (display_width, display_height), 
-                                                  interpolation=cv2.INTER_LINEAR)
-                        
-                        # 转换为PIL Image
-                        img = Image.fromarray(frame_resized)
-                        photo_image = ImageTk.PhotoImage(image=img)
-                        
-                        # 更新Canvas
-                        canvas.delete("all")
-                        canvas.create_image(0, 0, anchor=tk.NW, image=photo_image)
-            except Empty:
-                pass
+                    # 记录延迟
+                    display_us = now_us()
+                    if capture_us:
+                        self.latency.on_displayed(capture_us, decode_us, display_us)
+                    if self.latency_marker:
+                        self.latency.on_marker(self.image, display_us)
             except Exception as e:
                 pass  # 忽略偶发错误，保持运行
             
             # 更新状态
-            elapsed = time.time() - self.stats['start_time']
+            metrics = self.metrics
+            elapsed = time.time() - metrics.start_time
             if elapsed > 0:
-                bandwidth = self.stats['bytes_recv'] / elapsed / 1024 / 1024  # MB/s
-                status_text = f"FPS: {self.stats['current_fps']} | 带宽: {bandwidth:.2f} MB/s | 接收: {self.stats['recv_count']} | 跳帧: {self.stats['skip_count']}"
+                bandwidth = metrics.bytes_received.value / elapsed / 1024 / 1024  # MB/s
+                status_text = f"FPS: {metrics.fps.value} | 带宽: {bandwidth:.2f} MB/s | 接收: {metrics.frames.value} | 跳帧: {metrics.packet_count('skip')} | 重连: {metrics.reconnects.value} | 重传块: {metrics.resync_tiles.value} | 延迟: {self.latency.summary('capture_to_display')}"
                 status_label.config(text=status_text)
             
             # 动态刷新间隔（提高刷新频率）
@@ -259,21 +576,32 @@ class RemoteDesktopClient:
         
         def on_closing():
             """窗口关闭"""
-            self.running = False
-            if self.socket:
-                self.socket.close()
-            root.quit()
+            self.stop()
+            if master is None:
+                root.quit()
             root.destroy()
         
         def on_key_press(event):
             """键盘事件"""
             if event.char == 'q' or event.keysym == 'Escape':
                 on_closing()
+            elif event.char in ('+', '='):
+                self.zoom(1 / ZOOM_STEP)
+            elif event.char == '-':
+                self.zoom(ZOOM_STEP)
+            elif event.char == '0':
+                self.zoom(float('inf'))  # 整个屏幕
+            elif event.char == 'f':
+                self.cycle_format()
+            elif event.keysym in ('Left', 'Right', 'Up', 'Down'):
+                dx = {'Left': -PAN_STEP, 'Right': PAN_STEP}.get(event.keysym, 0)
+                dy = {'Up': -PAN_STEP, 'Down': PAN_STEP}.get(event.keysym, 0)
+                self.pan(dx, dy)
             elif event.char == 's':
-                # 保存截图
-                if self.current_frame is not None:
+                # 保存截图（帧缓冲分辨率）
+                if self.image is not None:
                     filename = f"remote_screenshot_{int(time.time())}.png"
-                    cv2.imwrite(filename, self.current_frame)
+                    cv2.imwrite(filename, self.image[:, :, :3])
                     print(f"[客户端] 截图已保存: {filename}")
         
         # 绑定事件
@@ -284,29 +612,183 @@ class RemoteDesktopClient:
         root.after(100, update_frame)
         
         # 主循环
-        root.mainloop()
+        if master is None:
+            root.mainloop()
     
     def run(self):
         """运行客户端"""
+        if self.view is None and not self.latency_marker:
+            # 只显示DISPLAY_WIDTH宽的画面，请求服务器缩放后再传输（延迟标记需要原始分辨率才能读出）
+            self.view = View(width=DISPLAY_WIDTH)
         if not self.connect():
             return
         
-        # 启动接收线程
-        recv_thread = threading.Thread(target=self.receive_loop, daemon=True)
+        # 启动接收线程（含断线重连）
+        recv_thread = threading.Thread(target=self.connection_loop, name="receive", daemon=True)
         recv_thread.start()
         
         # 启动GUI
         self.start_gui()
         
+        print("[客户端] 延迟统计:")
+        print(self.latency.report())
         print("[客户端] 已退出")
+    
+    def run_headless(self, duration=None):
+        """无界面运行：接收并解码（断线自动重连），直到duration秒后，duration为None时运行到Ctrl+C
+        
+        Returns:
+            是否成功连接
+        """
+        if not self.connect():
+            return False
+        
+        recv_thread = threading.Thread(target=self.connection_loop, name=f"receive {self.metrics.viewer}",
+                                       daemon=True)
+        recv_thread.start()
+        try:
+            recv_thread.join(duration)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+        recv_thread.join(1.0)
+        return True
+
+
+def run_streams(host, port, streams=None, headless=False, duration=None, view=None, dial=None, **kwargs):
+    """通过一个多路复用连接接收多个流（见multiplex.py），每个流一个客户端，GUI模式下各一个窗口
+    
+    streams为流号列表，None表示服务器的全部流；dial为建立连接的函数（见MuxConnection，None时使用TCP）；
+    其余参数同RemoteDesktopClient。
+    
+    Returns:
+        各流的客户端（未能连接时为空列表）
+    """
+    mux = MuxConnection(host, port, dial)
+    try:
+        names = mux.connect()
+    except OSError as e:
+        print(f"[客户端] 连接失败: {e}")
+        return []
+    print(f"[客户端] 多路复用连接: " + ", ".join(f"{i}={name}" for i, name in enumerate(names)))
+    if view is None and not headless:
+        view = View(width=DISPLAY_WIDTH)
+    titles, clients = [], []
+    for stream in (range(len(names)) if streams is None else streams):
+        client = RemoteDesktopClient(host, port, viewer=f"stream{stream}", headless=headless, view=view,
+                                     connector=functools.partial(mux.open_stream, stream), **kwargs)
+        if client.connect():
+            clients.append(client)
+            titles.append(f"远程桌面 - {host}:{port} 流 {stream} ({names[stream]})")
+    threads = []
+    for client in clients:
+        thread = threading.Thread(target=client.connection_loop, name=f"receive {client.metrics.viewer}",
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+    
+    if headless:
+        try:
+            deadline = time.time() + duration if duration is not None else None
+            while any(thread.is_alive() for thread in threads) and (deadline is None or time.time() < deadline):
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            pass
+    elif clients:
+        import tkinter as tk
+        master = tk.Tk()
+        master.withdraw()
+        for client, title in zip(clients, titles):
+            client.start_gui(master, title)
+        
+        def check_closed():
+            if any(client.running for client in clients):
+                master.after(200, check_closed)
+            else:
+                master.quit()
+        master.after(200, check_closed)
+        master.mainloop()
+    
+    for client in clients:
+        client.stop()
+    for thread in threads:
+        thread.join(1.0)
+    mux.close()
+    return clients
 
 
 if __name__ == "__main__":
     import sys
     
-    # 命令行参数: python client.py [host] [port]
-    host = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
-    port = int(sys.argv[2]) if len(sys.argv) > 2 else 9999
+    # 命令行参数: python client.py [host] [port] [--latency-marker] [--metrics-port=9102] [--trace=FILE]
+    #            [--headless] [--duration=秒] [--throttle=KB/s] [--output=宽[x高]] [--viewport=左,上,右,下]
+    #            [--native] [--pixel-format=bgra|rgb565|yuv420|gray8|auto] [--streams[=0,1,...]]
+    #            [--udp] [--fec-group=N] [--udp-loss=比例] [--udp-reorder=比例]
+    latency_marker = '--latency-marker' in sys.argv
+    headless = '--headless' in sys.argv
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    metrics_port = int(options.get('metrics-port', 0))
+    trace_path = options.get('trace')
+    duration = float(options['duration']) if 'duration' in options else None
+    throttle = float(options['throttle']) * 1024 if 'throttle' in options else None
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    host = args[0] if len(args) > 0 else '127.0.0.1'
+    port = int(args[1]) if len(args) > 1 else 9999
+    # 视图：--output 请求输出分辨率，--viewport 只看屏幕的一部分，--native 以原始分辨率接收整个屏幕
+    # --pixel-format 请求低精度的传输像素格式（auto由服务器按链路状况选择）
+    view = None
+    if 'output' in options or 'viewport' in options:
+        output = [int(v) for v in options.get('output', '0').split('x')] + [0]
+        viewport = [int(v) for v in options['viewport'].split(',')] if 'viewport' in options else [0, 0, 0, 0]
+        view = View(output[0], output[1], *viewport)
+    elif '--native' in sys.argv:
+        view = View()
+    if 'pixel-format' in options:
+        codes = {name: code for code, name in PIXEL_FORMAT_NAMES.items()}
+        view = (view or View(width=0 if headless else DISPLAY_WIDTH))._replace(
+            pixel_format=codes[options['pixel-format']])
+    
+    # --udp 使用数据报传输（服务器须以 --udp 启动），--udp-loss/--udp-reorder 模拟发出数据报的丢包/乱序（测试用）
+    dial = None
+    if '--udp' in sys.argv:
+        simulator = None
+        if 'udp-loss' in options or 'udp-reorder' in options:
+            simulator = NetworkSimulator(float(options.get('udp-loss', 0)),
+                                         reorder=float(options.get('udp-reorder', 0)))
+        dial = functools.partial(connect_datagram, fec_group=int(options.get('fec-group', FEC_GROUP)),
+                                 simulator=simulator)
+    
+    if trace_path:
+        TRACER.enable(process_name="client")
+    if metrics_port:
+        start_http_server(metrics_port, routes={'/trace': ('application/json', TRACER.to_json)})
+    
+    if '--streams' in sys.argv or 'streams' in options:
+        # 多路复用服务器：同一连接接收多个流（默认全部），每个流一个客户端
+        streams = [int(v) for v in options['streams'].split(',')] if 'streams' in options else None
+        for client in run_streams(host, port, streams, headless=headless, duration=duration, view=view,
+                                  dial=dial, latency_marker=latency_marker, throttle=throttle):
+            metrics = client.metrics
+            elapsed = time.time() - metrics.start_time
+            print(f"[客户端] {metrics.viewer}: 接收 {metrics.frames.value} 次更新 | "
+                  f"平均 {metrics.frames.value / elapsed:.1f} fps | "
+                  f"带宽 {metrics.bytes_received.value / elapsed / 1024 / 1024:.2f} MB/s")
+        if trace_path:
+            print(f"[客户端] 已写入追踪文件 {trace_path} ({TRACER.export(trace_path)} 个事件)")
+        sys.exit(0)
+    
+    client = RemoteDesktopClient(server_host=host, server_port=port, latency_marker=latency_marker,
+                                 headless=headless, throttle=throttle, view=view,
+                                 connector=functools.partial(dial, host, port) if dial else None)
+    if headless:
+        client.run_headless(duration)
+        metrics = client.metrics
+        elapsed = time.time() - metrics.start_time
+        print(f"[客户端] 接收 {metrics.frames.value} 次更新 | 平均 {metrics.frames.value / elapsed:.1f} fps | "
+              f"带宽 {metrics.bytes_received.value / elapsed / 1024 / 1024:.2f} MB/s")
+        print(client.latency.report())
+    else:
+        client.run()
     
-    client = RemoteDesktopClient(server_host=host, server_port=port)
-    client.run()
+    if trace_path:
+        print(f"[客户端] 已写入追踪文件 {trace_path} ({TRACER.export(trace_path)} 个事件)")
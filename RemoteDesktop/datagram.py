@@ -0,0 +1,768 @@
+"""
+远程桌面 - 数据报（UDP）传输：分片、FEC与按需重传
+TCP中一个报文段丢失，其后的所有数据都要等它重传（队头阻塞），Wi-Fi等有随机丢包的链路上延迟抖动很大。
+数据报传输把每个数据包（Protocol的包，不含长度前缀）切成不超过FRAGMENT_SIZE的分片，分片号连续递增：
+
+    FEC        每fec_group个分片再发一个奇偶校验分片（各分片按位异或），组内只丢一个分片时接收端直接恢复，不需要往返
+    NACK重传   接收端发现FEC无法恢复的缺失分片时请求重传；发送端只重传关键包的分片，
+               可丢弃的包（跳帧、心跳、校验和，见EXPENDABLE）回复"已放弃"（DG_GONE），接收端跳过该包
+
+接收端仍按发送顺序交付数据包（XOR增量必须按序应用），Protocol的包语义不变：
+两端各以一个本地socket（socket.socketpair的一端）与原有的服务器会话/客户端交换带长度前缀的数据包，
+用法与TCP连接、多路复用的流相同（见multiplex.py）。交付队列不限长度，积压量受会话在途窗口限制。
+
+数据报格式:
+    DG_HELLO/DG_WELCOME  [kind:1][nonce:8]                      建立连接（nonce区分同一地址的新旧连接）
+    DG_DATA      [kind:1][fragment:4][flags:1][index:2][count:2] + 分片数据（index/count为该包的第几片/共几片）
+    DG_PARITY    [kind:1][first:4][count:1][size:2] + 组内各分片flags起的部分按位异或（短的补0），size为其长度的异或
+    DG_FEEDBACK  [kind:1][next:4][received:4][n:2] + n×[fragment:4]
+                 next为本端下一个要发送的分片号（对端据此发现末尾的丢失），received之前的分片都已收到（累计确认），
+                 其后为请求重传的分片（NACK）；同时作为保活
+    DG_GONE      [kind:1][n:2] + n×[fragment:4][flags:1][index:2][count:2]   不再重传的分片
+    DG_CLOSE     [kind:1]
+
+用法:
+    python server.py --source typing --udp
+    python client.py 127.0.0.1 9999 --udp
+    python client.py 127.0.0.1 9999 --udp --udp-loss=0.05 --udp-reorder=0.05   # 模拟丢包/乱序
+    python datagram.py --loss 0.05 --burst 2 --reorder 0.05                     # 本机回环测试
+"""
+
+import heapq
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from queue import Queue
+from typing import Callable, Dict, List, Optional, Tuple
+
+from protocol import Protocol, PKT_SKIP, PKT_HEARTBEAT, PKT_CHECKSUM, PKT_STREAM, STREAM_HEADER
+from metrics import REGISTRY
+
+# 分片数据的最大长度（字节）：加上包头与IP/UDP头后不超过常见的1280字节路径MTU
+FRAGMENT_SIZE = 1200
+# 默认每组分片数（每组一个奇偶校验分片，开销约1/FEC_GROUP；0表示不用FEC），上限255
+FEC_GROUP = 8
+MAX_FEC_GROUP = 255
+# 发送端未被确认的字节上限（超出时暂停读取本地socket，向上层施加背压）
+SEND_WINDOW = 8 * 1024 * 1024
+# 定时任务间隔；收到数据后回复反馈（确认/NACK）的最小间隔
+TICK = 0.005
+FEEDBACK_INTERVAL = 0.01
+# 发现缺失后等待多久才请求重传（容忍乱序）、同一分片重复请求的间隔、一个反馈中最多请求的分片数
+NACK_DELAY = 0.01
+NACK_RETRY = 0.05
+MAX_NACKS = 128
+# 无数据时的保活间隔、多久收不到对端的数据报判为断开
+KEEPALIVE = 0.5
+LINK_TIMEOUT = 5.0
+# 建立连接：DG_HELLO重发间隔与超时
+HELLO_RETRY = 0.2
+CONNECT_TIMEOUT = 3.0
+# 本端关闭后等待已发送数据被确认的时间
+DRAIN_TIMEOUT = 1.0
+# UDP socket收发缓冲
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+# 数据报类型
+DG_HELLO = 0
+DG_WELCOME = 1
+DG_DATA = 2
+DG_PARITY = 3
+DG_FEEDBACK = 4
+DG_GONE = 5
+DG_CLOSE = 6
+
+DATAGRAM_NAMES = {
+    DG_HELLO: 'hello',
+    DG_WELCOME: 'welcome',
+    DG_DATA: 'data',
+    DG_PARITY: 'parity',
+    DG_FEEDBACK: 'feedback',
+    DG_GONE: 'gone',
+    DG_CLOSE: 'close',
+}
+
+HELLO = struct.Struct('!B8s')
+FRAGMENT_HEADER = struct.Struct('!BI')       # [kind][fragment]，其后为分片体
+FRAGMENT_INFO = struct.Struct('!BHH')        # 分片体的头: [flags][index][count]（奇偶校验覆盖分片体）
+PARITY_HEADER = struct.Struct('!BIBH')
+FEEDBACK_HEADER = struct.Struct('!BIIH')
+GONE_HEADER = struct.Struct('!BH')
+
+FLAG_CRITICAL = 0x01   # 关键包：丢失后必须重传
+_ABANDONED = 0x80      # 仅接收端内部使用：发送端已放弃的分片（只有分片体的头，没有数据）
+
+# 丢失后不重传的数据包：跳帧、心跳（下一次心跳会重新测量）、校验和（定期下发）。
+# 确认包虽是累计确认，丢失最后一个仍可能使在途窗口一直满，按关键包处理
+EXPENDABLE = frozenset((PKT_SKIP, PKT_HEARTBEAT, PKT_CHECKSUM))
+
+# 指标（所有连接合计）
+DATAGRAMS = REGISTRY.counter('rd_udp_datagrams_total', "发送的数据报", ['kind'])
+RECOVERED = REGISTRY.counter('rd_udp_fec_recovered_total', "由奇偶校验恢复的分片数").labels()
+RETRANSMITTED = REGISTRY.counter('rd_udp_retransmitted_total', "按NACK重传的分片数").labels()
+ABANDONED = REGISTRY.counter('rd_udp_abandoned_total', "丢失后未重传而跳过的数据包（可丢弃的包）").labels()
+
+Accept = Callable[[socket.socket, Tuple], None]
+
+
+def is_critical(packet) -> bool:
+    """丢失后是否必须重传（多路复用连接按流数据包中的原数据包判断，空的流数据包即关闭流，也是关键包）"""
+    pkt_type = packet[0]
+    if pkt_type == PKT_STREAM and len(packet) > STREAM_HEADER.size:
+        pkt_type = packet[STREAM_HEADER.size]
+    return pkt_type not in EXPENDABLE
+
+
+def _xor(blocks: List[bytes], size: int) -> int:
+    """各块（短的在末尾补0到size）的按位异或，以整数表示"""
+    value = 0
+    for block in blocks:
+        value ^= int.from_bytes(block, 'big') << (8 * (size - len(block)))
+    return value
+
+
+def _close(sock: socket.socket) -> None:
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def _tune(sock: socket.socket) -> None:
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        except OSError:
+            pass
+
+
+class NetworkSimulator:
+    """丢包/乱序模拟（测试用），代替socket.sendto发出数据报
+
+    loss为平均丢包率，burst为平均连续丢失的数据报数（两状态的Gilbert模型）；
+    reorder为数据报被推迟reorder_delay秒发出（被其后的数据报超过）的概率；delay为所有数据报的固定单程延迟（秒）。
+    """
+
+    def __init__(self, loss: float = 0.0, burst: float = 1.0, reorder: float = 0.0,
+                 reorder_delay: float = 0.005, delay: float = 0.0, seed: Optional[int] = None):
+        burst = max(burst, 1.0)
+        self.loss = loss
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.delay = delay
+        # 丢失后继续丢失的概率为1-1/burst；正常时开始丢失的概率p使稳态丢包率 p / (p + 1/burst) 等于loss
+        self.keep_losing = 1 - 1 / burst
+        self.start_losing = min(1.0, loss / (burst * (1 - loss))) if loss < 1 else 1.0
+        self.random = random.Random(seed)
+        self.losing = False
+        self.dropped = 0
+        self.reordered = 0
+        self.pending = []  # (到期时间, 序号, socket, 数据报, 地址)
+        self.counter = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def sendto(self, sock: socket.socket, data: bytes, address: Tuple) -> None:
+        with self.cond:
+            self.losing = self.random.random() < (self.keep_losing if self.losing else self.start_losing)
+            if self.losing:
+                self.dropped += 1
+                return
+            delay = self.delay
+            if self.reorder and self.random.random() < self.reorder:
+                delay += self.reorder_delay
+                self.reordered += 1
+            if not delay:
+                sock.sendto(data, address)
+                return
+            self.counter += 1
+            heapq.heappush(self.pending, (time.monotonic() + delay, self.counter, sock, bytes(data), address))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._release, daemon=True, name="udp simulator")
+                self.thread.start()
+            self.cond.notify()
+
+    def _release(self) -> None:
+        """按到期时间发出被推迟的数据报"""
+        while True:
+            with self.cond:
+                while not self.pending or self.pending[0][0] > time.monotonic():
+                    self.cond.wait(self.pending[0][0] - time.monotonic() if self.pending else None)
+                _, _, sock, data, address = heapq.heappop(self.pending)
+            try:
+                sock.sendto(data, address)
+            except OSError:
+                pass
+
+
+class DatagramLink:
+    """一个数据报连接：本地socket上的数据包 ⇄ 分片/FEC/重传的数据报
+
+    发送线程（_forward）从本地socket读取数据包，分片发出，保留到被对端累计确认；
+    on_datagram（端点线程调用）按分片号收集分片，由奇偶校验恢复或请求重传缺失的分片，按序重组出完整的数据包
+    放入交付队列，交付线程（_deliver）写入本地socket。tick（端点线程定时调用）发送反馈与保活、检查超时。
+    """
+
+    def __init__(self, endpoint: 'DatagramEndpoint', address: Tuple, sock: socket.socket, nonce: bytes,
+                 fec_group: int = FEC_GROUP):
+        self.endpoint = endpoint
+        self.address = address
+        self.sock = sock
+        self.nonce = nonce
+        self.fec_group = min(fec_group, MAX_FEC_GROUP)
+        self.lock = threading.Condition()
+        self.closed = False
+        self.queue = Queue()  # 待交付的数据包，None表示交付完后关闭本地socket
+        now = time.monotonic()
+
+        # 发送端
+        self.next_fragment = 0    # 下一个分片号
+        self.acked = 0            # 对端已收到此前的全部分片
+        self.sent = {}            # 分片号 → DG_DATA数据报（未被确认，供重传）
+        self.sent_bytes = 0
+        self.group = []           # 当前FEC组的分片体
+        self.group_first = 0
+        self.group_critical = False
+        self.last_sent = now
+        self.last_data_sent = now
+        self.probe_interval = FEEDBACK_INTERVAL  # 有未确认数据且空闲时发送反馈（让对端发现末尾丢失）的间隔，逐次加倍
+
+        # 接收端
+        self.received = 0         # 此前的分片都已收到/恢复/放弃，并已重组
+        self.peer_next = 0        # 对端下一个要发送的分片号
+        self.scanned = 0          # 已检查过缺失的分片号上界
+        self.fragments = {}       # 分片号 → 分片体（重组后保留最近MAX_FEC_GROUP个，供恢复同组的分片）
+        self.consumed = deque()
+        self.abandoned = set()
+        self.parities = {}        # 组的第一个分片号 → (分片数, 长度异或, 奇偶校验数据)
+        self.missing = {}         # 分片号 → [发现时间, 上次请求重传的时间]
+        self.message = []         # 正在重组的数据包的各分片数据
+        self.message_broken = False
+        self.feedback_due = False
+        self.last_feedback = now
+        self.last_received = now
+
+    def start(self) -> None:
+        name = f"udp {self.address[0]}:{self.address[1]}"
+        threading.Thread(target=self._forward, daemon=True, name=name).start()
+        threading.Thread(target=self._deliver, daemon=True, name=f"{name} deliver").start()
+
+    # ---- 发送 ----
+
+    def _transmit(self, datagram: bytes, kind: int) -> None:
+        try:
+            self.endpoint.sendto(datagram, self.address)
+        except OSError:
+            pass  # 发送失败等同丢包
+        self.last_sent = time.monotonic()
+        DATAGRAMS.labels(kind=DATAGRAM_NAMES[kind]).inc()
+
+    def _forward(self) -> None:
+        """发送线程：本地socket上的数据包 → 数据报；本地一端关闭时等已发数据被确认后关闭连接"""
+        try:
+            while not self.closed:
+                packet = Protocol.recv_packet(self.sock)
+                if not packet:
+                    self._drain()
+                    break
+                self.send(packet)
+                if not select.select([self.sock], [], [], 0)[0]:
+                    self.flush()
+        except (OSError, ValueError):
+            pass
+        self.close()
+
+    def send(self, packet: bytes) -> None:
+        """分片发送一个数据包（未确认的数据超过SEND_WINDOW时等待）"""
+        flags = FLAG_CRITICAL if is_critical(packet) else 0
+        count = max(1, -(-len(packet) // FRAGMENT_SIZE))
+        if count > 0xFFFF:
+            raise ValueError(f"数据包过大: {len(packet)} 字节")
+        data = memoryview(packet)
+        for index in range(count):
+            body = FRAGMENT_INFO.pack(flags, index, count) + data[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE]
+            with self.lock:
+                while self.sent_bytes >= SEND_WINDOW and not self.closed:
+                    self.lock.wait(0.1)
+                if self.closed:
+                    return
+                fragment = self.next_fragment
+                self.next_fragment += 1
+                datagram = FRAGMENT_HEADER.pack(DG_DATA, fragment) + body
+                self.sent[fragment] = datagram
+                self.sent_bytes += len(datagram)
+                parity = None
+                if self.fec_group:
+                    if not self.group:
+                        self.group_first = fragment
+                    self.group.append(body)
+                    self.group_critical = self.group_critical or bool(flags & FLAG_CRITICAL)
+                    if len(self.group) >= self.fec_group:
+                        parity = self._parity()
+            self._transmit(datagram, DG_DATA)
+            self.last_data_sent = time.monotonic()
+            if parity is not None:
+                self._transmit(parity, DG_PARITY)
+
+    def flush(self) -> None:
+        """暂无后续数据包：当前组含关键包的分片时立即发出奇偶校验，不等凑满一组"""
+        with self.lock:
+            parity = self._parity() if self.group and self.group_critical else None
+        if parity is not None:
+            self._transmit(parity, DG_PARITY)
+
+    def _parity(self) -> bytes:
+        """当前组的奇偶校验数据报，并开始新的一组（调用方持有lock）"""
+        size = max(len(body) for body in self.group)
+        lengths = 0
+        for body in self.group:
+            lengths ^= len(body)
+        datagram = (PARITY_HEADER.pack(DG_PARITY, self.group_first, len(self.group), lengths) +
+                    _xor(self.group, size).to_bytes(size, 'big'))
+        self.group = []
+        self.group_critical = False
+        return datagram
+
+    def _drain(self) -> None:
+        """等待已发送的分片被确认（最多DRAIN_TIMEOUT秒）"""
+        self.flush()
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        with self.lock:
+            while self.acked < self.next_fragment and not self.closed and time.monotonic() < deadline:
+                self.lock.wait(0.05)
+
+    def _on_feedback(self, data: bytes) -> Tuple[List[bytes], List[bytes]]:
+        """处理对端的确认与重传请求，返回 (重传的数据报, 放弃的分片项)（调用方持有lock）"""
+        _, peer_next, received, count = FEEDBACK_HEADER.unpack_from(data)
+        nacks = struct.unpack_from(f'!{count}I', data, FEEDBACK_HEADER.size)
+        self.peer_next = max(self.peer_next, peer_next)
+        if received > self.acked:
+            for fragment in range(self.acked, min(received, self.next_fragment)):
+                datagram = self.sent.pop(fragment, None)
+                if datagram is not None:
+                    self.sent_bytes -= len(datagram)
+            self.acked = received
+            self.probe_interval = FEEDBACK_INTERVAL
+            self.lock.notify_all()
+        resend, gone = [], []
+        for fragment in nacks:
+            datagram = self.sent.get(fragment)
+            if datagram is None:
+                continue
+            if datagram[FRAGMENT_HEADER.size] & FLAG_CRITICAL:
+                resend.append(datagram)
+            else:
+                gone.append(datagram[1:FRAGMENT_HEADER.size + FRAGMENT_INFO.size])
+        return resend, gone
+
+    # ---- 接收 ----
+
+    def on_datagram(self, kind: int, data: bytes) -> None:
+        """处理一个数据报（端点线程调用）"""
+        if kind == DG_CLOSE:
+            self.close(notify=False)
+            return
+        resend = gone = ()
+        with self.lock:
+            self.last_received = time.monotonic()
+            if kind == DG_DATA:
+                _, fragment = FRAGMENT_HEADER.unpack_from(data)
+                self._add_fragment(fragment, data[FRAGMENT_HEADER.size:])
+                self.peer_next = max(self.peer_next, fragment + 1)
+                self.feedback_due = True
+            elif kind == DG_PARITY:
+                _, first, count, lengths = PARITY_HEADER.unpack_from(data)
+                if count and first + count > self.received:
+                    self.parities[first] = (count, lengths, data[PARITY_HEADER.size:])
+                    self.peer_next = max(self.peer_next, first + count)
+                    self._recover(first)
+                self.feedback_due = True
+            elif kind == DG_FEEDBACK:
+                resend, gone = self._on_feedback(data)
+            elif kind == DG_GONE:
+                _, count = GONE_HEADER.unpack_from(data)
+                item = FRAGMENT_HEADER.size - 1 + FRAGMENT_INFO.size
+                for offset in range(GONE_HEADER.size, GONE_HEADER.size + count * item, item):
+                    fragment, = struct.unpack_from('!I', data, offset)
+                    if fragment >= self.received and fragment not in self.fragments:
+                        self.fragments[fragment] = data[offset + 4:offset + item]
+                        self.abandoned.add(fragment)
+            else:
+                return
+            packets = self._reassemble()
+        for packet in packets:
+            self.queue.put(packet)
+        for datagram in resend:
+            self._transmit(datagram, DG_DATA)
+            RETRANSMITTED.inc()
+        if gone:
+            self._transmit(GONE_HEADER.pack(DG_GONE, len(gone)) + b''.join(gone), DG_GONE)
+
+    def _add_fragment(self, fragment: int, body: bytes) -> None:
+        """收到一个分片（调用方持有lock）"""
+        if fragment < self.received or fragment in self.fragments:
+            return  # 重复（重传或已由奇偶校验恢复）
+        self.fragments[fragment] = body
+        self.missing.pop(fragment, None)
+        for first, (count, _, _) in list(self.parities.items()):
+            if first <= fragment < first + count:
+                self._recover(first)
+
+    def _recover(self, first: int) -> None:
+        """组内只缺一个分片时由奇偶校验恢复（调用方持有lock）"""
+        count, lengths, parity = self.parities[first]
+        group = range(first, first + count)
+        missing = [fragment for fragment in group if fragment not in self.fragments]
+        if len(missing) != 1 or missing[0] < self.received:
+            if not missing:
+                del self.parities[first]
+            return
+        lost = missing[0]
+        others = [self.fragments[fragment] for fragment in group if fragment != lost]
+        if any(fragment in self.abandoned for fragment in group):
+            return
+        for body in others:
+            lengths ^= len(body)
+        if lengths > len(parity):
+            return
+        body = (int.from_bytes(parity, 'big') ^ _xor(others, len(parity))).to_bytes(len(parity), 'big')
+        self.fragments[lost] = body[:lengths]
+        self.missing.pop(lost, None)
+        del self.parities[first]
+        RECOVERED.inc()
+
+    def _reassemble(self) -> List[bytes]:
+        """按分片号顺序重组出完整的数据包（调用方持有lock）"""
+        packets = []
+        while self.received in self.fragments:
+            fragment = self.received
+            body = self.fragments[fragment]
+            _, index, count = FRAGMENT_INFO.unpack_from(body)
+            if index == 0:
+                self.message = []
+                self.message_broken = False
+            if fragment in self.abandoned:
+                self.message_broken = True
+            else:
+                self.message.append(body[FRAGMENT_INFO.size:])
+            if index == count - 1:
+                if self.message_broken:
+                    ABANDONED.inc()
+                else:
+                    packets.append(b''.join(self.message))
+                self.message = []
+            self.received += 1
+            self.missing.pop(fragment, None)
+            self.consumed.append(fragment)
+        # 同组的分片可能还要用于恢复：保留最近MAX_FEC_GROUP个
+        while self.consumed and self.consumed[0] < self.received - MAX_FEC_GROUP:
+            fragment = self.consumed.popleft()
+            self.fragments.pop(fragment, None)
+            self.abandoned.discard(fragment)
+        for first in [first for first, (count, _, _) in self.parities.items() if first + count <= self.received]:
+            del self.parities[first]
+        return packets
+
+    def _deliver(self) -> None:
+        """交付线程：队列中的数据包 → 本地socket，遇到关闭标记后关闭本地socket"""
+        try:
+            while True:
+                packet = self.queue.get()
+                if packet is None:
+                    break
+                Protocol.send_packet(self.sock, packet)
+        except OSError:
+            pass
+        _close(self.sock)
+        self.close()
+
+    # ---- 定时任务 ----
+
+    def tick(self, now: float) -> None:
+        """发送确认/重传请求/保活，检查超时（端点线程定时调用）"""
+        if self.closed:
+            return
+        if now - self.last_received > LINK_TIMEOUT:
+            print(f"[数据报] {self.address} 超过 {LINK_TIMEOUT:.0f}s 未收到数据，断开")
+            self.close()
+            return
+        with self.lock:
+            for fragment in range(max(self.scanned, self.received), self.peer_next):
+                if fragment not in self.fragments:
+                    self.missing.setdefault(fragment, [now, 0.0])
+            self.scanned = max(self.scanned, self.peer_next)
+            nacks = []
+            for fragment in sorted(self.missing):
+                found, requested = self.missing[fragment]
+                if now - found >= NACK_DELAY and now - requested >= NACK_RETRY:
+                    self.missing[fragment][1] = now
+                    nacks.append(fragment)
+                    if len(nacks) >= MAX_NACKS:
+                        break
+            probe = self.acked < self.next_fragment and now - self.last_data_sent >= self.probe_interval
+            if not (nacks or probe or now - self.last_sent >= KEEPALIVE or
+                    self.feedback_due and now - self.last_feedback >= FEEDBACK_INTERVAL):
+                return
+            if probe:
+                self.probe_interval = min(self.probe_interval * 2, KEEPALIVE)
+                self.last_data_sent = now
+            self.feedback_due = False
+            self.last_feedback = now
+            datagram = (FEEDBACK_HEADER.pack(DG_FEEDBACK, self.next_fragment, self.received, len(nacks)) +
+                        struct.pack(f'!{len(nacks)}I', *nacks))
+        self._transmit(datagram, DG_FEEDBACK)
+
+    def close(self, notify: bool = True) -> None:
+        """关闭连接：通知对端（notify），已交付队列中的数据包写完后关闭本地socket"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.lock.notify_all()
+        if notify:
+            self._transmit(bytes([DG_CLOSE]), DG_CLOSE)
+        self.queue.put(None)
+        self.endpoint.remove(self)
+
+
+class DatagramEndpoint:
+    """一个UDP socket及其上的数据报连接（服务器端按对端地址区分多个连接，客户端只有一个）
+
+    run()在调用线程中读取数据报分发给各连接，并定时执行各连接的tick。
+    accept不为None时（服务器端），收到新地址的DG_HELLO时创建连接，在新线程中调用 accept(本地socket, 地址)；
+    为None时（客户端）连接关闭后端点随之关闭。simulator不为None时所有发出的数据报经其模拟丢包/乱序。
+    """
+
+    def __init__(self, sock: socket.socket, accept: Optional[Accept] = None, fec_group: int = FEC_GROUP,
+                 simulator: Optional[NetworkSimulator] = None, name: str = "udp"):
+        self.sock = sock
+        self.accept = accept
+        self.fec_group = fec_group
+        self.simulator = simulator
+        self.name = name
+        self.links: Dict[Tuple, DatagramLink] = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def sendto(self, data: bytes, address: Tuple) -> None:
+        if self.simulator is not None:
+            self.simulator.sendto(self.sock, data, address)
+        else:
+            self.sock.sendto(data, address)
+
+    def open(self, address: Tuple, sock: socket.socket, nonce: bytes) -> DatagramLink:
+        """创建到address的连接，sock为与上层交换数据包的本地socket"""
+        link = DatagramLink(self, address, sock, nonce, self.fec_group)
+        with self.lock:
+            old = self.links.get(address)
+            self.links[address] = link
+        if old is not None:
+            old.close(notify=False)
+        link.start()
+        return link
+
+    def remove(self, link: DatagramLink) -> None:
+        """连接已关闭（客户端端点随之关闭）"""
+        with self.lock:
+            if self.links.get(link.address) is link:
+                del self.links[link.address]
+        if self.accept is None:
+            self.close()
+
+    def _dispatch(self, data: bytes, address: Tuple) -> None:
+        kind = data[0]
+        with self.lock:
+            link = self.links.get(address)
+        if kind == DG_HELLO and len(data) >= HELLO.size:
+            _, nonce = HELLO.unpack_from(data)
+            if link is None or link.nonce != nonce:
+                if self.accept is None:
+                    return
+                # 新连接（同一地址的新nonce表示对端重新连接，旧连接作废）
+                local, remote = socket.socketpair()
+                self.open(address, remote, nonce)
+                threading.Thread(target=self.accept, args=(local, address), daemon=True,
+                                 name=f"sender {address[0]}:{address[1]}").start()
+            self.sendto(HELLO.pack(DG_WELCOME, nonce), address)  # 重复的DG_HELLO说明DG_WELCOME丢失，再回复一次
+        elif link is not None:
+            link.on_datagram(kind, data)
+        elif self.accept is not None and kind != DG_CLOSE:
+            self.sendto(bytes([DG_CLOSE]), address)  # 未知的连接（如服务器重启后），让对端尽快重连
+
+    def run(self) -> None:
+        """读取数据报并执行定时任务，端点关闭时关闭所有连接后返回"""
+        self.sock.settimeout(TICK)
+        next_tick = time.monotonic()
+        while not self.closed:
+            try:
+                data, address = self.sock.recvfrom(65536)
+                if data:
+                    self._dispatch(data, address)
+            except socket.timeout:
+                pass
+            except ConnectionResetError:
+                pass  # Windows：之前发出的数据报收到ICMP端口不可达
+            except (OSError, struct.error):
+                if self.closed:
+                    break
+            now = time.monotonic()
+            if now >= next_tick:
+                next_tick = now + TICK
+                with self.lock:
+                    links = list(self.links.values())
+                for link in links:
+                    link.tick(now)
+        self.close()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            links = list(self.links.values())
+        for link in links:
+            link.close()
+        self.sock.close()
+
+
+def listen_datagram(host: str, port: int, accept: Accept, fec_group: int = FEC_GROUP,
+                    simulator: Optional[NetworkSimulator] = None) -> DatagramEndpoint:
+    """在UDP端口上接受数据报连接，每个连接在新线程中调用 accept(本地socket, 地址)
+
+    Returns:
+        端点（调用方在线程中运行其run()）
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    _tune(sock)
+    sock.bind((host, port))
+    return DatagramEndpoint(sock, accept, fec_group, simulator, name=f"udp {host}:{port}")
+
+
+def connect_datagram(host: str, port: int, fec_group: int = FEC_GROUP,
+                     simulator: Optional[NetworkSimulator] = None) -> socket.socket:
+    """建立到服务器的数据报连接，返回本地socket（按普通的服务器连接使用）"""
+    address = (socket.gethostbyname(host), port)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    _tune(sock)
+    endpoint = DatagramEndpoint(sock, fec_group=fec_group, simulator=simulator, name=f"udp {host}:{port}")
+    nonce = os.urandom(8)
+    hello = HELLO.pack(DG_HELLO, nonce)
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    sock.settimeout(HELLO_RETRY)
+    try:
+        while True:
+            if time.monotonic() > deadline:
+                raise ConnectionError(f"数据报连接 {host}:{port} 超时")
+            endpoint.sendto(hello, address)
+            try:
+                data, source = sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except ConnectionResetError:
+                time.sleep(HELLO_RETRY)
+                continue
+            if source == address and data == HELLO.pack(DG_WELCOME, nonce):
+                break
+    except Exception:
+        sock.close()
+        raise
+    local, remote = socket.socketpair()
+    endpoint.open(address, remote, nonce)
+    threading.Thread(target=endpoint.run, daemon=True, name=endpoint.name).start()
+    return local
+
+
+def _loopback(count: int, fec_group: int, simulator_args: Dict, seed: int) -> bool:
+    """回环测试：客户端发出count个数据包（脏矩形大小的关键包与跳帧/心跳），服务器端按序接收并核对
+
+    Returns:
+        关键包是否全部按序、逐字节一致地到达
+    """
+    from protocol import now_us
+
+    received = []
+    done = threading.Event()
+
+    def accept(sock, address):
+        while True:
+            packet = Protocol.recv_packet(sock)
+            if not packet:
+                break
+            received.append((time.perf_counter(), packet))
+            if len(received) == count:
+                done.set()
+        done.set()
+
+    counters = (RECOVERED, RETRANSMITTED, ABANDONED, DATAGRAMS.labels(kind='data'), DATAGRAMS.labels(kind='parity'))
+    before = [counter.value for counter in counters]
+    server_simulator = NetworkSimulator(seed=seed + 1, **simulator_args)
+    client_simulator = NetworkSimulator(seed=seed, **simulator_args)
+    endpoint = listen_datagram('127.0.0.1', 0, accept, fec_group, server_simulator)
+    threading.Thread(target=endpoint.run, daemon=True).start()
+    sock = connect_datagram('127.0.0.1', endpoint.sock.getsockname()[1], fec_group, client_simulator)
+
+    rng = random.Random(seed)
+    sent, send_times = [], {}
+    for seq in range(1, count + 1):
+        kind = rng.random()
+        if kind < 0.2:
+            packet = Protocol.pack_skip(seq, now_us())
+        elif kind < 0.3:
+            packet = Protocol.pack_heartbeat(now_us())
+        else:
+            size = int(rng.choice((200, 2000, 20000, 200000)) * rng.uniform(0.5, 1.5))
+            packet = Protocol.pack_dirty([{'left': 0, 'top': 0, 'right': size // 4, 'bottom': 1}],
+                                         rng.randbytes(size // 4 * 4), compress=False, seq=seq)
+        sent.append(packet)
+        send_times[packet] = time.perf_counter()
+        Protocol.send_packet(sock, packet)
+        time.sleep(0.002)
+    done.wait(timeout=10 + count * 0.01)
+    _close(sock)
+    endpoint.close()
+
+    critical = [packet for packet in sent if is_critical(packet)]
+    arrived = [packet for _, packet in received]
+    in_order = [packet for packet in arrived if is_critical(packet)] == critical
+    positions = {packet: i for i, packet in enumerate(sent)}
+    ordered = all(positions[a] < positions[b] for a, b in zip(arrived, arrived[1:]))
+    latency = sorted((t - send_times[packet]) * 1000 for t, packet in received)
+    recovered, retransmitted, abandoned, data, parity = (counter.value - value
+                                                         for counter, value in zip(counters, before))
+    expendable = len(sent) - len(critical)
+    print(f"[基准] FEC组 {fec_group or '无'}: 关键包 {len(critical)} 个全部按序一致到达: {in_order} | "
+          f"交付顺序正确: {ordered} | 可丢弃包到达 {len(arrived) - len(critical)}/{expendable}")
+    if latency:
+        print(f"[基准]   延迟 p50 {latency[len(latency) // 2]:.1f}ms | p99 {latency[int(len(latency) * 0.99)]:.1f}ms | "
+              f"最大 {latency[-1]:.1f}ms | FEC恢复 {recovered:.0f} | 重传 {retransmitted:.0f} | 放弃 {abandoned:.0f} | "
+              f"模拟丢弃 {client_simulator.dropped + server_simulator.dropped} / "
+              f"乱序 {client_simulator.reordered + server_simulator.reordered} | "
+              f"奇偶校验开销 {parity / max(1, data) * 100:.1f}%")
+    return in_order and ordered
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="数据报传输回环测试（注入丢包/乱序）")
+    parser.add_argument('--count', type=int, default=300, help="发送的数据包数")
+    parser.add_argument('--loss', type=float, default=0.05, help="平均丢包率")
+    parser.add_argument('--burst', type=float, default=1.5, help="平均连续丢失的数据报数")
+    parser.add_argument('--reorder', type=float, default=0.05, help="数据报被推迟（乱序）的概率")
+    parser.add_argument('--delay', type=float, default=0.0, help="单程延迟（毫秒）")
+    parser.add_argument('--fec-group', type=int, nargs='+', default=[FEC_GROUP, 0],
+                        help="比较的FEC组大小（0表示不用FEC）")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    impairments = dict(loss=args.loss, burst=args.burst, reorder=args.reorder, delay=args.delay / 1000)
+    results = [_loopback(args.count, group, impairments, args.seed) for group in args.fec_group]
+    print(f"[检查] {sum(results)}/{len(results)} 项通过")
+    sys.exit(0 if all(results) else 1)
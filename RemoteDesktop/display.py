@@ -0,0 +1,106 @@
+"""
+远程桌面 - 增量显示缓冲
+客户端窗口的画面是帧缓冲缩放后的结果。每次更新都对整帧做颜色转换和缩放，在4K下要几十毫秒，
+而大多数更新只改动了几个小矩形。
+
+DisplayBuffer 持有一份显示分辨率的RGB缓冲，客户端的解码线程应用完更新后只把脏矩形对应的显示区域
+重新缩放（cv2.remap，使用整帧的坐标映射，逐块结果与整帧缩放一致，不会在矩形边界出现接缝）并转换颜色；
+GUI线程取走累积的显示区域（take）后只把这些区域写入画布图像，不接触完整帧。
+"""
+
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from buffers import ScratchBuffer
+
+# 累积的显示区域超过此数量时合并为外接矩形（GUI跟不上时避免列表无限增长）
+MAX_PENDING_RECTS = 64
+
+
+class DisplayBuffer:
+    """帧缓冲（BGRA）到显示分辨率RGB缓冲的增量缩放
+
+    update()由解码线程调用，take()由GUI线程调用，二者以lock同步。
+    """
+
+    def __init__(self, width: int, height: int, display_width: int, display_height: int):
+        self.display_width = display_width
+        self.display_height = display_height
+        self.rgb = np.zeros((display_height, display_width, 3), dtype=np.uint8)
+        self.lock = threading.Lock()
+        self._scratch = ScratchBuffer()  # 缩放后、颜色转换前的BGRA区域
+        self._pending: List[Tuple[int, int, int, int]] = []  # 待显示区域 (x0, y0, x1, y1)
+        self._pending_since = 0.0  # 最早一个待显示区域的加入时间（perf_counter）
+        self._latest = (0, 0, 0)  # 最近一次更新的 (seq, capture_us, decode_us)
+        self._set_source(width, height)
+
+    def _set_source(self, width: int, height: int) -> None:
+        """按源尺寸计算整帧的坐标映射（与cv2.resize的INTER_LINEAR相同：像素中心对齐）"""
+        self.width, self.height = width, height
+        self.scale_x = self.display_width / width
+        self.scale_y = self.display_height / height
+        map_x = (np.arange(self.display_width, dtype=np.float32) + 0.5) / self.scale_x - 0.5
+        map_y = (np.arange(self.display_height, dtype=np.float32) + 0.5) / self.scale_y - 0.5
+        map_x, map_y = np.meshgrid(map_x, map_y)
+        # 定点形式（remap更快）
+        self._map1, self._map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+    def display_rect(self, rect: Dict) -> Optional[Tuple[int, int, int, int]]:
+        """源矩形影响到的显示区域（双线性插值会用到相邻像素，向外多取一个像素）"""
+        x0 = max(0, math.floor((rect['left'] - 0.5) * self.scale_x - 0.5) - 1)
+        y0 = max(0, math.floor((rect['top'] - 0.5) * self.scale_y - 0.5) - 1)
+        x1 = min(self.display_width, math.ceil((rect['right'] + 0.5) * self.scale_x - 0.5) + 1)
+        y1 = min(self.display_height, math.ceil((rect['bottom'] + 0.5) * self.scale_y - 0.5) + 1)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return x0, y0, x1, y1
+
+    def update(self, frame: np.ndarray, rects: Optional[List[Dict]], seq: int = 0,
+               capture_us: int = 0, decode_us: int = 0) -> None:
+        """帧缓冲的rects区域已更新（None表示整帧），重新缩放对应的显示区域"""
+        if frame.shape[:2] != (self.height, self.width):
+            # 重连后分辨率变化：显示尺寸不变，重新计算映射并整帧刷新
+            self._set_source(frame.shape[1], frame.shape[0])
+            rects = None
+        if rects is None:
+            areas = [(0, 0, self.display_width, self.display_height)]
+        else:
+            areas = [area for area in map(self.display_rect, rects) if area is not None]
+
+        with self.lock:
+            for x0, y0, x1, y1 in areas:
+                scaled = self._scratch.get((y1 - y0) * (x1 - x0) * 4).reshape(y1 - y0, x1 - x0, 4)
+                cv2.remap(frame, self._map1[y0:y1, x0:x1], self._map2[y0:y1, x0:x1], cv2.INTER_LINEAR,
+                          dst=scaled, borderMode=cv2.BORDER_REPLICATE)
+                cv2.cvtColor(scaled, cv2.COLOR_BGRA2RGB, dst=self.rgb[y0:y1, x0:x1])
+            pending = self._pending
+            if not pending:
+                self._pending_since = time.perf_counter()
+            pending.extend(areas)
+            if len(pending) > MAX_PENDING_RECTS:
+                pending[:] = [(min(a[0] for a in pending), min(a[1] for a in pending),
+                               max(a[2] for a in pending), max(a[3] for a in pending))]
+            self._latest = (seq, capture_us, decode_us)
+
+    @property
+    def pending(self) -> int:
+        """待显示区域数"""
+        return len(self._pending)
+
+    def take(self) -> Tuple[List[Tuple[int, int, int, int, bytes]], int, int, int, float]:
+        """取走累积的待显示区域
+
+        Returns:
+            ([(x, y, 宽, 高, RGB像素), ...], seq, capture_us, decode_us, 最早区域的等待秒数)，没有新内容时列表为空
+        """
+        with self.lock:
+            pending, self._pending = self._pending, []
+            waited = time.perf_counter() - self._pending_since if pending else 0.0
+            patches = [(x0, y0, x1 - x0, y1 - y0, self.rgb[y0:y1, x0:x1].tobytes())
+                       for x0, y0, x1, y1 in pending]
+            return (patches, *self._latest, waited)
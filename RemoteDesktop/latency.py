@@ -0,0 +1,176 @@
+"""
+远程桌面 - 延迟测量
+心跳往返估计RTT与时钟偏差，按阶段记录 捕获→接收→解码→显示 的延迟；
+测试模式下在帧左上角嵌入帧计数/时间戳标记，用于回环验证端到端延迟。
+"""
+
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from metrics import Histogram, Registry
+
+# 延迟阶段
+STAGES = (
+    'capture_to_receive',   # 服务器捕获 → 客户端收到（含网络与排队）
+    'receive_to_decode',    # 收到 → 解码并应用到帧缓冲
+    'decode_to_display',    # 应用 → 显示
+    'capture_to_display',   # 端到端（glass-to-glass）
+    'rtt',                  # 心跳往返
+    'marker',               # 测试模式：从显示画面读出的标记时间戳 → 显示
+)
+
+STAGE_NAMES = {
+    'capture_to_receive': "捕获→接收",
+    'receive_to_decode': "接收→解码",
+    'decode_to_display': "解码→显示",
+    'capture_to_display': "端到端",
+    'rtt': "RTT",
+    'marker': "画面标记",
+}
+
+# 心跳间隔（秒）
+HEARTBEAT_INTERVAL = 1.0
+
+# 帧标记：4位同步码 + 16位帧计数 + 32位毫秒时间戳，每位一个黑/白方块
+MARKER_SYNC = (1, 0, 1, 0)
+MARKER_BITS = len(MARKER_SYNC) + 16 + 32
+MARKER_CELL = 8
+
+
+class ClockSync:
+    """用心跳往返估计RTT和时钟偏差（服务器时钟 - 本地时钟）
+
+    取最近window个样本中RTT最小者的偏差，排队越少的样本越准确。
+    """
+
+    def __init__(self, window: int = 16):
+        self.samples = deque(maxlen=window)  # (rtt_us, offset_us)
+        self.offset = 0
+        self.rtt = 0
+
+    def on_echo(self, sent_us: int, server_us: int, received_us: int) -> int:
+        """处理服务器回传的心跳
+
+        Returns:
+            本次RTT（微秒）
+        """
+        rtt = received_us - sent_us
+        offset = server_us - (sent_us + received_us) // 2
+        self.samples.append((rtt, offset))
+        self.rtt, self.offset = min(self.samples)
+        return rtt
+
+    def to_local(self, server_us: int) -> int:
+        """服务器时间戳换算为本地时间"""
+        return server_us - self.offset
+
+
+class LatencyTracker:
+    """按阶段记录延迟直方图
+
+    给出registry时直方图注册为 rd_latency_seconds{viewer, stage}，可通过 /metrics 导出。
+    """
+
+    def __init__(self, registry: Optional[Registry] = None, viewer: str = ''):
+        self.clock = ClockSync()
+        if registry is None:
+            self.histograms: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        else:
+            family = registry.histogram('rd_latency_seconds', "观看端各阶段延迟（秒）", ['viewer', 'stage'])
+            self.histograms = {stage: family.labels(viewer=viewer, stage=stage) for stage in STAGES}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        if seconds >= 0:
+            self.histograms[stage].observe(seconds)
+
+    def on_echo(self, sent_us: int, server_us: int, received_us: int) -> None:
+        self.observe('rtt', self.clock.on_echo(sent_us, server_us, received_us) / 1e6)
+
+    def on_decoded(self, capture_us: int, receive_us: int, decode_us: int) -> None:
+        """记录一个更新的 捕获→接收 和 接收→解码"""
+        self.observe('capture_to_receive', (receive_us - self.clock.to_local(capture_us)) / 1e6)
+        self.observe('receive_to_decode', (decode_us - receive_us) / 1e6)
+
+    def on_displayed(self, capture_us: int, decode_us: int, display_us: int) -> None:
+        """记录一个更新的 解码→显示 和端到端延迟"""
+        self.observe('decode_to_display', (display_us - decode_us) / 1e6)
+        self.observe('capture_to_display', (display_us - self.clock.to_local(capture_us)) / 1e6)
+
+    def on_marker(self, frame: np.ndarray, display_us: int) -> Optional[int]:
+        """测试模式：从显示的画面读出标记，记录标记时间戳→显示的延迟
+
+        Returns:
+            帧计数，未找到标记时为None
+        """
+        marker = read_marker(frame)
+        if marker is None:
+            return None
+        counter, timestamp_ms = marker
+        # 标记中的时间戳只有低32位（毫秒），差值按32位回绕处理
+        local_ms = self.clock.to_local(timestamp_ms * 1000) // 1000
+        delay_ms = (display_us // 1000 - local_ms) & 0xFFFFFFFF
+        if delay_ms < 0x80000000:
+            self.observe('marker', delay_ms / 1000)
+        return counter
+
+    def summary(self, stage: str) -> str:
+        return self.histograms[stage].summary()
+
+    def report(self) -> str:
+        """多行延迟报告"""
+        lines = [f"时钟偏差 {self.clock.offset / 1000:.1f}ms"]
+        for stage in STAGES:
+            if self.histograms[stage].count:
+                lines.append(f"{STAGE_NAMES[stage]}: {self.summary(stage)}")
+        return "\n".join(lines)
+
+
+def marker_rect(width: int, height: int) -> Optional[Dict]:
+    """帧标记所在矩形，画面太小放不下时返回None"""
+    if width < MARKER_BITS * MARKER_CELL or height < MARKER_CELL:
+        return None
+    return {'left': 0, 'top': 0, 'right': MARKER_BITS * MARKER_CELL, 'bottom': MARKER_CELL}
+
+
+def stamp_marker(frame: np.ndarray, counter: int, timestamp_ms: int) -> Optional[Dict]:
+    """在帧左上角写入标记（BGRA/BGR均可）
+
+    Returns:
+        被修改的矩形，画面太小时为None
+    """
+    rect = marker_rect(frame.shape[1], frame.shape[0])
+    if rect is None:
+        return None
+
+    bits = list(MARKER_SYNC)
+    bits += [(counter >> (15 - i)) & 1 for i in range(16)]
+    bits += [(timestamp_ms >> (31 - i)) & 1 for i in range(32)]
+    for i, bit in enumerate(bits):
+        frame[0:MARKER_CELL, i * MARKER_CELL:(i + 1) * MARKER_CELL, :3] = 255 if bit else 0
+    return rect
+
+
+def read_marker(frame: np.ndarray) -> Optional[Tuple[int, int]]:
+    """读出帧标记（按每个方块中心像素的亮度判定）
+
+    Returns:
+        (counter, timestamp_ms)，同步码不匹配时为None
+    """
+    if marker_rect(frame.shape[1], frame.shape[0]) is None:
+        return None
+
+    center = MARKER_CELL // 2
+    samples = frame[center, center::MARKER_CELL, :3][:MARKER_BITS].astype(np.int32).mean(axis=1)
+    bits = [1 if v > 127 else 0 for v in samples]
+    if tuple(bits[:len(MARKER_SYNC)]) != MARKER_SYNC:
+        return None
+
+    counter = 0
+    for bit in bits[4:20]:
+        counter = (counter << 1) | bit
+    timestamp_ms = 0
+    for bit in bits[20:52]:
+        timestamp_ms = (timestamp_ms << 1) | bit
+    return counter, timestamp_ms
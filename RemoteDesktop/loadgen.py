@@ -0,0 +1,140 @@
+"""
+远程桌面 - 负载生成器
+启动N个无界面客户端（headless）同时连接一台服务器，测量服务器的扩展能力。
+客户端可分布在多个进程中（避免单进程GIL成为瓶颈），可对部分客户端限速以模拟慢速网络。
+
+用法:
+    python server.py --source typing                                  # 服务器端（合成场景，无需DXGI）
+    python loadgen.py 127.0.0.1 9999 -n 50 --processes 4 --duration 30
+    python loadgen.py 127.0.0.1 9999 -n 20 --throttle 256 --throttled 5   # 其中5个限速256KB/s
+"""
+
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from client import RemoteDesktopClient
+
+
+def run_clients(host: str, port: int, names: List[str], throttles: List[Optional[float]],
+                duration: float, quiet: bool = True) -> List[Dict]:
+    """在本进程中运行一组客户端，返回每个客户端的统计"""
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, 'w', encoding='utf-8')  # 屏蔽各客户端的连接日志
+    try:
+        clients = [RemoteDesktopClient(host, port, viewer=name, headless=True, throttle=throttle)
+                   for name, throttle in zip(names, throttles)]
+        threads = [threading.Thread(target=client.run_headless, args=(duration,), name=name, daemon=True)
+                   for client, name in zip(clients, names)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(duration + 5)
+    finally:
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    results = []
+    for client, throttle in zip(clients, throttles):
+        metrics = client.metrics
+        elapsed = max(time.time() - metrics.start_time, 1e-6)
+        lag = client.latency.histograms['capture_to_receive']
+        results.append({
+            'client': metrics.viewer,
+            'connected': client.width > 0,
+            'throttle_kbps': throttle / 1024 if throttle else None,
+            'frames': metrics.frames.value,
+            'fps': round(metrics.frames.value / elapsed, 2),
+            'skips': metrics.packet_count('skip'),
+            'bandwidth_kbps': round(metrics.bytes_received.value / elapsed / 1024, 1),
+            'lag_p50_ms': _ms(lag.percentile(0.5)),
+            'lag_p99_ms': _ms(lag.percentile(0.99)),
+            'decode_ms': _ms(metrics.stages['apply'].percentile(0.5)),
+            'reconnects': metrics.reconnects.value,
+            'resync_tiles': metrics.resync_tiles.value,
+        })
+    return results
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def aggregate(results: List[Dict], duration: float) -> Dict:
+    """汇总：总/平均/最低fps、总带宽、延迟中位数与最差p99"""
+    connected = [r for r in results if r['connected']]
+    fps = [r['fps'] for r in connected]
+    lag_p50 = [r['lag_p50_ms'] for r in connected if r['lag_p50_ms'] is not None]
+    lag_p99 = [r['lag_p99_ms'] for r in connected if r['lag_p99_ms'] is not None]
+    return {
+        'clients': len(results),
+        'connected': len(connected),
+        'duration': duration,
+        'fps_total': round(sum(fps), 1),
+        'fps_mean': round(statistics.mean(fps), 2) if fps else 0.0,
+        'fps_min': round(min(fps), 2) if fps else 0.0,
+        'bandwidth_mbps': round(sum(r['bandwidth_kbps'] for r in connected) / 1024, 2),
+        'lag_p50_ms': round(statistics.median(lag_p50), 2) if lag_p50 else None,
+        'lag_p99_ms': max(lag_p99) if lag_p99 else None,
+        'reconnects': sum(r['reconnects'] for r in results),
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="远程桌面负载生成器（多个无界面客户端）")
+    parser.add_argument('host', nargs='?', default='127.0.0.1', help="服务器地址")
+    parser.add_argument('port', nargs='?', type=int, default=9999, help="服务器端口")
+    parser.add_argument('-n', '--clients', type=int, default=10, help="客户端数")
+    parser.add_argument('--processes', type=int, default=1, help="客户端分布到的进程数")
+    parser.add_argument('--duration', type=float, default=10.0, help="运行时长（秒）")
+    parser.add_argument('--throttle', type=float, default=None, help="限速（KB/s）")
+    parser.add_argument('--throttled', type=int, default=None, help="限速的客户端数（默认全部）")
+    parser.add_argument('--output', metavar='FILE', help="结果写入JSON文件")
+    parser.add_argument('--verbose', action='store_true', help="显示各客户端的日志")
+    args = parser.parse_args()
+
+    names = [f'load{i}' for i in range(args.clients)]
+    throttled = args.clients if args.throttled is None else args.throttled
+    throttles = [args.throttle * 1024 if args.throttle and i < throttled else None for i in range(args.clients)]
+
+    processes = max(1, min(args.processes, args.clients))
+    groups = [(args.host, args.port, names[i::processes], throttles[i::processes], args.duration, not args.verbose)
+              for i in range(processes)]
+    print(f"[负载] {args.clients} 个客户端 / {processes} 个进程 → {args.host}:{args.port}，运行 {args.duration:.0f}s")
+
+    if processes == 1:
+        results = run_clients(*groups[0])
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = [r for group in pool.starmap(run_clients, groups) for r in group]
+    results.sort(key=lambda r: int(r['client'][4:]))
+
+    print(f"{'客户端':<8} {'限速KB/s':>9} {'fps':>7} {'跳帧':>6} {'带宽KB/s':>10} {'延迟p50':>9} {'延迟p99':>9} {'重连':>5}")
+    for r in results:
+        if not r['connected']:
+            print(f"{r['client']:<8} 未连接")
+            continue
+        print(f"{r['client']:<8} {r['throttle_kbps'] or '-':>9} {r['fps']:>7.1f} {r['skips']:>6} "
+              f"{r['bandwidth_kbps']:>10.1f} {r['lag_p50_ms'] or '-':>9} {r['lag_p99_ms'] or '-':>9} {r['reconnects']:>5}")
+
+    summary = aggregate(results, args.duration)
+    print(f"[负载] 已连接 {summary['connected']}/{summary['clients']} | 总 {summary['fps_total']} fps | "
+          f"平均 {summary['fps_mean']} fps | 最低 {summary['fps_min']} fps | 总带宽 {summary['bandwidth_mbps']} MB/s | "
+          f"延迟 p50 {summary['lag_p50_ms']}ms / 最差 p99 {summary['lag_p99_ms']}ms")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary, 'clients': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
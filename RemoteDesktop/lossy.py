@@ -0,0 +1,216 @@
+"""
+远程桌面 - 高运动区域的有损编码与无损修正
+窗口中播放视频时每帧都有大块脏矩形，XOR后几乎全是非0字节，zlib也压不下去，带宽极高。
+
+MotionMap按 tile_size×tile_size 的块统计变化频率（指数衰减的变化次数，半衰期half_life秒），
+发送时把脏矩形分为两部分：
+    高运动块（热度 ≥ threshold，且连成的矩形不小于min_tiles块）→ JPEG/WebP编码（PKT_LOSSY）
+    其余区域                                                    → 照常XOR+zlib（PKT_DIRTY）
+高运动矩形还要是"照片类"内容（抽样的颜色数多）才按有损发送：滚动的文字页面颜色很少，
+zlib比JPEG压得更小，画质也无损，仍按XOR发送。
+服务器把自己编码的图像解码写回会话参考帧，参考帧始终与客户端一致，之后的XOR、校验和都不受影响。
+以有损方式发送过的块静止refine_delay秒后重新作为脏矩形投递，此时已不是高运动块，
+按XOR发送"原图 XOR 有损图"，客户端最终的画面与服务器逐像素一致。
+
+只用于BGRA传输帧（低精度像素格式本身已是有损的，不再叠加）。
+
+用法:
+    python lossy.py                 # 测量1080p视频区域在不同质量下的编码大小与耗时
+"""
+
+import time
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from blockdiff import mask_rects
+from protocol import CODEC_JPEG, CODEC_WEBP, LOSSY_CODEC_NAMES
+
+# 块边长（像素，为JPEG色度MCU 16的倍数，块边界与编码块对齐）
+TILE_SIZE = 64
+# 变化热度的半衰期（秒）与判为高运动的阈值：稳定在每秒f次变化时热度约为 1/(1-0.5^(1/f))，阈值6约对应每秒4次
+HALF_LIFE = 1.0
+THRESHOLD = 6.0
+# 高运动矩形的最小块数：光标闪烁、打字等小范围的频繁变化仍按无损发送
+MIN_TILES = 4
+# 有损块静止多久后发送无损修正（秒）
+REFINE_DELAY = 0.3
+# 照片类内容的判定：抽样约PHOTO_SAMPLES个像素，不同颜色数不少于样本数的PHOTO_RATIO
+PHOTO_SAMPLES = 4096
+PHOTO_RATIO = 0.25
+# 默认编码质量（JPEG/WebP均为0~100）
+DEFAULT_QUALITY = 70
+
+_EXTENSIONS = {CODEC_JPEG: ('.jpg', cv2.IMWRITE_JPEG_QUALITY), CODEC_WEBP: ('.webp', cv2.IMWRITE_WEBP_QUALITY)}
+
+
+class LossyEncoder:
+    """高运动区域的图像编码设置（服务器所有会话共用）"""
+
+    def __init__(self, codec: int = CODEC_JPEG, quality: int = DEFAULT_QUALITY):
+        if codec not in _EXTENSIONS:
+            raise ValueError(f"不支持的有损编码: {codec}")
+        self.codec = codec
+        self.quality = quality
+        self.name = LOSSY_CODEC_NAMES[codec]
+        extension, flag = _EXTENSIONS[codec]
+        self._extension = extension
+        self._params = [flag, quality]
+
+    def encode(self, pixels: np.ndarray) -> bytes:
+        """编码BGR(A)像素区域（忽略alpha）"""
+        ok, data = cv2.imencode(self._extension, np.ascontiguousarray(pixels[..., :3]), self._params)
+        if not ok:
+            raise RuntimeError(f"{self.name} 编码失败")
+        return data.tobytes()
+
+
+def is_photographic(pixels: np.ndarray) -> bool:
+    """BGRA像素区域是否为照片类内容（颜色丰富，适合有损编码）"""
+    height, width = pixels.shape[:2]
+    step = max(1, int((height * width / PHOTO_SAMPLES) ** 0.5))
+    sample = pixels[::step, ::step].view(np.uint32) & 0x00FFFFFF
+    return len(np.unique(sample)) >= sample.size * PHOTO_RATIO
+
+
+def decode_into(image: bytes, dst: np.ndarray) -> None:
+    """把编码的图像解码写入dst（BGR或BGRA，BGRA的alpha置255）；服务器与观看端都用它，保证结果一致"""
+    pixels = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if pixels is None or pixels.shape[:2] != dst.shape[:2]:
+        raise ValueError(f"有损图像解码失败或尺寸不符: {None if pixels is None else pixels.shape}")
+    dst[..., :3] = pixels
+    if dst.shape[2] == 4:
+        dst[..., 3] = 255
+
+
+class MotionMap:
+    """一个会话参考帧的分块变化频率，以及以有损方式发送过、等待无损修正的块（调用方持有会话的cond）"""
+
+    def __init__(self, width: int, height: int, tile_size: int = TILE_SIZE, half_life: float = HALF_LIFE,
+                 threshold: float = THRESHOLD, min_tiles: int = MIN_TILES, refine_delay: float = REFINE_DELAY):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.half_life = half_life
+        self.threshold = threshold
+        self.min_tiles = min_tiles
+        self.refine_delay = refine_delay
+        self.rows = (height + tile_size - 1) // tile_size
+        self.cols = (width + tile_size - 1) // tile_size
+        self.heat = np.zeros((self.rows, self.cols), dtype=np.float32)
+        self.changed = np.zeros((self.rows, self.cols), dtype=np.float64)  # 最近一次变化的时间
+        self.lossy = np.zeros((self.rows, self.cols), dtype=bool)         # 参考帧中为有损图像的块
+        self._mask = np.zeros((self.rows, self.cols), dtype=bool)
+
+    def _tile_mask(self, rects: List[Dict]) -> np.ndarray:
+        """rects覆盖的块（返回内部数组）"""
+        mask = self._mask
+        mask[:] = False
+        t = self.tile_size
+        for r in rects:
+            mask[r['top'] // t:-(-r['bottom'] // t), r['left'] // t:-(-r['right'] // t)] = True
+        return mask
+
+    def update(self, rects: List[Dict], now: float) -> None:
+        """记录一次捕获的脏矩形（同一次捕获中多个矩形覆盖同一块只计一次）"""
+        mask = self._tile_mask(rects)
+        decay = np.exp2((self.changed[mask] - now) / self.half_life)
+        self.heat[mask] = self.heat[mask] * decay + 1
+        self.changed[mask] = now
+
+    def split(self, rects: List[Dict], now: float) -> Tuple[List[Dict], List[Dict]]:
+        """把待发送的脏矩形分为 (高运动矩形, 其余矩形)
+
+        高运动矩形由高运动块合并而成（按块对齐）；其余矩形为原矩形去掉高运动块后剩余的部分。
+        调用方决定按有损发送的矩形须用mark()记为等待修正。
+        """
+        hot = self._tile_mask(rects) & (self.heat >= self.threshold) & (now - self.changed < self.refine_delay)
+        if hot.sum() < self.min_tiles:
+            return [], rects
+        t = self.tile_size
+        lossy = []
+        for rect in mask_rects(hot, t, self.width, self.height):
+            if (rect['right'] - rect['left']) * (rect['bottom'] - rect['top']) < self.min_tiles * t * t:
+                hot[rect['top'] // t:-(-rect['bottom'] // t), rect['left'] // t:-(-rect['right'] // t)] = False
+            else:
+                lossy.append(rect)
+        if not lossy:
+            return [], rects
+
+        lossless = []
+        for r in rects:
+            r0, r1 = r['top'] // t, -(-r['bottom'] // t)
+            c0, c1 = r['left'] // t, -(-r['right'] // t)
+            covered = hot[r0:r1, c0:c1]
+            if not covered.any():
+                lossless.append(r)
+                continue
+            # 矩形内不属于高运动块的部分（按块合并后与原矩形求交）
+            for part in mask_rects(~covered, t, (c1 - c0) * t, (r1 - r0) * t):
+                left, top = max(r['left'], c0 * t + part['left']), max(r['top'], r0 * t + part['top'])
+                right, bottom = min(r['right'], c0 * t + part['right']), min(r['bottom'], r0 * t + part['bottom'])
+                if right > left and bottom > top:
+                    lossless.append({'left': left, 'top': top, 'right': right, 'bottom': bottom})
+        return lossy, lossless
+
+    def mark(self, rects: List[Dict]) -> None:
+        """rects（按块对齐）已按有损发送，等待修正"""
+        t = self.tile_size
+        for r in rects:
+            self.lossy[r['top'] // t:-(-r['bottom'] // t), r['left'] // t:-(-r['right'] // t)] = True
+
+    def refine(self, now: float) -> List[Dict]:
+        """已静止refine_delay秒的有损块（清除等待标记），返回待无损重发的矩形"""
+        due = self.lossy & (now - self.changed >= self.refine_delay)
+        if not due.any():
+            return []
+        self.lossy &= ~due
+        return mask_rects(due, self.tile_size, self.width, self.height)
+
+    def clear(self) -> None:
+        """参考帧已整体按无损内容重置（完整帧），不再有等待修正的块"""
+        self.lossy[:] = False
+
+    @property
+    def pending(self) -> int:
+        """等待修正的块数"""
+        return int(self.lossy.sum())
+
+
+def _benchmark():
+    """测量1080p视频区域在不同质量下的编码大小与耗时（与XOR+zlib对比）"""
+    import zlib
+    from capture import VideoSource
+
+    source = VideoSource(1920, 1080, fps=None, full_screen=True)
+    frames = []
+    for _ in range(6):
+        source.acquire(0)
+        rects = source.dirty_rects()
+        data = source.copy_dirty_regions()
+        source.release()
+        if rects and data is not None:
+            frames.append(source.frame.copy())
+    previous, current = frames[-2], frames[-1]
+    xor_start = time.perf_counter()
+    xor_size = len(zlib.compress(np.bitwise_xor(previous, current), 1))
+    xor_ms = (time.perf_counter() - xor_start) * 1000
+    print(f"[基准] 1080p视频帧 XOR+zlib: {xor_size / 1024:.0f} KB, {xor_ms:.1f}ms")
+    for codec in (CODEC_JPEG, CODEC_WEBP):
+        for quality in (50, 70, 90):
+            encoder = LossyEncoder(codec, quality)
+            start = time.perf_counter()
+            image = encoder.encode(current)
+            encode_ms = (time.perf_counter() - start) * 1000
+            decoded = np.empty_like(current)
+            start = time.perf_counter()
+            decode_into(image, decoded)
+            decode_ms = (time.perf_counter() - start) * 1000
+            error = np.abs(decoded[..., :3].astype(np.int16) - current[..., :3]).mean()
+            print(f"[基准] {encoder.name:4s} 质量 {quality}: {len(image) / 1024:6.0f} KB | "
+                  f"编码 {encode_ms:5.1f}ms | 解码 {decode_ms:5.1f}ms | 平均误差 {error:.2f}")
+
+
+if __name__ == '__main__':
+    _benchmark()
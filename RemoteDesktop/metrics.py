@@ -0,0 +1,325 @@
+"""
+远程桌面 - 统计指标
+带标签的计数器、仪表和固定桶直方图，按Prometheus文本格式导出。
+服务器通过start_http_server提供 /metrics，web_server.py在Flask中注册同名路由。
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from tracing import TRACER
+
+# 默认延迟桶（秒）
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    """单调递增计数器"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    """可增可减的仪表；set_function后每次读取时调用函数取值"""
+
+    def __init__(self):
+        self._value = 0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    @property
+    def value(self) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+
+class Histogram:
+    """固定桶直方图（线程安全）"""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """记录一个样本"""
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """记录with块的耗时（秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def cumulative(self) -> List[int]:
+        """累计桶计数（与buckets对应，最后一个为 +Inf）"""
+        with self.lock:
+            counts = list(self.counts)
+        total = 0
+        result = []
+        for c in counts:
+            total += c
+            result.append(total)
+        return result
+
+    def percentile(self, q: float) -> Optional[float]:
+        """按桶内线性插值估计分位数（q取0~1），无样本时返回None"""
+        cumulative = self.cumulative()
+        total = cumulative[-1]
+        if total == 0:
+            return None
+
+        rank = q * total
+        index = bisect.bisect_left(cumulative, rank)
+        if index >= len(self.buckets):
+            return self.buckets[-1]
+
+        lower = self.buckets[index - 1] if index > 0 else 0.0
+        upper = self.buckets[index]
+        below = cumulative[index - 1] if index > 0 else 0
+        in_bucket = cumulative[index] - below
+        if in_bucket == 0:
+            return upper
+        return lower + (upper - lower) * (rank - below) / in_bucket
+
+    def summary(self) -> str:
+        """一行摘要（毫秒）"""
+        if self.count == 0:
+            return "无样本"
+        p50 = self.percentile(0.5) * 1000
+        p99 = self.percentile(0.99) * 1000
+        mean = self.sum / self.count * 1000
+        return f"p50 {p50:.1f}ms | p99 {p99:.1f}ms | 平均 {mean:.1f}ms | 样本 {self.count}"
+
+
+class MetricFamily:
+    """同名指标族，按标签值区分子指标"""
+
+    def __init__(self, name: str, help_text: str, metric_type: str,
+                 labelnames: Sequence[str], factory: Callable):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children: Dict[Tuple[str, ...], object] = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，收到 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def labels(self, **labels):
+        """取得（必要时创建）指定标签值的子指标"""
+        key = self._key(labels)
+        with self.lock:
+            child = self.children.get(key)
+            if child is None:
+                child = self.children[key] = self.factory()
+            return child
+
+    def remove(self, **labels) -> None:
+        """删除标签值匹配的子指标，可只给出部分标签（客户端离开后避免标签无限增长）"""
+        unknown = set(labels) - set(self.labelnames)
+        if unknown:
+            raise ValueError(f"{self.name} 没有标签 {tuple(unknown)}")
+        match = [(self.labelnames.index(name), str(value)) for name, value in labels.items()]
+        with self.lock:
+            for key in [k for k in self.children if all(k[i] == v for i, v in match)]:
+                del self.children[key]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            children = list(self.children.items())
+        for key, child in children:
+            labels = list(zip(self.labelnames, key))
+            if self.type == 'histogram':
+                cumulative = child.cumulative()
+                for bound, count in zip(child.buckets + (float('inf'),), cumulative):
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', le)])} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {child.sum}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {child.count}")
+            else:
+                lines.append(f"{self.name}{_format_labels(labels)} {child.value}")
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self.families: Dict[str, MetricFamily] = {}
+        self.lock = threading.Lock()
+
+    def _family(self, name: str, help_text: str, metric_type: str,
+                labelnames: Sequence[str], factory: Callable) -> MetricFamily:
+        """取得同名指标族（不存在则创建），多个组件可以共享同一族"""
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = MetricFamily(name, help_text, metric_type, labelnames, factory)
+            elif family.type != metric_type or family.labelnames != tuple(labelnames):
+                raise ValueError(f"指标 {name} 已以不同类型或标签注册")
+            return family
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> MetricFamily:
+        return self._family(name, help_text, 'counter', labelnames, Counter)
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> MetricFamily:
+        return self._family(name, help_text, 'gauge', labelnames, Gauge)
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> MetricFamily:
+        return self._family(name, help_text, 'histogram', labelnames, lambda: Histogram(buckets))
+
+    def render(self) -> str:
+        """Prometheus文本格式"""
+        with self.lock:
+            families = list(self.families.values())
+        lines = []
+        for family in families:
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+# 默认注册表
+REGISTRY = Registry()
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    """标签格式化为 {a="1",b="2"}（按Prometheus规则转义）"""
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class ViewerMetrics:
+    """观看端（client.py / web_server.py）指标
+
+    stage直方图: receive（读取包体）、decompress（解包解压）、apply（应用到帧缓冲）、display（转换并显示）。
+    queue: 内部队列的长度与等待时间，decode（读取线程 → 解码线程的包）、display（解码线程 → GUI的待显示区域）。
+    viewer标签区分同一进程中的多个观看端。启用追踪时各阶段同时记录为带帧序号的span。
+    """
+
+    STAGES = ('receive', 'decompress', 'apply', 'display')
+    QUEUES = ('decode', 'display')
+
+    def __init__(self, viewer: str, registry: Registry = REGISTRY):
+        self.viewer = viewer
+        stage = registry.histogram('rd_viewer_stage_seconds', "观看端各阶段耗时（秒）", ['viewer', 'stage'])
+        self.stages = {name: stage.labels(viewer=viewer, stage=name) for name in self.STAGES}
+        self.packets = registry.counter('rd_viewer_packets_total', "收到的数据包", ['viewer', 'type'])
+        self.bytes_received = registry.counter(
+            'rd_viewer_received_bytes_total', "收到的字节", ['viewer']).labels(viewer=viewer)
+        self.frames = registry.counter(
+            'rd_viewer_frames_total', "应用到帧缓冲的更新数", ['viewer']).labels(viewer=viewer)
+        self.reconnects = registry.counter(
+            'rd_viewer_reconnects_total', "断线重连次数", ['viewer']).labels(viewer=viewer)
+        self.resync_tiles = registry.counter(
+            'rd_viewer_resync_tiles_total', "校验不一致而请求重传的块数", ['viewer']).labels(viewer=viewer)
+        self.fps = registry.gauge('rd_viewer_fps', "最近一秒应用的更新数", ['viewer']).labels(viewer=viewer)
+        depth = registry.gauge('rd_viewer_queue_depth', "观看端内部队列的长度", ['viewer', 'queue'])
+        wait = registry.histogram('rd_viewer_queue_wait_seconds', "在观看端内部队列中等待的时间（秒）",
+                                  ['viewer', 'queue'])
+        self.queue_depth = {name: depth.labels(viewer=viewer, queue=name) for name in self.QUEUES}
+        self.queue_wait = {name: wait.labels(viewer=viewer, queue=name) for name in self.QUEUES}
+        self.coalesced = registry.counter(
+            'rd_viewer_coalesced_total', "与同批更新合并显示（未单独刷新显示）的更新数", ['viewer']).labels(viewer=viewer)
+        self.start_time = time.time()
+        self._fps_count = 0
+        self._fps_time = time.time()
+
+    @contextmanager
+    def stage(self, name: str, seq: Optional[int] = None):
+        """记录某阶段耗时的上下文管理器"""
+        with self.stages[name].time(), TRACER.span(name, seq, viewer=self.viewer):
+            yield
+
+    def observe(self, name: str, seconds: float, seq: Optional[int] = None) -> None:
+        """记录刚结束的某阶段耗时"""
+        self.stages[name].observe(seconds)
+        if TRACER.enabled:
+            TRACER.record(name, time.time_ns() // 1000 - int(seconds * 1e6), int(seconds * 1e6), seq,
+                          viewer=self.viewer)
+
+    def on_packet(self, kind: str, size: int) -> None:
+        self.packets.labels(viewer=self.viewer, type=kind).inc()
+        self.bytes_received.inc(size)
+
+    def on_frame(self) -> None:
+        """应用一个更新后调用，每秒刷新一次fps"""
+        self.frames.inc()
+        self._fps_count += 1
+        now = time.time()
+        if now - self._fps_time >= 1.0:
+            self.fps.set(self._fps_count)
+            self._fps_count = 0
+            self._fps_time = now
+
+    def packet_count(self, kind: str) -> int:
+        return self.packets.labels(viewer=self.viewer, type=kind).value
+
+
+def start_http_server(port: int, host: str = '0.0.0.0', registry: Registry = REGISTRY,
+                      routes: Optional[Dict[str, Tuple[str, Callable[[], str]]]] = None) -> ThreadingHTTPServer:
+    """在后台线程启动 /metrics HTTP端点
+
+    routes: 额外的路径 -> (Content-Type, 生成响应文本的函数)，如 /trace
+    """
+    handlers = {'/metrics': (CONTENT_TYPE, registry.render)}
+    handlers.update(routes or {})
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            handler = handlers.get(self.path.split('?')[0])
+            if handler is None:
+                self.send_error(404)
+                return
+            content_type, render = handler
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # 不打印访问日志
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
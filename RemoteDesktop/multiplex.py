@@ -0,0 +1,301 @@
+"""
+远程桌面 - 多路复用：一个TCP连接承载多个画面流
+多显示器，或经中继同时观看多台主机时，每个画面原本需要一个连接。多路复用连接中每个数据包加上流头
+（PKT_STREAM [stream:2]，见protocol.py），一个连接可以承载多个流。
+
+每个流在本地对应一个socket（socket.socketpair的一端），流的另一端交给原有的服务器会话或客户端，
+它们照常收发带长度前缀的数据包；Multiplexer把本地socket读出的包加上流头后经共享连接发送，
+收到的包按流号写回对应的socket。因此每个流有自己的会话、序号窗口、完整帧与断线恢复状态，互不影响。
+
+连接建立：客户端先发送空的PKT_STREAMS，服务器回复各流名称（流号即下标）；
+之后客户端在某个流上发送的第一个包（PKT_RESUME）打开该流。空的流数据包表示该流关闭。
+第一个包不是PKT_STREAMS的旧客户端按流0的普通连接转接。
+
+用法（服务器）:
+    python server.py --source typing --stream video --stream 192.168.1.20:9999
+客户端:
+    python client.py 127.0.0.1 9999 --streams          # 每个流一个窗口
+    python client.py 127.0.0.1 9999 --streams=0,2 --headless
+"""
+
+import socket
+import threading
+from queue import Queue
+from typing import Callable, Dict, List, Optional, Tuple
+
+from protocol import Protocol, PKT_STREAM, PKT_STREAMS
+
+# 等待客户端第一个包（流列表请求或旧客户端的恢复请求）的时间（秒）
+HELLO_WAIT = 1.0
+
+Opener = Callable[[int], socket.socket]
+
+
+def connect_upstream(host: str, port: int) -> socket.socket:
+    """连接上游服务器（中继：把另一台主机作为一个流）"""
+    upstream = socket.create_connection((host, port))
+    upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return upstream
+
+
+def _close(sock: socket.socket) -> None:
+    """关闭socket（先shutdown，使阻塞在该socket上的读取立即返回）"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+class _Channel:
+    """一个流的本地socket与待写入它的包队列"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.queue = Queue()  # 包，None表示写完后关闭
+
+
+class Multiplexer:
+    """一个多路复用连接：流号 → 本地socket
+
+    每个流两个线程：转发（本地socket → 连接）与写入（队列 → 本地socket）；run()在调用线程中读取连接，
+    按流号放入各流的队列。某个流的读取方处理得慢只会积压它自己的队列（积压量受该流会话的在途窗口限制），
+    不会阻塞连接的读取而拖慢其他流。
+    open_stream不为None时（服务器端），收到未打开的流的数据包时调用它取得该流的本地socket。
+    """
+
+    def __init__(self, conn: socket.socket, open_stream: Optional[Opener] = None, name: str = "mux"):
+        self.conn = conn
+        self.open_stream = open_stream
+        self.name = name
+        self.channels: Dict[int, _Channel] = {}
+        self.lock = threading.Lock()       # channels
+        self.send_lock = threading.Lock()  # 各转发线程共用连接
+        self.closed = False
+
+    def attach(self, stream: int, sock: socket.socket) -> None:
+        """把本地socket作为流stream，启动其转发与写入线程"""
+        channel = _Channel(sock)
+        with self.lock:
+            old = self.channels.pop(stream, None)
+            self.channels[stream] = channel
+        if old is not None:
+            old.queue.put(None)
+            _close(old.sock)
+        threading.Thread(target=self._forward, args=(stream, channel), daemon=True,
+                         name=f"{self.name} stream {stream}").start()
+        threading.Thread(target=self._deliver, args=(channel,), daemon=True,
+                         name=f"{self.name} stream {stream} deliver").start()
+
+    def send(self, stream: int, packet: bytes = b'') -> None:
+        """在流stream上发送数据包（空包表示关闭该流）"""
+        with self.send_lock:
+            Protocol.send_packet(self.conn, Protocol.pack_stream(stream, packet))
+
+    def _forward(self, stream: int, channel: _Channel) -> None:
+        """转发线程：本地socket → 连接；本地一端关闭时通知对端关闭该流"""
+        try:
+            while True:
+                packet = Protocol.recv_packet(channel.sock)
+                if not packet:
+                    break
+                self.send(stream, packet)
+        except OSError:
+            pass
+        with self.lock:
+            current = self.channels.get(stream) is channel
+            if current:
+                del self.channels[stream]
+        channel.queue.put(None)
+        if current and not self.closed:
+            try:
+                self.send(stream)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _deliver(channel: _Channel) -> None:
+        """写入线程：队列中的包 → 本地socket，写完关闭标记之前的包后关闭socket"""
+        try:
+            while True:
+                packet = channel.queue.get()
+                if packet is None:
+                    break
+                Protocol.send_packet(channel.sock, packet)
+        except OSError:
+            pass
+        _close(channel.sock)
+
+    def _close_stream(self, stream: int) -> None:
+        """对端关闭了流：已收到的包写完后关闭本地socket"""
+        with self.lock:
+            channel = self.channels.pop(stream, None)
+        if channel is not None:
+            channel.queue.put(None)
+
+    def run(self) -> None:
+        """读取连接并把各流的数据包写入对应的本地socket，连接断开时关闭所有流后返回"""
+        try:
+            while True:
+                packet = Protocol.recv_packet(self.conn)
+                if not packet:
+                    break
+                if Protocol.get_packet_type(packet) != PKT_STREAM:
+                    continue
+                stream, inner = Protocol.unpack_stream(packet)
+                with self.lock:
+                    channel = self.channels.get(stream)
+                if not inner:
+                    self._close_stream(stream)
+                    continue
+                if channel is None:
+                    sock = self.open_stream(stream) if self.open_stream is not None else None
+                    if sock is None:
+                        self.send(stream)  # 不存在的流
+                        continue
+                    self.attach(stream, sock)
+                    with self.lock:
+                        channel = self.channels[stream]
+                channel.queue.put(inner)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """关闭连接和所有流"""
+        self.closed = True
+        with self.lock:
+            channels = list(self.channels.values())
+            self.channels.clear()
+        for channel in channels:
+            channel.queue.put(None)
+            _close(channel.sock)
+        _close(self.conn)
+
+
+def _relay(source: socket.socket, target: socket.socket) -> None:
+    """按包转发 source → target，任一端断开时关闭两端"""
+    try:
+        while True:
+            packet = Protocol.recv_packet(source)
+            if not packet:
+                break
+            Protocol.send_packet(target, packet)
+    except OSError:
+        pass
+    finally:
+        _close(source)
+        _close(target)
+
+
+class StreamMux:
+    """服务器端：接受多路复用连接，把各流转接到本地的服务器会话或上游主机
+
+    streams为 [(名称, opener)]，opener(address) 返回与该流通信的socket
+    （本机服务器见RemoteDesktopServer.open_stream，上游主机见connect_upstream）。
+    同一连接的各流以 "地址#流号" 区分（会话的client指标标签）。
+    """
+
+    def __init__(self, streams: List[Tuple[str, Callable[[Tuple], socket.socket]]]):
+        self.streams = streams
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self.streams]
+
+    def _open(self, address: Tuple, stream: int) -> Optional[socket.socket]:
+        if stream >= len(self.streams):
+            return None
+        try:
+            return self.streams[stream][1]((f"{address[0]}#{stream}", address[1]))
+        except OSError as e:
+            print(f"[服务器] 流 {stream} ({self.streams[stream][0]}) 打开失败: {e}")
+            return None
+
+    def handle_connection(self, conn: socket.socket, address: Tuple) -> None:
+        """处理一个连接（连接线程调用，连接断开时返回）"""
+        packet = None
+        conn.settimeout(HELLO_WAIT)
+        try:
+            packet = Protocol.recv_packet(conn)
+        except socket.timeout:
+            pass
+        finally:
+            conn.settimeout(None)
+
+        if not packet or Protocol.get_packet_type(packet) != PKT_STREAMS:
+            # 旧客户端：按流0的普通连接转接
+            upstream = self._open(address, 0)
+            if upstream is None:
+                _close(conn)
+                return
+            if packet:
+                Protocol.send_packet(upstream, packet)
+            threading.Thread(target=_relay, args=(upstream, conn), daemon=True,
+                             name=f"relay {address[0]}:{address[1]}").start()
+            _relay(conn, upstream)
+            return
+
+        Protocol.send_packet(conn, Protocol.pack_streams(self.names))
+        print(f"[服务器] 客户端 {address} 使用多路复用连接（{len(self.streams)} 个流）")
+        Multiplexer(conn, lambda stream: self._open(address, stream),
+                    name=f"mux {address[0]}:{address[1]}").run()
+
+
+class MuxConnection:
+    """客户端：到多路复用服务器的连接，各流通过open_stream取得本地socket
+
+    连接断开后所有流的本地socket随之关闭（各客户端照常断线重连），再次open_stream时自动重新连接。
+    dial为建立连接的函数 dial(host, port)，None时使用TCP（如UDP传输见datagram.connect_datagram）。
+    """
+
+    def __init__(self, host: str, port: int, dial: Optional[Callable[[str, int], socket.socket]] = None):
+        self.host = host
+        self.port = port
+        self.dial = dial
+        self.names: List[str] = []
+        self.mux: Optional[Multiplexer] = None
+        self.lock = threading.Lock()
+
+    def connect(self) -> List[str]:
+        """连接并读取流列表（已连接时直接返回）
+
+        Returns:
+            各流名称，流号即下标
+        """
+        with self.lock:
+            if self.mux is not None and not self.mux.closed:
+                return self.names
+            if self.dial is not None:
+                conn = self.dial(self.host, self.port)
+            else:
+                conn = socket.create_connection((self.host, self.port))
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
+            try:
+                Protocol.send_packet(conn, Protocol.pack_streams([]))
+                packet = Protocol.recv_packet(conn)
+                if not packet or Protocol.get_packet_type(packet) != PKT_STREAMS:
+                    raise ConnectionError("服务器不支持多路复用连接")
+                self.names = Protocol.unpack_streams(packet)
+            except Exception:
+                conn.close()
+                raise
+            self.mux = Multiplexer(conn, name=f"mux {self.host}:{self.port}")
+            threading.Thread(target=self.mux.run, daemon=True, name=self.mux.name).start()
+            return self.names
+
+    def open_stream(self, stream: int) -> socket.socket:
+        """打开流stream，返回本地socket（按普通的服务器连接使用）"""
+        names = self.connect()
+        if stream >= len(names):
+            raise ConnectionError(f"服务器没有流 {stream}（共 {len(names)} 个）")
+        local, remote = socket.socketpair()
+        self.mux.attach(stream, remote)
+        return local
+
+    def close(self) -> None:
+        with self.lock:
+            if self.mux is not None:
+                self.mux.close()
@@ -0,0 +1,198 @@
+"""
+远程桌面 - 传输像素格式
+默认以32位BGRA传输。受限链路（蜂窝网络、VPN）上可协商低精度格式：
+
+    PF_RGB565   16位，每像素2字节
+    PF_YUV420   YCbCr 4:2:0（BT.601全范围），每2×2块6字节，即每像素1.5字节
+    PF_GRAY8    8位灰度，每像素1字节
+
+每种格式把输出画面表示为一个"传输帧"（H×W×C的uint8数组，C×1字节为一个像素单元，C为1/2/4），
+会话参考帧、XOR编码、校验和、完整帧都直接作用在传输帧上，regions/checksum无需区分格式。
+4:2:0的传输帧每行对应画面的两行，每个2×2块占3个2字节单元：(Y00,Y01) (Y10,Y11) (Cb,Cr)，
+因此画面矩形须按2对齐，传输帧中的矩形坐标为 (左×3/2, 上/2, 右×3/2, 下/2)。
+
+服务器用 encode 把BGRA画面的矩形转换到传输帧，观看端用 decode 转换回BGR(A)；均为NumPy向量运算。
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from protocol import PF_BGRA, PF_RGB565, PF_YUV420, PF_GRAY8
+
+
+class PixelFormat:
+    """BGRA（传输帧即画面本身）；其他格式的基类"""
+
+    code = PF_BGRA
+    name = 'bgra'
+    block = 1            # 画面矩形的对齐（像素）
+    bytes_per_pixel = 4.0
+
+    def wire_shape(self, width: int, height: int) -> Tuple[int, int, int]:
+        """width×height画面的传输帧形状"""
+        return height, width, 4
+
+    def allocate(self, width: int, height: int) -> np.ndarray:
+        return np.zeros(self.wire_shape(width, height), dtype=np.uint8)
+
+    def wire_rect(self, rect: Dict) -> Dict:
+        """画面矩形（已按block对齐）→ 传输帧矩形"""
+        return rect
+
+    def output_rect(self, rect: Dict) -> Dict:
+        """传输帧矩形 → 覆盖它的画面矩形"""
+        return rect
+
+    def encode(self, image: np.ndarray, wire: np.ndarray, rects: List[Dict]) -> None:
+        """把BGRA画面的rects区域转换到传输帧"""
+        for rect in rects:
+            top, bottom, left, right = rect['top'], rect['bottom'], rect['left'], rect['right']
+            self._encode(image[top:bottom, left:right], wire, rect)
+
+    def decode(self, wire: np.ndarray, image: np.ndarray, rects: Optional[List[Dict]] = None) -> None:
+        """把传输帧转换回画面（BGR或BGRA，BGRA的alpha置255）的rects区域，None表示整帧"""
+        if rects is None:
+            rects = [{'left': 0, 'top': 0, 'right': image.shape[1], 'bottom': image.shape[0]}]
+        for rect in rects:
+            top, bottom, left, right = rect['top'], rect['bottom'], rect['left'], rect['right']
+            if right <= left or bottom <= top:
+                continue
+            dst = image[top:bottom, left:right]
+            self._decode(wire, dst, rect)
+            if dst.shape[2] == 4:
+                dst[..., 3] = 255
+
+    def _encode(self, pixels: np.ndarray, wire: np.ndarray, rect: Dict) -> None:
+        wire[rect['top']:rect['bottom'], rect['left']:rect['right']] = pixels
+
+    def _decode(self, wire: np.ndarray, dst: np.ndarray, rect: Dict) -> None:
+        dst[..., :3] = wire[rect['top']:rect['bottom'], rect['left']:rect['right'], :3]
+
+
+class Rgb565(PixelFormat):
+    """RGB565：小端uint16，红5位在高位"""
+
+    code = PF_RGB565
+    name = 'rgb565'
+    bytes_per_pixel = 2.0
+
+    def wire_shape(self, width, height):
+        return height, width, 2
+
+    def _encode(self, pixels, wire, rect):
+        b = pixels[..., 0] >> 3
+        g = pixels[..., 1] >> 2
+        r = pixels[..., 2] >> 3
+        value = r.astype(np.uint16) << 11
+        value |= g.astype(np.uint16) << 5
+        value |= b
+        wire[rect['top']:rect['bottom'], rect['left']:rect['right']].view('<u2')[..., 0] = value
+
+    def _decode(self, wire, dst, rect):
+        value = wire[rect['top']:rect['bottom'], rect['left']:rect['right']].view('<u2')[..., 0]
+        # 高位复制到低位，使31/63映射到255
+        r = (value >> 11).astype(np.uint8)
+        g = ((value >> 5) & 0x3F).astype(np.uint8)
+        b = (value & 0x1F).astype(np.uint8)
+        dst[..., 0] = (b << 3) | (b >> 2)
+        dst[..., 1] = (g << 2) | (g >> 4)
+        dst[..., 2] = (r << 3) | (r >> 2)
+
+
+def _luma(pixels: np.ndarray) -> np.ndarray:
+    """BT.601亮度（定点，uint16内计算不会溢出）"""
+    y = pixels[..., 2].astype(np.uint16) * 77
+    y += pixels[..., 1].astype(np.uint16) * 150
+    y += pixels[..., 0].astype(np.uint16) * 29
+    y += 128
+    return (y >> 8).astype(np.uint8)
+
+
+class Gray8(PixelFormat):
+    """8位灰度（BT.601亮度）"""
+
+    code = PF_GRAY8
+    name = 'gray8'
+    bytes_per_pixel = 1.0
+
+    def wire_shape(self, width, height):
+        return height, width, 1
+
+    def _encode(self, pixels, wire, rect):
+        wire[rect['top']:rect['bottom'], rect['left']:rect['right'], 0] = _luma(pixels)
+
+    def _decode(self, wire, dst, rect):
+        dst[..., :3] = wire[rect['top']:rect['bottom'], rect['left']:rect['right']]
+
+
+class Yuv420(PixelFormat):
+    """YCbCr 4:2:0（BT.601全范围，与JPEG相同），色度取2×2块的平均"""
+
+    code = PF_YUV420
+    name = 'yuv420'
+    block = 2
+    bytes_per_pixel = 1.5
+
+    def wire_shape(self, width, height):
+        return (height + 1) // 2, (width + 1) // 2 * 3, 2
+
+    def wire_rect(self, rect):
+        return {'left': rect['left'] // 2 * 3, 'top': rect['top'] // 2,
+                'right': rect['right'] // 2 * 3, 'bottom': rect['bottom'] // 2}
+
+    def output_rect(self, rect):
+        # 传输帧的一个单元属于 列//3 号块，扩展到完整的块
+        return {'left': rect['left'] // 3 * 2, 'top': rect['top'] * 2,
+                'right': -(-rect['right'] // 3) * 2, 'bottom': rect['bottom'] * 2}
+
+    @staticmethod
+    def _blocks(wire: np.ndarray, rect: Dict) -> np.ndarray:
+        """画面矩形对应的块数组 (块行, 块列, 6)"""
+        blocks = wire.reshape(wire.shape[0], wire.shape[1] // 3, 6)
+        return blocks[rect['top'] // 2:rect['bottom'] // 2, rect['left'] // 2:rect['right'] // 2]
+
+    def _encode(self, pixels, wire, rect):
+        blocks = self._blocks(wire, rect)
+        rows, cols = blocks.shape[:2]
+        luma = _luma(pixels)
+        blocks[..., 0:2] = luma[0::2].reshape(rows, cols, 2)
+        blocks[..., 2:4] = luma[1::2].reshape(rows, cols, 2)
+        # 2×2块的通道和（4个像素），系数为×256的定点值，合计除以1024
+        sums = pixels[0::2, 0::2, :3].astype(np.uint16)
+        sums += pixels[0::2, 1::2, :3]
+        sums += pixels[1::2, 0::2, :3]
+        sums += pixels[1::2, 1::2, :3]
+        b, g, r = (sums[..., channel].astype(np.int32) for channel in range(3))
+        cb = (-43 * r - 85 * g + 128 * b + 512) >> 10
+        cr = (128 * r - 107 * g - 21 * b + 512) >> 10
+        blocks[..., 4] = np.clip(cb + 128, 0, 255)
+        blocks[..., 5] = np.clip(cr + 128, 0, 255)
+
+    def _decode(self, wire, dst, rect):
+        # decode传入的矩形已按块扩展，画面为奇数尺寸时最后一块只取一行/一列
+        rect = dict(rect, right=rect['left'] + -(-dst.shape[1] // 2) * 2,
+                    bottom=rect['top'] + -(-dst.shape[0] // 2) * 2)
+        blocks = self._blocks(wire, rect)
+        rows, cols = blocks.shape[:2]
+        cb = blocks[..., 4].astype(np.int32) - 128
+        cr = blocks[..., 5].astype(np.int32) - 128
+        # 色度项在块分辨率上计算（int16足够），分别加到块内上下两行的亮度上
+        red = ((359 * cr + 128) >> 8).astype(np.int16)[..., None]
+        green = ((88 * cb + 183 * cr + 128) >> 8).astype(np.int16)[..., None]
+        blue = ((454 * cb + 128) >> 8).astype(np.int16)[..., None]
+        height, width = dst.shape[:2]
+        for row in range(2):
+            luma = blocks[..., 2 * row:2 * row + 2].astype(np.int16)
+            target = dst[row::2]
+            for channel, value in ((0, luma + blue), (1, luma - green), (2, luma + red)):
+                np.clip(value, 0, 255, out=value)
+                target[..., channel] = value.reshape(rows, cols * 2)[:target.shape[0], :width]
+
+
+PIXEL_FORMATS = {fmt.code: fmt for fmt in (PixelFormat(), Rgb565(), Yuv420(), Gray8())}
+
+
+def get_format(code: int) -> PixelFormat:
+    """按编号取像素格式，未知编号按BGRA处理"""
+    return PIXEL_FORMATS.get(code, PIXEL_FORMATS[PF_BGRA])
@@ -4,8 +4,9 @@
 """
 
 import struct
+import time
 import zlib
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, NamedTuple, Optional, Tuple
 
 # 数据包类型
 PKT_INIT = 0        # 初始化包（屏幕信息）
@@ -13,108 +14,383 @@ PKT_FRAME = 1       # 完整帧
 PKT_DIRTY = 2       # 脏矩形增量更新
 PKT_SKIP = 3        # 跳帧（无变化）
 PKT_HEARTBEAT = 4   # 心跳包
+PKT_ACK = 5         # 确认包（客户端→服务器）
+PKT_RESUME = 6      # 会话恢复请求（客户端→服务器，连接后的第一个包）
+PKT_CHECKSUM = 7    # 分块校验和（服务器→客户端）
+PKT_RESYNC = 8      # 请求重传不一致的块（客户端→服务器）
+PKT_REFRESH = 9     # 原始像素矩形更新（非XOR，用于重传）
+PKT_VIEW = 10       # 输出分辨率/视口（客户端→服务器为请求，服务器→客户端为生效的视图）
+PKT_LOSSY = 11      # 有损编码（JPEG/WebP）的矩形更新（高运动区域，静止后以PKT_DIRTY无损修正）
+PKT_STREAM = 12     # 多路复用连接中某个流的数据包（流头 + 原数据包，见multiplex.py）
+PKT_STREAMS = 13    # 多路复用连接的流列表（客户端→服务器为请求，服务器→客户端为各流名称）
+
+# 数据包类型名（用于日志和指标标签）
+PACKET_NAMES = {
+    PKT_INIT: 'init',
+    PKT_FRAME: 'frame',
+    PKT_DIRTY: 'dirty',
+    PKT_SKIP: 'skip',
+    PKT_HEARTBEAT: 'heartbeat',
+    PKT_ACK: 'ack',
+    PKT_RESUME: 'resume',
+    PKT_CHECKSUM: 'checksum',
+    PKT_RESYNC: 'resync',
+    PKT_REFRESH: 'refresh',
+    PKT_VIEW: 'view',
+    PKT_LOSSY: 'lossy',
+    PKT_STREAM: 'stream',
+    PKT_STREAMS: 'streams',
+}
+
+# 传输像素格式（见pixelformat.py）；PF_AUTO只用于请求，表示由服务器按链路状况自动选择
+PF_BGRA = 0
+PF_RGB565 = 1
+PF_YUV420 = 2
+PF_GRAY8 = 3
+PF_AUTO = 255
+
+PIXEL_FORMAT_NAMES = {
+    PF_BGRA: 'bgra',
+    PF_RGB565: 'rgb565',
+    PF_YUV420: 'yuv420',
+    PF_GRAY8: 'gray8',
+    PF_AUTO: 'auto',
+}
+
+# 有损区域的图像编码（见lossy.py）
+CODEC_JPEG = 0
+CODEC_WEBP = 1
+
+LOSSY_CODEC_NAMES = {
+    CODEC_JPEG: 'jpeg',
+    CODEC_WEBP: 'webp',
+}
+
+# 协议版本：1为不带能力字段的旧版本，2起握手时交换能力（见Capabilities）
+PROTOCOL_VERSION = 2
+LEGACY_VERSION = 1
+
+# 能力字段的标签
+CAP_PACKET_TYPES = 0   # 能处理的数据包类型（按1 << PKT_*的位图）
+CAP_PIXEL_FORMATS = 1  # 支持的传输像素格式（按1 << PF_*的位图，不含PF_AUTO）
+CAP_LOSSY_CODECS = 2   # 支持的有损编码（按1 << CODEC_*的位图）
+CAP_MAX_RECTS = 3      # 一个更新包中矩形数的上限（0表示不限）
+CAP_WINDOW = 4         # 可缓冲的未处理更新包数，限制在途窗口（0表示不限）
+
+# 会话令牌长度（全0表示新会话）
+SESSION_TOKEN_SIZE = 16
+EMPTY_TOKEN = b'\x00' * SESSION_TOKEN_SIZE
+
+# 更新包公共头: [type:1][seq:4][timestamp:8]
+# seq为更新序号，timestamp为服务器捕获时间（微秒）
+UPDATE_HEADER = struct.Struct('!BIQ')
+UPDATE_HEADER_SIZE = UPDATE_HEADER.size
+
+# 流头: [type:1][stream:2]，其后为该流的原数据包（不含长度前缀）
+STREAM_HEADER = struct.Struct('!BH')
+
+# 视图字段: [width:4][height:4][left:4][top:4][right:4][bottom:4][pixel_format:1]
+VIEW_FORMAT = struct.Struct('!IIIIIIB')
+
+# 能力字段: [version:2][count:1]，其后count项 [tag:1][size:1][value:size]（大端无符号整数），未知标签跳过
+CAPS_HEADER = struct.Struct('!HB')
+CAP_ITEM = struct.Struct('!BB')
+
+# 分块压缩的输入块大小：zlib.compress一次压缩大块数据时输出缓冲按块增长后再拼接，内存峰值约为输出的3~4倍；
+# 分块压缩后与包头一次拼接，峰值约为输出的2倍
+COMPRESS_CHUNK = 256 * 1024
+# 打包/解压到暂存区（out为ScratchBuffer）时的块大小（压缩的输入块、解压的输出块），临时分配只有约一块；
+# 解压时每次送入的压缩数据（未消耗的输入由zlib复制为unconsumed_tail，取小块使其有界）
+POOLED_CHUNK = 64 * 1024
+DECOMPRESS_INPUT = 16 * 1024
+
+
+class View(NamedTuple):
+    """观看端的视图：输出分辨率 + 视口（屏幕坐标的矩形）+ 传输像素格式
+    
+    请求中的0表示默认：宽高都为0时输出视口原始尺寸，只给出一个时按视口比例计算另一个；
+    视口为空时表示整个屏幕。服务器回复的视图总是完整的实际值（像素格式不会是PF_AUTO）。
+    """
+    width: int = 0
+    height: int = 0
+    left: int = 0
+    top: int = 0
+    right: int = 0
+    bottom: int = 0
+    pixel_format: int = PF_BGRA
+    
+    @property
+    def viewport(self) -> Dict:
+        return {'left': self.left, 'top': self.top, 'right': self.right, 'bottom': self.bottom}
+
+
+def bitmask(values) -> int:
+    """编号集合 → 位图（能力字段用）"""
+    mask = 0
+    for value in values:
+        mask |= 1 << value
+    return mask
+
+
+class Capabilities(NamedTuple):
+    """握手时交换的能力
+    
+    客户端在PKT_RESUME中给出自己支持的能力，服务器取与自己的交集（见intersect）作为本连接使用的能力，
+    在PKT_INIT中回复。旧版本的对端不带能力字段，按LEGACY_CAPABILITIES处理。
+    位图字段按 1 << 编号 表示支持的数据包类型/像素格式/有损编码；max_rects与window为0表示不限。
+    """
+    version: int = PROTOCOL_VERSION
+    packet_types: int = 0
+    pixel_formats: int = 0
+    lossy_codecs: int = 0
+    max_rects: int = 0
+    window: int = 0
+    
+    def has_packet(self, pkt_type: int) -> bool:
+        return bool(self.packet_types >> pkt_type & 1)
+    
+    def has_pixel_format(self, pixel_format: int) -> bool:
+        return bool(self.pixel_formats >> pixel_format & 1)
+    
+    def has_codec(self, codec: int) -> bool:
+        return bool(self.lossy_codecs >> codec & 1)
+    
+    def intersect(self, other: 'Capabilities') -> 'Capabilities':
+        """双方都支持的能力（版本取较低者，上限取较严者）"""
+        def limit(a, b):
+            return min(a, b) if a and b else a or b
+        return Capabilities(min(self.version, other.version), self.packet_types & other.packet_types,
+                            self.pixel_formats & other.pixel_formats, self.lossy_codecs & other.lossy_codecs,
+                            limit(self.max_rects, other.max_rects), limit(self.window, other.window))
+    
+    def describe(self) -> str:
+        """日志用的简要描述"""
+        def names(mask, table):
+            return ','.join(name for code, name in table.items() if mask >> code & 1 and code < 32) or '-'
+        return (f"协议 v{self.version} | 格式 {names(self.pixel_formats, PIXEL_FORMAT_NAMES)} | "
+                f"有损 {names(self.lossy_codecs, LOSSY_CODEC_NAMES)} | "
+                f"矩形上限 {self.max_rects or '不限'} | 窗口 {self.window or '不限'}")
+
+
+# 旧版本对端的能力：版本2之前已有的数据包类型（不含有损与多路复用）、全部像素格式（按请求发送，与旧行为相同）
+LEGACY_CAPABILITIES = Capabilities(
+    LEGACY_VERSION, bitmask(range(PKT_INIT, PKT_VIEW + 1)),
+    bitmask(code for code in PIXEL_FORMAT_NAMES if code != PF_AUTO), 0, 0, 0)
+
+
+def now_us() -> int:
+    """当前时间戳（微秒）"""
+    return int(time.time() * 1000000)
+
 
 class Protocol:
     """通信协议处理类"""
     
     @staticmethod
-    def pack_init(width: int, height: int) -> bytes:
+    def pack_init(width: int, height: int, session_token: bytes = EMPTY_TOKEN,
+                  screen_size: Optional[Tuple[int, int]] = None, view: Optional[View] = None,
+                  capabilities: Optional[Capabilities] = None) -> bytes:
         """打包初始化数据包
         
-        格式: [type:1][width:4][height:4]
+        格式: [type:1][width:4][height:4][session_token:16][screen_width:4][screen_height:4][view:25][capabilities]
+        width/height为输出画面尺寸；之后为屏幕尺寸和生效的视图（格式同PKT_VIEW），
+        未给出screen_size时省略（与旧格式相同）；最后为协商后的能力（见pack_capabilities），
+        客户端未给出能力时省略
         """
-        return struct.pack('!BII', PKT_INIT, width, height)
+        packet = struct.pack('!BII16s', PKT_INIT, width, height, session_token)
+        if screen_size is None:
+            return packet
+        if view is None:
+            view = View(width, height, 0, 0, *screen_size)
+        packet += struct.pack('!II', *screen_size) + VIEW_FORMAT.pack(*view)
+        return packet + Protocol.pack_capabilities(capabilities) if capabilities is not None else packet
     
     @staticmethod
-    def unpack_init(data: bytes) -> Tuple[int, int]:
+    def unpack_init(data: bytes) -> Tuple[int, int, bytes]:
         """解包初始化数据包
         
         Returns:
-            (width, height)
+            (width, height, session_token)，旧格式（无令牌）返回EMPTY_TOKEN
         """
         pkt_type, width, height = struct.unpack('!BII', data[:9])
         if pkt_type != PKT_INIT:
             raise ValueError(f"Invalid packet type: {pkt_type}")
-        return width, height
+        session_token = data[9:9+SESSION_TOKEN_SIZE] if len(data) >= 9 + SESSION_TOKEN_SIZE else EMPTY_TOKEN
+        return width, height, session_token
+    
+    @staticmethod
+    def unpack_init_view(data: bytes) -> Optional[Tuple[int, int, View]]:
+        """初始化数据包中的屏幕尺寸与视图
+        
+        Returns:
+            (screen_width, screen_height, view)，旧格式返回None（整个屏幕的原始分辨率，BGRA）
+        """
+        offset = 9 + SESSION_TOKEN_SIZE
+        if len(data) < offset + 8 + VIEW_FORMAT.size:
+            return None
+        screen_width, screen_height = struct.unpack_from('!II', data, offset)
+        return screen_width, screen_height, View(*VIEW_FORMAT.unpack_from(data, offset + 8))
+    
+    @staticmethod
+    def unpack_init_capabilities(data: bytes) -> Optional[Capabilities]:
+        """初始化数据包中协商后的能力，旧格式返回None"""
+        return Protocol.unpack_capabilities(data, 9 + SESSION_TOKEN_SIZE + 8 + VIEW_FORMAT.size)
     
     @staticmethod
-    def pack_frame(frame_data: bytes, compress: bool = True) -> bytes:
+    def pack_frame(frame_data: bytes, compress: bool = True,
+                   seq: int = 0, timestamp: int = 0, level: int = 1) -> bytes:
         """打包完整帧数据包
         
-        格式: [type:1][compressed:1][original_size:4][data_size:4][data:N]
+        格式: [type:1][seq:4][timestamp:8][compressed:1][original_size:4][data_size:4][data:N]
+        level为zlib压缩等级，默认1（快速压缩）
         """
-        original_size = len(frame_data)
+        original_size = memoryview(frame_data).nbytes  # frame_data可以是bytes或连续的numpy数组
         
         if compress:
-            compressed_data = zlib.compress(frame_data, level=1)  # 快速压缩
-            data_size = len(compressed_data)
-            header = struct.pack('!BBII', PKT_FRAME, 1, original_size, data_size)
-            return header + compressed_data
+            compressed_parts = Protocol._compress(frame_data, level)
+            data_size = sum(len(part) for part in compressed_parts)
+            header = struct.pack('!BIQBII', PKT_FRAME, seq, timestamp, 1, original_size, data_size)
+            return b''.join((header, *compressed_parts))
         else:
-            header = struct.pack('!BBII', PKT_FRAME, 0, original_size, original_size)
-            return header + frame_data
+            header = struct.pack('!BIQBII', PKT_FRAME, seq, timestamp, 0, original_size, original_size)
+            return b''.join((header, frame_data))
     
     @staticmethod
-    def unpack_frame(data: bytes) -> bytes:
+    def unpack_frame(data: bytes, out=None) -> bytes:
         """解包完整帧数据包
         
+        out为ScratchBuffer时解压到其中（见_decompress）
+        
         Returns:
             frame_data (解压后的原始数据)
         """
-        pkt_type, compressed, original_size, data_size = struct.unpack('!BBII', data[:10])
+        pkt_type, _, _, compressed, original_size, data_size = struct.unpack('!BIQBII', data[:22])
         
         if pkt_type != PKT_FRAME:
             raise ValueError(f"Invalid packet type: {pkt_type}")
         
-        frame_data = data[10:10+data_size]
+        frame_data = data[22:22+data_size]
         
         if compressed:
-            return zlib.decompress(frame_data)
+            return Protocol._decompress(frame_data, original_size, out)
         else:
             return frame_data
     
     @staticmethod
-    def pack_dirty(rects: List[Dict], frame_data: bytes, compress: bool = True) -> bytes:
+    def pack_dirty(rects: List[Dict], frame_data: bytes, compress: bool = True,
+                   seq: int = 0, timestamp: int = 0, level: int = 1, out=None) -> bytes:
         """打包脏矩形增量更新数据包
         
-        格式: [type:1][compressed:1][rect_count:2][original_size:4][data_size:4]
-              [rects...][data:N]
+        格式: [type:1][seq:4][timestamp:8][compressed:1][rect_count:2]
+              [original_size:4][data_size:4][rects...][data:N]
         
         每个rect: [left:4][top:4][right:4][bottom:4]
+        
+        out为ScratchBuffer时打包到其中并返回memoryview（下次使用该buffer前有效），不分配整包大小的内存
         """
+        return Protocol._pack_rects(PKT_DIRTY, rects, frame_data, compress, seq, timestamp, level, out)
+    
+    @staticmethod
+    def unpack_dirty(data: bytes, out=None) -> Tuple[List[Dict], bytes]:
+        """解包脏矩形增量更新数据包（out见unpack_frame）
+        
+        Returns:
+            (rects, frame_data)
+        """
+        return Protocol._unpack_rects(PKT_DIRTY, data, out)
+    
+    @staticmethod
+    def pack_refresh(rects: List[Dict], pixel_data: bytes, compress: bool = True,
+                     seq: int = 0, timestamp: int = 0, level: int = 1, out=None) -> bytes:
+        """打包原始像素矩形更新数据包（客户端直接覆盖，不做XOR）
+        
+        格式与PKT_DIRTY相同，仅类型不同（out见pack_dirty）
+        """
+        return Protocol._pack_rects(PKT_REFRESH, rects, pixel_data, compress, seq, timestamp, level, out)
+    
+    @staticmethod
+    def unpack_refresh(data: bytes, out=None) -> Tuple[List[Dict], bytes]:
+        """解包原始像素矩形更新数据包（out见unpack_frame）
+        
+        Returns:
+            (rects, pixel_data)
+        """
+        return Protocol._unpack_rects(PKT_REFRESH, data, out)
+    
+    @staticmethod
+    def pack_lossy(rects: List[Dict], images: List[bytes], codec: int = CODEC_JPEG,
+                   seq: int = 0, timestamp: int = 0) -> bytes:
+        """打包有损编码的矩形更新数据包（客户端解码后直接覆盖，不做XOR）
+        
+        格式: [type:1][seq:4][timestamp:8][codec:1][rect_count:2][rects...][images...]
+        
+        每个rect: [left:4][top:4][right:4][bottom:4][size:4]，images为各矩形编码后的图像（已压缩，不再zlib）
+        """
+        header = struct.pack('!BIQBH', PKT_LOSSY, seq, timestamp, codec, len(rects))
+        rects_data = b''.join(struct.pack('!IIIII', r['left'], r['top'], r['right'], r['bottom'], len(image))
+                              for r, image in zip(rects, images))
+        return b''.join((header, rects_data, *images))
+    
+    @staticmethod
+    def unpack_lossy(data: bytes) -> Tuple[int, List[Dict], List[bytes]]:
+        """解包有损编码的矩形更新数据包
+        
+        Returns:
+            (codec, rects, images)
+        """
+        pkt_type, _, _, codec, rect_count = struct.unpack('!BIQBH', data[:16])
+        if pkt_type != PKT_LOSSY:
+            raise ValueError(f"Invalid packet type: {pkt_type}")
+        
+        rects, sizes = [], []
+        offset = 16
+        for left, top, right, bottom, size in struct.iter_unpack('!IIIII', data[offset:offset + 20 * rect_count]):
+            rects.append({'left': left, 'top': top, 'right': right, 'bottom': bottom,
+                          'width': right - left, 'height': bottom - top})
+            sizes.append(size)
+        offset += 20 * rect_count
+        
+        images = []
+        for size in sizes:
+            images.append(data[offset:offset + size])
+            offset += size
+        return codec, rects, images
+    
+    @staticmethod
+    def _pack_rects(pkt_type: int, rects: List[Dict], frame_data: bytes, compress: bool,
+                    seq: int, timestamp: int, level: int, out=None) -> bytes:
+        """打包矩形类数据包（PKT_DIRTY / PKT_REFRESH）"""
         rect_count = len(rects)
-        original_size = len(frame_data)
+        original_size = memoryview(frame_data).nbytes  # frame_data可以是bytes或连续的numpy数组
         
         # 打包矩形数据
-        rects_data = b''
-        for r in rects:
-            rects_data += struct.pack('!IIII', r['left'], r['top'], r['right'], r['bottom'])
+        rects_data = b''.join(struct.pack('!IIII', r['left'], r['top'], r['right'], r['bottom']) for r in rects)
+        
+        if out is not None:
+            return Protocol._pack_into(out, pkt_type, rect_count, rects_data, frame_data, original_size,
+                                       compress, seq, timestamp, level)
         
         # 压缩帧数据
         if compress:
-            compressed_data = zlib.compress(frame_data, level=1)
-            data_size = len(compressed_data)
-            header = struct.pack('!BBHII', PKT_DIRTY, 1, rect_count, original_size, data_size)
-            return header + rects_data + compressed_data
+            compressed_parts = Protocol._compress(frame_data, level)
+            data_size = sum(len(part) for part in compressed_parts)
+            header = struct.pack('!BIQBHII', pkt_type, seq, timestamp, 1, rect_count, original_size, data_size)
+            return b''.join((header, rects_data, *compressed_parts))
         else:
-            header = struct.pack('!BBHII', PKT_DIRTY, 0, rect_count, original_size, original_size)
-            return header + rects_data + frame_data
+            header = struct.pack('!BIQBHII', pkt_type, seq, timestamp, 0, rect_count, original_size, original_size)
+            return b''.join((header, rects_data, frame_data))
     
     @staticmethod
-    def unpack_dirty(data: bytes) -> Tuple[List[Dict], bytes]:
-        """解包脏矩形增量更新数据包
+    def _unpack_rects(expected_type: int, data: bytes, out=None) -> Tuple[List[Dict], bytes]:
+        """解包矩形类数据包"""
+        pkt_type, _, _, compressed, rect_count, original_size, data_size = struct.unpack('!BIQBHII', data[:24])
         
-        Returns:
-            (rects, frame_data)
-        """
-        pkt_type, compressed, rect_count, original_size, data_size = struct.unpack('!BBHII', data[:12])
-        
-        if pkt_type != PKT_DIRTY:
+        if pkt_type != expected_type:
             raise ValueError(f"Invalid packet type: {pkt_type}")
         
         # 解析矩形
         rects = []
-        offset = 12
+        offset = 24
         for i in range(rect_count):
             left, top, right, bottom = struct.unpack('!IIII', data[offset:offset+16])
             rects.append({
@@ -131,17 +407,83 @@ class Protocol:
         frame_data = data[offset:offset+data_size]
         
         if compressed:
-            frame_data = zlib.decompress(frame_data)
+            frame_data = Protocol._decompress(frame_data, original_size, out)
         
         return rects, frame_data
     
     @staticmethod
-    def pack_skip() -> bytes:
+    def _compress(data, level: int) -> List[bytes]:
+        """按COMPRESS_CHUNK分块压缩，返回压缩数据的各段（拼接后与zlib.compress同为完整的zlib流）"""
+        view = memoryview(data).cast('B')
+        compressor = zlib.compressobj(level)
+        parts = [compressor.compress(view[i:i + COMPRESS_CHUNK]) for i in range(0, view.nbytes, COMPRESS_CHUNK)]
+        parts.append(compressor.flush())
+        return parts
+    
+    @staticmethod
+    def _pack_into(out, pkt_type: int, rect_count: int, rects_data: bytes, frame_data, original_size: int,
+                   compress: bool, seq: int, timestamp: int, level: int) -> memoryview:
+        """把矩形类数据包写入ScratchBuffer：逐块压缩并复制到包头之后，最后填入压缩后大小"""
+        start = 24 + len(rects_data)
+        # zlib输出的上限（zlib的compressBound，另加zlib头尾6字节）
+        bound = original_size + (original_size >> 12) + (original_size >> 14) + (original_size >> 25) + 19
+        target = memoryview(out.get(start + bound))
+        target[24:start] = rects_data
+        view = memoryview(frame_data).cast('B')
+        offset = start
+        if compress:
+            compressor = zlib.compressobj(level)
+            for i in range(0, original_size, POOLED_CHUNK):
+                part = compressor.compress(view[i:i + POOLED_CHUNK])
+                target[offset:offset + len(part)] = part
+                offset += len(part)
+            part = compressor.flush()
+            target[offset:offset + len(part)] = part
+            offset += len(part)
+        else:
+            target[start:start + original_size] = view
+            offset += original_size
+        struct.pack_into('!BIQBHII', target, 0, pkt_type, seq, timestamp, int(compress), rect_count,
+                         original_size, offset - start)
+        return target[:offset]
+    
+    @staticmethod
+    def _decompress(data, original_size: int, out=None):
+        """解压zlib数据
+        
+        out为ScratchBuffer时分块解压并复制到其中，返回其前original_size字节的视图（下次使用该buffer前有效），
+        临时分配只有一块；否则按原始大小一次分配输出（默认的逐步增长再拼接峰值约为输出的2.5倍）
+        """
+        if out is None:
+            return zlib.decompress(data, bufsize=original_size)
+        target = out.get(original_size)
+        output = memoryview(target)
+        view = memoryview(data).cast('B')
+        decompressor = zlib.decompressobj()
+        offset = 0
+        for i in range(0, view.nbytes, DECOMPRESS_INPUT):
+            pending = view[i:i + DECOMPRESS_INPUT]
+            while True:
+                chunk = decompressor.decompress(pending, POOLED_CHUNK)
+                if offset + len(chunk) > original_size:
+                    raise ValueError("解压后数据超出原始大小")
+                output[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+                pending = decompressor.unconsumed_tail
+                if not pending and len(chunk) < POOLED_CHUNK:
+                    break
+        if offset != original_size or not decompressor.eof:
+            raise ValueError(f"解压后数据大小不符: {offset} != {original_size}")
+        return target
+    
+    @staticmethod
+    def pack_skip(seq: int = 0, timestamp: int = 0) -> bytes:
         """打包跳帧数据包（无变化）
         
-        格式: [type:1]
+        格式: [type:1][seq:4][timestamp:8]
+        seq为最近一次已发送更新的序号（跳帧不占用新序号）
         """
-        return struct.pack('!B', PKT_SKIP)
+        return UPDATE_HEADER.pack(PKT_SKIP, seq, timestamp)
     
     @staticmethod
     def unpack_skip(data: bytes) -> bool:
@@ -154,26 +496,236 @@ class Protocol:
         return pkt_type == PKT_SKIP
     
     @staticmethod
-    def pack_heartbeat() -> bytes:
+    def pack_heartbeat(timestamp: Optional[int] = None, echo_timestamp: int = 0) -> bytes:
         """打包心跳数据包
         
-        格式: [type:1][timestamp:8]
+        格式: [type:1][timestamp:8][echo_timestamp:8]
+        客户端发送本地时间戳（微秒）；服务器回传时填入服务器时间戳，
+        并把客户端的时间戳原样放入echo_timestamp，客户端据此计算RTT和时钟偏差
         """
-        import time
-        timestamp = int(time.time() * 1000)
-        return struct.pack('!BQ', PKT_HEARTBEAT, timestamp)
+        if timestamp is None:
+            timestamp = now_us()
+        return struct.pack('!BQQ', PKT_HEARTBEAT, timestamp, echo_timestamp)
     
     @staticmethod
-    def unpack_heartbeat(data: bytes) -> int:
+    def unpack_heartbeat(data: bytes) -> Tuple[int, int]:
         """解包心跳数据包
         
         Returns:
-            timestamp
+            (timestamp, echo_timestamp)
         """
-        pkt_type, timestamp = struct.unpack('!BQ', data[:9])
+        pkt_type, timestamp, echo_timestamp = struct.unpack('!BQQ', data[:17])
         if pkt_type != PKT_HEARTBEAT:
             raise ValueError(f"Invalid packet type: {pkt_type}")
-        return timestamp
+        return timestamp, echo_timestamp
+    
+    @staticmethod
+    def unpack_update_header(data: bytes) -> Tuple[int, int, int]:
+        """解包更新包公共头（PKT_FRAME / PKT_DIRTY / PKT_SKIP）
+        
+        Returns:
+            (pkt_type, seq, timestamp)
+        """
+        if len(data) < UPDATE_HEADER_SIZE:
+            raise ValueError("Invalid packet: too short")
+        return UPDATE_HEADER.unpack_from(data)
+    
+    @staticmethod
+    def pack_ack(seq: int, timestamp: int) -> bytes:
+        """打包确认数据包（客户端→服务器）
+        
+        格式: [type:1][seq:4][timestamp:8]
+        seq为客户端已应用的最新更新序号（累计确认），timestamp回传该更新的捕获时间
+        """
+        return struct.pack('!BIQ', PKT_ACK, seq, timestamp)
+    
+    @staticmethod
+    def unpack_ack(data: bytes) -> Tuple[int, int]:
+        """解包确认数据包
+        
+        Returns:
+            (seq, timestamp)
+        """
+        pkt_type, seq, timestamp = struct.unpack('!BIQ', data[:13])
+        if pkt_type != PKT_ACK:
+            raise ValueError(f"Invalid packet type: {pkt_type}")
+        return seq, timestamp
+    
+    @staticmethod
+    def pack_resume(session_token: bytes = EMPTY_TOKEN, last_seq: int = 0, checksum: int = 0,
+                    view: Optional[View] = None, capabilities: Optional[Capabilities] = None) -> bytes:
+        """打包会话恢复请求（客户端→服务器）
+        
+        格式: [type:1][session_token:16][last_seq:4][checksum:4][view:25][capabilities]
+        新连接发送EMPTY_TOKEN；重连时发送上次的令牌、最近应用的序号和帧缓冲校验和。
+        view为请求的视图（格式同PKT_VIEW），None时省略，服务器按整个屏幕原始分辨率发送；
+        capabilities为客户端支持的能力（见pack_capabilities），给出时视图不能省略（View()即默认视图）
+        """
+        packet = struct.pack('!B16sII', PKT_RESUME, session_token, last_seq, checksum)
+        if capabilities is not None:
+            return packet + VIEW_FORMAT.pack(*(view or View())) + Protocol.pack_capabilities(capabilities)
+        return packet + VIEW_FORMAT.pack(*view) if view is not None else packet
+    
+    @staticmethod
+    def unpack_resume(data: bytes) -> Tuple[bytes, int, int, Optional[View]]:
+        """解包会话恢复请求
+        
+        Returns:
+            (session_token, last_seq, checksum, view)，旧格式（无视图）的view为None
+        """
+        pkt_type, session_token, last_seq, checksum = struct.unpack('!B16sII', data[:25])
+        if pkt_type != PKT_RESUME:
+            raise ValueError(f"Invalid packet type: {pkt_type}")
+        view = View(*VIEW_FORMAT.unpack_from(data, 25)) if len(data) >= 25 + VIEW_FORMAT.size else None
+        return session_token, last_seq, checksum, view
+    
+    @staticmethod
+    def unpack_resume_capabilities(data: bytes) -> Optional[Capabilities]:
+        """会话恢复请求中客户端的能力，旧格式返回None"""
+        return Protocol.unpack_capabilities(data, 25 + VIEW_FORMAT.size)
+    
+    @staticmethod
+    def pack_capabilities(capabilities: Capabilities) -> bytes:
+        """打包能力字段（附在PKT_RESUME/PKT_INIT之后）
+        
+        格式: [version:2][count:1]，其后每项 [tag:1][size:1][value:size]；
+        新增能力只需增加标签，旧版本按size跳过不认识的标签
+        """
+        items = [(CAP_PACKET_TYPES, capabilities.packet_types), (CAP_PIXEL_FORMATS, capabilities.pixel_formats),
+                 (CAP_LOSSY_CODECS, capabilities.lossy_codecs), (CAP_MAX_RECTS, capabilities.max_rects),
+                 (CAP_WINDOW, capabilities.window)]
+        parts = [CAPS_HEADER.pack(capabilities.version, len(items))]
+        for tag, value in items:
+            parts.append(CAP_ITEM.pack(tag, 4) + struct.pack('!I', value))
+        return b''.join(parts)
+    
+    @staticmethod
+    def unpack_capabilities(data: bytes, offset: int = 0) -> Optional[Capabilities]:
+        """解包offset处的能力字段，不存在时返回None（缺少的标签按0处理）"""
+        if len(data) < offset + CAPS_HEADER.size:
+            return None
+        version, count = CAPS_HEADER.unpack_from(data, offset)
+        offset += CAPS_HEADER.size
+        fields = {}
+        for _ in range(count):
+            tag, size = CAP_ITEM.unpack_from(data, offset)
+            offset += CAP_ITEM.size
+            if offset + size > len(data):
+                raise ValueError("能力字段不完整")
+            fields[tag] = int.from_bytes(data[offset:offset + size], 'big')
+            offset += size
+        return Capabilities(version, fields.get(CAP_PACKET_TYPES, 0), fields.get(CAP_PIXEL_FORMATS, 0),
+                            fields.get(CAP_LOSSY_CODECS, 0), fields.get(CAP_MAX_RECTS, 0),
+                            fields.get(CAP_WINDOW, 0))
+    
+    @staticmethod
+    def pack_view(view: View) -> bytes:
+        """打包视图数据包
+        
+        格式: [type:1][width:4][height:4][left:4][top:4][right:4][bottom:4][pixel_format:1]
+        客户端→服务器：运行中更换输出分辨率、视口（缩放/平移）或像素格式；
+        服务器→客户端：生效的视图，其后紧跟该分辨率的完整帧
+        """
+        return struct.pack('!B', PKT_VIEW) + VIEW_FORMAT.pack(*view)
+    
+    @staticmethod
+    def unpack_view(data: bytes) -> View:
+        """解包视图数据包"""
+        if data[0] != PKT_VIEW:
+            raise ValueError(f"Invalid packet type: {data[0]}")
+        return View(*VIEW_FORMAT.unpack_from(data, 1))
+    
+    @staticmethod
+    def pack_checksum(seq: int, tile_size: int, cols: int, rows: int, sums: bytes,
+                      timestamp: int = 0) -> bytes:
+        """打包分块校验和数据包（服务器→客户端）
+        
+        格式: [type:1][seq:4][timestamp:8][tile_size:2][cols:2][rows:2][sums:2*cols*rows]
+        seq表示校验和对应"应用完该序号更新后"的帧缓冲
+        """
+        return struct.pack('!BIQHHH', PKT_CHECKSUM, seq, timestamp, tile_size, cols, rows) + sums
+    
+    @staticmethod
+    def unpack_checksum(data: bytes) -> Tuple[int, int, int, int, bytes]:
+        """解包分块校验和数据包
+        
+        Returns:
+            (seq, tile_size, cols, rows, sums)
+        """
+        pkt_type, seq, _, tile_size, cols, rows = struct.unpack('!BIQHHH', data[:19])
+        if pkt_type != PKT_CHECKSUM:
+            raise ValueError(f"Invalid packet type: {pkt_type}")
+        return seq, tile_size, cols, rows, data[19:19 + 2 * cols * rows]
+    
+    @staticmethod
+    def pack_resync(seq: int, tiles: List[int]) -> bytes:
+        """打包块重传请求（客户端→服务器）
+        
+        格式: [type:1][seq:4][count:4][tile_index:4*count]
+        """
+        return struct.pack(f'!BII{len(tiles)}I', PKT_RESYNC, seq, len(tiles), *tiles)
+    
+    @staticmethod
+    def unpack_resync(data: bytes) -> Tuple[int, List[int]]:
+        """解包块重传请求
+        
+        Returns:
+            (seq, tiles)
+        """
+        pkt_type, seq, count = struct.unpack('!BII', data[:9])
+        if pkt_type != PKT_RESYNC:
+            raise ValueError(f"Invalid packet type: {pkt_type}")
+        return seq, list(struct.unpack(f'!{count}I', data[9:9 + 4 * count]))
+    
+    @staticmethod
+    def pack_stream(stream: int, packet: bytes = b'') -> bytes:
+        """打包多路复用的流数据包
+        
+        格式: [type:1][stream:2][packet:N]
+        packet为该流的原数据包；为空表示该流已关闭（两个方向都可发送）
+        """
+        return b''.join((STREAM_HEADER.pack(PKT_STREAM, stream), packet))
+    
+    @staticmethod
+    def unpack_stream(data: bytes) -> Tuple[int, memoryview]:
+        """解包多路复用的流数据包
+        
+        Returns:
+            (stream, packet)，packet为原数据包的视图（空表示流已关闭）
+        """
+        pkt_type, stream = STREAM_HEADER.unpack_from(data)
+        if pkt_type != PKT_STREAM:
+            raise ValueError(f"Invalid packet type: {pkt_type}")
+        return stream, memoryview(data)[STREAM_HEADER.size:]
+    
+    @staticmethod
+    def pack_streams(names: List[str]) -> bytes:
+        """打包流列表
+        
+        格式: [type:1][count:2][name_size:1][name:N]...
+        客户端连接多路复用服务器时先发送空列表（请求），服务器回复各流的名称，流号即列表下标
+        """
+        encoded = [name.encode('utf-8')[:255] for name in names]
+        return struct.pack('!BH', PKT_STREAMS, len(encoded)) + b''.join(
+            struct.pack('!B', len(name)) + name for name in encoded)
+    
+    @staticmethod
+    def unpack_streams(data: bytes) -> List[str]:
+        """解包流列表"""
+        pkt_type, count = struct.unpack('!BH', data[:3])
+        if pkt_type != PKT_STREAMS:
+            raise ValueError(f"Invalid packet type: {pkt_type}")
+        names, offset = [], 3
+        for _ in range(count):
+            size = data[offset]
+            names.append(bytes(data[offset + 1:offset + 1 + size]).decode('utf-8', 'replace'))
+            offset += 1 + size
+        return names
+    
+    @staticmethod
+    def frame_checksum(frame) -> int:
+        """计算帧缓冲校验和（CRC32，frame为bytes或连续的numpy数组）"""
+        return zlib.crc32(frame) & 0xFFFFFFFF
     
     @staticmethod
     def get_packet_type(data: bytes) -> int:
@@ -193,9 +745,12 @@ class Protocol:
         sock.sendall(data)
     
     @staticmethod
-    def recv_packet(sock) -> Optional[bytes]:
+    def recv_packet(sock, buffer=None) -> Optional[bytes]:
         """接收数据包（读取长度前缀）
         
+        buffer为ScratchBuffer时包体接收到其中并返回memoryview（下次使用该buffer接收前有效），
+        避免每个包分配新的内存；否则返回bytes
+        
         Returns:
             packet data or None if connection closed
         """
@@ -207,15 +762,39 @@ class Protocol:
         length, = struct.unpack('!I', length_data)
         
         # 读取数据
-        return Protocol._recv_exact(sock, length)
-    
+        return Protocol._recv_exact(sock, length, buffer)
+
     @staticmethod
-    def _recv_exact(sock, size: int) -> Optional[bytes]:
-        """精确接收指定字节数"""
-        data = b''
-        while len(data) < size:
-            chunk = sock.recv(size - len(data))
-            if not chunk:
+    def recv_packet_timed(sock, buffer=None) -> Tuple[Optional[bytes], float]:
+        """接收数据包，并返回读取包体的耗时（秒，不含等待长度前缀的空闲时间）"""
+        length_data = Protocol._recv_exact(sock, 4)
+        if not length_data:
+            return None, 0.0
+
+        length, = struct.unpack('!I', length_data)
+        start = time.perf_counter()
+        packet = Protocol._recv_exact(sock, length, buffer)
+        return packet, time.perf_counter() - start
+
+    @staticmethod
+    def _recv_exact(sock, size: int, buffer=None) -> Optional[bytes]:
+        """精确接收指定字节数（buffer见recv_packet）"""
+        if buffer is None:
+            chunks = []
+            remaining = size
+            while remaining > 0:
+                chunk = sock.recv(remaining)
+                if not chunk:
+                    return None
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+        
+        view = memoryview(buffer.get(size))
+        received = 0
+        while received < size:
+            count = sock.recv_into(view[received:])
+            if not count:
                 return None
-            data += chunk
-        return data
+            received += count
+        return view
@@ -0,0 +1,757 @@
+"""
+远程桌面 - 协议微基准与往返性质检查
+
+bench: 扫描矩形数（1~4096）、负载大小与压缩设置，测量 Protocol.pack_dirty / unpack_dirty、
+       服务器XOR编码（xor_encode）与客户端XOR应用的耗时，结果可导出为JSON或CSV用于跟踪趋势。
+check: 对每种数据包做 unpack(pack(x)) == x 的随机往返检查，并检查XOR编码/应用/撤销互逆、像素格式逐矩形转换与整帧转换一致。
+       安装了hypothesis时由其生成并收缩反例，否则使用内置的随机生成器（偏向取边界值）。
+alloc: 用tracemalloc测量热路径每帧的内存分配峰值（服务器: 捕获→XOR编码→打包，客户端: 接收→解包→应用→入显示队列），
+       超过与包大小无关的固定上限时返回非0。
+window: 服务器会话经socketpair连接限速读取（TokenBucket）的客户端，检查在途数不超过窗口、
+       窗口满时积压的变化合并为更少的包、停止捕获并发完后客户端帧缓冲与服务器屏幕一致。
+
+用法:
+    python protocol_bench.py bench                       # 默认扫描，打印表格
+    python protocol_bench.py bench --rects 1 64 4096 --payload 1048576 --level 0 1 6
+    python protocol_bench.py bench --output bench.json   # 导出（.csv后缀导出为CSV）
+    python protocol_bench.py check --examples 500
+    python protocol_bench.py alloc --frames 60           # 默认4K的打字/滚动/视频场景
+    python protocol_bench.py window --window 2 --throttle 64   # 限速64KB/s的滚动/拖动场景
+"""
+
+import csv
+import gc
+import json
+import math
+import platform
+import socket
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from buffers import ScratchBuffer
+from protocol import (Protocol, PKT_INIT, PKT_FRAME, PKT_DIRTY, PKT_SKIP, PKT_REFRESH, PKT_CHECKSUM, PKT_VIEW,
+                      PKT_LOSSY, PKT_STREAMS, SESSION_TOKEN_SIZE, POOLED_CHUNK, Capabilities, View)
+import regions
+from pixelformat import PIXEL_FORMATS
+
+# 默认扫描参数
+RECT_COUNTS = (1, 4, 16, 64, 256, 1024, 4096)
+PAYLOAD_SIZES = (16 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+LEVELS = (0, 1, 6)  # 0表示不压缩
+# 负载内容：XOR结果中非0字节的比例（静态桌面的XOR大部分为0）
+CONTENTS = {'zeros': 0.0, 'sparse': 0.05, 'random': 1.0}
+
+# 基准画布（足够容纳8MB负载）
+CANVAS_WIDTH = 3840
+CANVAS_HEIGHT = 2160
+
+# 每项至少测量的时间（秒）与重复次数（取中位数）
+MIN_TIME = 0.05
+REPEAT = 5
+
+# 分配检查：场景、预热帧数（计划缓存与暂存区增长），以及每帧允许的固定余量
+# （字节，主要是每次压缩的deflate状态约300KB，其余为矩形列表等小对象）；
+# 每帧上限为 ALLOC_SLACK + POOLED_CHUNK（压缩/解压的一块）+ 本帧暂存区增长，与负载大小无关
+ALLOC_WORKLOADS = ('typing', 'scrolling', 'video')
+ALLOC_WARMUP = 5
+ALLOC_SLACK = 512 * 1024
+
+# 窗口检查：场景（变化足以占满限速链路）、画布、限速（字节/秒）、运行时间与停止捕获后等待发完的时间（秒）
+WINDOW_WORKLOADS = ('scrolling', 'drag')
+WINDOW_WIDTH = 640
+WINDOW_HEIGHT = 360
+WINDOW_THROTTLE = 64 * 1024
+WINDOW_DURATION = 3.0
+WINDOW_DRAIN = 15.0
+
+
+def make_rects(count: int, payload: int) -> List[Dict]:
+    """在画布上按网格排列count个大小相同的方形矩形，总像素约为payload/4；放不下时返回空列表"""
+    side = max(1, int(math.sqrt(payload / 4 / count)))
+    cols = CANVAS_WIDTH // side
+    if cols == 0 or math.ceil(count / cols) * side > CANVAS_HEIGHT:
+        return []
+    rects = []
+    for i in range(count):
+        left, top = (i % cols) * side, (i // cols) * side
+        rects.append({'left': left, 'top': top, 'right': left + side, 'bottom': top + side,
+                      'width': side, 'height': side})
+    return rects
+
+
+def make_frames(density: float, rng: np.random.Generator):
+    """参考帧与当前帧（两者的XOR中约density比例的字节非0）"""
+    reference = rng.integers(0, 256, (CANVAS_HEIGHT, CANVAS_WIDTH, 4), dtype=np.uint8)
+    current = reference.copy()
+    if density > 0:
+        mask = rng.random(reference.shape, dtype=np.float32) < density
+        current[mask] ^= rng.integers(1, 256, int(mask.sum()), dtype=np.uint8)
+    return reference, current
+
+
+def _time(function: Callable[[], object]) -> float:
+    """单次调用耗时（秒，REPEAT组的中位数）"""
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < MIN_TIME:
+        number *= 2
+    samples = sorted(timer.repeat(REPEAT, number))
+    return samples[len(samples) // 2] / number
+
+
+def bench(rect_counts=RECT_COUNTS, payloads=PAYLOAD_SIZES, levels=LEVELS, content='sparse',
+          seed=0) -> List[Dict]:
+    """运行扫描，返回每个组合一行结果"""
+    rng = np.random.default_rng(seed)
+    reference, current = make_frames(CONTENTS[content], rng)
+    results = []
+    for payload in payloads:
+        for count in rect_counts:
+            rects = make_rects(count, payload)
+            if not rects:
+                continue
+            data = regions.xor_encode(current, reference.copy(), rects)
+            size = data.nbytes
+            # xor_encode会把参考帧更新为当前帧，之后重复编码的结果全为0，但耗时与内容无关
+            frame = reference.copy()
+            out = np.empty_like(data)
+            encode = _time(lambda: regions.xor_encode(current, frame, rects, out))
+            frame = reference.copy()
+            apply = _time(lambda: regions.xor_apply(frame, rects, data))
+
+            for level in levels:
+                compress = level > 0
+                packet = Protocol.pack_dirty(rects, data, compress=compress, level=max(level, 1))
+                pack = _time(lambda: Protocol.pack_dirty(rects, data, compress=compress, level=max(level, 1)))
+                unpack = _time(lambda: Protocol.unpack_dirty(packet))
+                results.append({
+                    'rects': count,
+                    'rect_size': rects[0]['width'],
+                    'payload_bytes': size,
+                    'content': content,
+                    'level': level,
+                    'packet_bytes': len(packet),
+                    'ratio': round(len(packet) / size, 4),
+                    'pack_us': round(pack * 1e6, 2),
+                    'unpack_us': round(unpack * 1e6, 2),
+                    'xor_encode_us': round(encode * 1e6, 2),
+                    'xor_apply_us': round(apply * 1e6, 2),
+                    'pack_mbps': round(size / pack / 1024 / 1024, 1),
+                    'unpack_mbps': round(size / unpack / 1024 / 1024, 1),
+                    'apply_ns_per_rect': round(apply * 1e9 / count, 1),
+                })
+    return results
+
+
+def print_table(results: List[Dict]) -> None:
+    print(f"{'矩形':>6} {'边长':>5} {'负载':>10} {'等级':>4} {'包大小':>10} {'打包us':>10} {'解包us':>10} "
+          f"{'XOR编码us':>10} {'XOR应用us':>10} {'应用ns/矩形':>11}")
+    for r in results:
+        print(f"{r['rects']:>6} {r['rect_size']:>5} {r['payload_bytes']:>10} {r['level']:>4} {r['packet_bytes']:>10} "
+              f"{r['pack_us']:>10.1f} {r['unpack_us']:>10.1f} {r['xor_encode_us']:>10.1f} "
+              f"{r['xor_apply_us']:>10.1f} {r['apply_ns_per_rect']:>11.0f}")
+
+
+def export(results: List[Dict], path: str) -> None:
+    """导出结果：.csv为CSV，其余为JSON（附运行环境）"""
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+        return
+    report = {
+        'version': 1,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': results,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+# ---- 往返性质 ----
+
+U8 = 0xFF
+U16 = 0xFFFF
+U32 = 0xFFFFFFFF
+U64 = 0xFFFFFFFFFFFFFFFF
+
+
+class RandomDraw:
+    """内置随机生成器，约1/5的概率取边界值"""
+
+    def __init__(self, rng: np.random.Generator):
+        self.rng = rng
+
+    def integers(self, low: int, high: int) -> int:
+        if self.rng.random() < 0.2:
+            return low if self.rng.random() < 0.5 else high
+        return int(self.rng.integers(low, high, endpoint=True, dtype=np.uint64)) if high > 2**62 \
+            else int(self.rng.integers(low, high + 1))
+
+    def booleans(self) -> bool:
+        return bool(self.rng.random() < 0.5)
+
+    def binary(self, size: int) -> bytes:
+        return self.rng.bytes(size)
+
+
+class HypothesisDraw:
+    """把hypothesis的data()策略适配为与RandomDraw相同的接口"""
+
+    def __init__(self, data):
+        from hypothesis import strategies as st
+        self.data = data
+        self.st = st
+
+    def integers(self, low: int, high: int) -> int:
+        return self.data.draw(self.st.integers(low, high))
+
+    def booleans(self) -> bool:
+        return self.data.draw(self.st.booleans())
+
+    def binary(self, size: int) -> bytes:
+        return self.data.draw(self.st.binary(min_size=size, max_size=size))
+
+
+def _rects(draw, width: int = U32, height: int = U32, max_count: int = 32) -> List[Dict]:
+    rects = []
+    for _ in range(draw.integers(0, max_count)):
+        left, right = sorted((draw.integers(0, width), draw.integers(0, width)))
+        top, bottom = sorted((draw.integers(0, height), draw.integers(0, height)))
+        rects.append({'left': left, 'top': top, 'right': right, 'bottom': bottom,
+                      'width': right - left, 'height': bottom - top})
+    return rects
+
+
+def _view(draw) -> View:
+    return View(*(draw.integers(0, U32) for _ in View._fields[:-1]), draw.integers(0, U8))
+
+
+def prop_init(draw):
+    width, height, token = draw.integers(0, U32), draw.integers(0, U32), draw.binary(SESSION_TOKEN_SIZE)
+    packet = Protocol.pack_init(width, height, token)
+    assert Protocol.get_packet_type(packet) == PKT_INIT
+    assert Protocol.unpack_init(packet) == (width, height, token)
+    assert Protocol.unpack_init_view(packet) is None
+    screen = (draw.integers(0, U32), draw.integers(0, U32))
+    view = _view(draw)
+    packet = Protocol.pack_init(width, height, token, screen, view)
+    assert Protocol.unpack_init(packet) == (width, height, token)
+    assert Protocol.unpack_init_view(packet) == (*screen, view)
+
+
+def prop_frame(draw):
+    data = draw.binary(draw.integers(0, 4096))
+    compress, seq, timestamp, level = draw.booleans(), draw.integers(0, U32), draw.integers(0, U64), draw.integers(0, 9)
+    packet = Protocol.pack_frame(data, compress=compress, seq=seq, timestamp=timestamp, level=level)
+    assert Protocol.unpack_update_header(packet) == (PKT_FRAME, seq, timestamp)
+    assert Protocol.unpack_frame(packet) == data
+    assert bytes(Protocol.unpack_frame(packet, ScratchBuffer())) == data
+
+
+def prop_rects(draw):
+    rects = _rects(draw)
+    data = draw.binary(draw.integers(0, 4096))
+    compress, seq, timestamp, level = draw.booleans(), draw.integers(0, U32), draw.integers(0, U64), draw.integers(0, 9)
+    refresh = draw.booleans()
+    pack, unpack, kind = ((Protocol.pack_refresh, Protocol.unpack_refresh, PKT_REFRESH) if refresh
+                          else (Protocol.pack_dirty, Protocol.unpack_dirty, PKT_DIRTY))
+    if draw.booleans():
+        data *= draw.integers(1, 160)  # 跨越多个压缩/解压块
+    packet = pack(rects, data, compress=compress, seq=seq, timestamp=timestamp, level=level)
+    assert Protocol.unpack_update_header(packet) == (kind, seq, timestamp)
+    assert unpack(packet) == (rects, data)
+    # 打包/解压到暂存区（压缩的分块不同，字节可能不同，往返结果相同）
+    pooled = bytes(pack(rects, data, compress=compress, seq=seq, timestamp=timestamp, level=level,
+                        out=ScratchBuffer()))
+    assert Protocol.unpack_update_header(pooled) == (kind, seq, timestamp)
+    assert unpack(pooled) == (rects, data)
+    unpacked_rects, unpacked = unpack(packet, ScratchBuffer())
+    assert unpacked_rects == rects and bytes(unpacked) == data
+
+
+def prop_lossy(draw):
+    rects = _rects(draw)
+    images = [draw.binary(draw.integers(0, 256)) for _ in rects]
+    codec, seq, timestamp = draw.integers(0, U8), draw.integers(0, U32), draw.integers(0, U64)
+    packet = Protocol.pack_lossy(rects, images, codec, seq=seq, timestamp=timestamp)
+    assert Protocol.unpack_update_header(packet) == (PKT_LOSSY, seq, timestamp)
+    assert Protocol.unpack_lossy(packet) == (codec, rects, images)
+
+
+def _capabilities(draw):
+    return Capabilities(draw.integers(0, U16), *(draw.integers(0, U32) for _ in Capabilities._fields[1:]))
+
+
+def prop_capabilities(draw):
+    """能力字段附在恢复请求/初始化包之后的往返；交集不超出任何一方"""
+    token, seq, checksum = draw.binary(SESSION_TOKEN_SIZE), draw.integers(0, U32), draw.integers(0, U32)
+    capabilities = _capabilities(draw)
+    view = _view(draw) if draw.booleans() else None
+    packet = Protocol.pack_resume(token, seq, checksum, view, capabilities)
+    assert Protocol.unpack_resume(packet) == (token, seq, checksum, view or View())
+    assert Protocol.unpack_resume_capabilities(packet) == capabilities
+    assert Protocol.unpack_resume_capabilities(Protocol.pack_resume(token, seq, checksum, view)) is None
+    width, height, screen = draw.integers(0, U32), draw.integers(0, U32), (draw.integers(0, U32), draw.integers(0, U32))
+    packet = Protocol.pack_init(width, height, token, screen, _view(draw), capabilities)
+    assert Protocol.unpack_init(packet) == (width, height, token)
+    assert Protocol.unpack_init_capabilities(packet) == capabilities
+    other = _capabilities(draw)
+    common = capabilities.intersect(other)
+    assert common == other.intersect(capabilities)
+    assert common.packet_types & ~(capabilities.packet_types & other.packet_types) == 0
+    assert common.version == min(capabilities.version, other.version)
+    for limit in ('max_rects', 'window'):
+        assert getattr(common, limit) in (getattr(capabilities, limit), getattr(other, limit))
+
+
+def prop_stream(draw):
+    stream = draw.integers(0, U16)
+    inner = Protocol.pack_ack(draw.integers(0, U32), draw.integers(0, U64)) if draw.booleans() else b''
+    assert Protocol.unpack_stream(Protocol.pack_stream(stream, inner)) == (stream, inner)
+    names = [draw.binary(draw.integers(0, 32)).hex() for _ in range(draw.integers(0, 8))]
+    packet = Protocol.pack_streams(names)
+    assert Protocol.get_packet_type(packet) == PKT_STREAMS
+    assert Protocol.unpack_streams(packet) == names
+
+
+def prop_small(draw):
+    seq, timestamp, echo = draw.integers(0, U32), draw.integers(0, U64), draw.integers(0, U64)
+    assert Protocol.unpack_update_header(Protocol.pack_skip(seq, timestamp)) == (PKT_SKIP, seq, timestamp)
+    assert Protocol.unpack_skip(Protocol.pack_skip(seq, timestamp))
+    assert Protocol.unpack_heartbeat(Protocol.pack_heartbeat(timestamp, echo)) == (timestamp, echo)
+    assert Protocol.unpack_ack(Protocol.pack_ack(seq, timestamp)) == (seq, timestamp)
+    token, checksum = draw.binary(SESSION_TOKEN_SIZE), draw.integers(0, U32)
+    assert Protocol.unpack_resume(Protocol.pack_resume(token, seq, checksum)) == (token, seq, checksum, None)
+    view = _view(draw)
+    assert Protocol.unpack_resume(Protocol.pack_resume(token, seq, checksum, view)) == (token, seq, checksum, view)
+    assert Protocol.get_packet_type(Protocol.pack_view(view)) == PKT_VIEW
+    assert Protocol.unpack_view(Protocol.pack_view(view)) == view
+
+
+def prop_checksum(draw):
+    seq, tile_size, timestamp = draw.integers(0, U32), draw.integers(0, U16), draw.integers(0, U64)
+    cols, rows = draw.integers(0, 64), draw.integers(0, 64)
+    sums = draw.binary(2 * cols * rows)
+    packet = Protocol.pack_checksum(seq, tile_size, cols, rows, sums, timestamp)
+    assert Protocol.unpack_update_header(packet) == (PKT_CHECKSUM, seq, timestamp)
+    assert Protocol.unpack_checksum(packet) == (seq, tile_size, cols, rows, sums)
+
+
+def prop_resync(draw):
+    seq = draw.integers(0, U32)
+    tiles = [draw.integers(0, U32) for _ in range(draw.integers(0, 256))]
+    assert Protocol.unpack_resync(Protocol.pack_resync(seq, tiles)) == (seq, tiles)
+
+
+def prop_xor(draw):
+    """XOR编码后应用得到当前帧（重叠矩形按顺序处理），撤销后回到参考帧"""
+    height, width = draw.integers(1, 48), draw.integers(1, 48)
+    reference = np.frombuffer(draw.binary(height * width * 4), dtype=np.uint8).reshape(height, width, 4).copy()
+    current = np.frombuffer(draw.binary(height * width * 4), dtype=np.uint8).reshape(height, width, 4)
+    rects = _rects(draw, width, height, max_count=8)
+
+    server_reference = reference.copy()
+    data = regions.xor_encode(current, server_reference, rects)
+    assert data.nbytes == sum(r['width'] * r['height'] * 4 for r in rects)
+
+    packet = Protocol.pack_dirty(rects, data, compress=draw.booleans())
+    rects, data = Protocol.unpack_dirty(packet)
+    frame = reference.copy()
+    regions.xor_apply(frame, rects, data)
+    assert np.array_equal(frame, server_reference)
+    mask = np.zeros((height, width), dtype=bool)
+    for r in rects:
+        mask[r['top']:r['bottom'], r['left']:r['right']] = True
+    assert np.array_equal(frame[mask], current[mask])
+    assert np.array_equal(frame[~mask], reference[~mask])
+
+    regions.xor_apply(frame, rects, data)
+    assert np.array_equal(frame, reference)
+
+
+def prop_regions(draw):
+    """拼接的区域像素写回后与原帧一致；数据不足时只写入完整覆盖的矩形；两种处理方式结果相同"""
+    height, width = draw.integers(1, 48), draw.integers(1, 48)
+    current = np.frombuffer(draw.binary(height * width * 4), dtype=np.uint8).reshape(height, width, 4)
+    rects = _rects(draw, width, height, max_count=8)
+
+    data = regions.gather(current, rects)
+    frame = np.zeros_like(current)
+    assert regions.scatter(frame, rects, data) == rects
+    for r in rects:
+        assert np.array_equal(frame[r['top']:r['bottom'], r['left']:r['right']],
+                              current[r['top']:r['bottom'], r['left']:r['right']])
+
+    truncated = data[:draw.integers(0, data.nbytes)]
+    written = regions.scatter(np.zeros_like(current), rects, truncated)
+    assert sum(r['width'] * r['height'] * 4 for r in written) <= truncated.nbytes
+    assert written == rects[:len(written)]
+
+    reference = np.zeros_like(current)
+    by_index = regions.RegionPlan(rects, width, height, sliced=False)
+    by_slice = regions.RegionPlan(rects, width, height, sliced=True)
+    expected = by_index.xor_encode(current, reference.copy())
+    assert np.array_equal(by_slice.xor_encode(current, reference.copy()), expected)
+
+
+def prop_pixelformat(draw):
+    """逐矩形转换与整帧转换的传输帧一致；传输帧矩形解码回的画面与整帧解码一致"""
+    formats = list(PIXEL_FORMATS.values())
+    pixel_format = formats[draw.integers(0, len(formats) - 1)]
+    block = pixel_format.block
+    height, width = draw.integers(1, 24) * block, draw.integers(1, 24) * block
+    image = np.frombuffer(draw.binary(height * width * 4), dtype=np.uint8).reshape(height, width, 4)
+    whole = {'left': 0, 'top': 0, 'right': width, 'bottom': height}
+    expected = pixel_format.allocate(width, height)
+    pixel_format.encode(image, expected, [whole])
+    decoded = np.zeros((height, width, 3), dtype=np.uint8)
+    pixel_format.decode(expected, decoded)
+
+    rects = [{key: r[key] // block * block for key in ('left', 'top', 'right', 'bottom')}
+             for r in _rects(draw, width, height, max_count=8)]
+    wire = pixel_format.allocate(width, height)
+    pixel_format.encode(image, wire, rects)
+    wire_rects = [pixel_format.wire_rect(r) for r in rects]
+    output = np.zeros_like(decoded)
+    pixel_format.decode(wire, output, [pixel_format.output_rect(r) for r in wire_rects])
+    for r, w in zip(rects, wire_rects):
+        assert np.array_equal(wire[w['top']:w['bottom'], w['left']:w['right']],
+                              expected[w['top']:w['bottom'], w['left']:w['right']])
+        assert np.array_equal(output[r['top']:r['bottom'], r['left']:r['right']],
+                              decoded[r['top']:r['bottom'], r['left']:r['right']])
+
+
+PROPERTIES = {
+    'init': prop_init,
+    'frame': prop_frame,
+    'dirty/refresh': prop_rects,
+    'lossy': prop_lossy,
+    'stream/streams': prop_stream,
+    'capabilities': prop_capabilities,
+    'skip/heartbeat/ack/resume': prop_small,
+    'checksum': prop_checksum,
+    'resync': prop_resync,
+    'xor': prop_xor,
+    'regions': prop_regions,
+    'pixelformat': prop_pixelformat,
+}
+
+
+def check(examples: int = 200, seed: int = 0) -> int:
+    """运行全部往返性质
+
+    Returns:
+        失败的性质数
+    """
+    try:
+        from hypothesis import given, settings, strategies as st, HealthCheck
+    except ImportError:
+        given = None
+
+    failures = 0
+    for name, prop in PROPERTIES.items():
+        try:
+            if given is not None:
+                run = settings(max_examples=examples, deadline=None, derandomize=True,
+                               suppress_health_check=list(HealthCheck))(
+                    given(st.data())(lambda data, prop=prop: prop(HypothesisDraw(data))))
+                run()
+            else:
+                rng = np.random.default_rng(seed)
+                for i in range(examples):
+                    state = rng.bit_generator.state
+                    try:
+                        prop(RandomDraw(rng))
+                    except Exception:
+                        rng.bit_generator.state = state  # 便于复现：以相同状态重放
+                        print(f"[检查] {name} 第 {i} 个样例失败")
+                        raise
+            print(f"[检查] {name}: 通过 ({examples} 个样例)")
+        except Exception as e:
+            failures += 1
+            print(f"[检查] {name}: 失败 {type(e).__name__}: {e}")
+    engine = 'hypothesis' if given is not None else '内置随机生成器'
+    print(f"[检查] {len(PROPERTIES) - failures}/{len(PROPERTIES)} 项通过（{engine}）")
+    return failures
+
+
+class _PacketSink:
+    """只收集数据包、不发送的socket（服务器端测量不包含网络）"""
+
+    def __init__(self):
+        self.packets = []
+
+    def sendall(self, data) -> None:
+        if len(data) > 4:  # 跳过长度前缀
+            self.packets.append(data)
+
+
+def _frame_peak(function: Callable[[], object]) -> int:
+    """调用function期间新分配内存的峰值（字节，相对调用前）"""
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    function()
+    return tracemalloc.get_traced_memory()[1] - base
+
+
+def alloc(workloads=ALLOC_WORKLOADS, frames: int = 60, width: int = CANVAS_WIDTH,
+          height: int = CANVAS_HEIGHT) -> List[Dict]:
+    """测量每个场景热路径的每帧分配峰值
+
+    每帧上限为固定值 ALLOC_SLACK + POOLED_CHUNK，另加本帧暂存区（含会话历史环）的增长：
+        服务器 XOR编码到暂存区，逐块压缩写入打包暂存区，历史包复制到会话的环中
+        客户端 包体接收到池中的缓冲区，逐块解压到解码暂存区
+    """
+    from capture import create_source
+    from client import RemoteDesktopClient
+    from server import ClientSession, RemoteDesktopServer, merge_rects
+
+    results = []
+    for name in workloads:
+        source = create_source(name, width, height, fps=None)
+        server = RemoteDesktopServer(capture_source=source, metrics_port=0)
+        server.screen = source.frame.copy()
+        initial = server.screen.copy()
+        sink = _PacketSink()
+        session = ClientSession(sink, ('alloc', 0), width, height)
+        session.previous_frame[:] = server.screen
+        session.tiles.reset(session.previous_frame)
+
+        # 服务器：逐帧测量（跳过无变化的帧）
+        server_peaks = []
+        tracemalloc.start()
+        gc_before = gc.get_stats()[0]['collections']
+        seq = 0
+        while len(server_peaks) < frames + ALLOC_WARMUP:
+            def encode():
+                nonlocal seq
+                source.acquire(0)
+                try:
+                    rects = server._read_dirty_rects()
+                finally:
+                    source.release()
+                if rects:
+                    with session.cond:
+                        seq = session.next_seq()
+                    server.send_dirty(session, merge_rects(rects), seq, seq)
+                    session.on_ack(seq, 0)
+                return rects
+
+            grown = _pooled(session, source)
+            count = len(sink.packets)
+            peak = _frame_peak(encode)
+            if len(sink.packets) > count:
+                # 包在会话的打包暂存区中（下一帧会覆盖），在测量之外复制
+                sink.packets[count:] = [bytes(packet) for packet in sink.packets[count:]]
+                server_peaks.append((peak, POOLED_CHUNK + _pooled(session, source) - grown))
+        server_gc = gc.get_stats()[0]['collections'] - gc_before
+        tracemalloc.stop()
+
+        # 客户端：由另一线程经socketpair发送记录的包，本线程接收并解码
+        client = RemoteDesktopClient(viewer=f'alloc-{name}', headless=True)
+        client.resize(width, height)
+        client.frame_buffer[:] = initial
+        client.tiles.reset(client.frame_buffer)
+        sender, receiver = socket.socketpair()
+        client.socket = receiver
+        writer = threading.Thread(
+            target=lambda: [Protocol.send_packet(sender, packet) for packet in sink.packets], daemon=True)
+        writer.start()
+
+        receive_buffer = client.packet_buffers.get()  # 与读取线程相同：包体接收到池中的缓冲区
+        client_peaks = []
+        tracemalloc.start()
+        gc_before = gc.get_stats()[0]['collections']
+        for packet_index in range(len(sink.packets)):
+            def decode():
+                packet, receive_time = Protocol.recv_packet_timed(receiver, receive_buffer)
+                client.handle_packet(packet, receive_time)
+                return packet
+
+            grown = receive_buffer.capacity + client.decode_buffer.capacity
+            peak = _frame_peak(decode)
+            grown = receive_buffer.capacity + client.decode_buffer.capacity - grown
+            client_peaks.append((peak, POOLED_CHUNK + grown))
+        client_gc = gc.get_stats()[0]['collections'] - gc_before
+        tracemalloc.stop()
+        writer.join()
+        sender.close()
+        receiver.close()
+
+        measured = {'server': (server_peaks[ALLOC_WARMUP:], server_gc),
+                    'client': (client_peaks[ALLOC_WARMUP:], client_gc)}
+        for side, (peaks, collections) in measured.items():
+            over = [(peak, allowance) for peak, allowance in peaks if peak > allowance + ALLOC_SLACK]
+            results.append({
+                'workload': name,
+                'side': side,
+                'frames': len(peaks),
+                'mean_kb': round(sum(p for p, _ in peaks) / max(1, len(peaks)) / 1024, 1),
+                'max_kb': round(max((p for p, _ in peaks), default=0) / 1024, 1),
+                'allowance_kb': round(max((a for _, a in peaks), default=0) / 1024 + ALLOC_SLACK / 1024, 1),
+                'gc_per_frame': round(collections / max(1, len(peaks) + ALLOC_WARMUP), 2),
+                'over': len(over),
+            })
+    return results
+
+
+def _pooled(session, source) -> int:
+    """服务器热路径各暂存区已分配的字节数"""
+    history = session.history.capacity if session.history._buffer is not None else 0
+    return session.scratch.capacity + session.packet_scratch.capacity + source._scratch.capacity + history
+
+
+class _WindowProbe(dict):
+    """会话的在途表（seq -> 发送时间），记录出现过的最大长度"""
+
+    peak = 0
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self.peak = max(self.peak, len(self))
+
+
+def window(workloads=WINDOW_WORKLOADS, max_in_flight: int = 2, throttle: float = WINDOW_THROTTLE,
+           duration: float = WINDOW_DURATION, width: int = WINDOW_WIDTH, height: int = WINDOW_HEIGHT) -> List[Dict]:
+    """在限速链路上运行完整的服务器会话与客户端，检查在途窗口的暂缓与合并
+
+    每个场景: 捕获线程按30fps投递变化，服务器发送线程照常运行；客户端读取每个包前按throttle消耗令牌。
+    运行duration秒后暂停捕获，等待积压的变化发完、全部确认后比较客户端帧缓冲与服务器屏幕。
+    """
+    from capture import create_source
+    from client import RemoteDesktopClient
+    from server import CAPTURES, RemoteDesktopServer
+
+    results = []
+    for name in workloads:
+        server = RemoteDesktopServer(capture_source=create_source(name, width, height, fps=30), metrics_port=0,
+                                     max_in_flight=max_in_flight)
+        server.start_capture(stats=False)
+        local, remote = socket.socketpair()
+        client = RemoteDesktopClient(viewer=f'window-{name}', headless=True, throttle=throttle,
+                                     connector=lambda: remote)
+        connect = threading.Thread(target=client.connect, daemon=True)
+        connect.start()
+        session, resume = server.open_session(local, ('window', len(results)))
+        # 同一进程中多次运行时会话指标的标签相同，按差值统计
+        kinds = ('dirty', 'lossy', 'refresh')
+        updates, held = sum(session.metrics.updates(kind) for kind in kinds), session.metrics.held.value
+        probe = _WindowProbe()
+        with session.cond:
+            probe.update(session.in_flight)
+            session.in_flight = probe
+        threading.Thread(target=server.handle_client, args=(session, resume), daemon=True,
+                         name=f"sender window-{name}").start()
+        connect.join()
+        threading.Thread(target=client.receive_loop, daemon=True, name=f"receiver window-{name}").start()
+
+        captured = CAPTURES.labels(result='dirty').value
+        time.sleep(duration)
+        with server.capture_lock:  # 暂停捕获，等待积压的变化发完
+            captured = CAPTURES.labels(result='dirty').value - captured
+            deadline = time.time() + WINDOW_DRAIN
+            while time.time() < deadline:
+                with session.cond:
+                    drained = not (session.pending_rects or session.refresh_tiles or session.in_flight)
+                if drained and client.last_seq == session.seq:
+                    break
+                time.sleep(0.05)
+            with server.screen_lock:
+                match = bool(np.array_equal(client.frame_buffer, server.screen))
+            server.running = False
+        client.stop()
+        session.close()
+
+        updates = sum(session.metrics.updates(kind) for kind in kinds) - updates
+        held = session.metrics.held.value - held
+        results.append({
+            'workload': name,
+            'window': max_in_flight,
+            'peak_in_flight': probe.peak,
+            'captured': int(captured),
+            'updates': int(updates),
+            'held': int(held),
+            'match': match,
+            'ok': probe.peak <= max_in_flight and held > 0 and updates < captured and match,
+        })
+    return results
+
+
+def print_window(results: List[Dict]) -> None:
+    print(f"{'场景':>10} {'窗口':>4} {'最大在途':>8} {'有变化的帧':>10} {'更新包':>6} {'暂缓':>6} {'一致':>4}")
+    for r in results:
+        print(f"{r['workload']:>10} {r['window']:>4} {r['peak_in_flight']:>8} {r['captured']:>10} "
+              f"{r['updates']:>6} {r['held']:>6} {'是' if r['match'] else '否':>4}")
+
+
+def print_alloc(results: List[Dict]) -> None:
+    print(f"{'场景':>10} {'端':>7} {'帧':>5} {'平均KB':>10} {'最大KB':>10} {'上限KB':>10} {'GC/帧':>6} {'超限':>5}")
+    for r in results:
+        print(f"{r['workload']:>10} {r['side']:>7} {r['frames']:>5} {r['mean_kb']:>10.1f} {r['max_kb']:>10.1f} "
+              f"{r['allowance_kb']:>10.1f} {r['gc_per_frame']:>6.2f} {r['over']:>5}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="远程桌面协议微基准与往返检查")
+    sub = parser.add_subparsers(dest='command', required=True)
+    b = sub.add_parser('bench', help="扫描矩形数/负载/压缩设置")
+    b.add_argument('--rects', type=int, nargs='+', default=list(RECT_COUNTS), help="矩形数")
+    b.add_argument('--payload', type=int, nargs='+', default=list(PAYLOAD_SIZES), help="负载字节数")
+    b.add_argument('--level', type=int, nargs='+', default=list(LEVELS), help="zlib等级，0为不压缩")
+    b.add_argument('--content', choices=list(CONTENTS), default='sparse', help="XOR负载内容")
+    b.add_argument('--output', metavar='FILE', help="导出结果（.json 或 .csv）")
+    c = sub.add_parser('check', help="往返性质检查")
+    c.add_argument('--examples', type=int, default=200, help="每项性质的样例数")
+    c.add_argument('--seed', type=int, default=0, help="内置生成器的随机种子")
+    a = sub.add_parser('alloc', help="热路径每帧分配检查（tracemalloc）")
+    a.add_argument('workloads', nargs='*', default=list(ALLOC_WORKLOADS), help="合成场景")
+    a.add_argument('--frames', type=int, default=60, help="每个场景测量的帧数")
+    a.add_argument('--width', type=int, default=CANVAS_WIDTH)
+    a.add_argument('--height', type=int, default=CANVAS_HEIGHT)
+    w = sub.add_parser('window', help="限速链路上的在途窗口检查（暂缓、合并、最终一致）")
+    w.add_argument('workloads', nargs='*', default=list(WINDOW_WORKLOADS), help="合成场景")
+    w.add_argument('--window', type=int, default=2, help="在途窗口（包）")
+    w.add_argument('--throttle', type=float, default=WINDOW_THROTTLE / 1024, help="客户端读取限速（KB/s）")
+    w.add_argument('--duration', type=float, default=WINDOW_DURATION, help="每个场景的运行时间（秒）")
+    w.add_argument('--width', type=int, default=WINDOW_WIDTH)
+    w.add_argument('--height', type=int, default=WINDOW_HEIGHT)
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        sys.exit(1 if check(args.examples, args.seed) else 0)
+    if args.command == 'alloc':
+        results = alloc(args.workloads, args.frames, args.width, args.height)
+        print_alloc(results)
+        over = sum(r['over'] for r in results)
+        print(f"[检查] 每帧分配{'全部在上限内' if not over else f'有 {over} 帧超过上限'}")
+        sys.exit(1 if over else 0)
+    if args.command == 'window':
+        results = window(args.workloads, args.window, args.throttle * 1024, args.duration, args.width, args.height)
+        print_window(results)
+        failed = [r['workload'] for r in results if not r['ok']]
+        print(f"[检查] 窗口: {len(results) - len(failed)}/{len(results)} 项通过"
+              + (f"（失败: {', '.join(failed)}）" if failed else ""))
+        sys.exit(1 if failed else 0)
+
+    results = bench(args.rects, args.payload, args.level, args.content)
+    print_table(results)
+    if args.output:
+        export(results, args.output)
+        print(f"[基准] 已导出 {len(results)} 行到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+远程桌面 - 速率控制
+基于确认时序的带宽估计、令牌桶发送节奏控制，以及按带宽调整压缩等级与像素格式
+"""
+
+import time
+from collections import deque
+from typing import Dict, Optional, Sequence, Tuple
+
+# 节奏控制速率 = 估计带宽 × 增益（>1 以便带宽上升时能探测到）
+PACING_GAIN = 1.25
+
+# zlib压缩等级档位（从快到省带宽）
+COMPRESS_LEVELS = (1, 3, 6, 9)
+
+
+class BandwidthEstimator:
+    """基于确认时序的带宽估计
+
+    每个确认产生一个交付速率样本:
+        (当前累计交付字节 - 发送时累计交付字节) / (当前时间 - 发送时最近交付时间)
+    对最近window秒内的样本取最大值，避免发送方空闲（应用受限）时低估带宽。
+    """
+
+    def __init__(self, window: float = 2.0):
+        self.window = window
+        self.delivered = 0                  # 累计已确认字节
+        self.delivered_time = time.time()   # 最近一次确认的时间
+        self.packets: Dict[int, Tuple[int, float, int, float]] = {}  # seq -> (size, send_time, delivered, delivered_time)
+        self.samples = deque()              # (time, rate)
+        self.sends = deque()                # (time, size)
+        self.rate = 0.0                     # 估计带宽（字节/秒），0表示尚无估计
+        self.last_rtt = 0.0                 # 最近一次发送→确认耗时（秒）
+
+    def on_send(self, seq: int, size: int, now: Optional[float] = None) -> None:
+        """记录已发送的包"""
+        now = now or time.time()
+        if not self.packets:
+            # 空闲后重新开始计时，避免把空闲时间算进交付间隔
+            self.delivered_time = now
+        self.packets[seq] = (size, now, self.delivered, self.delivered_time)
+        self.sends.append((now, size))
+        while self.sends and now - self.sends[0][0] > self.window:
+            self.sends.popleft()
+
+    def on_ack(self, seq: int, now: Optional[float] = None) -> None:
+        """处理累计确认，生成交付速率样本"""
+        now = now or time.time()
+        acked = sorted(s for s in self.packets if s <= seq)
+        if not acked:
+            return
+
+        for s in acked:
+            self.delivered += self.packets[s][0]
+
+        # 以本次确认的最新包计算样本
+        _, send_time, delivered_at_send, delivered_time_at_send = self.packets[acked[-1]]
+        for s in acked:
+            del self.packets[s]
+        self.delivered_time = now
+        self.last_rtt = now - send_time
+
+        interval = now - delivered_time_at_send
+        if interval > 0:
+            self.samples.append((now, (self.delivered - delivered_at_send) / interval))
+
+        while self.samples and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        if self.samples:
+            self.rate = max(rate for _, rate in self.samples)
+
+    @property
+    def send_rate(self) -> float:
+        """最近window秒的实际发送速率（字节/秒）"""
+        if not self.sends:
+            return 0.0
+        return sum(size for _, size in self.sends) / self.window
+
+
+class TokenBucket:
+    """令牌桶发送节奏控制
+
+    rate为None时不限速。桶容量为burst_time秒的令牌（至少min_burst字节）。
+    允许令牌透支：一个大包可以立即发出，之后的发送会等待令牌补回，平均速率不超过rate。
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst_time: float = 0.05,
+                 min_burst: int = 16 * 1024):
+        self.burst_time = burst_time
+        self.min_burst = min_burst
+        self.rate = rate
+        self.tokens = self.burst
+        self.last = time.time()
+
+    @property
+    def burst(self) -> float:
+        """桶容量（字节）"""
+        return max(float(self.min_burst), (self.rate or 0) * self.burst_time)
+
+    def set_rate(self, rate: Optional[float]) -> None:
+        """调整速率（字节/秒）"""
+        self._refill()
+        self.rate = rate
+
+    def _refill(self) -> None:
+        now = time.time()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, size: int) -> float:
+        """取出size字节的令牌，必要时阻塞等待
+
+        Returns:
+            等待的秒数
+        """
+        if self.rate is None or self.rate <= 0:
+            return 0.0
+
+        self._refill()
+        waited = 0.0
+        if self.tokens < 0:
+            waited = -self.tokens / self.rate
+            time.sleep(waited)
+            self._refill()
+        self.tokens -= size
+        return waited
+
+
+class CompressionController:
+    """根据发送速率与估计带宽的比值调整zlib压缩等级
+
+    发送速率接近带宽（链路受限）时提高压缩等级，以CPU换带宽；
+    带宽富余时降低等级，减少压缩耗时。
+    """
+
+    def __init__(self, interval: float = 1.0, high: float = 0.8, low: float = 0.4):
+        self.interval = interval
+        self.high = high
+        self.low = low
+        self.index = 0
+        self.last_update = time.time()
+
+    @property
+    def level(self) -> int:
+        return COMPRESS_LEVELS[self.index]
+
+    def update(self, send_rate: float, bandwidth: float) -> int:
+        """每interval秒最多调整一档
+
+        Returns:
+            当前压缩等级
+        """
+        now = time.time()
+        if bandwidth <= 0 or now - self.last_update < self.interval:
+            return self.level
+        self.last_update = now
+
+        usage = send_rate / bandwidth
+        if usage > self.high and self.index < len(COMPRESS_LEVELS) - 1:
+            self.index += 1
+        elif usage < self.low and self.index > 0:
+            self.index -= 1
+        return self.level
+
+
+class FormatController:
+    """链路受限时逐级降低传输像素格式的精度，带宽富余时恢复
+
+    压缩等级已到最高、发送速率仍高于带宽×high，并持续hold秒时降一级；
+    按每像素字节数之比估算恢复上一级后的占用，低于low并持续hold秒时升一级。
+    切换格式需要重发完整帧，hold较长以免来回切换。
+    """
+
+    def __init__(self, ladder: Sequence[Tuple[int, float]], hold: float = 5.0,
+                 high: float = 0.9, low: float = 0.5):
+        self.ladder = list(ladder)  # [(像素格式, 每像素字节数), ...]，精度从高到低
+        self.hold = hold
+        self.high = high
+        self.low = low
+        self.index = 0
+        self.direction = 0      # 正在观察的调整方向（1降级，-1升级，0无）
+        self.since = 0.0        # 该方向条件开始成立的时间
+
+    @property
+    def pixel_format(self) -> int:
+        return self.ladder[self.index][0]
+
+    def update(self, send_rate: float, bandwidth: float, saturated: bool) -> int:
+        """saturated表示压缩等级已无法再提高
+
+        Returns:
+            当前像素格式
+        """
+        if bandwidth <= 0:
+            return self.pixel_format
+        usage = send_rate / bandwidth
+        direction = 0
+        if saturated and usage > self.high and self.index < len(self.ladder) - 1:
+            direction = 1
+        elif self.index > 0 and usage * self.ladder[self.index - 1][1] / self.ladder[self.index][1] < self.low:
+            direction = -1
+
+        now = time.time()
+        if direction != self.direction:
+            self.direction = direction
+            self.since = now
+        elif direction and now - self.since >= self.hold:
+            self.index += direction
+            self.direction = 0
+        return self.pixel_format
@@ -0,0 +1,337 @@
+"""
+远程桌面 - 捕获录制与回放
+把捕获源的输出（时间戳、脏矩形、脏区域像素，以及定期关键帧）追加写入分块压缩文件，
+文件末尾附带定位索引；回放时内存映射文件，可从任意时刻最近的关键帧开始，按原速或加速重放，
+重放的脏矩形与像素与录制时逐字节一致，便于在相同输入上比较编码器改动。
+
+文件格式（整数均为网络字节序）:
+    文件头  [magic:8 "RDREC\\0\\0\\1"][width:4][height:4]
+    块      [magic:4 "CHNK"][kind:1][first_ts:8][last_ts:8][count:4][raw_size:4][data_size:4][zlib数据]
+            kind为 K（关键帧：[ts:8][完整BGRA帧]）或 D（若干条记录）
+            记录: [ts:8][rect_count:2][rects: left,top,right,bottom 各4字节][data_size:4][data]
+    索引    每块一项 [offset:8][kind:1][first_ts:8][last_ts:8][count:4]
+    文件尾  [index_count:4][index_offset:8][magic:8 "RDINDEX\\0"]
+文件尾缺失（录制中断）时按顺序扫描各块重建索引。
+"""
+
+import mmap
+import struct
+import zlib
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from capture import CaptureSource, FS_OK, ReplaySource
+from protocol import now_us
+import regions
+
+FILE_MAGIC = b'RDREC\x00\x00\x01'
+INDEX_MAGIC = b'RDINDEX\x00'
+CHUNK_MAGIC = b'CHNK'
+
+FILE_HEADER = struct.Struct('!8sII')
+CHUNK_HEADER = struct.Struct('!4scQQIII')
+INDEX_ENTRY = struct.Struct('!QcQQI')
+FILE_FOOTER = struct.Struct('!IQ8s')
+RECORD_HEADER = struct.Struct('!QH')
+RECT = struct.Struct('!IIII')
+
+KIND_KEYFRAME = b'K'
+KIND_DELTA = b'D'
+
+# 默认关键帧间隔（秒）与块大小上限
+KEYFRAME_INTERVAL = 10.0
+CHUNK_DURATION = 1.0
+CHUNK_BYTES = 4 * 1024 * 1024
+
+
+class ChunkInfo(NamedTuple):
+    offset: int
+    kind: bytes
+    first_ts: int
+    last_ts: int
+    count: int
+
+
+class RecordingWriter:
+    """追加写入录制文件（每块独立压缩，写满或超时后落盘）"""
+
+    def __init__(self, path: str, width: int, height: int, level: int = 1,
+                 chunk_duration: float = CHUNK_DURATION, chunk_bytes: int = CHUNK_BYTES):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.level = level
+        self.chunk_duration = chunk_duration
+        self.chunk_bytes = chunk_bytes
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, width, height))
+        self.index: List[ChunkInfo] = []
+        self.pending: List[bytes] = []
+        self.pending_size = 0
+        self.pending_first = 0
+        self.pending_last = 0
+        self.record_count = 0
+
+    def write_keyframe(self, timestamp: int, frame: np.ndarray) -> None:
+        """写入关键帧（先落盘之前的记录，保证关键帧表示其之前所有记录应用后的画面）"""
+        self.flush()
+        self._write_chunk(KIND_KEYFRAME, timestamp, timestamp, 1,
+                          [struct.pack('!Q', timestamp), np.ascontiguousarray(frame).tobytes()])
+
+    def write(self, timestamp: int, rects: List[Dict], data) -> None:
+        """追加一条记录（rects为空表示有帧但无变化）"""
+        parts = [RECORD_HEADER.pack(timestamp, len(rects))]
+        parts.extend(RECT.pack(r['left'], r['top'], r['right'], r['bottom']) for r in rects)
+        payload = bytes(data) if rects and data is not None else b''
+        parts.append(struct.pack('!I', len(payload)))
+        parts.append(payload)
+
+        if not self.pending:
+            self.pending_first = timestamp
+        self.pending.extend(parts)
+        self.pending_size += sum(len(p) for p in parts)
+        self.pending_last = timestamp
+        self.record_count += 1
+
+        if (self.pending_size >= self.chunk_bytes
+                or (timestamp - self.pending_first) / 1e6 >= self.chunk_duration):
+            self.flush()
+
+    def flush(self) -> None:
+        """把累积的记录写成一个块"""
+        if not self.pending:
+            return
+        count = self.record_count
+        self._write_chunk(KIND_DELTA, self.pending_first, self.pending_last, count, self.pending)
+        self.pending = []
+        self.pending_size = 0
+        self.record_count = 0
+
+    def _write_chunk(self, kind: bytes, first_ts: int, last_ts: int, count: int, parts: List[bytes]) -> None:
+        raw = b''.join(parts)
+        data = zlib.compress(raw, self.level)
+        offset = self.file.tell()
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, kind, first_ts, last_ts, count, len(raw), len(data)))
+        self.file.write(data)
+        self.file.flush()
+        self.index.append(ChunkInfo(offset, kind, first_ts, last_ts, count))
+
+    def close(self) -> None:
+        """落盘剩余记录并写入索引"""
+        if self.file.closed:
+            return
+        self.flush()
+        index_offset = self.file.tell()
+        for entry in self.index:
+            self.file.write(INDEX_ENTRY.pack(*entry))
+        self.file.write(FILE_FOOTER.pack(len(self.index), index_offset, INDEX_MAGIC))
+        self.file.close()
+
+
+class RecordingSource(CaptureSource):
+    """把捕获源的输出同时写入录制文件（对调用方透明）
+
+    capture()得到的完整帧与每keyframe_interval秒一次的完整画面作为关键帧。
+    """
+
+    def __init__(self, source: CaptureSource, path: str, keyframe_interval: float = KEYFRAME_INTERVAL):
+        self.source = source
+        self.width = source.width
+        self.height = source.height
+        self.writer = RecordingWriter(path, source.width, source.height)
+        self.keyframe_interval = keyframe_interval
+        self.last_keyframe = 0
+        self._timestamp = 0
+        self._rects: Optional[List[Dict]] = None
+        self._data = None
+
+    @property
+    def size(self):
+        return self.source.size
+
+    def acquire(self, timeout_ms=100):
+        status = self.source.acquire(timeout_ms)
+        if status == FS_OK:
+            self._timestamp = now_us()
+            self._rects = None
+            self._data = None
+        return status
+
+    def dirty_rects(self):
+        self._rects = self.source.dirty_rects()
+        return self._rects
+
+    def copy_dirty_regions(self):
+        self._data = self.source.copy_dirty_regions()
+        return self._data
+
+    def copy_frame(self):
+        return self.source.copy_frame()
+
+    def release(self):
+        rects = self._rects if self._rects is not None else self.source.dirty_rects()
+        data = self._data
+        if rects and data is None:
+            data = self.source.copy_dirty_regions()
+        # 复制失败时（data为None）记为无变化，与服务器的处理一致
+        self.writer.write(self._timestamp, rects if data is not None else [], data)
+
+        if (self._timestamp - self.last_keyframe) / 1e6 >= self.keyframe_interval:
+            frame = self.source.copy_frame()
+            if frame is not None:
+                self.writer.write_keyframe(self._timestamp, frame)
+                self.last_keyframe = self._timestamp
+        self.source.release()
+
+    def capture(self, timeout_ms=100):
+        status, frame = self.source.capture(timeout_ms)
+        if status == FS_OK and frame is not None:
+            self.last_keyframe = now_us()
+            self.writer.write_keyframe(self.last_keyframe, frame)
+        return status, frame
+
+    def close(self):
+        self.writer.close()
+        self.source.close()
+
+
+class RecordingReader:
+    """内存映射读取录制文件"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width, self.height = FILE_HEADER.unpack_from(self.map, 0)
+        if magic != FILE_MAGIC:
+            raise ValueError(f"不是录制文件: {path}")
+        self.index = self._read_index()
+
+    def _read_index(self) -> List[ChunkInfo]:
+        size = len(self.map)
+        if size >= FILE_HEADER.size + FILE_FOOTER.size:
+            count, index_offset, magic = FILE_FOOTER.unpack_from(self.map, size - FILE_FOOTER.size)
+            if magic == INDEX_MAGIC:
+                return [ChunkInfo(*INDEX_ENTRY.unpack_from(self.map, index_offset + i * INDEX_ENTRY.size))
+                        for i in range(count)]
+
+        # 没有文件尾：顺序扫描，忽略末尾不完整的块
+        index = []
+        offset = FILE_HEADER.size
+        while offset + CHUNK_HEADER.size <= size:
+            magic, kind, first_ts, last_ts, count, _, data_size = CHUNK_HEADER.unpack_from(self.map, offset)
+            if magic != CHUNK_MAGIC or offset + CHUNK_HEADER.size + data_size > size:
+                break
+            index.append(ChunkInfo(offset, kind, first_ts, last_ts, count))
+            offset += CHUNK_HEADER.size + data_size
+        return index
+
+    def _chunk_data(self, chunk: ChunkInfo) -> bytes:
+        _, _, _, _, _, raw_size, data_size = CHUNK_HEADER.unpack_from(self.map, chunk.offset)
+        start = chunk.offset + CHUNK_HEADER.size
+        with memoryview(self.map) as view:
+            return zlib.decompress(view[start:start + data_size], bufsize=raw_size)
+
+    @property
+    def start_time(self) -> int:
+        return self.index[0].first_ts if self.index else 0
+
+    @property
+    def duration(self) -> float:
+        """录制时长（秒）"""
+        return (self.index[-1].last_ts - self.index[0].first_ts) / 1e6 if self.index else 0.0
+
+    @property
+    def record_count(self) -> int:
+        return sum(c.count for c in self.index if c.kind == KIND_DELTA)
+
+    def keyframe(self, chunk: ChunkInfo) -> Tuple[int, np.ndarray]:
+        data = self._chunk_data(chunk)
+        timestamp, = struct.unpack_from('!Q', data, 0)
+        frame = np.frombuffer(data, dtype=np.uint8, offset=8).reshape(self.height, self.width, 4)
+        return timestamp, frame
+
+    def seek(self, timestamp: Optional[int] = None) -> int:
+        """不晚于timestamp的最近关键帧所在块的序号（timestamp为None时取第一个关键帧）"""
+        keyframes = [i for i, c in enumerate(self.index) if c.kind == KIND_KEYFRAME]
+        if not keyframes:
+            raise ValueError("录制文件中没有关键帧")
+        if timestamp is None:
+            return keyframes[0]
+        earlier = [i for i in keyframes if self.index[i].first_ts <= timestamp]
+        return earlier[-1] if earlier else keyframes[0]
+
+    def chunk_records(self, chunk: ChunkInfo) -> Iterator[Tuple[int, List[Dict], memoryview]]:
+        """解析一个记录块，产生 (timestamp, rects, data)，data为解压缓冲区上的切片"""
+        view = memoryview(self._chunk_data(chunk))
+        offset = 0
+        for _ in range(chunk.count):
+            timestamp, rect_count = RECORD_HEADER.unpack_from(view, offset)
+            offset += RECORD_HEADER.size
+            rects = []
+            for _ in range(rect_count):
+                left, top, right, bottom = RECT.unpack_from(view, offset)
+                rects.append({'left': left, 'top': top, 'right': right, 'bottom': bottom})
+                offset += RECT.size
+            data_size, = struct.unpack_from('!I', view, offset)
+            offset += 4
+            yield timestamp, rects, view[offset:offset + data_size]
+            offset += data_size
+
+    def records(self, start_chunk: int = 0) -> Iterator[Tuple[int, List[Dict], memoryview]]:
+        """从第start_chunk块开始依次产生全部记录，跳过关键帧块"""
+        for chunk in self.index[start_chunk:]:
+            if chunk.kind == KIND_DELTA:
+                yield from self.chunk_records(chunk)
+
+    def source(self, speed: Optional[float] = 1.0, start: Optional[int] = None) -> ReplaySource:
+        """从start（原始时间戳，微秒）之前最近的关键帧开始回放；speed为None时尽快回放"""
+        chunk = self.seek(start)
+        _, frame = self.keyframe(self.index[chunk])
+        return ReplaySource(self.records(chunk + 1), self.width, self.height, initial=frame, speed=speed)
+
+    def verify(self) -> Tuple[int, int]:
+        """从第一个关键帧顺序重放，与之后每个关键帧逐字节比较
+
+        Returns:
+            (比较的关键帧数, 不一致的关键帧数)
+        """
+        frame = None
+        checked = mismatched = 0
+        for chunk in self.index:
+            if chunk.kind == KIND_KEYFRAME:
+                _, keyframe = self.keyframe(chunk)
+                if frame is not None:
+                    checked += 1
+                    if not np.array_equal(frame, keyframe):
+                        mismatched += 1
+                frame = keyframe.copy()
+            elif frame is not None:
+                for _, rects, data in self.chunk_records(chunk):
+                    if rects:
+                        regions.scatter(frame, rects, data)
+        return checked, mismatched
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="远程桌面录制文件工具")
+    parser.add_argument('command', choices=['info', 'verify'], help="info: 显示概要；verify: 重放并与关键帧逐字节比较")
+    parser.add_argument('path', help="录制文件")
+    args = parser.parse_args()
+
+    reader = RecordingReader(args.path)
+    keyframes = sum(1 for c in reader.index if c.kind == KIND_KEYFRAME)
+    print(f"[录制] {args.path}: {reader.width}x{reader.height} | 时长 {reader.duration:.1f}s | "
+          f"记录 {reader.record_count} | 关键帧 {keyframes} | 块 {len(reader.index)}")
+    if args.command == 'verify':
+        checked, mismatched = reader.verify()
+        print(f"[录制] 比较关键帧 {checked} 个，不一致 {mismatched} 个")
+    reader.close()
@@ -0,0 +1,273 @@
+"""
+远程桌面 - 矩形区域批量收集/分发
+服务器XOR编码、客户端/Web端XOR应用与原始像素覆盖都要按矩形列表顺序处理拼接的像素数据。
+RegionPlan为一组矩形预先计算像素索引（按矩形顺序、行优先），把帧视为一维像素数组（BGRA为uint32），
+一次take/put完成全部矩形，避免逐矩形的Python循环；相同矩形列表的计划会被缓存复用。
+安装了numba时XOR编码/应用改用编译的逐行内核（不需要索引数组）。
+
+重叠矩形的语义与逐矩形顺序处理相同：
+    编码时后面矩形中已编码过的像素异或结果为0（参考帧已更新）；
+    应用XOR时各次异或可交换，结果与顺序应用一致；覆盖时后面的矩形生效。
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# 缓存的计划数
+PLAN_CACHE_SIZE = 256
+# 矩形平均像素数不少于此值时逐矩形切片处理（每行是连续内存，比按下标收集快）
+SLICE_MIN_PIXELS = 1024
+
+# 每像素字节数 -> 像素单元类型
+_PIXEL_TYPES = {1: np.uint8, 2: np.uint16, 4: np.uint32}
+
+
+def _pixels(frame: np.ndarray) -> np.ndarray:
+    """帧（H×W×C，C连续）视为一维像素数组（不复制）"""
+    channels = frame.shape[2] if frame.ndim == 3 else 1
+    dtype = _PIXEL_TYPES.get(channels * frame.itemsize)
+    if dtype is None or not frame.flags.c_contiguous:
+        raise ValueError(f"不支持的帧布局: shape={frame.shape} dtype={frame.dtype}")
+    return frame.reshape(-1).view(dtype)
+
+
+def _as_pixels(data, dtype, count: int) -> np.ndarray:
+    """拼接数据的前count个像素（不复制）"""
+    array = data.reshape(-1).view(np.uint8) if isinstance(data, np.ndarray) else np.frombuffer(data, dtype=np.uint8)
+    return array[:count * np.dtype(dtype).itemsize].view(dtype)
+
+
+class RegionPlan:
+    """一组矩形的像素索引计划
+
+    小矩形多时（平均不足SLICE_MIN_PIXELS像素）按下标一次处理全部矩形：
+        index: 各矩形像素在帧中的一维下标，按矩形顺序拼接
+        first: 有重叠时，index中每个位置是否为该像素第一次出现（None表示无重叠）
+    否则逐矩形切片，slices为 (top, bottom, left, right, 数据偏移, 像素数)。sliced可强制指定处理方式。
+    """
+
+    def __init__(self, rects: Sequence[Dict], width: int, height: int, sliced: Optional[bool] = None):
+        self.rects = list(rects)
+        self.width = width
+        self.height = height
+        # 超出帧的部分被裁掉（与切片的行为一致）
+        bounds = np.array([(r['left'], r['top'], r['right'], r['bottom']) for r in self.rects],
+                          dtype=np.int64).reshape(-1, 4)
+        self.bounds = np.clip(bounds, 0, [width, height, width, height])
+        left, top, right, bottom = self.bounds.T
+        widths = np.maximum(right - left, 0)
+        sizes = widths * np.maximum(bottom - top, 0)
+        self.sizes = sizes  # 各矩形像素数
+        self.pixels = int(sizes.sum())
+        self.sliced = self.pixels >= len(self.rects) * SLICE_MIN_PIXELS if sliced is None else sliced
+        if self.sliced:
+            offsets = np.cumsum(sizes) - sizes
+            self.slices = [(int(t), int(b), int(l), int(r), int(o), int(n))
+                           for (l, t, r, b), o, n in zip(self.bounds, offsets, sizes) if n]
+            return
+
+        # 向量化展开所有矩形的像素下标
+        rect_id = np.repeat(np.arange(len(self.rects)), sizes)
+        local = np.arange(self.pixels) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        row_width = np.maximum(widths[rect_id], 1)
+        self.index = ((top[rect_id] + local // row_width) * width + left[rect_id] + local % row_width).astype(np.intp)
+
+        self.first = None
+        if self.pixels and len(self.rects) > 1:
+            _, first_positions = np.unique(self.index, return_index=True)
+            if len(first_positions) != self.pixels:
+                self.first = np.zeros(self.pixels, dtype=bool)
+                self.first[first_positions] = True
+
+    def nbytes(self, channels: int = 4) -> int:
+        """拼接数据的字节数"""
+        return self.pixels * channels
+
+    def prefix(self, nbytes: int, channels: int = 4) -> 'RegionPlan':
+        """数据只有nbytes字节时能完整覆盖的前若干个矩形的计划"""
+        if nbytes >= self.nbytes(channels):
+            return self
+        count = int(np.searchsorted(np.cumsum(self.sizes) * channels, nbytes, side='right'))
+        return plan(self.rects[:count], self.width, self.height)
+
+    def gather(self, frame: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """按矩形顺序拼接区域像素（写入out，返回一维uint8视图）
+
+        out可以比所需的大（如ScratchBuffer的暂存区），返回其前nbytes()字节的视图
+        """
+        pixels = _pixels(frame)
+        if out is None:
+            out = np.empty(self.pixels * pixels.itemsize, dtype=np.uint8)
+        result = _as_pixels(out, pixels.dtype, self.pixels)
+        if self.sliced:
+            pixels = pixels.reshape(self.height, self.width)
+            for top, bottom, left, right, offset, size in self.slices:
+                result[offset:offset + size].reshape(bottom - top, right - left)[:] = pixels[top:bottom, left:right]
+        else:
+            np.take(pixels, self.index, out=result)
+        return result.view(np.uint8)
+
+    def scatter(self, frame: np.ndarray, data) -> None:
+        """拼接的区域像素写回帧（覆盖）"""
+        pixels = _pixels(frame)
+        values = _as_pixels(data, pixels.dtype, self.pixels)
+        if self.sliced:
+            pixels = pixels.reshape(self.height, self.width)
+            for top, bottom, left, right, offset, size in self.slices:
+                pixels[top:bottom, left:right] = values[offset:offset + size].reshape(bottom - top, right - left)
+        else:
+            pixels[self.index] = values
+
+    def xor_encode(self, current: np.ndarray, reference: np.ndarray,
+                   out: Optional[np.ndarray] = None) -> np.ndarray:
+        """计算 current XOR reference 写入out（可以比所需的大），并把reference对应区域更新为current
+
+        Returns:
+            out前nbytes()字节的一维uint8视图
+        """
+        cur, ref = _pixels(current), _pixels(reference)
+        if out is None:
+            out = np.empty(self.pixels * cur.itemsize, dtype=np.uint8)
+        result = _as_pixels(out, cur.dtype, self.pixels)
+        if _numba_kernels is not None and cur.dtype == np.uint32:
+            _numba_kernels[0](cur, ref, self.width, self.bounds, result)
+            return result.view(np.uint8)
+
+        if self.sliced:
+            cur, ref = cur.reshape(self.height, self.width), ref.reshape(self.height, self.width)
+            for top, bottom, left, right, offset, size in self.slices:
+                region = cur[top:bottom, left:right]
+                np.bitwise_xor(region, ref[top:bottom, left:right],
+                               out=result[offset:offset + size].reshape(bottom - top, right - left))
+                ref[top:bottom, left:right] = region
+            return result.view(np.uint8)
+
+        previous = np.take(ref, self.index)
+        np.take(cur, self.index, out=result)
+        ref[self.index] = result
+        np.bitwise_xor(result, previous, out=result)
+        if self.first is not None:
+            result[~self.first] = 0
+        return result.view(np.uint8)
+
+    def xor_apply(self, frame: np.ndarray, data) -> None:
+        """应用XOR数据（frame对应区域 ^= data），再次应用即撤销"""
+        pixels = _pixels(frame)
+        values = _as_pixels(data, pixels.dtype, self.pixels)
+        if _numba_kernels is not None and pixels.dtype == np.uint32:
+            _numba_kernels[1](pixels, self.width, self.bounds, values)
+        elif self.sliced:
+            pixels = pixels.reshape(self.height, self.width)
+            for top, bottom, left, right, offset, size in self.slices:
+                pixels[top:bottom, left:right] ^= values[offset:offset + size].reshape(bottom - top, right - left)
+        elif self.first is None:
+            pixels[self.index] ^= values
+        else:
+            np.bitwise_xor.at(pixels, self.index, values)
+
+
+_plans: 'OrderedDict[tuple, RegionPlan]' = OrderedDict()
+# 捕获线程、各会话的发送线程与客户端/Web端的解码线程共用缓存
+_plans_lock = threading.Lock()
+
+
+def plan(rects: Sequence[Dict], width: int, height: int) -> RegionPlan:
+    """取得矩形列表的计划（LRU缓存，线程安全；计划在锁外创建）"""
+    key = (width, height, tuple((r['left'], r['top'], r['right'], r['bottom']) for r in rects))
+    with _plans_lock:
+        cached = _plans.get(key)
+        if cached is not None:
+            _plans.move_to_end(key)
+            return cached
+    cached = RegionPlan(rects, width, height)
+    with _plans_lock:
+        _plans[key] = cached
+        if len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return cached
+
+
+def _frame_plan(frame: np.ndarray, rects: Sequence[Dict]) -> RegionPlan:
+    return plan(rects, frame.shape[1], frame.shape[0])
+
+
+def gather(frame: np.ndarray, rects: Sequence[Dict], out: Optional[np.ndarray] = None) -> np.ndarray:
+    """按矩形顺序拼接区域像素"""
+    return _frame_plan(frame, rects).gather(frame, out)
+
+
+def scatter(frame: np.ndarray, rects: Sequence[Dict], data) -> List[Dict]:
+    """把拼接的区域像素写回帧（数据不足时只写入能完整覆盖的矩形）
+
+    Returns:
+        实际写入的矩形
+    """
+    region_plan = _frame_plan(frame, rects).prefix(_nbytes(data), _channels(frame))
+    region_plan.scatter(frame, data)
+    return region_plan.rects
+
+
+def xor_encode(current: np.ndarray, reference: np.ndarray, rects: Sequence[Dict],
+               out: Optional[np.ndarray] = None) -> np.ndarray:
+    """current XOR reference（按矩形顺序拼接），并把reference对应区域更新为current"""
+    return _frame_plan(current, rects).xor_encode(current, reference, out)
+
+
+def xor_apply(frame: np.ndarray, rects: Sequence[Dict], data) -> List[Dict]:
+    """应用XOR数据（数据不足时只应用能完整覆盖的矩形），再次应用即撤销
+
+    Returns:
+        实际应用的矩形
+    """
+    region_plan = _frame_plan(frame, rects).prefix(_nbytes(data), _channels(frame))
+    region_plan.xor_apply(frame, data)
+    return region_plan.rects
+
+
+def _nbytes(data) -> int:
+    return data.nbytes if isinstance(data, (np.ndarray, memoryview)) else len(data)
+
+
+def _channels(frame: np.ndarray) -> int:
+    return (frame.shape[2] if frame.ndim == 3 else 1) * frame.itemsize
+
+
+def _build_numba_kernels():
+    """逐矩形逐行的XOR内核（顺序处理，重叠语义与逐矩形循环相同）"""
+
+    @numba.njit(cache=True, nogil=True)
+    def encode(cur, ref, width, bounds, out):
+        offset = 0
+        for i in range(bounds.shape[0]):
+            left, top, right, bottom = bounds[i, 0], bounds[i, 1], bounds[i, 2], bounds[i, 3]
+            for y in range(top, bottom):
+                base = y * width
+                for x in range(left, right):
+                    value = cur[base + x]
+                    out[offset] = value ^ ref[base + x]
+                    ref[base + x] = value
+                    offset += 1
+
+    @numba.njit(cache=True, nogil=True)
+    def apply(pixels, width, bounds, data):
+        offset = 0
+        for i in range(bounds.shape[0]):
+            left, top, right, bottom = bounds[i, 0], bounds[i, 1], bounds[i, 2], bounds[i, 3]
+            for y in range(top, bottom):
+                base = y * width
+                for x in range(left, right):
+                    pixels[base + x] ^= data[offset]
+                    offset += 1
+
+    return encode, apply
+
+
+_numba_kernels = _build_numba_kernels() if numba is not None else None
@@ -0,0 +1,148 @@
+"""
+远程桌面 - 服务器端缩放与视口
+在小屏幕上观看4K主机时，客户端最终只显示约1280像素宽的画面，按原始分辨率传输的像素大部分被缩放丢弃。
+客户端可以请求输出分辨率和视口（View）：服务器为每种视图维护一份缩放后的屏幕（ScaledView），
+会话以它为参考帧做XOR编码，只有与视口相交的脏矩形才会被缩放、编码和发送。
+
+缩放为面积平均（cv2.INTER_AREA）。输出尺寸取与视口尺寸成小整数比的值（每 p 个源像素对应 q 个输出像素，
+q 不超过 MAX_PERIOD），脏矩形映射到输出后按 q 对齐，对应的源区域恰好按 p 对齐，
+逐矩形缩放的结果与整帧缩放逐像素一致，不会在矩形边界出现接缝。
+
+视图的像素格式不是BGRA时，缩放后的画面（image）再按脏矩形转换为传输帧（frame，见pixelformat.py），
+会话以传输帧为参考帧；此时即使不缩放也需要一份视图。
+"""
+
+import math
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from pixelformat import PIXEL_FORMATS, get_format
+from protocol import PF_BGRA, View
+
+# 输出与视口比例的最大周期（输出像素数）；越大输出尺寸越接近请求值，但脏矩形对齐后扩大得越多
+MAX_PERIOD = 16
+
+
+def _fit_length(requested: int, source: int, multiple: int = 1) -> int:
+    """不超过requested（也不超过source）、为multiple的倍数、且与source之比的周期不超过MAX_PERIOD的最大长度"""
+    length = max(multiple, min(requested, source) // multiple * multiple)
+    while length > multiple and length // math.gcd(source, length) > MAX_PERIOD:
+        length -= multiple
+    return length
+
+
+def resolve_view(request: Optional[View], screen_width: int, screen_height: int) -> View:
+    """把客户端请求的视图解析为实际视图
+
+    视口裁剪到屏幕内（为空时取整个屏幕）；输出保持视口比例缩小到请求的宽高以内（不放大），
+    再按MAX_PERIOD与像素格式的块大小取整。未知的像素格式按BGRA处理（PF_AUTO须由调用方先替换）。
+    """
+    request = request or View()
+    pixel_format = request.pixel_format if request.pixel_format in PIXEL_FORMATS else PF_BGRA
+    block = PIXEL_FORMATS[pixel_format].block
+    left = min(max(request.left, 0), screen_width)
+    top = min(max(request.top, 0), screen_height)
+    right = min(request.right, screen_width)
+    bottom = min(request.bottom, screen_height)
+    if right <= left or bottom <= top:
+        left, top, right, bottom = 0, 0, screen_width, screen_height
+    view_width, view_height = right - left, bottom - top
+
+    scale = 1.0
+    if request.width:
+        scale = min(scale, request.width / view_width)
+    if request.height:
+        scale = min(scale, request.height / view_height)
+    width = _fit_length(round(view_width * scale), view_width, block)
+    height = _fit_length(round(view_height * scale), view_height, block)
+    return View(width, height, left, top, right, bottom, pixel_format)
+
+
+def is_native(view: View, screen_width: int, screen_height: int) -> bool:
+    """视图是否就是整个屏幕的原始分辨率BGRA（不需要缩放和转换）"""
+    return view == View(screen_width, screen_height, 0, 0, screen_width, screen_height)
+
+
+class _Axis:
+    """一个方向上源坐标（视口内）与输出坐标的对应：每period_in个源像素对应period_out个输出像素
+
+    输出区间按unit（period_out与像素格式块大小的最小公倍数）对齐。
+    """
+
+    def __init__(self, origin: int, source: int, output: int, block: int = 1):
+        self.origin = origin
+        self.source = source
+        self.output = output
+        divisor = math.gcd(source, output)
+        self.period_in = source // divisor
+        self.period_out = output // divisor
+        self.unit = self.period_out * block // math.gcd(self.period_out, block)
+
+    def span(self, lo: int, hi: int) -> Optional[Tuple[int, int, int, int]]:
+        """源区间[lo, hi)（屏幕坐标）影响的输出区间，按周期对齐
+
+        Returns:
+            (输出起点, 输出终点, 源起点, 源终点)，与视口不相交时为None
+        """
+        lo = max(lo - self.origin, 0)
+        hi = min(hi - self.origin, self.source)
+        if hi <= lo:
+            return None
+        q, p, unit = self.period_out, self.period_in, self.unit
+        start = lo // p * q // unit * unit
+        end = min(-(-(-(-hi // p) * q) // unit) * unit, self.output)
+        return start, end, self.origin + start // q * p, self.origin + -(-end // q) * p
+
+
+class ScaledView:
+    """一种视图的输出画面（image，BGRA）与传输帧（frame），由服务器在screen_lock下随screen一起更新
+
+    BGRA格式时frame就是image。
+    """
+
+    def __init__(self, view: View):
+        self.view = view
+        self.format = get_format(view.pixel_format)
+        self.image = np.zeros((view.height, view.width, 4), dtype=np.uint8)
+        self.frame = self.image if self.format.code == PF_BGRA else self.format.allocate(view.width, view.height)
+        self.scaled = (view.width, view.height) != (view.right - view.left, view.bottom - view.top)
+        self._x = _Axis(view.left, view.right - view.left, view.width, self.format.block)
+        self._y = _Axis(view.top, view.bottom - view.top, view.height, self.format.block)
+
+    def _resample(self, source: np.ndarray, x0: int, y0: int, x1: int, y1: int) -> None:
+        """源区域缩放（或复制）到image的 [x0, x1) × [y0, y1)"""
+        if self.scaled:
+            cv2.resize(source, (x1 - x0, y1 - y0), dst=self.image[y0:y1, x0:x1], interpolation=cv2.INTER_AREA)
+        else:
+            np.copyto(self.image[y0:y1, x0:x1], source)
+
+    def render(self, screen: np.ndarray) -> None:
+        """整帧缩放并转换"""
+        view = self.view
+        self._resample(screen[view.top:view.bottom, view.left:view.right], 0, 0, view.width, view.height)
+        if self.frame is not self.image:
+            self.format.encode(self.image, self.frame,
+                               [{'left': 0, 'top': 0, 'right': view.width, 'bottom': view.height}])
+
+    def update(self, screen: np.ndarray, rects: List[Dict]) -> List[Dict]:
+        """screen的rects区域已更新，重新缩放并转换受影响的输出区域
+
+        Returns:
+            传输帧坐标的脏矩形（视口外的矩形被丢弃）
+        """
+        output = []
+        for rect in rects:
+            x = self._x.span(rect['left'], rect['right'])
+            y = self._y.span(rect['top'], rect['bottom']) if x else None
+            if y is None:
+                continue
+            x0, x1, sx0, sx1 = x
+            y0, y1, sy0, sy1 = y
+            self._resample(screen[sy0:sy1, sx0:sx1], x0, y0, x1, y1)
+            output.append({'left': x0, 'top': y0, 'right': x1, 'bottom': y1})
+        if self.frame is not self.image:
+            self.format.encode(self.image, self.frame, output)
+            output = [self.format.wire_rect(rect) for rect in output]
+        return output
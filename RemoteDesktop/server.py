@@ -7,201 +7,666 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import ctypes
 import numpy as np
 import time
 import threading
 import socket
-from pathlib import Path
 from queue import Queue, Empty
-from protocol import Protocol, PKT_INIT, PKT_FRAME, PKT_DIRTY, PKT_SKIP
+from protocol import (Protocol, PKT_INIT, PKT_FRAME, PKT_DIRTY, PKT_SKIP, PKT_ACK, PKT_RESUME, PKT_RESYNC,
+                      PKT_HEARTBEAT, PKT_CHECKSUM, PKT_REFRESH, PKT_VIEW, PKT_LOSSY, PF_AUTO, PF_BGRA, PF_RGB565,
+                      PF_YUV420, PIXEL_FORMAT_NAMES, CODEC_JPEG, CODEC_WEBP, LOSSY_CODEC_NAMES, LEGACY_CAPABILITIES,
+                      LEGACY_VERSION, Capabilities, View, bitmask, now_us)
+from ratecontrol import (BandwidthEstimator, TokenBucket, CompressionController, FormatController, PACING_GAIN,
+                         COMPRESS_LEVELS)
+from checksum import TileChecksums
+import regions
+from buffers import PacketRing, ScratchBuffer
+from pixelformat import PIXEL_FORMATS, get_format
+from lossy import TILE_SIZE, LossyEncoder, MotionMap, decode_into, is_photographic
+from scaling import ScaledView, is_native, resolve_view
+from latency import stamp_marker
+from multiplex import StreamMux, connect_upstream
+from datagram import FEC_GROUP, RECOVERED, RETRANSMITTED, ABANDONED, NetworkSimulator, listen_datagram
+from capture import FS_OK, FS_TIMEOUT, BlockDiffSource, DxgiCapture, SYNTHETIC_SOURCES, create_source
+from recording import RecordingReader, RecordingSource
+from sharedframe import FramePublisher, DEFAULT_NAME as DEFAULT_SHARED_NAME
+from metrics import REGISTRY, start_http_server
+from tracing import TRACER
 
-# 定义FrameStatus枚举
-FS_OK = 0
-FS_TIMEOUT = 1
-FS_ERROR = 2
+# 每个客户端允许的最大在途（未确认）更新数
+DEFAULT_MAX_IN_FLIGHT = 4
+# 窗口满时累积的脏矩形超过此数量则合并为外接矩形
+MAX_PENDING_RECTS = 64
 
-# 定义DirtyRect结构体
-class DirtyRect(ctypes.Structure):
-    _fields_ = [
-        ("left", ctypes.c_int),
-        ("top", ctypes.c_int),
-        ("right", ctypes.c_int),
-        ("bottom", ctypes.c_int)
-    ]
+# 更新包按优先级拆分（见schedule_rects）：每个包的像素数按约PACKET_INTERVAL秒可发完估算（可用带宽与近期压缩率），
+# 限制在 [MIN_PACKET_PIXELS, MAX_PACKET_PIXELS] 内；面积不超过SMALL_RECT_AREA的矩形（打字、光标）优先发送，
+# 被推迟的大块区域超过DEFER_DEADLINE秒仍未发完时改为优先发送
+PACKET_INTERVAL = 0.1
+MIN_PACKET_PIXELS = 64 * 1024
+MAX_PACKET_PIXELS = 3840 * 2160
+SMALL_RECT_AREA = 128 * 128
+DEFER_DEADLINE = 0.25
 
-class DxgiCapture:
-    def __init__(self, dll_path="../DxgiGrab3.dll"):
-        """初始化DXGI捕获"""
-        # 加载DLL
-        dll_file = Path(dll_path)
-        
-        if not dll_file.exists():
-            for possible_path in [
-                "DxgiGrab3.dll",
-                "../DxgiGrab3.dll",
-                "../../DxgiGrab3.dll",
-                r"C:\Users\Administrator\Desktop\DXGI-ScreenCapture-DLL\DxgiGrab3.dll"
-            ]:
-                dll_file = Path(possible_path)
-                if dll_file.exists():
-                    break
+# 会话恢复：等待客户端恢复请求的时间、断开后保留会话的时间、每个会话保留的历史包字节数
+RESUME_WAIT = 1.0
+SESSION_KEEPALIVE = 60.0
+HISTORY_BYTES = 16 * 1024 * 1024
+
+# 自动像素格式（PF_AUTO）的降级顺序
+AUTO_FORMATS = (PF_BGRA, PF_RGB565, PF_YUV420)
+
+# 服务器的能力（与客户端的能力取交集）：发送的数据包类型、像素格式与有损编码；未启用有损区域时去掉有损部分
+SERVER_CAPABILITIES = Capabilities(
+    packet_types=bitmask((PKT_INIT, PKT_FRAME, PKT_DIRTY, PKT_SKIP, PKT_HEARTBEAT, PKT_CHECKSUM, PKT_REFRESH,
+                          PKT_VIEW, PKT_LOSSY)),
+    pixel_formats=bitmask(PIXEL_FORMATS), lossy_codecs=bitmask(LOSSY_CODEC_NAMES))
+# 客户端不支持服务器配置的有损编码时，按编码速度依次选择双方都支持的编码
+LOSSY_PREFERENCE = (CODEC_JPEG, CODEC_WEBP)
+
+# 下发分块校验和的间隔（秒）
+CHECKSUM_INTERVAL = 2.0
+
+# 指标HTTP端点默认端口：0表示不启动（同时提供/trace，监听所有网卡，需要时用 --metrics-port 9101 显式开启）
+DEFAULT_METRICS_PORT = 0
+
+# 指标（Prometheus），client标签为会话建立时的客户端地址
+CAPTURE_SECONDS = REGISTRY.histogram('rd_capture_seconds', "捕获一次（获取帧+复制脏区域）的耗时（秒）").labels()
+CAPTURES = REGISTRY.counter('rd_captures_total', "捕获检测次数", ['result'])
+SCALE_SECONDS = REGISTRY.histogram('rd_scale_seconds', "按脏矩形更新全部缩放视图的耗时（秒）").labels()
+VIEWS = REGISTRY.gauge('rd_views', "会话使用的缩放视图数").labels()
+STAGE_SECONDS = REGISTRY.histogram('rd_server_stage_seconds', "服务器各阶段耗时（秒）", ['client', 'stage'])
+UPDATES_SENT = REGISTRY.counter('rd_updates_sent_total', "已发送的数据包", ['client', 'type'])
+BYTES_SENT = REGISTRY.counter('rd_sent_bytes_total', "已发送字节", ['client'])
+XOR_INPUT_BYTES = REGISTRY.counter('rd_xor_input_bytes_total', "XOR编码前的脏区域字节", ['client'])
+XOR_OUTPUT_BYTES = REGISTRY.counter('rd_xor_output_bytes_total', "XOR编码并压缩后的脏矩形包字节", ['client'])
+HELD = REGISTRY.counter('rd_held_total', "因窗口满而暂缓发送的次数", ['client'])
+DEFERRED = REGISTRY.counter('rd_deferred_rects_total', "超出包预算而推迟到后续包的矩形数", ['client'])
+ACKS = REGISTRY.counter('rd_acks_total', "收到的确认数", ['client'])
+RESYNC_TILES = REGISTRY.counter('rd_resync_tiles_total', "客户端报告不一致而重传的块数", ['client'])
+PACED_SECONDS = REGISTRY.counter('rd_paced_seconds_total', "令牌桶累计等待（秒）", ['client'])
+ACK_LATENCY = REGISTRY.histogram('rd_ack_latency_seconds', "捕获→收到确认的耗时（秒）", ['client'])
+IN_FLIGHT = REGISTRY.gauge('rd_in_flight', "在途（未确认）更新数", ['client'])
+BANDWIDTH = REGISTRY.gauge('rd_bandwidth_estimate_bytes', "估计带宽（字节/秒）", ['client'])
+SEND_RATE = REGISTRY.gauge('rd_send_rate_bytes', "实际发送速率（字节/秒）", ['client'])
+PACING_RATE = REGISTRY.gauge('rd_pacing_rate_bytes', "节奏控制速率（字节/秒，0表示不限）", ['client'])
+COMPRESS_LEVEL = REGISTRY.gauge('rd_compress_level', "当前zlib压缩等级", ['client'])
+SESSIONS = REGISTRY.gauge('rd_sessions', "会话数", ['state'])
+
+SESSION_FAMILIES = (STAGE_SECONDS, UPDATES_SENT, BYTES_SENT, XOR_INPUT_BYTES, XOR_OUTPUT_BYTES, HELD, DEFERRED,
+                    ACKS, RESYNC_TILES, PACED_SECONDS, ACK_LATENCY, IN_FLIGHT, BANDWIDTH, SEND_RATE, PACING_RATE,
+                    COMPRESS_LEVEL)
+
+def merge_rects(rects, max_rects=MAX_PENDING_RECTS):
+    """合并累积的脏矩形
+    
+    去除重复和被完全包含的矩形；数量仍超过max_rects时退化为一个外接矩形。
+    """
+    unique = list(dict.fromkeys((r['left'], r['top'], r['right'], r['bottom']) for r in rects))
+    kept = [
+        a for i, a in enumerate(unique)
+        if not any(
+            j != i and b[0] <= a[0] and b[1] <= a[1] and b[2] >= a[2] and b[3] >= a[3]
+            for j, b in enumerate(unique)
+        )
+    ] if len(unique) <= max_rects else unique
+    
+    if len(kept) > max_rects:
+        kept = [(
+            min(r[0] for r in kept), min(r[1] for r in kept),
+            max(r[2] for r in kept), max(r[3] for r in kept)
+        )]
+    
+    return [{'left': l, 'top': t, 'right': r, 'bottom': b} for l, t, r, b in kept]
+
+
+def restrict_request(request, capabilities):
+    """按协商的能力限制客户端请求的视图
+    
+    对方不支持的像素格式改为BGRA；自动像素格式须能切换视图（PKT_VIEW）且有可降级的格式，否则也改为BGRA。
+    """
+    if request is None or request.pixel_format == PF_BGRA:
+        return request
+    if request.pixel_format == PF_AUTO:
+        if capabilities.has_packet(PKT_VIEW) and len(auto_formats(capabilities)) > 1:
+            return request
+    elif capabilities.has_pixel_format(request.pixel_format):
+        return request
+    return request._replace(pixel_format=PF_BGRA)
+
+
+def auto_formats(capabilities):
+    """自动像素格式可用的降级顺序（AUTO_FORMATS中双方都支持的）"""
+    return [code for code in AUTO_FORMATS if code == PF_BGRA or capabilities.has_pixel_format(code)]
+
+
+def _area(rect):
+    return (rect['right'] - rect['left']) * (rect['bottom'] - rect['top'])
+
+
+def schedule_rects(rects, budget, focus=None, bulk_first=False):
+    """按优先级从合并后的脏矩形中取出一个更新包的矩形（总像素数不超过budget）
+    
+    小矩形（面积不超过SMALL_RECT_AREA）在前，其中离focus（最近一次小范围变化的中心）近的优先，大块区域在后；
+    bulk_first为True时大块区域在前（推迟已久，避免被持续的小变化挤占）。
+    第一个矩形就超过budget时按行切成条带（按有损分块的TILE_SIZE行对齐），只取第一条。
+    
+    Returns:
+        (本包的矩形, 留待后续包的矩形)
+    """
+    def priority(rect):
+        small = _area(rect) <= SMALL_RECT_AREA
+        distance = 0
+        if focus is not None:
+            distance = max(abs((rect['left'] + rect['right']) // 2 - focus[0]),
+                           abs((rect['top'] + rect['bottom']) // 2 - focus[1]))
+        return small == bulk_first, distance, _area(rect)
+    
+    batch, rest, used = [], [], 0
+    for rect in sorted(rects, key=priority):
+        area = _area(rect)
+        if used + area <= budget:
+            batch.append(rect)
+            used += area
+        elif not batch:
+            rows = max(TILE_SIZE, budget // (rect['right'] - rect['left']) // TILE_SIZE * TILE_SIZE)
+            cut = (rect['top'] + rows) // TILE_SIZE * TILE_SIZE
+            if cut < rect['bottom']:
+                batch.append(dict(rect, bottom=cut))
+                rest.append(dict(rect, top=cut))
             else:
-                raise FileNotFoundError(f"找不到DLL文件")
-        
-        self.dll = ctypes.CDLL(str(dll_file.absolute()))
-        
-        # 定义函数原型
-        self.dll.dxgi_create.restype = ctypes.c_void_p
-        self.dll.dxgi_create.argtypes = []
-        
-        self.dll.dxgi_destroy.restype = None
-        self.dll.dxgi_destroy.argtypes = [ctypes.c_void_p]
-        
-        self.dll.dxgi_get_width.restype = ctypes.c_int
-        self.dll.dxgi_get_width.argtypes = [ctypes.c_void_p]
-        
-        self.dll.dxgi_get_height.restype = ctypes.c_int
-        self.dll.dxgi_get_height.argtypes = [ctypes.c_void_p]
-        
-        self.dll.dxgi_get_size.restype = ctypes.c_int
-        self.dll.dxgi_get_size.argtypes = [ctypes.c_void_p]
-        
-        self.dll.dxgi_get_frame.restype = ctypes.c_int
-        self.dll.dxgi_get_frame.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_int]
-        
-        self.dll.dxgi_acquire_frame.restype = ctypes.c_int
-        self.dll.dxgi_acquire_frame.argtypes = [ctypes.c_void_p, ctypes.c_int]
-        
-        self.dll.dxgi_release_frame.restype = None
-        self.dll.dxgi_release_frame.argtypes = [ctypes.c_void_p]
-        
-        self.dll.dxgi_get_dirty_rects_count.restype = ctypes.c_int
-        self.dll.dxgi_get_dirty_rects_count.argtypes = [ctypes.c_void_p]
-        
-        self.dll.dxgi_get_dirty_rects.restype = ctypes.c_int
-        self.dll.dxgi_get_dirty_rects.argtypes = [ctypes.c_void_p, ctypes.POINTER(DirtyRect), ctypes.c_int]
+                batch.append(rect)
+            used = budget
+        else:
+            rest.append(rect)
+    return batch, rest
+
+
+class SessionMetrics:
+    """单个会话的指标（client标签），会话过期时从注册表删除"""
+    
+    def __init__(self, session):
+        self.client = f"{session.address[0]}:{session.address[1]}"
+        labels = {'client': self.client}
+        self.xor = STAGE_SECONDS.labels(stage='xor', **labels)
+        self.compress = STAGE_SECONDS.labels(stage='compress', **labels)
+        self.send = STAGE_SECONDS.labels(stage='send', **labels)
+        self.lossy = STAGE_SECONDS.labels(stage='lossy', **labels)
+        self.bytes_sent = BYTES_SENT.labels(**labels)
+        self.xor_input = XOR_INPUT_BYTES.labels(**labels)
+        self.xor_output = XOR_OUTPUT_BYTES.labels(**labels)
+        self.held = HELD.labels(**labels)
+        self.deferred = DEFERRED.labels(**labels)
+        self.acks = ACKS.labels(**labels)
+        self.resync_tiles = RESYNC_TILES.labels(**labels)
+        self.paced = PACED_SECONDS.labels(**labels)
+        self.ack_latency = ACK_LATENCY.labels(**labels)
         
-        self.dll.dxgi_copy_acquired_frame.restype = ctypes.c_int
-        self.dll.dxgi_copy_acquired_frame.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char)]
+        def locked(read):
+            def value():
+                with session.cond:
+                    return read()
+            return value
         
-        self.dll.dxgi_get_dirty_region_size.restype = ctypes.c_int
-        self.dll.dxgi_get_dirty_region_size.argtypes = [ctypes.c_void_p]
+        IN_FLIGHT.labels(**labels).set_function(locked(lambda: len(session.in_flight)))
+        BANDWIDTH.labels(**labels).set_function(locked(lambda: session.estimator.rate))
+        SEND_RATE.labels(**labels).set_function(locked(lambda: session.estimator.send_rate))
+        PACING_RATE.labels(**labels).set_function(locked(lambda: session.pacer.rate or 0))
+        COMPRESS_LEVEL.labels(**labels).set_function(lambda: session.compressor.level)
+    
+    def on_update(self, kind, size):
+        """记录一个已发送的包（kind: frame/dirty/refresh/skip/checksum）"""
+        UPDATES_SENT.labels(client=self.client, type=kind).inc()
+        self.bytes_sent.inc(size)
+    
+    def updates(self, kind):
+        return UPDATES_SENT.labels(client=self.client, type=kind).value
+    
+    def remove(self):
+        for family in SESSION_FAMILIES:
+            family.remove(client=self.client)
+
+
+class ClientSession:
+    """单个客户端的发送状态
+    
+    维护客户端的参考帧（previous_frame）、更新序号和在途窗口。
+    捕获线程通过add_damage/add_tick投递变化，发送线程在窗口有空位时
+    把累积的脏矩形合并后按优先级取出一个更新包发送（见take_rects），其余留待后续包；
+    窗口满时变化持续累积，不会丢失。留待的区域发送时读取的是最新画面，被新变化覆盖的旧矩形在合并时去除。
+    
+    发送节奏由令牌桶控制：速率取估计带宽×PACING_GAIN，并受max_bandwidth硬上限约束。
+    
+    lossy不为None时按块变化频率把高运动区域以有损图像发送（见lossy.py，仅BGRA传输帧），motion为其分块统计。
+    
+    view为会话的视图（缩放/视口/像素格式），None表示整个屏幕的原始分辨率BGRA；
+    参考帧与脏矩形都是该视图传输帧（见pixelformat.py）的坐标，width/height为传输帧的尺寸。
+    requested_view为客户端请求的视图，其像素格式为PF_AUTO时由formats按链路状况选择。
+    capabilities为握手协商的能力（旧客户端为LEGACY_CAPABILITIES），限制像素格式、校验和、
+    在途窗口（客户端可缓冲的包数）与每个包的矩形数。
+    """
+    
+    def __init__(self, client_socket, address, width, height,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_bandwidth=None, view=None, channels=4, lossy=None,
+                 capabilities=LEGACY_CAPABILITIES):
+        self.socket = client_socket
+        self.address = address
+        self.token = os.urandom(16)  # 会话令牌，重连时用于恢复
+        self.detached = threading.Event()  # 连接已断开、等待恢复
+        self.detach_time = 0
+        self.capabilities = capabilities
+        if capabilities.window:
+            max_in_flight = min(max_in_flight, capabilities.window)
+        self.max_in_flight = max_in_flight
+        self.max_bandwidth = max_bandwidth  # 字节/秒，None表示不设上限
+        self.view = view
+        self.view_request = None  # 待切换的视图请求（客户端运行中请求或自动像素格式变化），由发送线程切换
+        self.requested_view = None
+        self.formats = None  # 自动像素格式时的FormatController
+        self.lossy = lossy
+        self.previous_frame = np.zeros((height, width, channels), dtype=np.uint8)
+        self.motion = self._motion_map()
+        self.scratch = ScratchBuffer()  # 发送线程的XOR/原始像素暂存区（压缩后即可复用）
+        self.packet_scratch = ScratchBuffer()  # 发送线程打包（压缩输出）的暂存区（发送后即可复用）
+        self.running = True
+        self.cond = threading.Condition()
+        self.send_lock = threading.Lock()  # 发送线程与确认线程（心跳回传）共用socket
         
-        self.dll.dxgi_copy_dirty_regions.restype = ctypes.c_int
-        self.dll.dxgi_copy_dirty_regions.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_int]
+        # 序号与在途窗口
+        self.seq = 0            # 最近发送的更新序号
+        self.acked_seq = 0      # 客户端累计确认的序号
+        self.in_flight = {}     # seq -> 发送时间
         
-        # 创建DXGI实例
-        self.dxgi = self.dll.dxgi_create()
-        if not self.dxgi:
-            raise RuntimeError("创建DXGI实例失败")
+        # 已发送的脏矩形包（seq -> packet），用于断线恢复时重建客户端状态；保存在环中，不为每个包分配内存
+        self.history = PacketRing(HISTORY_BYTES)
         
-        # 获取屏幕信息
-        self.width = self.dll.dxgi_get_width(self.dxgi)
-        self.height = self.dll.dxgi_get_height(self.dxgi)
-        self.size = self.dll.dxgi_get_size(self.dxgi)
+        # 待发送的变化
+        self.pending_rects = []
+        self.pending_timestamp = 0
+        self.skip_pending = False
+        self.focus = None           # 最近一次小范围变化（打字、光标）的中心
+        self.deferred_since = 0     # pending_rects中有被推迟的区域时，最早推迟的时间
+        self.compress_ratio = 0.5   # 近期脏矩形包的压缩率（包大小/原始字节），用于估算包预算
         
-        # 创建缓冲区
-        self.buffer = (ctypes.c_char * self.size)()
-        self.dirty_buffer = (ctypes.c_char * self.size)()  # 脏区域缓冲
+        # 参考帧的分块校验和，以及客户端请求重传的块
+        self.tiles = TileChecksums(width, height)
+        self.refresh_tiles = set()
+        self.last_checksum_time = time.time()
         
-        # XOR优化：维护上一帧（BGRA格式）
-        self.previous_frame = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+        # 速率控制
+        self.estimator = BandwidthEstimator()
+        self.pacer = TokenBucket(rate=max_bandwidth)
+        self.compressor = CompressionController()
         
-        print(f"[服务器] 屏幕尺寸: {self.width}x{self.height}, 帧大小: {self.size/1024/1024:.2f} MB")
+        self.metrics = SessionMetrics(self)
     
-    def capture(self, timeout_ms=100):
-        """捕获完整帧（BGRA格式）"""
-        status = self.dll.dxgi_get_frame(self.dxgi, self.buffer, timeout_ms)
-        
-        if status == FS_OK:
-            frame = np.frombuffer(self.buffer, dtype=np.uint8).copy()
-            frame = frame.reshape(self.height, self.width, 4)  # 保持BGRA格式
-            return status, frame
-        
-        return status, None
+    def _motion_map(self):
+        """按当前参考帧创建分块运动统计（未启用有损区域或不是BGRA传输帧时为None）"""
+        if self.lossy is None or self.previous_frame.shape[2] != 4:
+            return None
+        return MotionMap(self.width, self.height)
     
-    def capture_dirty_rects(self, timeout_ms=100):
-        """使用脏矩形捕获"""
-        status = self.dll.dxgi_acquire_frame(self.dxgi, timeout_ms)
-        
-        if status != FS_OK:
-            return status, None, None
+    def add_damage(self, rects, timestamp):
+        """投递新的脏矩形（捕获线程调用）"""
+        with self.cond:
+            small = [r for r in rects if _area(r) <= SMALL_RECT_AREA]
+            if small:
+                self.focus = ((small[-1]['left'] + small[-1]['right']) // 2,
+                              (small[-1]['top'] + small[-1]['bottom']) // 2)
+            if self.motion is not None:
+                now = time.time()
+                self.motion.update(rects, now)
+                rects = rects + self.motion.refine(now)
+            self.pending_rects.extend(rects)
+            if len(self.pending_rects) > MAX_PENDING_RECTS * 4:
+                # 长时间未发送（窗口满或断线等待恢复）时及时合并，避免无限增长
+                self.pending_rects = merge_rects(self.pending_rects)
+            self.pending_timestamp = timestamp
+            self.cond.notify()
+    
+    def add_refine(self, timestamp):
+        """投递已静止足够久的有损块的无损修正（捕获线程调用）
         
-        try:
-            dirty_count = self.dll.dxgi_get_dirty_rects_count(self.dxgi)
-            
-            dirty_info = {
-                'count': dirty_count,
-                'rects': []
-            }
-            
-            # 无变化
-            if dirty_count == 0:
-                self.dll.dxgi_release_frame(self.dxgi)
-                return FS_OK, None, dirty_info
-            
-            # 获取脏矩形
-            rects_array = (DirtyRect * dirty_count)()
-            self.dll.dxgi_get_dirty_rects(self.dxgi, rects_array, dirty_count)
-            
-            dirty_info['rects'] = [
-                {
-                    'left': r.left,
-                    'top': r.top,
-                    'right': r.right,
-                    'bottom': r.bottom
-                }
-                for r in rects_array
-            ]
-            
-            # 获取完整帧
-            status_frame = self.dll.dxgi_copy_acquired_frame(self.dxgi, self.buffer)
-            
-            if status_frame == FS_OK:
-                frame = np.frombuffer(self.buffer, dtype=np.uint8).copy()
-                frame = frame.reshape(self.height, self.width, 4)
-                frame = frame[:, :, :3]
-                return FS_OK, frame, dirty_info
-            
-        finally:
-            self.dll.dxgi_release_frame(self.dxgi)
+        Returns:
+            是否有需要修正的块
+        """
+        if self.motion is None:
+            return False
+        with self.cond:
+            rects = self.motion.refine(time.time())
+            if rects:
+                self.pending_rects.extend(rects)
+                self.pending_timestamp = timestamp
+                self.cond.notify()
+            return bool(rects)
+    
+    def add_tick(self, timestamp):
+        """投递一次无变化的检测（捕获线程调用）；有待修正的有损块时改为投递修正"""
+        if self.add_refine(timestamp):
+            return
+        with self.cond:
+            if not self.pending_rects:
+                self.skip_pending = True
+                self.pending_timestamp = timestamp
+                self.cond.notify()
+    
+    def request_refresh(self, tiles):
+        """客户端报告块校验不一致，排队重传这些块"""
+        with self.cond:
+            self.refresh_tiles.update(tiles)
+            self.metrics.resync_tiles.inc(len(tiles))
+            self.cond.notify()
+    
+    def request_view(self, view):
+        """客户端请求更换视图（确认线程调用）"""
+        with self.cond:
+            self.view_request = view
+            self.cond.notify()
+    
+    def set_request(self, request):
+        """记录客户端请求的视图（调用方持有cond），请求自动像素格式时创建格式控制器
         
-        return FS_ERROR, None, None
+        Returns:
+            按协商的能力限制后的请求（见restrict_request）
+        """
+        request = self.requested_view = restrict_request(request, self.capabilities)
+        if request is None or request.pixel_format != PF_AUTO:
+            self.formats = None
+        elif self.formats is None:
+            self.formats = FormatController([(code, get_format(code).bytes_per_pixel)
+                                             for code in auto_formats(self.capabilities)])
+        return request
+    
+    def adapt_format(self):
+        """自动像素格式：按链路占用调整，格式变化时排队切换视图（调用方持有cond）"""
+        if self.formats is None or self.view_request is not None:
+            return
+        current = self.formats.pixel_format
+        saturated = self.compressor.index == len(COMPRESS_LEVELS) - 1
+        if self.formats.update(self.estimator.send_rate, self.available_bandwidth(), saturated) != current:
+            self.view_request = self.requested_view
+    
+    def set_view(self, view, shape):
+        """切换视图并按传输帧形状 (高, 宽, 通道) 重建参考帧（之后须发送完整帧）"""
+        with self.cond:
+            self.view = view
+            self.previous_frame = np.zeros(shape, dtype=np.uint8)
+            self.motion = self._motion_map()
+            self.tiles = TileChecksums(shape[1], shape[0])
+            self.pending_rects = []
+            self.deferred_since = 0
+            self.focus = None
+            self.refresh_tiles.clear()
+    
+    @property
+    def width(self):
+        return self.previous_frame.shape[1]
+    
+    @property
+    def height(self):
+        return self.previous_frame.shape[0]
+    
+    def window_full(self):
+        return len(self.in_flight) >= self.max_in_flight
+    
+    @property
+    def rect_limit(self):
+        """一个更新包的矩形数上限（客户端给出的上限与MAX_PENDING_RECTS中较小者）"""
+        return min(self.capabilities.max_rects or MAX_PENDING_RECTS, MAX_PENDING_RECTS)
+    
+    def limit_rects(self, rects):
+        """矩形数超过客户端的上限时合并（未给出上限时原样返回）"""
+        limit = self.capabilities.max_rects
+        return merge_rects(rects, limit) if limit and len(rects) > limit else rects
+    
+    def checksum_due(self):
+        return (self.seq > 0 and self.capabilities.has_packet(PKT_CHECKSUM)
+                and time.time() - self.last_checksum_time >= CHECKSUM_INTERVAL)
     
-    def __del__(self):
-        """释放资源"""
-        if hasattr(self, 'dxgi') and self.dxgi:
-            self.dll.dxgi_destroy(self.dxgi)
+    def has_work(self):
+        """发送线程是否有事可做（调用方持有cond）"""
+        if self.view_request is not None:
+            return True
+        if not self.window_full() and (self.refresh_tiles or self.pending_rects):
+            return True
+        return self.checksum_due() or (self.skip_pending and not self.pending_rects)
+    
+    def next_seq(self):
+        """分配新的更新序号并记入在途窗口（调用方持有cond）"""
+        self.seq += 1
+        self.in_flight[self.seq] = time.time()
+        return self.seq
+    
+    def packet_budget(self):
+        """一个更新包的像素预算：按可用带宽与近期压缩率约PACKET_INTERVAL秒可发完（调用方持有cond）"""
+        bandwidth = self.available_bandwidth()
+        if not bandwidth:
+            return MAX_PACKET_PIXELS
+        pixels = bandwidth * PACKET_INTERVAL / (self.compress_ratio * self.previous_frame.shape[2])
+        return int(min(max(pixels, MIN_PACKET_PIXELS), MAX_PACKET_PIXELS))
+    
+    def take_rects(self):
+        """合并待发送的脏矩形并按优先级取出一个更新包，超出预算的部分留在pending_rects（调用方持有cond）"""
+        now = time.time()
+        overdue = bool(self.deferred_since) and now - self.deferred_since >= DEFER_DEADLINE
+        rects, self.pending_rects = schedule_rects(merge_rects(self.pending_rects, self.rect_limit),
+                                                   self.packet_budget(), self.focus, overdue)
+        if not self.pending_rects:
+            self.deferred_since = 0
+        else:
+            if overdue or not self.deferred_since:
+                self.deferred_since = now
+            self.metrics.deferred.inc(len(self.pending_rects))
+        return rects
+    
+    def defer_rects(self, rects):
+        """把已取出但本次不发送的矩形放回pending_rects（调用方持有cond），像素在之后发送时重新读取"""
+        self.pending_rects.extend(rects)
+        if not self.deferred_since:
+            self.deferred_since = time.time()
+        self.metrics.deferred.inc(len(rects))
+        self.cond.notify()
+    
+    def record_history(self, seq, packet):
+        """保存已发送的脏矩形包的副本（调用方持有cond），超出HISTORY_BYTES时丢弃最旧的"""
+        self.history.put(seq, packet)
+    
+    def reset_history(self):
+        """发送完整帧后，之前的历史不再可用于恢复（调用方持有cond）"""
+        self.history.clear()
+    
+    def attach(self, client_socket, address):
+        """把断开的会话绑定到新连接"""
+        with self.cond:
+            self.socket = client_socket
+            self.address = address
+            self.running = True
+            self.skip_pending = False
+            # 断线前未确认的包视为丢失
+            self.in_flight.clear()
+            self.estimator.packets.clear()
+            self.detached.clear()
+    
+    def pacing_rate(self):
+        """当前节奏控制速率（字节/秒），None表示不限速"""
+        rate = self.estimator.rate * PACING_GAIN if self.estimator.rate > 0 else None
+        if self.max_bandwidth:
+            rate = min(rate, self.max_bandwidth) if rate else self.max_bandwidth
+        return rate
+    
+    def available_bandwidth(self):
+        """可用带宽：估计带宽与硬上限取小（调用方持有cond）"""
+        bandwidth = self.estimator.rate
+        if self.max_bandwidth:
+            bandwidth = min(bandwidth, self.max_bandwidth) if bandwidth else self.max_bandwidth
+        return bandwidth
+    
+    def compress_level(self):
+        """按发送速率与可用带宽选择压缩等级"""
+        with self.cond:
+            return self.compressor.update(self.estimator.send_rate, self.available_bandwidth())
+    
+    def send(self, packet, kind, seq=None):
+        """按令牌桶节奏发送数据包；seq不为None时计入带宽估计"""
+        start_us = now_us()
+        waited = self.pacer.consume(len(packet))
+        if waited:
+            self.metrics.paced.inc(waited)
+            TRACER.record('pace', start_us, int(waited * 1e6), seq)
+        with self.send_lock, self.metrics.send.time(), TRACER.span('send', seq, type=kind, size=len(packet)):
+            Protocol.send_packet(self.socket, packet)
+        self.metrics.on_update(kind, len(packet) + 4)
+        if seq is not None:
+            with self.cond:
+                self.estimator.on_send(seq, len(packet) + 4)
+    
+    def send_control(self, packet):
+        """立即发送控制包（不经过令牌桶）"""
+        with self.send_lock:
+            Protocol.send_packet(self.socket, packet)
+    
+    def on_ack(self, seq, timestamp):
+        """处理客户端确认（累计确认）"""
+        with self.cond:
+            if seq > self.acked_seq:
+                self.acked_seq = seq
+            for s in [s for s in self.in_flight if s <= seq]:
+                del self.in_flight[s]
+            self.estimator.on_ack(seq)
+            self.pacer.set_rate(self.pacing_rate())
+            self.metrics.acks.inc()
+            if timestamp:
+                self.metrics.ack_latency.observe((now_us() - timestamp) / 1e6)
+            self.cond.notify()
+    
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
 
 
 class RemoteDesktopServer:
-    """远程桌面服务器"""
+    """远程桌面服务器
+    
+    单个捕获线程负责DXGI采集并维护最新屏幕（screen），
+    每个客户端由独立的ClientSession按自己的确认窗口发送XOR增量。
+    """
     
-    def __init__(self, host='0.0.0.0', port=9999):
+    def __init__(self, host='0.0.0.0', port=9999, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 max_bandwidth=None, session_keepalive=SESSION_KEEPALIVE, latency_marker=False,
+                 metrics_port=DEFAULT_METRICS_PORT, trace_path=None, capture_source=None, shared_memory=None,
+                 lossy=None, streams=None, udp=False, fec_group=FEC_GROUP, udp_simulator=None):
         self.host = host
         self.port = port
-        self.capture = None
-        self.client_socket = None
+        self.metrics_port = metrics_port
+        self.trace_path = trace_path  # 不为None时启用逐帧追踪，退出时写入该文件
+        self.max_in_flight = max_in_flight
+        self.max_bandwidth = max_bandwidth  # 每个客户端的带宽硬上限（字节/秒）
+        self.latency_marker = latency_marker  # 测试模式：每次检测都在画面左上角写入帧计数/时间戳标记
+        self.marker_counter = 0
+        self.capture = capture_source  # CaptureSource，None时使用DXGI
+        self.shared_memory = shared_memory  # 不为None时screen放在该名称的共享内存段中，供本机观看端直接读取
+        self.lossy = lossy  # LossyEncoder，不为None时高运动区域以有损图像发送
+        self.lossy_encoders = {lossy.codec: lossy} if lossy is not None else {}  # 按客户端支持的编码选用
+        self.capabilities = SERVER_CAPABILITIES if lossy is not None else SERVER_CAPABILITIES._replace(
+            packet_types=SERVER_CAPABILITIES.packet_types & ~bitmask((PKT_LOSSY,)), lossy_codecs=0)
+        # 多路复用连接的其他流 [(名称, opener)]（见multiplex.py），本服务器的画面为流0；为空时不使用多路复用
+        self.streams = streams or []
+        # 数据报传输（见datagram.py）：udp为True时同一端口号上另外接受UDP连接，fec_group为每组分片数，
+        # udp_simulator为测试用的丢包/乱序模拟
+        self.udp = udp
+        self.fec_group = fec_group
+        self.udp_simulator = udp_simulator
+        self.datagram = None
+        self.publisher = None
         self.running = False
         self.capture_lock = threading.Lock()  # 同步对capture的访问
         
-        # 统计信息
-        self.stats = {
-            'detect_count': 0,
-            'send_count': 0,
-            'skip_count': 0,
-            'bytes_sent': 0,
-            'start_time': 0,
-            'xor_saved': 0,  # XOR节省的字节数
-            'original_size': 0  # 原始未XOR大小
-        }
+        # 最新屏幕（BGRA），由捕获线程更新
+        self.screen = None
+        self.screen_lock = threading.Lock()
+        # 会话使用的缩放视图（View -> ScaledView），与screen一同在screen_lock下更新
+        self.views = {}
+        
+        # 客户端会话（包括断线后等待恢复的会话）
+        self.sessions = []
+        self.detached_sessions = {}  # token -> session
+        self.sessions_lock = threading.Lock()
+        self.session_keepalive = session_keepalive
+        SESSIONS.labels(state='attached').set_function(
+            lambda: len(self.sessions) - len(self.detached_sessions))
+        SESSIONS.labels(state='detached').set_function(lambda: len(self.detached_sessions))
+        VIEWS.set_function(lambda: len(self.views))
+    
+    def start_capture(self, stats=True):
+        """初始化捕获，启动捕获线程（stats为True时同时启动统计线程）
+        
+        多路复用连接的其他流（见multiplex.py）的服务器只调用此方法，不监听端口，由主服务器的open_stream转接。
+        """
+        if self.capture is None:
+            self.capture = DxgiCapture()
+        else:
+            print(f"[服务器] 捕获源: {type(self.capture).__name__} {self.capture.width}x{self.capture.height}")
+        if self.shared_memory:
+            self.publisher = FramePublisher(self.capture.width, self.capture.height, self.shared_memory)
+            self.screen = self.publisher.frame
+            print(f"[服务器] 共享内存帧缓冲: {self.shared_memory}")
+        else:
+            self.screen = np.zeros((self.capture.height, self.capture.width, 4), dtype=np.uint8)
+        
+        # 捕获首帧作为屏幕初始内容
+        print("[服务器] 捕获首帧...")
+        with self.capture_lock:
+            self.capture.capture(timeout_ms=1000)  # 跳过黑屏
+            status, frame = self.capture.capture(timeout_ms=1000)
+        if status == FS_OK and frame is not None:
+            self._update_screen(lambda screen: np.copyto(screen, frame), now_us())
+        
+        self.running = True
+        threading.Thread(target=self.capture_loop, name="capture", daemon=True).start()
+        if stats:
+            threading.Thread(target=self.print_stats, name="stats", daemon=True).start()
+    
+    def stop_capture(self):
+        """停止捕获线程并关闭捕获源与共享内存"""
+        self.running = False
+        if self.capture is not None:
+            with self.capture_lock:
+                self.capture.close()  # 录制时写入索引
+        if self.publisher is not None:
+            self.publisher.close()
+    
+    @property
+    def stream_name(self):
+        """作为多路复用连接的一个流时的名称"""
+        capture = self.capture
+        return f"{type(capture).__name__} {capture.width}x{capture.height}" if capture else "screen"
+    
+    def open_stream(self, address):
+        """为多路复用连接的一个流创建本地socket对：一端按普通连接处理（会话、窗口、恢复都与独立连接相同），返回另一端"""
+        local, remote = socket.socketpair()
+        threading.Thread(target=self.handle_client_thread, args=(local, address), daemon=True,
+                         name=f"sender {address[0]}:{address[1]}").start()
+        return remote
     
     def start(self):
         """启动服务器"""
+        server_socket = None
+        handler = self.handle_client_thread
         try:
-            # 初始化捕获
-            self.capture = DxgiCapture()
+            # 初始化捕获，启动捕获线程和统计线程
+            self.start_capture()
+            
+            if self.trace_path:
+                TRACER.enable(process_name="server")
+            
+            if self.metrics_port:
+                try:
+                    start_http_server(self.metrics_port, self.host,
+                                      routes={'/trace': ('application/json', TRACER.to_json)})
+                    print(f"[服务器] 指标: http://{self.host}:{self.metrics_port}/metrics")
+                except OSError as e:
+                    # 指标端口被占用（如同一主机上的另一个服务器）不影响画面服务
+                    print(f"[服务器] 警告: 指标端口 {self.metrics_port} 启动失败（{e}），不提供指标")
             
             # 创建服务器socket
             server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -213,13 +678,29 @@ class RemoteDesktopServer:
             
             print(f"[服务器] 监听 {self.host}:{self.port}")
             
+            # 有其他流时每个连接都按多路复用处理（旧客户端转接到本服务器，即流0）
+            if self.streams:
+                mux = StreamMux([(self.stream_name, self.open_stream)] + self.streams)
+                handler = mux.handle_connection
+                print(f"[服务器] 多路复用: {len(mux.streams)} 个流 " +
+                      ", ".join(f"{i}={name}" for i, name in enumerate(mux.names)))
+            
+            if self.udp:
+                # UDP连接与TCP连接的处理相同（会话、多路复用都在本地socket上进行）
+                self.datagram = listen_datagram(self.host, self.port, self._accept_datagram(handler),
+                                                self.fec_group, self.udp_simulator)
+                threading.Thread(target=self.datagram.run, name="udp", daemon=True).start()
+                print(f"[服务器] 数据报传输: UDP {self.host}:{self.port} | "
+                      f"FEC {f'每 {self.fec_group} 个分片一组' if self.fec_group else '关闭'}")
+            
             while True:
                 print("[服务器] 等待客户端连接...")
                 client_socket, client_address = server_socket.accept()
                 print(f"[服务器] 客户端已连接: {client_address}")
                 
                 # 为每个客户端启动新线程
-                client_thread = threading.Thread(target=self.handle_client_thread, args=(client_socket, client_address))
+                client_thread = threading.Thread(target=handler, args=(client_socket, client_address),
+                                                 name=f"sender {client_address[0]}:{client_address[1]}")
                 client_thread.daemon = True
                 client_thread.start()
         
@@ -230,157 +711,448 @@ class RemoteDesktopServer:
             import traceback
             traceback.print_exc()
         finally:
-            server_socket.close()
+            if server_socket:
+                server_socket.close()
+            if self.datagram:
+                self.datagram.close()
+            self.stop_capture()
+            if self.trace_path:
+                count = TRACER.export(self.trace_path)
+                print(f"[服务器] 已写入追踪文件 {self.trace_path} ({count} 个事件)")
+    
+    @staticmethod
+    def _accept_datagram(handler):
+        """UDP连接建立时的回调（在新线程中调用）：与TCP连接相同地处理"""
+        def accept(sock, address):
+            print(f"[服务器] 客户端已连接: {address} (UDP)")
+            handler(sock, address)
+        return accept
+    
+    def capture_loop(self):
+        """捕获线程：采集脏矩形，更新screen并投递给所有会话"""
+        print("[服务器] 捕获线程已启动")
+        capture = self.capture
+        
+        while self.running:
+            try:
+                with self.capture_lock:
+                    # 直接控制 DXGI API 流程
+                    start_us = now_us()
+                    start = time.perf_counter()
+                    status = capture.acquire(16)
+                    
+                    if status != FS_OK:
+                        CAPTURES.labels(result='timeout' if status == FS_TIMEOUT else 'error').inc()
+                        if self.lossy is not None:
+                            # 画面静止时不会有检测结果，在此投递有损块的无损修正
+                            with self.sessions_lock:
+                                sessions = list(self.sessions)
+                            for session in sessions:
+                                session.add_refine(now_us())
+                    else:
+                        timestamp = now_us()
+                        try:
+                            rects = self._read_dirty_rects(timestamp)
+                        finally:
+                            # 释放帧
+                            capture.release()
+                        elapsed = time.perf_counter() - start
+                        CAPTURE_SECONDS.observe(elapsed)
+                        # 捕获不属于某个客户端的序号，以捕获时间戳（即更新头的timestamp）关联
+                        TRACER.record('capture', start_us, int(elapsed * 1e6), timestamp=timestamp, rects=len(rects))
+                        CAPTURES.labels(result='dirty' if rects else 'idle').inc()
+                        
+                        if self.latency_marker:
+                            rects = rects + self._stamp_marker(timestamp)
+                        
+                        damage = self._update_views(rects)
+                        with self.sessions_lock:
+                            sessions = list(self.sessions)
+                        for session in sessions:
+                            # 缩放视图的会话只收到与视口相交的脏矩形（输出坐标）
+                            session_rects = rects if session.view is None else damage.get(session.view)
+                            if session_rects:
+                                session.add_damage(session_rects, timestamp)
+                            else:
+                                session.add_tick(timestamp)
+                
+                # 限制频率 60fps
+                time.sleep(0.016)
+            
+            except Exception as e:
+                print(f"[服务器] 捕获错误: {e}")
+                time.sleep(0.1)
+    
+    def _update_screen(self, update, timestamp):
+        """在screen_lock下调用 update(screen) 修改screen，返回其修改的矩形（None表示整帧）
+        
+        启用共享内存时修改过程处于写入状态（读取方等待或重试），结束后把修改的矩形记入变更日志。
+        """
+        with self.screen_lock:
+            if self.publisher is None:
+                return update(self.screen)
+            self.publisher.begin()
+            rects = None
+            try:
+                rects = update(self.screen)
+            finally:
+                self.publisher.commit(rects, timestamp)
+            return rects
+    
+    def _update_views(self, rects):
+        """按screen的脏矩形更新各缩放视图，并清理已没有会话使用的视图
+        
+        Returns:
+            {视图: 输出坐标的脏矩形}
+        """
+        with self.screen_lock:
+            with self.sessions_lock:
+                used = {session.view for session in self.sessions}
+            for view in [view for view in self.views if view not in used]:
+                del self.views[view]
+            if not rects or not self.views:
+                return {}
+            with SCALE_SECONDS.time():
+                return {view: scaled.update(self.screen, rects) for view, scaled in self.views.items()}
+    
+    def _session_screen(self, session):
+        """会话视图对应的屏幕：原始分辨率时为screen，否则为视图的传输帧（调用方持有screen_lock）"""
+        if session.view is None:
+            return self.screen
+        scaled = self.views.get(session.view)
+        if scaled is None:
+            scaled = self.views[session.view] = ScaledView(session.view)
+            scaled.render(self.screen)
+        return scaled.frame
+    
+    def _resolve_view(self, request, formats=None):
+        """解析客户端请求的视图，返回 (会话视图, 实际视图)
+        
+        整个屏幕的原始分辨率BGRA时会话视图为None（直接使用screen）；像素格式为PF_AUTO时取formats当前的选择。
+        """
+        if request is not None and request.pixel_format == PF_AUTO:
+            request = request._replace(pixel_format=formats.pixel_format if formats else PF_BGRA)
+        view = resolve_view(request, self.capture.width, self.capture.height)
+        return (None if is_native(view, self.capture.width, self.capture.height) else view), view
+    
+    def negotiate(self, capabilities):
+        """与客户端的能力取交集，未给出能力的旧客户端按LEGACY_CAPABILITIES"""
+        return self.capabilities.intersect(capabilities or LEGACY_CAPABILITIES)
+    
+    def _session_lossy(self, capabilities):
+        """会话使用的有损编码：客户端不支持有损包或没有共同的编码时为None，
+        否则优先服务器配置的编码，其次按LOSSY_PREFERENCE（质量与服务器配置相同）
+        """
+        if self.lossy is None or not capabilities.has_packet(PKT_LOSSY):
+            return None
+        codec = next((code for code in (self.lossy.codec,) + LOSSY_PREFERENCE if capabilities.has_codec(code)),
+                     None)
+        if codec is None:
+            return None
+        if codec not in self.lossy_encoders:
+            self.lossy_encoders[codec] = LossyEncoder(codec, self.lossy.quality)
+        return self.lossy_encoders[codec]
+    
+    def _full_view(self, session):
+        """会话的实际视图（原始分辨率时也返回完整的View）"""
+        width, height = self.capture.width, self.capture.height
+        return session.view or View(width, height, 0, 0, width, height)
+    
+    def _read_dirty_rects(self, timestamp=0):
+        """读取已获取帧的脏矩形并把脏区域写入screen（调用方持有capture_lock）
+        
+        Returns:
+            脏矩形列表，无变化或复制失败时为空列表
+        """
+        capture = self.capture
+        
+        # 获取脏矩形坐标
+        rects = capture.dirty_rects()
+        if not rects:
+            return []
+        
+        # 复制脏区域数据
+        dirty_array = capture.copy_dirty_regions()
+        if dirty_array is None:
+            return []
+        
+        # 把每个脏矩形区域写入最新屏幕
+        return self._update_screen(lambda screen: regions.scatter(screen, rects, dirty_array), timestamp)
+    
+    def _stamp_marker(self, timestamp):
+        """测试模式：在screen左上角写入帧计数和捕获时间戳（毫秒低32位）"""
+        self.marker_counter = (self.marker_counter + 1) & 0xFFFF
+        
+        def stamp(screen):
+            rect = stamp_marker(screen, self.marker_counter, (timestamp // 1000) & 0xFFFFFFFF)
+            return [rect] if rect else []
+        return self._update_screen(stamp, timestamp)
     
     def handle_client_thread(self, client_socket, client_address):
         """处理客户端连接的线程函数"""
+        session = None
         try:
-            self.client_socket = client_socket
-            self.handle_client()
+            session, resume = self.open_session(client_socket, client_address)
+            self.handle_client(session, resume)
         except Exception as e:
             print(f"[服务器] 客户端 {client_address} 错误: {e}")
         finally:
-            if self.client_socket:
-                self.client_socket.close()
+            if session:
+                self.detach_session(session)
+            client_socket.close()
             print(f"[服务器] 客户端 {client_address} 已断开")
     
-    def handle_client(self):
-        """处理客户端连接"""
+    def open_session(self, client_socket, client_address):
+        """读取客户端的恢复请求，返回(会话, 恢复参数)
+        
+        客户端连接后先发送PKT_RESUME（可附带请求的视图）；令牌匹配到断开的会话时恢复该会话，
+        恢复参数为(last_seq, checksum)，否则创建新会话，恢复参数为None。
+        恢复的会话请求了不同的视图时切换视图并按新会话处理（发送完整帧）。
+        不发送恢复请求的客户端等待RESUME_WAIT后按新会话处理。
+        新会话按恢复请求中客户端的能力协商（见negotiate），恢复的会话沿用建立时协商的能力。
+        """
+        self.expire_sessions()
+        
+        packet = None
+        client_socket.settimeout(RESUME_WAIT)
         try:
-            # 为每个客户端创建自己的previous_frame副本
-            self.previous_frame = self.capture.previous_frame.copy()
+            packet = Protocol.recv_packet(client_socket)
+        except socket.timeout:
+            pass
+        finally:
+            client_socket.settimeout(None)
+        
+        request = capabilities = None
+        if packet and Protocol.get_packet_type(packet) == PKT_RESUME:
+            token, last_seq, checksum, request = Protocol.unpack_resume(packet)
+            capabilities = Protocol.unpack_resume_capabilities(packet)
+            with self.sessions_lock:
+                session = next((s for s in self.sessions if s.token == token), None)
+            if session:
+                if not session.detached.is_set():
+                    # 旧连接尚未察觉断开（半开连接），主动关闭并等待其发送线程退出
+                    try:
+                        session.socket.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    session.detached.wait(timeout=2.0)
+                with self.sessions_lock:
+                    self.detached_sessions.pop(token, None)
+                session.attach(client_socket, client_address)
+                with session.cond:
+                    request = session.set_request(request)
+                session_view, view = self._resolve_view(request, session.formats)
+                if session_view != session.view:
+                    with self.screen_lock:
+                        session.set_view(session_view,
+                                         get_format(view.pixel_format).wire_shape(view.width, view.height))
+                    print(f"[服务器] 客户端 {client_address} 恢复会话并切换视图 {view.width}x{view.height} "
+                          f"{PIXEL_FORMAT_NAMES[view.pixel_format]}")
+                    return session, None
+                print(f"[服务器] 客户端 {client_address} 恢复会话 (序号 {last_seq} → {session.seq})")
+                return session, (last_seq, checksum)
+        
+        capabilities = self.negotiate(capabilities)
+        request = restrict_request(request, capabilities)
+        session_view, view = self._resolve_view(request)
+        height, width, channels = get_format(view.pixel_format).wire_shape(view.width, view.height)
+        session = ClientSession(client_socket, client_address, width, height,
+                                self.max_in_flight, self.max_bandwidth, session_view, channels,
+                                self._session_lossy(capabilities), capabilities)
+        session.set_request(request)
+        print(f"[服务器] 客户端 {client_address} {capabilities.describe()}")
+        return session, None
+    
+    def detach_session(self, session):
+        """连接断开：保留会话等待恢复，期间继续累积变化"""
+        session.close()
+        with self.sessions_lock:
+            if session in self.sessions:
+                session.detach_time = time.time()
+                self.detached_sessions[session.token] = session
+            else:
+                # 尚未发出首帧就断开的会话不会被恢复
+                session.metrics.remove()
+        session.detached.set()
+    
+    def expire_sessions(self):
+        """清理超过保留时间仍未恢复的会话"""
+        now = time.time()
+        with self.sessions_lock:
+            for token, session in list(self.detached_sessions.items()):
+                if now - session.detach_time > self.session_keepalive:
+                    del self.detached_sessions[token]
+                    if session in self.sessions:
+                        self.sessions.remove(session)
+                    session.metrics.remove()
+    
+    def send_full_frame(self, session):
+        """发送完整帧，重置客户端参考帧"""
+        # 取当前屏幕快照，同时注册会话，保证之后的变化不会遗漏
+        with self.screen_lock:
+            session.previous_frame[:] = self._session_screen(session)
+            timestamp = now_us()
+            with session.cond:
+                session.pending_rects = []
+                session.deferred_since = 0
+                if session.motion is not None:
+                    session.motion.clear()
+            with self.sessions_lock:
+                if session not in self.sessions:
+                    self.sessions.append(session)
+        
+        session.tiles.reset(session.previous_frame)
+        with session.cond:
+            session.reset_history()
+            session.refresh_tiles.clear()
+            seq = session.next_seq()
+        with TRACER.span('compress', seq, type='frame'):
+            frame_packet = Protocol.pack_frame(session.previous_frame, compress=True,
+                                               seq=seq, timestamp=timestamp)
+        session.send(frame_packet, 'frame', seq)
+        view = self._full_view(session)
+        print(f"[服务器] 已发送首帧 {view.width}x{view.height} {PIXEL_FORMAT_NAMES[view.pixel_format]} "
+              f"({len(frame_packet)/1024:.1f} KB)")
+    
+    def resume_session(self, session, last_seq, checksum):
+        """尝试用历史增量恢复会话
+        
+        从当前参考帧按相反顺序撤销last_seq之后的历史包，重建客户端的帧缓冲并校验；
+        校验通过则把这些包的累计变化合并为一个脏矩形包发送。
+        
+        Returns:
+            是否恢复成功（失败时调用方应发送完整帧）
+        """
+        with session.cond:
+            missed = list(range(last_seq + 1, session.seq + 1))
+            if last_seq > session.seq or any(seq not in session.history for seq in missed):
+                return False
+            
+            # 重建客户端的帧缓冲
+            client_frame = session.previous_frame.copy()
+            rects = []
+            for seq in reversed(missed):
+                packet_rects, xor_data = Protocol.unpack_dirty(session.history[seq])
+                regions.xor_apply(client_frame, packet_rects, xor_data)  # 再次异或即撤销
+                rects.extend(packet_rects)
+            
+            if Protocol.frame_checksum(client_frame) != checksum:
+                print(f"[服务器] 客户端 {session.address} 帧缓冲校验失败，改发完整帧")
+                return False
+            
+            if not missed:
+                return True
             
+            # 累计变化：客户端帧缓冲 → 当前参考帧
+            rects = merge_rects(rects, session.rect_limit)
+            xor_data = regions.xor_encode(session.previous_frame, client_frame, rects)
+            seq = session.next_seq()
+            timestamp = session.pending_timestamp
+            packet = Protocol.pack_dirty(rects, xor_data, compress=True, seq=seq, timestamp=timestamp)
+            session.record_history(seq, packet)
+        
+        session.send(packet, 'dirty', seq)
+        print(f"[服务器] 已发送恢复增量 ({len(missed)} 个包合并, {len(packet)/1024:.1f} KB)")
+        return True
+    
+    def handle_client(self, session, resume=None):
+        """处理客户端连接"""
+        try:
             # 发送初始化信息
-            init_packet = Protocol.pack_init(self.capture.width, self.capture.height)
-            Protocol.send_packet(self.client_socket, init_packet)
+            view = self._full_view(session)
+            capabilities = session.capabilities if session.capabilities.version > LEGACY_VERSION else None
+            init_packet = Protocol.pack_init(view.width, view.height, session.token,
+                                             (self.capture.width, self.capture.height), view, capabilities)
+            Protocol.send_packet(session.socket, init_packet)
             print(f"[服务器] 已发送初始化信息")
             
-            # 发送首帧
-            print("[服务器] 捕获首帧...")
-            with self.capture_lock:
-                self.capture.capture(timeout_ms=1000)  # 跳过黑屏
-                status, frame = self.capture.capture(timeout_ms=1000)
-            
-            if status == FS_OK and frame is not None:
-                frame_bytes = frame.tobytes()
-                frame_packet = Protocol.pack_frame(frame_bytes, compress=True)
-                Protocol.send_packet(self.client_socket, frame_packet)
-                self.stats['send_count'] += 1
-                self.stats['bytes_sent'] += len(frame_packet)
-                print(f"[服务器] 已发送首帧 ({len(frame_packet)/1024:.1f} KB)")
-                
-                # 初始化客户端的previous_frame
-                self.previous_frame[:] = frame
+            if not (resume and self.resume_session(session, *resume)):
+                self.send_full_frame(session)
             
-            # 重置统计
-            self.stats['detect_count'] = 0
-            self.stats['send_count'] = 0
-            self.stats['skip_count'] = 0
-            self.stats['bytes_sent'] = 0
-            self.stats['start_time'] = time.time()
+            # 启动确认接收线程
+            ack_thread = threading.Thread(target=self.ack_loop, args=(session, session.socket), daemon=True,
+                                          name=f"ack {session.address[0]}:{session.address[1]}")
+            ack_thread.start()
             
             # 持续发送帧
-            self.running = True
             print("[服务器] 开始传输屏幕...")
             
-            # 启动统计线程
-            stats_thread = threading.Thread(target=self.print_stats, daemon=True)
-            stats_thread.start()
-            
-            while self.running:
+            while self.running and session.running:
                 try:
-                    with self.capture_lock:
-                        # 直接控制 DXGI API 流程
-                        status = self.capture.dll.dxgi_acquire_frame(self.capture.dxgi, 16)
-                        self.stats['detect_count'] += 1
+                    if session.view_request is not None:
+                        self.change_view(session)
+                        continue
+                    
+                    with session.cond:
+                        # 等待：窗口有空位且有变化/重传，或需要发送校验和/跳帧
+                        while session.running and not session.has_work():
+                            if session.pending_rects and session.window_full():
+                                session.metrics.held.inc()
+                            session.cond.wait(timeout=0.5)
                         
-                        if status == FS_OK:
-                            try:
-                                # 获取脏矩形数量
-                                dirty_count = self.capture.dll.dxgi_get_dirty_rects_count(self.capture.dxgi)
-                                
-                                if dirty_count == 0:
-                                    # 无变化，发送跳帧包
-                                    skip_packet = Protocol.pack_skip()
-                                    Protocol.send_packet(self.client_socket, skip_packet)
-                                    self.stats['skip_count'] += 1
-                                    self.stats['bytes_sent'] += len(skip_packet)
-                                else:
-                                    # 有变化，获取脏矩形坐标
-                                    rects_array = (DirtyRect * dirty_count)()
-                                    self.capture.dll.dxgi_get_dirty_rects(self.capture.dxgi, rects_array, dirty_count)
-                                    
-                                    rects = [
-                                        {
-                                            'left': r.left,
-                                            'top': r.top,
-                                            'right': r.right,
-                                            'bottom': r.bottom
-                                        }
-                                        for r in rects_array
-                                    ]
-                                    
-                                    # 获取脏区域大小并复制数据
-                                    dirty_size = self.capture.dll.dxgi_get_dirty_region_size(self.capture.dxgi)
-                                    
-                                    if dirty_size > 0:
-                                        status_dirty = self.capture.dll.dxgi_copy_dirty_regions(
-                                            self.capture.dxgi, 
-                                            self.capture.dirty_buffer, 
-                                            dirty_size
-                                        )
-                                        
-                                        if status_dirty == FS_OK:
-                                            # XOR优化：对脏区域进行异或操作
-                                            dirty_data = bytes(self.capture.dirty_buffer[:dirty_size])
-                                            dirty_array = np.frombuffer(dirty_data, dtype=np.uint8).copy()
-                                            
-                                            # 处理每个脏矩形区域
-                                            offset = 0
-                                            xor_array = np.zeros_like(dirty_array)
-                                            
-                                            for rect in rects:
-                                                left, top = rect['left'], rect['top']
-                                                width = rect['right'] - rect['left']
-                                                height = rect['bottom'] - rect['top']
-                                                region_size = width * height * 4  # BGRA
-                                                
-                                                if offset + region_size <= len(dirty_array):
-                                                    # 当前脏区域数据
-                                                    current_region = dirty_array[offset:offset+region_size]
-                                                    current_region_2d = current_region.reshape(height, width, 4)
-                                                    
-                                                    # 上一帧对应区域
-                                                    previous_region = self.previous_frame[top:top+height, left:left+width]
-                                                    
-                                                    # XOR操作
-                                                    xor_region = np.bitwise_xor(current_region_2d, previous_region)
-                                                    xor_array[offset:offset+region_size] = xor_region.flatten()
-                                                    
-                                                    # 更新previous_frame
-                                                    self.previous_frame[top:top+height, left:left+width] = current_region_2d
-                                                    
-                                                    offset += region_size
-                                            
-                                            # 统计XOR效果
-                                            self.stats['original_size'] += dirty_size
-                                            
-                                            # 发送XOR后的数据
-                                            xor_data = xor_array.tobytes()
-                                            dirty_packet = Protocol.pack_dirty(rects, xor_data, compress=True)
-                                            
-                                            self.stats['xor_saved'] += (dirty_size - len(dirty_packet))
-                                            
-                                            Protocol.send_packet(self.client_socket, dirty_packet)
-                                            self.stats['send_count'] += 1
-                                            self.stats['bytes_sent'] += len(dirty_packet)
-                                
-                            finally:
-                                # 释放帧
-                                self.capture.dll.dxgi_release_frame(self.capture.dxgi)
+                        if not session.running:
+                            break
+                        session.adapt_format()
+                        if session.view_request is not None:
+                            continue
+                        
+                        timestamp = session.pending_timestamp
+                        refresh = rects = None
+                        lossy = []
+                        if session.refresh_tiles and not session.window_full():
+                            tiles = sorted(session.refresh_tiles)
+                            if session.capabilities.max_rects:
+                                tiles = tiles[:session.capabilities.max_rects]
+                            session.refresh_tiles.difference_update(tiles)
+                            refresh = session.tiles.tile_rects(tiles)
+                            seq = session.next_seq()
+                        elif session.pending_rects and not session.window_full():
+                            rects = session.take_rects()
+                            session.skip_pending = False
+                            seq = session.next_seq()
+                            if session.motion is not None:
+                                lossy, rects = session.motion.split(rects, time.time())
+                        else:
+                            seq = session.seq
                         
-                        # 限制频率 60fps
-                        time.sleep(0.016)
+                        checksum = session.checksum_due() and refresh is None and rects is None
+                        if checksum:
+                            session.last_checksum_time = time.time()
+                            checksum_packet = Protocol.pack_checksum(
+                                seq, session.tiles.tile_size, session.tiles.cols, session.tiles.rows,
+                                session.tiles.compact(), timestamp)
+                        skip = not checksum and refresh is None and rects is None
+                        session.skip_pending = session.skip_pending and not skip
+                    
+                    if refresh is not None:
+                        self.send_refresh(session, refresh, seq, timestamp)
+                    elif rects is not None:
+                        if lossy:
+                            lossy, flat = self.classify_lossy(session, lossy)
+                            rects = rects + flat
+                        rects, lossy = session.limit_rects(rects), session.limit_rects(lossy)
+                        if rects and lossy:
+                            # 有损部分另发一个包（排在无损部分之后），需要窗口再有一个空位；
+                            # 否则本次只发无损部分，有损矩形放回待发送，窗口有空位时再发
+                            with session.cond:
+                                if session.window_full():
+                                    session.defer_rects(lossy)
+                                    lossy_seq = None
+                                else:
+                                    lossy_seq = session.next_seq()
+                            self.send_dirty(session, rects, seq, timestamp)
+                            if lossy_seq is not None:
+                                self.send_lossy(session, lossy, lossy_seq, timestamp)
+                        elif lossy:
+                            self.send_lossy(session, lossy, seq, timestamp)
+                        else:
+                            self.send_dirty(session, rects, seq, timestamp)
+                    elif checksum:
+                        session.send(checksum_packet, 'checksum')
+                    else:
+                        # 无变化，发送跳帧包
+                        skip_packet = Protocol.pack_skip(seq=seq, timestamp=timestamp)
+                        session.send(skip_packet, 'skip')
                     
                 except ConnectionResetError:
                     print("[服务器] 客户端断开连接")
@@ -397,53 +1169,267 @@ class RemoteDesktopServer:
             import traceback
             traceback.print_exc()
         finally:
-            self.running = False
-            if self.client_socket:
-                self.client_socket.close()
+            session.close()
+    
+    def change_view(self, session):
+        """切换到请求的视图：发送生效的视图，随后发送该视图的完整帧（发送线程调用）
+        
+        请求来自客户端（PKT_VIEW），或自动像素格式的选择发生了变化。
+        """
+        with session.cond:
+            request, session.view_request = session.view_request, None
+            request = session.set_request(request)
+        session_view, view = self._resolve_view(request, session.formats)
+        if session_view == session.view:
+            return
+        with self.screen_lock:
+            session.set_view(session_view, get_format(view.pixel_format).wire_shape(view.width, view.height))
+            self._session_screen(session)  # 在screen_lock内创建视图，避免被捕获线程当作无人使用而清理
+        session.send(Protocol.pack_view(view), 'view')
+        print(f"[服务器] 客户端 {session.address} 切换视图 {view.width}x{view.height} "
+              f"{PIXEL_FORMAT_NAMES[view.pixel_format]} 视口 ({view.left}, {view.top})-({view.right}, {view.bottom})")
+        self.send_full_frame(session)
+    
+    def send_dirty(self, session, rects, seq, timestamp):
+        """对脏矩形做XOR编码并发送"""
+        # XOR优化：当前屏幕与客户端参考帧逐矩形异或，同时更新参考帧
+        region_plan = regions.plan(rects, session.width, session.height)
+        with self.screen_lock, session.metrics.xor.time(), TRACER.span('xor', seq, rects=len(rects)):
+            xor_data = region_plan.xor_encode(self._session_screen(session), session.previous_frame,
+                                              session.scratch.get(region_plan.nbytes()))
+            dirty_size = xor_data.nbytes
+        
+        # 发送XOR后的数据
+        level = session.compress_level()
+        with session.metrics.compress.time(), TRACER.span('compress', seq, level=level, size=dirty_size):
+            dirty_packet = Protocol.pack_dirty(rects, xor_data, compress=True, seq=seq, timestamp=timestamp,
+                                               level=level, out=session.packet_scratch)
+        
+        # 统计XOR效果
+        session.metrics.xor_input.inc(dirty_size)
+        session.metrics.xor_output.inc(len(dirty_packet))
+        
+        session.tiles.update(session.previous_frame, rects)
+        with session.cond:
+            session.record_history(seq, dirty_packet)
+            session.compress_ratio = session.compress_ratio * 0.8 + len(dirty_packet) / max(1, dirty_size) * 0.2
+        session.send(dirty_packet, 'dirty', seq)
+    
+    def classify_lossy(self, session, rects):
+        """高运动矩形中照片类内容按有损发送，其余（如滚动的文字）仍按XOR发送
+        
+        Returns:
+            (有损矩形, 无损矩形)
+        """
+        with self.screen_lock:
+            screen = self._session_screen(session)
+            photo = [is_photographic(screen[r['top']:r['bottom'], r['left']:r['right']]) for r in rects]
+        lossy = [r for r, p in zip(rects, photo) if p]
+        return lossy, [r for r, p in zip(rects, photo) if not p]
+    
+    def send_lossy(self, session, rects, seq, timestamp):
+        """把高运动区域编码为有损图像发送，参考帧写入解码结果（与客户端一致）"""
+        with self.screen_lock:
+            screen = self._session_screen(session)
+            pixels = [screen[r['top']:r['bottom'], r['left']:r['right'], :3].copy() for r in rects]
+        
+        encoder = session.lossy
+        with session.metrics.lossy.time(), TRACER.span('lossy', seq, rects=len(rects), codec=encoder.name):
+            images = [encoder.encode(region) for region in pixels]
+            for r, image in zip(rects, images):
+                decode_into(image, session.previous_frame[r['top']:r['bottom'], r['left']:r['right']])
+        packet = Protocol.pack_lossy(rects, images, encoder.codec, seq=seq, timestamp=timestamp)
+        
+        session.metrics.xor_input.inc(sum(region.nbytes for region in pixels) // 3 * 4)
+        session.metrics.xor_output.inc(len(packet))
+        session.tiles.update(session.previous_frame, rects)
+        with session.cond:
+            session.motion.mark(rects)
+            # 有损包覆盖像素，无法撤销，断线恢复时不能跨越它
+            session.reset_history()
+        session.send(packet, 'lossy', seq)
+    
+    def send_refresh(self, session, rects, seq, timestamp):
+        """按原始像素重传客户端报告不一致的块"""
+        region_plan = regions.plan(rects, session.width, session.height)
+        pixel_data = region_plan.gather(session.previous_frame, session.scratch.get(region_plan.nbytes()))
+        with TRACER.span('compress', seq, type='refresh'):
+            packet = Protocol.pack_refresh(rects, pixel_data, compress=True, seq=seq, timestamp=timestamp,
+                                           level=session.compress_level(), out=session.packet_scratch)
+        with session.cond:
+            # 原始像素包无法撤销，断线恢复时不能跨越它
+            session.reset_history()
+        session.send(packet, 'refresh', seq)
+        print(f"[服务器] 客户端 {session.address} 重传 {len(rects)} 个块 ({len(packet)/1024:.1f} KB)")
+    
+    def ack_loop(self, session, client_socket):
+        """接收客户端确认包"""
+        try:
+            while session.running:
+                packet = Protocol.recv_packet(client_socket)
+                if not packet:
+                    break
+                
+                pkt_type = Protocol.get_packet_type(packet)
+                if pkt_type == PKT_ACK:
+                    seq, timestamp = Protocol.unpack_ack(packet)
+                    session.on_ack(seq, timestamp)
+                elif pkt_type == PKT_RESYNC:
+                    _, tiles = Protocol.unpack_resync(packet)
+                    session.request_refresh(tiles)
+                elif pkt_type == PKT_VIEW:
+                    session.request_view(Protocol.unpack_view(packet))
+                elif pkt_type == PKT_HEARTBEAT:
+                    # 回传心跳：填入服务器时间戳，客户端据此计算RTT和时钟偏差
+                    client_timestamp, _ = Protocol.unpack_heartbeat(packet)
+                    session.send_control(Protocol.pack_heartbeat(now_us(), client_timestamp))
+        except OSError:
+            pass
+        finally:
+            # 会话可能已在新连接上恢复，只关闭属于本连接的会话
+            if session.socket is client_socket:
+                session.close()
     
     def print_stats(self):
-        """打印统计信息"""
+        """每秒打印一次统计（由指标计数器的增量计算）"""
         print("[统计] 统计线程已启动")
-        last_detect = 0
-        last_send = 0
-        last_skip = 0
-        last_bytes = 0
-        last_xor_saved = 0
-        last_original = 0
+        last = {}
+        
+        def delta(counter):
+            value = counter.value
+            previous = last.get(counter, 0)
+            last[counter] = value
+            return value - previous
+        
+        def p50_ms(histogram):
+            value = histogram.percentile(0.5)
+            return f"{value * 1000:.1f}ms" if value is not None else "-"
         
         while self.running:
             time.sleep(1)
             
-            # 计算增量
-            detect_delta = self.stats['detect_count'] - last_detect
-            send_delta = self.stats['send_count'] - last_send
-            skip_delta = self.stats['skip_count'] - last_skip
-            bytes_delta = self.stats['bytes_sent'] - last_bytes
-            xor_saved_delta = self.stats['xor_saved'] - last_xor_saved
-            original_delta = self.stats['original_size'] - last_original
-            
-            last_detect = self.stats['detect_count']
-            last_send = self.stats['send_count']
-            last_skip = self.stats['skip_count']
-            last_bytes = self.stats['bytes_sent']
-            last_xor_saved = self.stats['xor_saved']
-            last_original = self.stats['original_size']
-            
-            total = detect_delta
-            bandwidth = bytes_delta / 1024  # KB/s
-            skip_percent = (skip_delta / max(1, total)) * 100
+            detect_delta = sum(delta(CAPTURES.labels(result=r)) for r in ('dirty', 'idle', 'timeout', 'error'))
+            print(f"[统计] 检测: {detect_delta}fps | 捕获耗时 p50 {p50_ms(CAPTURE_SECONDS)}")
+            if self.datagram is not None:
+                print(f"[统计] UDP: 连接 {len(self.datagram.links)} | FEC恢复 {delta(RECOVERED):.0f} | "
+                      f"重传 {delta(RETRANSMITTED):.0f} | 放弃 {delta(ABANDONED):.0f}")
             
-            # 计算XOR压缩率
-            if original_delta > 0:
-                compression_ratio = (xor_saved_delta / original_delta) * 100
-                print(f"[统计] 检测: {detect_delta}fps | 发送: {send_delta}fps | "
-                      f"带宽: {bandwidth:.2f}KB/s | 跳帧: {skip_percent:.1f}% | "
-                      f"XOR压缩: {compression_ratio:.1f}%")
-            else:
-                print(f"[统计] 检测: {detect_delta}fps | 发送: {send_delta}fps | "
-                      f"带宽: {bandwidth:.2f}KB/s | 跳帧: {skip_percent:.1f}%")
+            # 每个客户端的发送、确认窗口与速率控制状态
+            with self.sessions_lock:
+                sessions = [s for s in self.sessions if s not in self.detached_sessions.values()]
+            for session in sessions:
+                metrics = session.metrics
+                send_delta = sum(delta(UPDATES_SENT.labels(client=metrics.client, type=kind))
+                                 for kind in ('frame', 'dirty', 'refresh', 'lossy'))
+                skip_delta = delta(UPDATES_SENT.labels(client=metrics.client, type='skip'))
+                skip_percent = skip_delta / max(1, detect_delta) * 100
+                bandwidth = delta(metrics.bytes_sent) / 1024  # KB/s
+                original_delta = delta(metrics.xor_input)
+                output_delta = delta(metrics.xor_output)
+                
+                text = (f"[统计]   {session.address}: 发送: {send_delta}fps | 带宽: {bandwidth:.2f}KB/s | "
+                        f"跳帧: {skip_percent:.1f}%")
+                if original_delta > 0:
+                    text += f" | XOR压缩: {(1 - output_delta / original_delta) * 100:.1f}%"
+                print(text)
+                
+                pacing = session.pacer.rate
+                pacing_text = f"{pacing/1024:.0f}KB/s" if pacing else "不限"
+                print(f"[统计]   {session.address}: 序号 {session.seq} | 已确认 {session.acked_seq} | "
+                      f"在途 {len(session.in_flight)}/{session.max_in_flight} | "
+                      f"暂缓 {metrics.held.value} | 推迟 {metrics.deferred.value} | "
+                      f"确认延迟 p50 {p50_ms(metrics.ack_latency)} | "
+                      f"重传块 {metrics.resync_tiles.value}")
+                print(f"[统计]   {session.address}: 估计带宽 {session.estimator.rate/1024:.0f}KB/s | "
+                      f"发送速率 {session.estimator.send_rate/1024:.0f}KB/s | 限速 {pacing_text} | "
+                      f"压缩等级 {session.compressor.level} | "
+                      f"像素格式 {PIXEL_FORMAT_NAMES[session.view.pixel_format if session.view else PF_BGRA]} | "
+                      f"XOR {p50_ms(metrics.xor)} / 压缩 {p50_ms(metrics.compress)} / 发送 {p50_ms(metrics.send)}")
 
 
 if __name__ == "__main__":
-    server = RemoteDesktopServer(host='0.0.0.0', port=9999)
-    server.start()
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="远程桌面被控端服务器")
+    parser.add_argument('--host', default='0.0.0.0', help="监听地址")
+    parser.add_argument('--port', type=int, default=9999, help="监听端口")
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="每个客户端允许的最大未确认更新数")
+    parser.add_argument('--max-bandwidth', type=float, default=None,
+                        help="每个客户端的带宽硬上限（MB/s），默认不限")
+    parser.add_argument('--latency-marker', action='store_true',
+                        help="测试模式：在画面左上角写入帧计数/时间戳标记，用于验证端到端延迟")
+    parser.add_argument('--metrics-port', type=int, default=DEFAULT_METRICS_PORT,
+                        help="Prometheus指标端口（/metrics、/trace，如9101），默认0表示不启动")
+    parser.add_argument('--source', default='dxgi', choices=['dxgi'] + list(SYNTHETIC_SOURCES),
+                        help="捕获源：dxgi 或合成场景（无需DXGI，可在Linux上无界面运行）")
+    parser.add_argument('--size', default='1920x1080', help="合成场景的分辨率（宽x高）")
+    parser.add_argument('--fps', type=float, default=30.0, help="合成场景的帧率")
+    parser.add_argument('--block-diff', action='store_true',
+                        help="不使用捕获源的脏矩形信息，逐帧分块比较生成脏矩形（DXGI使用整帧接口dxgi_get_frame）")
+    parser.add_argument('--shared-memory', metavar='NAME', nargs='?', const=DEFAULT_SHARED_NAME, default=None,
+                        help=f"把屏幕放在共享内存中供本机观看端直接读取（web_server.py --shared-memory），"
+                             f"默认名称 {DEFAULT_SHARED_NAME}")
+    parser.add_argument('--lossy-quality', type=int, default=0,
+                        help="高运动区域（如视频）以有损图像发送的质量（1~100），静止后无损修正；0表示不启用")
+    parser.add_argument('--lossy-codec', default='jpeg', choices=list(LOSSY_CODEC_NAMES.values()),
+                        help="有损区域的图像编码")
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                        help="启用逐帧追踪，退出时写入Chrome trace JSON（运行中也可从指标端口的 /trace 获取）")
+    parser.add_argument('--record', metavar='FILE', default=None,
+                        help="把捕获源的输出录制到文件（可用 --replay 重放）")
+    parser.add_argument('--replay', metavar='FILE', default=None,
+                        help="以录制文件代替 --source 作为捕获源")
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help="回放倍速，0表示尽快回放")
+    parser.add_argument('--stream', action='append', default=[], metavar='SOURCE|HOST:PORT',
+                        help="多路复用连接的其他流（可重复）：合成场景（与 --size/--fps 相同）或上游服务器（中继），"
+                             "本服务器的画面为流0")
+    parser.add_argument('--udp', action='store_true',
+                        help="同一端口号上另外接受UDP连接（分片+FEC+按需重传，适合有随机丢包的链路，client.py --udp）")
+    parser.add_argument('--fec-group', type=int, default=FEC_GROUP,
+                        help="UDP传输每组分片数（每组一个奇偶校验分片），0表示不用FEC")
+    parser.add_argument('--udp-loss', type=float, default=0.0, help="测试：UDP发出的数据报的模拟丢包率")
+    parser.add_argument('--udp-reorder', type=float, default=0.0, help="测试：UDP发出的数据报的模拟乱序概率")
+    args = parser.parse_args()
+    
+    max_bandwidth = int(args.max_bandwidth * 1024 * 1024) if args.max_bandwidth else None
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    if args.replay:
+        capture_source = RecordingReader(args.replay).source(speed=args.replay_speed or None)
+        if args.block_diff:
+            capture_source = BlockDiffSource(capture_source)
+    else:
+        capture_source = create_source(args.source, width, height, fps=args.fps, block_diff=args.block_diff)
+    if args.record:
+        capture_source = RecordingSource(capture_source, args.record)
+    lossy = None
+    if args.lossy_quality:
+        codecs = {name: code for code, name in LOSSY_CODEC_NAMES.items()}
+        lossy = LossyEncoder(codecs[args.lossy_codec], args.lossy_quality)
+    # 其他流：合成场景在本进程中各由一个不监听端口的服务器捕获，host:port 转接到上游服务器
+    stream_servers, streams = [], []
+    for spec in args.stream:
+        if spec in SYNTHETIC_SOURCES:
+            stream_server = RemoteDesktopServer(max_in_flight=args.max_in_flight, max_bandwidth=max_bandwidth,
+                                                metrics_port=0, lossy=lossy,
+                                                capture_source=create_source(spec, width, height, fps=args.fps))
+            stream_server.start_capture(stats=False)
+            stream_servers.append(stream_server)
+            streams.append((stream_server.stream_name, stream_server.open_stream))
+        else:
+            upstream_host, upstream_port = spec.rsplit(':', 1)
+            streams.append((spec, lambda address, h=upstream_host, p=int(upstream_port): connect_upstream(h, p)))
+    server = RemoteDesktopServer(host=args.host, port=args.port,
+                                 max_in_flight=args.max_in_flight, max_bandwidth=max_bandwidth,
+                                 latency_marker=args.latency_marker, metrics_port=args.metrics_port,
+                                 trace_path=args.trace, capture_source=capture_source,
+                                 shared_memory=args.shared_memory, lossy=lossy, streams=streams,
+                                 udp=args.udp, fec_group=args.fec_group,
+                                 udp_simulator=NetworkSimulator(args.udp_loss, reorder=args.udp_reorder)
+                                 if args.udp_loss or args.udp_reorder else None)
+    try:
+        server.start()
+    finally:
+        for stream_server in stream_servers:
+            stream_server.stop_capture()
@@ -0,0 +1,305 @@
+"""
+远程桌面 - 共享内存帧缓冲
+服务器把最新屏幕（screen）直接放在 multiprocessing.shared_memory 段中，并在其后附一个脏矩形变更日志，
+同一台机器上的观看端（web_server、录制、分析工具）直接映射该段读取像素，
+不需要再建一条TCP连接、解压和XOR恢复。
+
+段布局（小端）：
+    头部 64字节    uint64 × 8: 魔数/版本, 宽, 高, 序列号, 时间戳(us), 日志总条数, 日志容量, 已关闭
+    变更日志       日志容量 × uint64[5]: (代数, left, top, right, bottom)，环形覆盖
+    像素           高 × 宽 × 4 (BGRA)，起始位置按页对齐
+
+同步方式为seqlock：写入方开始写时序列号加一（变为奇数），写完像素和日志后再加一（变为偶数）；
+读取方在偶数序列号下读取，读完后序列号未变才说明读到的是一致的内容，否则重试。
+代数 = 序列号 // 2，即已提交的更新次数。
+
+用法:
+    python sharedframe.py [名称]          # 附加到服务器（--shared-memory）的帧缓冲，每秒打印更新统计
+"""
+
+import time
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 默认段名称
+DEFAULT_NAME = 'rd_framebuffer'
+# 魔数 'RDFB' + 版本号
+MAGIC = (0x52444642 << 32) | 1
+# 变更日志容量（矩形数）；读取方落后超过此数量时只能当作整帧变化
+LOG_CAPACITY = 1024
+
+HEADER_BYTES = 64
+LOG_ENTRY_WORDS = 5
+PAGE = 4096
+
+# 头部字段（uint64下标）
+H_MAGIC, H_WIDTH, H_HEIGHT, H_SEQUENCE, H_TIMESTAMP, H_LOG_COUNT, H_LOG_CAPACITY, H_CLOSED = range(8)
+
+# 读取方等待更新时的轮询间隔（秒）
+POLL_INTERVAL = 0.002
+
+
+def _layout(width: int, height: int, log_capacity: int) -> Tuple[int, int]:
+    """返回 (像素起始偏移, 段总字节数)"""
+    log_end = HEADER_BYTES + log_capacity * LOG_ENTRY_WORDS * 8
+    pixels = (log_end + PAGE - 1) // PAGE * PAGE
+    return pixels, pixels + width * height * 4
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """附加到已有的段，不向resource_tracker登记（否则读取方退出时会删除服务器的段）"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        segment = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(segment._name, 'shared_memory')
+        except Exception:
+            pass
+        return segment
+
+
+class _Segment:
+    """头部、变更日志、像素三个视图"""
+
+    def __init__(self, segment: shared_memory.SharedMemory, width: int, height: int, log_capacity: int):
+        self.segment = segment
+        buf = segment.buf
+        self.header = np.ndarray((8,), dtype='<u8', buffer=buf)
+        self.log = np.ndarray((log_capacity, LOG_ENTRY_WORDS), dtype='<u8', buffer=buf, offset=HEADER_BYTES)
+        offset, _ = _layout(width, height, log_capacity)
+        self.frame = np.ndarray((height, width, 4), dtype=np.uint8, buffer=buf, offset=offset)
+        self.width = width
+        self.height = height
+        self.log_capacity = log_capacity
+
+    def release(self) -> None:
+        # 视图引用着段的缓冲区，须先释放才能关闭
+        self.header = self.log = self.frame = None
+        try:
+            self.segment.close()
+        except BufferError:
+            pass  # 外部仍持有frame的视图（如服务器的screen），映射在视图释放后解除
+
+
+class FramePublisher(_Segment):
+    """写入方（服务器），frame即服务器的screen
+
+    修改frame的代码须在 begin() 与 commit() 之间进行，commit 把本次修改的矩形写入变更日志。
+    """
+
+    def __init__(self, width: int, height: int, name: str = DEFAULT_NAME, log_capacity: int = LOG_CAPACITY):
+        _, size = _layout(width, height, log_capacity)
+        try:
+            segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # 上次异常退出残留的段
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        super().__init__(segment, width, height, log_capacity)
+        self.name = name
+        header = self.header
+        header[:] = 0
+        header[H_WIDTH], header[H_HEIGHT], header[H_LOG_CAPACITY] = width, height, log_capacity
+        header[H_MAGIC] = MAGIC  # 最后写入魔数，读取方见到魔数时其余字段已就绪
+
+    @property
+    def generation(self) -> int:
+        return int(self.header[H_SEQUENCE]) >> 1
+
+    def begin(self) -> None:
+        """开始修改frame（序列号变为奇数，读取方将等待或重试）"""
+        self.header[H_SEQUENCE] += 1
+
+    def commit(self, rects: Optional[List[Dict]], timestamp: int = 0) -> int:
+        """结束修改并记录变更
+
+        Args:
+            rects: 本次修改的矩形，None表示整帧
+            timestamp: 对应的捕获时间戳（微秒）
+
+        Returns:
+            新的代数
+        """
+        header = self.header
+        generation = (int(header[H_SEQUENCE]) >> 1) + 1
+        if rects is None or len(rects) > self.log_capacity:
+            rects = [{'left': 0, 'top': 0, 'right': self.width, 'bottom': self.height}]
+        count = int(header[H_LOG_COUNT])
+        for rect in rects:
+            self.log[count % self.log_capacity] = (generation, rect['left'], rect['top'],
+                                                  rect['right'], rect['bottom'])
+            count += 1
+        header[H_LOG_COUNT] = count
+        header[H_TIMESTAMP] = timestamp
+        header[H_SEQUENCE] += 1
+        return generation
+
+    def publish(self, frame: np.ndarray, timestamp: int = 0) -> int:
+        """整帧写入"""
+        self.begin()
+        try:
+            self.frame[:] = frame
+        finally:
+            generation = self.commit(None, timestamp)
+        return generation
+
+    def close(self) -> None:
+        """标记已关闭并删除段（已附加的读取方仍可读到最后的内容）"""
+        if self.header is None:
+            return
+        self.header[H_CLOSED] = 1
+        self.release()
+        try:
+            self.segment.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class FrameSubscriber(_Segment):
+    """读取方，frame为只读视图（不复制）
+
+    直接读取frame时可能与写入交错；需要一致的内容时用 read()，或自行以 read_begin()/read_retry() 包裹。
+    """
+
+    def __init__(self, name: str = DEFAULT_NAME, timeout: float = 5.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                segment = _attach(name)
+                break
+            except FileNotFoundError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.1)
+        header = np.ndarray((8,), dtype='<u8', buffer=segment.buf)
+        while int(header[H_MAGIC]) != MAGIC:
+            if time.monotonic() >= deadline:
+                del header
+                segment.close()
+                raise ValueError(f"共享内存段 {name} 不是帧缓冲或版本不符")
+            time.sleep(0.01)
+        width, height, log_capacity = (int(v) for v in header[[H_WIDTH, H_HEIGHT, H_LOG_CAPACITY]])
+        del header
+        super().__init__(segment, width, height, log_capacity)
+        self.name = name
+        self.frame.flags.writeable = False
+
+    @property
+    def closed(self) -> bool:
+        return self.header is None or bool(self.header[H_CLOSED])
+
+    @property
+    def generation(self) -> int:
+        return int(self.header[H_SEQUENCE]) >> 1
+
+    @property
+    def timestamp(self) -> int:
+        """最近一次提交的捕获时间戳（微秒）"""
+        return int(self.header[H_TIMESTAMP])
+
+    def read_begin(self) -> int:
+        """等待写入方不在写入中，返回当前序列号"""
+        while True:
+            sequence = int(self.header[H_SEQUENCE])
+            if not sequence & 1:
+                return sequence
+            time.sleep(0)
+
+    def read_retry(self, sequence: int) -> bool:
+        """read_begin之后的读取期间是否发生过写入（为True时须重读）"""
+        return int(self.header[H_SEQUENCE]) != sequence
+
+    def read(self, reader: Callable[[np.ndarray], object]) -> Tuple[int, object]:
+        """以一致的内容调用 reader(frame)（被写入打断时重试）
+
+        Returns:
+            (代数, reader的返回值)
+        """
+        while True:
+            sequence = self.read_begin()
+            result = reader(self.frame)
+            if not self.read_retry(sequence):
+                return sequence >> 1, result
+
+    def wait(self, generation: int, timeout: Optional[float] = None) -> int:
+        """等待代数超过generation（或段已关闭、超时），返回当前代数"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            current = self.generation
+            if current > generation or self.closed:
+                return current
+            if deadline is not None and time.monotonic() >= deadline:
+                return current
+            time.sleep(POLL_INTERVAL)
+
+    def changes_since(self, generation: int) -> Tuple[int, Optional[List[Dict]]]:
+        """generation之后（不含）各次提交修改的矩形
+
+        Returns:
+            (当前代数, 矩形列表)；日志已被覆盖（落后太多）时矩形为None，应视为整帧变化
+        """
+        while True:
+            sequence = self.read_begin()
+            current = sequence >> 1
+            count = int(self.header[H_LOG_COUNT])
+            oldest = max(0, count - self.log_capacity)
+            index = count
+            while index > oldest and int(self.log[(index - 1) % self.log_capacity, 0]) > generation:
+                index -= 1
+            if index == oldest and oldest > 0 and current > generation:
+                entries = None  # 更早的条目已被覆盖，无法确定是否还有更多变化
+            else:
+                entries = [self.log[i % self.log_capacity, 1:].tolist() for i in range(index, count)]
+            if self.read_retry(sequence):
+                continue
+            if entries is None:
+                return current, None
+            return current, [{'left': l, 'top': t, 'right': r, 'bottom': b} for l, t, r, b in entries]
+
+    def close(self) -> None:
+        if self.header is not None:
+            self.release()
+
+
+def _monitor(name: str):
+    """附加到帧缓冲，每秒打印更新次数、脏矩形数和脏区域占比"""
+    subscriber = FrameSubscriber(name)
+    print(f"[共享] 已附加 {name}: {subscriber.width}x{subscriber.height}，代数 {subscriber.generation}")
+    generation = subscriber.generation
+    updates = rect_count = area = 0
+    last_report = time.monotonic()
+    try:
+        while not subscriber.closed:
+            current = subscriber.wait(generation, timeout=1.0)
+            if current > generation:
+                current, rects = subscriber.changes_since(generation)
+                if rects is None:
+                    rects = [{'left': 0, 'top': 0, 'right': subscriber.width, 'bottom': subscriber.height}]
+                updates += current - generation
+                rect_count += len(rects)
+                area += sum((r['right'] - r['left']) * (r['bottom'] - r['top']) for r in rects)
+                generation = current
+            now = time.monotonic()
+            if now - last_report >= 1.0:
+                elapsed = now - last_report
+                coverage = area / (subscriber.width * subscriber.height) / max(1, updates) * 100
+                print(f"[共享] 更新 {updates / elapsed:.1f}/s | 矩形 {rect_count / elapsed:.1f}/s | "
+                      f"每次更新脏区域 {coverage:.1f}%")
+                updates = rect_count = area = 0
+                last_report = now
+        print("[共享] 服务器已关闭帧缓冲")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+
+
+if __name__ == "__main__":
+    import sys
+    _monitor(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_NAME)
@@ -0,0 +1,104 @@
+"""
+远程桌面 - 逐帧追踪
+按流水线阶段记录时间区间（span），以帧序号标记，保存在固定容量的环形缓冲中，
+导出为Chrome/Perfetto可加载的trace-event JSON（chrome://tracing 或 ui.perfetto.dev）。
+时间戳取系统时钟（微秒），同一台机器上各进程导出的文件可以合并查看。
+默认关闭；关闭时span()返回空上下文，开销可忽略。
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+# 环形缓冲默认容量（事件数）
+DEFAULT_CAPACITY = 65536
+
+_NULL_SPAN = nullcontext()
+
+
+class Tracer:
+    """逐帧追踪器（线程安全，deque.append为原子操作）"""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, process_name: str = ''):
+        self.enabled = False
+        self.process_name = process_name or os.path.basename(sys.argv[0] or 'python')
+        self.pid = os.getpid()
+        self.events = deque(maxlen=capacity)  # (name, ts_us, dur_us, tid, args)
+        self.thread_names: Dict[int, str] = {}
+
+    def enable(self, capacity: Optional[int] = None, process_name: Optional[str] = None) -> None:
+        if capacity and capacity != self.events.maxlen:
+            self.events = deque(self.events, maxlen=capacity)
+        if process_name:
+            self.process_name = process_name
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def span(self, name: str, seq: Optional[int] = None, **args):
+        """记录with块耗时的上下文管理器，seq为帧序号"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, seq, args)
+
+    @contextmanager
+    def _span(self, name: str, seq: Optional[int], args: Dict):
+        start = time.time_ns()
+        try:
+            yield
+        finally:
+            end = time.time_ns()
+            self.record(name, start // 1000, (end - start) // 1000, seq, **args)
+
+    def record(self, name: str, ts_us: int, dur_us: int, seq: Optional[int] = None, **args) -> None:
+        """记录一个已完成的区间（用于跨越多个调用的阶段，如等待令牌桶）"""
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self.thread_names:
+            self.thread_names[tid] = thread.name
+        if seq is not None:
+            args['seq'] = seq
+        self.events.append((name, ts_us, dur_us, tid, args))
+
+    def clear(self) -> None:
+        self.events.clear()
+
+    def trace_events(self):
+        """转换为trace-event列表（"X"完整事件 + 进程/线程名元数据）"""
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': 0,
+                   'args': {'name': self.process_name}}]
+        for tid, name in list(self.thread_names.items()):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                           'args': {'name': name}})
+        for name, ts, dur, tid, args in list(self.events):
+            event = {'name': name, 'cat': 'frame', 'ph': 'X', 'ts': ts, 'dur': dur,
+                     'pid': self.pid, 'tid': tid}
+            if args:
+                event['args'] = args
+            events.append(event)
+        return events
+
+    def to_json(self) -> str:
+        return json.dumps({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'})
+
+    def export(self, path: str) -> int:
+        """写入trace文件
+
+        Returns:
+            写入的事件数
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_json())
+        return len(self.events)
+
+
+# 默认追踪器
+TRACER = Tracer()
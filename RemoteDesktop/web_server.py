@@ -2,7 +2,8 @@
 远程桌面Web服务器 - 通过浏览器查看屏幕
 支持局域网手机/平板访问
 使用MJPEG流，无需额外插件
-连接到RemoteDesktop服务器，使用XOR优化的低带宽传输
+连接到RemoteDesktop服务器，使用XOR优化的低带宽传输；
+与服务器在同一台机器时可用 --shared-memory 直接读取服务器的共享内存帧缓冲（不经TCP，无需解压和XOR恢复）
 """
 
 import sys
@@ -17,15 +18,46 @@ import socket as sock
 import threading
 
 # 导入协议
-from protocol import Protocol, PKT_FRAME, PKT_DIRTY, PKT_SKIP
+from protocol import (Protocol, PKT_INIT, PKT_FRAME, PKT_DIRTY, PKT_SKIP, PKT_CHECKSUM, PKT_REFRESH,
+                      PKT_HEARTBEAT, PKT_VIEW, PKT_LOSSY, PACKET_NAMES, PF_BGRA, PIXEL_FORMAT_NAMES,
+                      LOSSY_CODEC_NAMES, Capabilities, View, bitmask, now_us)
+from checksum import TileChecksums
+import regions
+from pixelformat import PIXEL_FORMATS, get_format
+from lossy import decode_into
+from buffers import ScratchBuffer
+from latency import LatencyTracker, HEARTBEAT_INTERVAL
+from metrics import REGISTRY, ViewerMetrics, CONTENT_TYPE
+from tracing import TRACER
+from sharedframe import FrameSubscriber, DEFAULT_NAME as DEFAULT_SHARED_NAME
+from multiplex import MuxConnection
 
 app = Flask(__name__)
 
+# 观看端的能力（握手时发给服务器）：能处理的数据包类型、全部像素格式与有损编码
+WEB_CAPABILITIES = Capabilities(
+    packet_types=bitmask((PKT_INIT, PKT_FRAME, PKT_DIRTY, PKT_SKIP, PKT_HEARTBEAT, PKT_CHECKSUM, PKT_REFRESH,
+                          PKT_VIEW, PKT_LOSSY)),
+    pixel_formats=bitmask(PIXEL_FORMATS), lossy_codecs=bitmask(LOSSY_CODEC_NAMES))
+
 # 全局状态
 tcp_socket = None
-frame_buffer = None
+mux = None  # --stream 时的多路复用连接（MuxConnection）
+frame_buffer = None  # 传输帧（像素格式不是BGRA时由bgr_frame解码得到画面）
+view = None  # 请求的视图（--pixel-format），None表示整个屏幕的原始分辨率BGRA
+pixel_format = PF_BGRA
+shared = None  # 共享内存模式下的FrameSubscriber（frame_buffer为其只读视图）
+tiles = None  # 帧缓冲分块校验和
+receive_buffer = ScratchBuffer()  # 接收包体（每个包复用）
+decode_buffer = ScratchBuffer()  # 解压后的负载（应用到帧缓冲后即可复用）
+bgr_frame = None  # 编码JPEG用的BGR连续副本（复用）
+last_seq = 0
 current_jpeg = None
+current_jpeg_times = (0, 0)  # 当前JPEG对应更新的 (capture_us, decode_us)
 jpeg_lock = threading.Lock()
+latency = LatencyTracker(REGISTRY, 'web')
+metrics = ViewerMetrics('web')
+latency_marker = False  # 测试模式：从画面读出服务器写入的帧标记
 width = 0
 height = 0
 running = False
@@ -106,32 +138,53 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
-def connect_to_server(server_host='127.0.0.1', server_port=9999):
-    """连接到RemoteDesktop服务器"""
-    global tcp_socket, frame_buffer, width, height
+def allocate(output_width, output_height, output_format=PF_BGRA):
+    """按输出尺寸和像素格式创建帧缓冲与BGR画面，内容由随后的完整帧填充"""
+    global frame_buffer, tiles, bgr_frame, width, height, pixel_format
+    
+    width, height, pixel_format = output_width, output_height, output_format
+    frame_buffer = get_format(pixel_format).allocate(width, height)
+    bgr_frame = np.zeros((height, width, 3), dtype=np.uint8)
+    tiles = TileChecksums(frame_buffer.shape[1], frame_buffer.shape[0])
+
+def connect_to_server(server_host='127.0.0.1', server_port=9999, stream=None):
+    """连接到RemoteDesktop服务器；stream不为None时经多路复用连接接收该流（见multiplex.py）"""
+    global tcp_socket, current_jpeg, mux
     
     try:
         print(f"[Web] 连接到服务器 {server_host}:{server_port}...", flush=True)
-        tcp_socket = sock.socket(sock.AF_INET, sock.SOCK_STREAM)
-        tcp_socket.setsockopt(sock.IPPROTO_TCP, sock.TCP_NODELAY, 1)
-        tcp_socket.setsockopt(sock.SOL_SOCKET, sock.SO_RCVBUF, 1048576)
-        tcp_socket.connect((server_host, server_port))
+        if stream is not None:
+            mux = MuxConnection(server_host, server_port)
+            names = mux.connect()
+            tcp_socket = mux.open_stream(stream)
+            print(f"[Web] 多路复用连接: 流 {stream} ({names[stream]})", flush=True)
+        else:
+            tcp_socket = sock.socket(sock.AF_INET, sock.SOCK_STREAM)
+            tcp_socket.setsockopt(sock.IPPROTO_TCP, sock.TCP_NODELAY, 1)
+            tcp_socket.setsockopt(sock.SOL_SOCKET, sock.SO_RCVBUF, 1048576)
+            tcp_socket.connect((server_host, server_port))
         print(f"[Web] 已连接", flush=True)
         
+        # 新会话（空令牌）
+        Protocol.send_packet(tcp_socket, Protocol.pack_resume(view=view, capabilities=WEB_CAPABILITIES))
+        
         # 接收初始化信息
         init_packet = Protocol.recv_packet(tcp_socket)
         if not init_packet:
             raise Exception("未收到初始化数据")
         
-        width, height = Protocol.unpack_init(init_packet)
-        print(f"[Web] 屏幕尺寸: {width}x{height}", flush=True)
+        output_width, output_height, _ = Protocol.unpack_init(init_packet)
+        screen = Protocol.unpack_init_view(init_packet)
+        output_format = screen[2].pixel_format if screen else PF_BGRA
+        print(f"[Web] 屏幕尺寸: {output_width}x{output_height} {PIXEL_FORMAT_NAMES.get(output_format)}", flush=True)
+        capabilities = Protocol.unpack_init_capabilities(init_packet)
+        print(f"[Web] {capabilities.describe() if capabilities else '服务器未回复能力（旧版本协议）'}", flush=True)
         
-        # 创建帧缓冲（BGRA格式）
-        frame_buffer = np.zeros((height, width, 4), dtype=np.uint8)
+        # 创建帧缓冲
+        allocate(output_width, output_height, output_format)
         
         # 初始化current_jpeg为空图像
-        bgr = frame_buffer[:, :, :3]
-        ret, buffer = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        ret, buffer = cv2.imencode('.jpg', bgr_frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
         if ret:
             with jpeg_lock:
                 current_jpeg = buffer.tobytes()
@@ -142,68 +195,207 @@ def connect_to_server(server_host='127.0.0.1', server_port=9999):
         print(f"[Web] 连接失败: {e}", flush=True)
         return False
 
+def update_jpeg(seq, capture_us, receive_us, rects=None):
+    """帧缓冲编码为JPEG供MJPEG流使用，并记录延迟
+    
+    rects为本次更新的传输帧矩形（None表示整帧），像素格式不是BGRA时只解码这些区域；
+    共享内存模式下bgr_frame已由copy_shared更新
+    """
+    global current_jpeg, current_jpeg_times
+    
+    decode_us = now_us()
+    latency.on_decoded(capture_us, receive_us, decode_us)
+    
+    bgr = bgr_frame
+    if shared is None and pixel_format != PF_BGRA:
+        output = get_format(pixel_format)
+        output.decode(frame_buffer, bgr, rects and [output.output_rect(rect) for rect in rects])
+    elif shared is None:
+        np.copyto(bgr, frame_buffer[:, :, :3])
+    if latency_marker:
+        latency.on_marker(bgr, decode_us)
+    
+    metrics.on_frame()
+    with metrics.stage('display', seq):
+        ret, buffer = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    if ret:
+        with jpeg_lock:
+            current_jpeg = buffer.tobytes()
+            current_jpeg_times = (capture_us, decode_us)
+
+def connect_shared(name=DEFAULT_SHARED_NAME):
+    """附加到服务器（server.py --shared-memory）的共享内存帧缓冲"""
+    global shared, frame_buffer, bgr_frame, width, height
+    
+    try:
+        print(f"[Web] 附加共享内存帧缓冲 {name}...", flush=True)
+        shared = FrameSubscriber(name)
+        width, height = shared.width, shared.height
+        frame_buffer = shared.frame
+        bgr_frame = np.zeros((height, width, 3), dtype=np.uint8)
+        print(f"[Web] 屏幕尺寸: {width}x{height}", flush=True)
+        return True
+    except Exception as e:
+        print(f"[Web] 附加失败: {e}", flush=True)
+        return False
+
+def copy_shared(generation):
+    """把共享帧缓冲中generation之后变化的矩形复制到bgr_frame，返回(复制到的代数, 矩形)
+    
+    矩形取自帧缓冲的变更日志；首次复制（generation < 0）或日志已被覆盖时复制整帧，矩形为None。
+    读取日志与复制在服务器两次写入之间完成，被写入打断则重试。
+    """
+    frame = shared.frame
+    while True:
+        sequence = shared.read_begin()
+        current, rects = shared.changes_since(generation) if generation >= 0 else (sequence >> 1, None)
+        if rects is None:
+            np.copyto(bgr_frame, frame[:, :, :3])
+        else:
+            for r in rects:
+                np.copyto(bgr_frame[r['top']:r['bottom'], r['left']:r['right']],
+                          frame[r['top']:r['bottom'], r['left']:r['right'], :3])
+        if not shared.read_retry(sequence):
+            return current, rects
+
+def shared_loop():
+    """共享内存模式的更新循环（后台线程）：代数变化时重新编码JPEG"""
+    global running
+    
+    print("[Web] 共享内存读取线程已启动", flush=True)
+    generation = -1
+    
+    try:
+        while running:
+            current = shared.wait(generation, timeout=1.0)
+            if shared.closed:
+                print("[Web] 服务器已关闭共享内存帧缓冲", flush=True)
+                break
+            if current == generation:
+                continue
+            generation, rects = copy_shared(generation)
+            metrics.on_packet('shared', 0)
+            update_jpeg(generation, shared.timestamp, now_us(), rects)
+    
+    except Exception as e:
+        print(f"[Web] 共享内存读取错误: {e}", flush=True)
+    finally:
+        running = False
+        print("[Web] 共享内存读取线程已退出", flush=True)
+
 def receive_loop():
     """接收数据循环（后台线程）"""
-    global tcp_socket, frame_buffer, current_jpeg, jpeg_lock, running
+    global tcp_socket, frame_buffer, tiles, last_seq, jpeg_lock, running
     
     print("[Web] 接收线程已启动", flush=True)
+    last_heartbeat = 0
     
     try:
         while running:
-            packet = Protocol.recv_packet(tcp_socket)
+            packet, receive_time = Protocol.recv_packet_timed(tcp_socket, receive_buffer)
             if not packet:
                 print("[Web] 连接已断开", flush=True)
                 break
+            receive_us = now_us()
+            
+            # 定期发送心跳，服务器回传后计算RTT和时钟偏差
+            if receive_us - last_heartbeat >= HEARTBEAT_INTERVAL * 1e6:
+                last_heartbeat = receive_us
+                Protocol.send_packet(tcp_socket, Protocol.pack_heartbeat(receive_us))
             
             pkt_type = Protocol.get_packet_type(packet)
+            metrics.on_packet(PACKET_NAMES.get(pkt_type, 'other'), len(packet) + 4)
+            if pkt_type == PKT_HEARTBEAT:
+                metrics.observe('receive', receive_time)
+                server_us, sent_us = Protocol.unpack_heartbeat(packet)
+                latency.on_echo(sent_us, server_us, receive_us)
+                continue
+            
+            if pkt_type == PKT_VIEW:
+                # 服务器切换了视图（自动像素格式），随后的完整帧为新的格式
+                current = Protocol.unpack_view(packet)
+                if (current.width, current.height, current.pixel_format) != (width, height, pixel_format):
+                    allocate(current.width, current.height, current.pixel_format)
+                print(f"[Web] 像素格式: {PIXEL_FORMAT_NAMES.get(current.pixel_format)}", flush=True)
+                continue
+            
+            pkt_type, seq, timestamp = Protocol.unpack_update_header(packet)
+            metrics.observe('receive', receive_time, seq)
             
             if pkt_type == PKT_SKIP:
                 # 跳帧，无需更新
                 continue
+            
+            elif pkt_type == PKT_CHECKSUM:
+                # 比对分块校验和，不一致的块请求重传
+                check_seq, _, cols, rows, sums = Protocol.unpack_checksum(packet)
+                if check_seq == last_seq and (cols, rows) == (tiles.cols, tiles.rows):
+                    diverged = tiles.diff(sums)
+                    if diverged:
+                        metrics.resync_tiles.inc(len(diverged))
+                        print(f"[Web] {len(diverged)} 个块校验不一致，请求重传", flush=True)
+                        Protocol.send_packet(tcp_socket, Protocol.pack_resync(check_seq, diverged))
+                continue
+            
+            elif pkt_type == PKT_REFRESH:
+                # 重传的原始像素块，直接覆盖
+                with metrics.stage('decompress', seq):
+                    rects, pixel_data = Protocol.unpack_refresh(packet, decode_buffer)
+                
+                with metrics.stage('apply', seq):
+                    regions.scatter(frame_buffer, rects, pixel_data)
+                    tiles.update(frame_buffer, rects)
+                last_seq = seq
+                Protocol.send_packet(tcp_socket, Protocol.pack_ack(seq, timestamp))
+                
+                # 编码为JPEG
+                update_jpeg(seq, timestamp, receive_us, rects)
+                
+            elif pkt_type == PKT_LOSSY:
+                # 高运动区域的有损图像，解码后直接覆盖（静止后服务器发送无损修正）
+                _, rects, images = Protocol.unpack_lossy(packet)
+                with metrics.stage('apply', seq):
+                    for r, image in zip(rects, images):
+                        decode_into(image, frame_buffer[r['top']:r['bottom'], r['left']:r['right']])
+                    tiles.update(frame_buffer, rects)
+                last_seq = seq
+                Protocol.send_packet(tcp_socket, Protocol.pack_ack(seq, timestamp))
+                
+                # 编码为JPEG
+                update_jpeg(seq, timestamp, receive_us, rects)
                 
             elif pkt_type == PKT_DIRTY:
                 # 脏矩形XOR数据
-                rects, xor_data = Protocol.unpack_dirty(packet)
+                with metrics.stage('decompress', seq):
+                    rects, xor_data = Protocol.unpack_dirty(packet, decode_buffer)
                 
-                xor_array = np.frombuffer(xor_data, dtype=np.uint8)
-                offset = 0
+                with metrics.stage('apply', seq):
+                    # XOR恢复：xor XOR old = new
+                    regions.xor_apply(frame_buffer, rects, xor_data)
+                    tiles.update(frame_buffer, rects)
                 
-                for rect in rects:
-                    left, top = rect['left'], rect['top']
-                    width_r, height_r = rect['width'], rect['height']
-                    region_size = width_r * height_r * 4
-                    
-                    if offset + region_size <= len(xor_array):
-                        xor_region_data = xor_array[offset:offset+region_size]
-                        xor_region = xor_region_data.reshape(height_r, width_r, 4)
-                        
-                        # XOR恢复：xor XOR old = new
-                        frame_buffer[top:top+height_r, left:left+width_r] = np.bitwise_xor(
-                            frame_buffer[top:top+height_r, left:left+width_r],
-                            xor_region
-                        )
-                        offset += region_size
+                # 确认已应用，服务器据此推进发送窗口
+                last_seq = seq
+                Protocol.send_packet(tcp_socket, Protocol.pack_ack(seq, timestamp))
                 
                 # 编码为JPEG
-                bgr = frame_buffer[:, :, :3]
-                ret, buffer = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                if ret:
-                    with jpeg_lock:
-                        current_jpeg = buffer.tobytes()
+                update_jpeg(seq, timestamp, receive_us, rects)
             
             elif pkt_type == PKT_FRAME:
                 # 完整帧
-                frame_data = Protocol.unpack_frame(packet)
-                frame = np.frombuffer(frame_data, dtype=np.uint8)
-                frame = frame.reshape(height, width, 4)
-                frame_buffer[:] = frame
+                with metrics.stage('decompress', seq):
+                    frame_data = Protocol.unpack_frame(packet, decode_buffer)
+                
+                with metrics.stage('apply', seq):
+                    frame = np.frombuffer(frame_data, dtype=np.uint8)
+                    frame = frame.reshape(frame_buffer.shape)
+                    frame_buffer[:] = frame
+                    tiles.reset(frame_buffer)
+                last_seq = seq
+                Protocol.send_packet(tcp_socket, Protocol.pack_ack(seq, timestamp))
                 
                 # 编码为JPEG
-                bgr = frame[:, :, :3]
-                ret, buffer = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                if ret:
-                    with jpeg_lock:
-                        current_jpeg = buffer.tobytes()
+                update_jpeg(seq, timestamp, receive_us)
     
     except Exception as e:
         print(f"[Web] 接收错误: {e}", flush=True)
@@ -223,15 +415,19 @@ def generate_frames():
     
     while running:
         with jpeg_lock:
-            if current_jpeg is not None and current_jpeg != last_jpeg:
+            if current_jpeg is not None and current_jpeg is not last_jpeg:
                 jpeg_data = current_jpeg
                 last_jpeg = current_jpeg
+                capture_us, decode_us = current_jpeg_times
             else:
                 jpeg_data = None
         
         if jpeg_data:
             yield (b'--frame\r\n'
                    b'Content-Type: image/jpeg\r\n\r\n' + jpeg_data + b'\r\n')
+            # 以交给浏览器的时刻作为显示时间
+            if capture_us:
+                latency.on_displayed(capture_us, decode_us, now_us())
         
         time.sleep(0.05)  # 20fps
 
@@ -249,6 +445,21 @@ def index():
         screen_size=screen_size
     )
 
+@app.route('/latency')
+def latency_report():
+    """延迟统计（纯文本）"""
+    return Response(latency.report() + "\n", mimetype='text/plain; charset=utf-8')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus指标"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/trace')
+def trace():
+    """逐帧追踪（Chrome trace JSON），需以 --trace 启动"""
+    return Response(TRACER.to_json(), mimetype='application/json')
+
 @app.route('/video_feed')
 def video_feed():
     """MJPEG视频流"""
@@ -259,9 +470,24 @@ def video_feed():
 
 def start_server():
     """启动服务器主函数"""
-    global running
+    global running, latency_marker, view
     import sys
     
+    # 命令行参数: python web_server.py [--latency-marker] [--trace=FILE] [--shared-memory[=NAME]]
+    #            [--pixel-format=bgra|rgb565|yuv420|gray8|auto] [--stream=N]
+    latency_marker = '--latency-marker' in sys.argv
+    format_name = next((a.split('=', 1)[1] for a in sys.argv[1:] if a.startswith('--pixel-format=')), None)
+    if format_name:
+        codes = {name: code for code, name in PIXEL_FORMAT_NAMES.items()}
+        view = View(pixel_format=codes[format_name])
+    shared_name = next((a.split('=', 1)[1] if '=' in a else DEFAULT_SHARED_NAME
+                        for a in sys.argv[1:] if a.split('=', 1)[0] == '--shared-memory'), None)
+    trace_path = next((a.split('=', 1)[1] for a in sys.argv[1:] if a.startswith('--trace=')), None)
+    # 多路复用服务器（server.py --stream ...）时选择要显示的流
+    stream = next((int(a.split('=', 1)[1]) for a in sys.argv[1:] if a.startswith('--stream=')), None)
+    if trace_path:
+        TRACER.enable(process_name="web_server")
+    
     print("\n" + "="*60, flush=True)
     print("远程桌面Web服务器 (XOR优化版)", flush=True)
     print("="*60, flush=True)
@@ -270,7 +496,13 @@ def start_server():
     server_host = '127.0.0.1'  # 如果server.py在同一台机器
     server_port = 9999
     
-    if not connect_to_server(server_host, server_port):
+    if shared_name:
+        if not connect_shared(shared_name):
+            print("\n❌ 无法附加共享内存帧缓冲", flush=True)
+            print(f"   请确保 server.py --shared-memory {shared_name} 正在本机运行", flush=True)
+            print("="*60 + "\n", flush=True)
+            sys.exit(1)
+    elif not connect_to_server(server_host, server_port, stream):
         print("\n❌ 无法连接到RemoteDesktop服务器", flush=True)
         print(f"   请确保 server.py 正在运行于 {server_host}:{server_port}", flush=True)
         print("="*60 + "\n", flush=True)
@@ -278,8 +510,8 @@ def start_server():
     
     running = True
     
-    # 启动接收线程
-    recv_thread = threading.Thread(target=receive_loop, daemon=True)
+    # 启动接收线程（共享内存模式下为读取线程）
+    recv_thread = threading.Thread(target=shared_loop if shared else receive_loop, name="receive", daemon=True)
     recv_thread.start()
     
     host_ip = get_local_ip()
@@ -309,6 +541,12 @@ def start_server():
         running = False
         if tcp_socket:
             tcp_socket.close()
+        if mux:
+            mux.close()
+        if shared:
+            shared.close()
+        if trace_path:
+            print(f"[Web] 已写入追踪文件 {trace_path} ({TRACER.export(trace_path)} 个事件)", flush=True)
 
 if __name__ == '__main__':
     start_server()